@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Measure how fast the SQLite leasequery store finds the delegated prefix that contains an address.
+
+The benchmark fills a leasequery database with one delegated prefix per client and then queries random addresses
+inside those prefixes, once with a range condition on the prefixes table, which is how the store used to search, and
+once with the exact lookups per prefix length that the store does now. Building a database with a million prefixes
+takes a while, it is kept so that the next run can reuse it.
+"""
+import argparse
+import os
+import random
+import time
+from ipaddress import IPv6Address
+
+from dhcpkit.ipv6.server.extensions.leasequery.sqlite import LeasequerySqliteStore
+
+
+def fill_database(store: LeasequerySqliteStore, count: int, prefix_length: int):
+    """
+    Add a client with a delegated prefix for every number up to count
+
+    :param store: The store to fill
+    :param count: The number of clients and prefixes
+    :param prefix_length: The length of the delegated prefixes
+    """
+    base = int(IPv6Address('2001:db8::'))
+    host_bits = 128 - prefix_length
+    valid_lifetime_end = int(time.time()) + 86400
+
+    link_address = IPv6Address('2001:db8:ffff::1').exploded
+
+    with store.db:
+        store.db.executemany("INSERT INTO clients (id, client_id, link_address) VALUES (?, ?, ?)",
+                             ((number + 1, '00030001{:012x}'.format(number), link_address)
+                              for number in range(count)))
+        store.db.executemany("INSERT INTO prefixes (client_fk, first_address, last_address, "
+                             "preferred_lifetime_end, valid_lifetime_end) VALUES (?, ?, ?, ?, ?)",
+                             ((number + 1,
+                               IPv6Address(base + (number << host_bits)).exploded,
+                               IPv6Address(base + (number << host_bits) + (1 << host_bits) - 1).exploded,
+                               valid_lifetime_end, valid_lifetime_end)
+                              for number in range(count)))
+        store.remember_prefix_length(store.db, IPv6Address(base).exploded,
+                                     IPv6Address(base + (1 << host_bits) - 1).exploded)
+
+
+def find_with_range(store: LeasequerySqliteStore, address: IPv6Address):
+    """
+    Find the clients with a prefix that contains the address with a range condition
+
+    :param store: The store to search
+    :param address: The address to look for
+    :return: The row ids of the clients
+    """
+    cur = store.db.execute("SELECT client_fk FROM prefixes WHERE ? BETWEEN first_address AND last_address",
+                           (address.exploded,))
+    return [row['client_fk'] for row in cur]
+
+
+def find_with_prefix_lengths(store: LeasequerySqliteStore, address: IPv6Address):
+    """
+    Find the clients with a prefix that contains the address with an exact lookup per prefix length
+
+    :param store: The store to search
+    :param address: The address to look for
+    :return: The row ids of the clients
+    """
+    prefix_ranges = store.get_containing_prefix_ranges(address)
+    cur = store.db.execute("SELECT client_fk FROM prefixes WHERE " +
+                           ' OR '.join(['(first_address=? AND last_address=?)'] * len(prefix_ranges)),
+                           [boundary for prefix_range in prefix_ranges for boundary in prefix_range])
+    return [row['client_fk'] for row in cur]
+
+
+def main():
+    """
+    Run the benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', '--prefixes', type=int, default=1000000, help="the number of delegated prefixes")
+    parser.add_argument('-l', '--prefix-length', type=int, default=56, help="the length of the delegated prefixes")
+    parser.add_argument('-q', '--queries', type=int, default=1000, help="the number of queries per method")
+    parser.add_argument('-d', '--database', default='leasequery-prefixes.sqlite', help="the database file to use")
+    args = parser.parse_args()
+
+    filled = os.path.exists(args.database)
+    store = LeasequerySqliteStore(args.database)
+    store.worker_init([])
+
+    if not filled:
+        print("Adding {} delegated prefixes to {}".format(args.prefixes, args.database))
+        start = time.perf_counter()
+        fill_database(store, args.prefixes, args.prefix_length)
+        print("Done in {:.1f} s".format(time.perf_counter() - start))
+
+    nr_prefixes = store.db.execute("SELECT COUNT(*) FROM prefixes").fetchone()[0]
+    base = int(IPv6Address('2001:db8::'))
+    host_bits = 128 - args.prefix_length
+
+    # Pick addresses spread over all prefixes, somewhere inside the prefix
+    addresses = [IPv6Address(base + (random.randrange(nr_prefixes) << host_bits) + random.randrange(1 << host_bits))
+                 for _ in range(args.queries)]
+
+    for name, find in (('range', find_with_range), ('prefix lengths', find_with_prefix_lengths)):
+        start = time.perf_counter()
+        for address in addresses:
+            if len(find(store, address)) != 1:
+                raise RuntimeError("Prefix for {} not found".format(address))
+        elapsed = time.perf_counter() - start
+
+        print("{:>15}: {:9.0f} queries/s, {:9.2f} µs/query".format(name, args.queries / elapsed,
+                                                                  elapsed / args.queries * 1e6))
+
+
+if __name__ == '__main__':
+    main()
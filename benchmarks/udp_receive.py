@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Measure how fast the main process can receive packets from a UDP listener over the loopback interface.
+
+The benchmark fills the receive buffer of a listener on ::1 with solicit messages and measures how long it takes to
+receive all of them, either with one select() and recv_request() per packet, which is how the server used to work, or
+with recv_requests(), which drains the socket after each wakeup. Listening on the DHCPv6 server port needs root
+privileges or CAP_NET_BIND_SERVICE.
+"""
+import argparse
+import selectors
+import socket
+import time
+
+from dhcpkit.ipv6 import SERVER_PORT
+from dhcpkit.ipv6.duids import LinkLayerDUID
+from dhcpkit.ipv6.messages import SolicitMessage
+from dhcpkit.ipv6.options import ClientIdOption, ElapsedTimeOption, IANAOption
+from dhcpkit.ipv6.server.listeners.udp import UDPListener
+
+
+def receive_one_per_wakeup(listener: UDPListener, count: int):
+    """
+    Receive a packet for every time select() says the socket is readable
+
+    :param listener: The listener to receive from
+    :param count: The number of packets to receive
+    """
+    with selectors.DefaultSelector() as sel:
+        sel.register(listener, selectors.EVENT_READ)
+        received = 0
+        while received < count:
+            for key, mask in sel.select():
+                key.fileobj.recv_request()
+                received += 1
+
+
+def receive_drain(listener: UDPListener, count: int):
+    """
+    Receive all the waiting packets every time select() says the socket is readable
+
+    :param listener: The listener to receive from
+    :param count: The number of packets to receive
+    """
+    with selectors.DefaultSelector() as sel:
+        sel.register(listener, selectors.EVENT_READ)
+        received = 0
+        while received < count:
+            for key, mask in sel.select():
+                received += len(key.fileobj.recv_requests())
+
+
+def main():
+    """
+    Run the benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-b', '--burst', type=int, default=1000, help="the number of packets to send at once")
+    parser.add_argument('-r', '--rounds', type=int, default=50, help="the number of bursts to send")
+    args = parser.parse_args()
+
+    message = SolicitMessage(transaction_id=b'\x01\x02\x03', options=[
+        ClientIdOption(duid=LinkLayerDUID(hardware_type=1, link_layer_address=bytes.fromhex('3431c43cb2f1'))),
+        ElapsedTimeOption(elapsed_time=0),
+        IANAOption(iaid=bytes.fromhex('c43cb2f1')),
+    ]).save()
+
+    listen_socket = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 1024 * 1024)
+    listen_socket.bind(('::1', SERVER_PORT))
+    listener = UDPListener('lo', listen_socket)
+
+    send_socket = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    destination = ('::1', SERVER_PORT)
+
+    for name, receive in (('one per wakeup', receive_one_per_wakeup), ('drain', receive_drain)):
+        elapsed = 0.0
+        for _ in range(args.rounds):
+            # Loopback delivers synchronously, so after this all packets are waiting in the receive buffer
+            for _ in range(args.burst):
+                send_socket.sendto(message, destination)
+
+            start = time.perf_counter()
+            receive(listener, args.burst)
+            elapsed += time.perf_counter() - start
+
+        total = args.burst * args.rounds
+        print("{:>15}: {:9.0f} packets/s, {:6.2f} µs/packet".format(name, total / elapsed, elapsed / total * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -23,7 +23,7 @@ def drop_privileges(user: pwd.struct_passwd, group: grp.struct_group, permanent:
 
     # Don't do anything if we are already the right user
     if os.geteuid() == user.pw_uid and os.getegid() == group.gr_gid:
-        logger.debug("Already {}/{}, not changing privileges".format(user.pw_name, group.gr_name))
+        logger.debug("Already %s/%s, not changing privileges", user.pw_name, group.gr_name)
         return
 
     # Restore euid=0 if we have previously changed it
@@ -36,11 +36,11 @@ def drop_privileges(user: pwd.struct_passwd, group: grp.struct_group, permanent:
     if permanent:  # pragma: no cover, we cannot test this
         os.setgid(group.gr_gid)
         os.setuid(user.pw_uid)
-        logger.debug("Permanently dropped privileges to {}/{}".format(user.pw_name, group.gr_name))
+        logger.debug("Permanently dropped privileges to %s/%s", user.pw_name, group.gr_name)
     else:
         os.setegid(group.gr_gid)
         os.seteuid(user.pw_uid)
-        logger.debug("Dropped privileges to {}/{}".format(user.pw_name, group.gr_name))
+        logger.debug("Dropped privileges to %s/%s", user.pw_name, group.gr_name)
 
 
 def restore_privileges():
@@ -49,7 +49,7 @@ def restore_privileges():
     """
     if os.getuid() != 0:
         user = pwd.getpwuid(os.getuid())
-        logger.warning("Root privileges have been permanently dropped, continuing as {}".format(user.pw_name))
+        logger.warning("Root privileges have been permanently dropped, continuing as %s", user.pw_name)
         return
 
     if os.geteuid() == 0 and os.getegid() == 0:
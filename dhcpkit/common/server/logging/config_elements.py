@@ -19,8 +19,14 @@ class Logging(ConfigSection):
 
     def validate_config_section(self):
         """
-        Check for duplicate handlers
+        Check for duplicate handlers, a sensible rate limit and batch interval
         """
+        if self.rate_limit < 0:
+            raise ValueError("The rate limit cannot be negative")
+
+        if self.batch_interval <= 0:
+            raise ValueError("The batch interval must be positive")
+
         # Check that we don't have multiple console loggers
         have_console = False
         for handler_factory in self.handlers:
@@ -0,0 +1,535 @@
+"""
+A load generator that simulates many DHCPv6 clients, optionally behind relays, to benchmark a DHCPv6 server
+"""
+import argparse
+import asyncio
+import logging
+import math
+import random
+import socket
+import sys
+import time
+from argparse import ArgumentDefaultsHelpFormatter
+from collections import OrderedDict
+from ipaddress import IPv6Address
+
+from dhcpkit.common.logging.verbosity import set_verbosity_logger
+from dhcpkit.ipv6 import CLIENT_PORT, SERVER_PORT
+from dhcpkit.ipv6.duids import LinkLayerDUID
+from dhcpkit.ipv6.extensions.prefix_delegation import IAPDOption
+from dhcpkit.ipv6.extensions.remote_id import RemoteIdOption
+from dhcpkit.ipv6.messages import AdvertiseMessage, ClientServerMessage, Message, RelayForwardMessage, \
+    RelayReplyMessage, RenewMessage, ReplyMessage, RequestMessage, SolicitMessage
+from dhcpkit.ipv6.options import ClientIdOption, ElapsedTimeOption, IANAOption, InterfaceIdOption, \
+    RelayMessageOption, STATUS_SUCCESS, ServerIdOption, StatusCodeOption
+from typing import Iterable, List, Optional, Tuple
+
+logger = logging.getLogger()
+
+# The enterprise number used in the Remote-ID option
+DEFAULT_ENTERPRISE_NUMBER = 40208
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """
+    Determine a percentile with the nearest-rank method
+
+    :param sorted_values: The values, sorted from low to high
+    :param fraction: The percentile as a fraction between 0 and 1
+    :return: The value at that percentile, or 0 if there are no values
+    """
+    if not sorted_values:
+        return 0.0
+
+    rank = min(max(math.ceil(fraction * len(sorted_values)), 1), len(sorted_values))
+    return sorted_values[rank - 1]
+
+
+class ExchangeStatistics:
+    """
+    Counters and latencies of one kind of exchange, like Solicit/Advertise
+
+    :type sent: int
+    :type retransmitted: int
+    :type replies: int
+    :type lost: int
+    :type failed: int
+    :type latencies: List[float]
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.retransmitted = 0
+        self.replies = 0
+        self.lost = 0
+        self.failed = 0
+        self.latencies = []
+
+    def report(self, name: str) -> str:
+        """
+        Format the statistics as a line of the report table
+
+        :param name: The name of the exchange
+        :return: The report line
+        """
+        latencies = sorted(self.latencies)
+        return '{:<8} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            name, self.sent, self.retransmitted, self.replies, self.lost, self.failed,
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000,
+            percentile(latencies, 0.99) * 1000, latencies[-1] * 1000 if latencies else 0.0)
+
+
+class SimulatedClient:
+    """
+    The identity of a simulated client, and the relay it is behind
+
+    :type number: int
+    :type relay: int
+    :type duid: LinkLayerDUID
+    :type iaid: bytes
+    :type link_local_address: IPv6Address
+    :type relay_options: List[Option]
+    """
+
+    def __init__(self, number: int, relay: int, relay_options: Iterable = None):
+        """
+        Create a client with a MAC address based on its number
+
+        :param number: The number of this client
+        :param relay: The number of the relay this client is behind
+        :param relay_options: The options that the relay adds when forwarding messages of this client
+        """
+        self.number = number
+        self.relay = relay
+
+        mac_address = b'\x02' + number.to_bytes(5, 'big')
+        self.duid = LinkLayerDUID(hardware_type=1, link_layer_address=mac_address)
+        self.iaid = mac_address[-4:]
+
+        # Modified EUI-64 link-local address
+        eui64 = bytes([mac_address[0] ^ 0x02]) + mac_address[1:3] + b'\xff\xfe' + mac_address[3:]
+        self.link_local_address = IPv6Address(b'\xfe\x80' + b'\x00' * 6 + eui64)
+
+        self.relay_options = list(relay_options or [])
+
+
+class LoadGenerator(asyncio.DatagramProtocol):
+    """
+    Simulate clients that go through Solicit, Advertise, Request, Reply and a number of Renew cycles, and keep
+    statistics about the exchanges. All clients share one UDP socket, replies are matched to the waiting client by
+    transaction-id.
+
+    :type options: argparse.Namespace
+    :type transport: Optional[asyncio.DatagramTransport]
+    :type pending: Dict[bytes, asyncio.Future]
+    :type statistics: Dict[str, ExchangeStatistics]
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.destination = (str(options.server), options.port)
+        self.transport = None
+
+        self.pending = {}
+        self.next_transaction_id = random.getrandbits(24)
+
+        self.statistics = OrderedDict((name, ExchangeStatistics()) for name in ('Solicit', 'Request', 'Renew'))
+        self.unexpected = 0
+        self.completed = 0
+        self.incomplete = 0
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        """
+        Remember the transport to send messages with
+
+        :param transport: The transport of the UDP socket
+        """
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, address: Tuple):
+        """
+        Match a reply to the client that is waiting for it
+
+        :param data: The received packet
+        :param address: The address it came from
+        """
+        received = time.monotonic()
+        try:
+            length, message = Message.parse(data)
+            if isinstance(message, RelayReplyMessage):
+                message = message.inner_message
+        except ValueError as e:
+            logger.debug("Ignoring unparsable message from %s: %s", address[0], e)
+            self.unexpected += 1
+            return
+
+        future = isinstance(message, ClientServerMessage) and self.pending.get(message.transaction_id)
+        if not future or future.done():
+            logger.debug("Ignoring unexpected %s from %s", type(message).__name__, address[0])
+            self.unexpected += 1
+            return
+
+        future.set_result((received, message))
+
+    def error_received(self, exc: Exception):
+        """
+        Errors like ICMP unreachable are reported here, the exchange will time out
+
+        :param exc: The error
+        """
+        logger.debug("Error on the client socket: %s", exc)
+
+    def get_transaction_id(self) -> bytes:
+        """
+        Get a transaction-id that is not in use
+
+        :return: The transaction-id
+        """
+        while True:
+            self.next_transaction_id = (self.next_transaction_id + 1) & 0xFFFFFF
+            transaction_id = self.next_transaction_id.to_bytes(3, 'big')
+            if transaction_id not in self.pending:
+                return transaction_id
+
+    def wrap_message(self, client: SimulatedClient, message: ClientServerMessage) -> Message:
+        """
+        Wrap the message of a client the way its relay would
+
+        :param client: The client sending the message
+        :param message: The message to send
+        :return: The message to put on the wire
+        """
+        if not self.options.relays:
+            return message
+
+        link_address = IPv6Address(int(self.options.link_address) + (client.relay << 64))
+        return RelayForwardMessage(hop_count=0, link_address=link_address, peer_address=client.link_local_address,
+                                   options=client.relay_options + [RelayMessageOption(relayed_message=message)])
+
+    async def exchange(self, name: str, client: SimulatedClient, message: ClientServerMessage,
+                       reply_type: type) -> Optional[ClientServerMessage]:
+        """
+        Send a message and wait for the reply, retransmitting when it doesn't come in time
+
+        :param name: The name of the exchange for the statistics
+        :param client: The client sending the message
+        :param message: The message to send
+        :param reply_type: The type of message we expect back
+        :return: The reply, or None if it was lost or wrong
+        """
+        statistics = self.statistics[name]
+        message.transaction_id = self.get_transaction_id()
+        future = asyncio.get_event_loop().create_future()
+        self.pending[message.transaction_id] = future
+
+        try:
+            start = time.monotonic()
+            for attempt in range(self.options.retries + 1):
+                if attempt:
+                    statistics.retransmitted += 1
+                    message.get_option_of_type(ElapsedTimeOption).elapsed_time = \
+                        min(int((time.monotonic() - start) * 100), 0xFFFF)
+                else:
+                    statistics.sent += 1
+
+                sent = time.monotonic()
+                self.transport.sendto(self.wrap_message(client, message).save(), self.destination)
+
+                done, not_done = await asyncio.wait([future], timeout=self.options.timeout)
+                if done:
+                    break
+            else:
+                statistics.lost += 1
+                return None
+        finally:
+            del self.pending[message.transaction_id]
+
+        received, reply = future.result()
+        statistics.replies += 1
+        statistics.latencies.append(received - sent)
+
+        if not isinstance(reply, reply_type) or not self.is_successful(reply):
+            logger.debug("Client %d received a failed %s", client.number, type(reply).__name__)
+            statistics.failed += 1
+            return None
+
+        return reply
+
+    @staticmethod
+    def is_successful(reply: ClientServerMessage) -> bool:
+        """
+        Check the status codes in the reply, and if it contains any assignments
+
+        :param reply: The reply from the server
+        :return: Whether the server gave the client what it asked for
+        """
+        status_codes = reply.get_options_of_type(StatusCodeOption)
+        ia_options = reply.get_options_of_type(IANAOption, IAPDOption)
+        for ia_option in ia_options:
+            status_codes += ia_option.get_options_of_type(StatusCodeOption)
+
+        return bool(ia_options) and all(status_code.status_code == STATUS_SUCCESS for status_code in status_codes)
+
+    def create_ia_options(self, client: SimulatedClient) -> list:
+        """
+        Create the empty IA options that a client asks for
+
+        :param client: The client
+        :return: The IA options
+        """
+        options = []
+        if self.options.ia in ('na', 'both'):
+            options.append(IANAOption(iaid=client.iaid))
+        if self.options.ia in ('pd', 'both'):
+            options.append(IAPDOption(iaid=client.iaid))
+        return options
+
+    async def run_client(self, client: SimulatedClient) -> bool:
+        """
+        Go through the life cycle of a client
+
+        :param client: The client to simulate
+        :return: Whether all exchanges were successful
+        """
+        advertise = await self.exchange('Solicit', client, SolicitMessage(options=[
+            ClientIdOption(duid=client.duid),
+            ElapsedTimeOption(elapsed_time=0),
+        ] + self.create_ia_options(client)), AdvertiseMessage)
+        if not advertise:
+            return False
+
+        server_id = advertise.get_option_of_type(ServerIdOption)
+        reply = await self.exchange('Request', client, RequestMessage(options=[
+            ClientIdOption(duid=client.duid),
+            server_id,
+            ElapsedTimeOption(elapsed_time=0),
+        ] + advertise.get_options_of_type(IANAOption, IAPDOption)), ReplyMessage)
+        if not reply:
+            return False
+
+        for cycle in range(self.options.renew):
+            reply = await self.exchange('Renew', client, RenewMessage(options=[
+                ClientIdOption(duid=client.duid),
+                server_id,
+                ElapsedTimeOption(elapsed_time=0),
+            ] + reply.get_options_of_type(IANAOption, IAPDOption)), ReplyMessage)
+            if not reply:
+                return False
+
+        return True
+
+    async def run_limited(self, client: SimulatedClient, semaphore: asyncio.Semaphore):
+        """
+        Simulate a client while holding a place in the concurrency limit
+
+        :param client: The client to simulate
+        :param semaphore: The semaphore that limits how many clients are active at once
+        """
+        try:
+            if await self.run_client(client):
+                self.completed += 1
+            else:
+                self.incomplete += 1
+        finally:
+            semaphore.release()
+
+    def create_client(self, number: int) -> SimulatedClient:
+        """
+        Create a simulated client and the options its relay adds
+
+        :param number: The number of the client
+        :return: The client
+        """
+        relay = number % self.options.relays if self.options.relays else 0
+        relay_options = []
+        if self.options.interface_id:
+            interface_id = self.options.interface_id.format(client=number, relay=relay)
+            relay_options.append(InterfaceIdOption(interface_id=interface_id.encode('utf-8')))
+        if self.options.remote_id:
+            remote_id = self.options.remote_id.format(client=number, relay=relay)
+            relay_options.append(RemoteIdOption(enterprise_number=self.options.enterprise_number,
+                                                remote_id=remote_id.encode('utf-8')))
+
+        return SimulatedClient(number, relay, relay_options)
+
+    async def run(self):
+        """
+        Start the clients at the configured rate and wait until they are all done
+        """
+        semaphore = asyncio.Semaphore(self.options.concurrency)
+        tasks = []
+
+        start = time.monotonic()
+        for number in range(self.options.clients):
+            if self.options.rate:
+                delay = start + number / self.options.rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            await semaphore.acquire()
+            tasks.append(asyncio.ensure_future(self.run_limited(self.create_client(number), semaphore)))
+
+        if tasks:
+            await asyncio.wait(tasks)
+
+        # Raise any unexpected errors from the clients
+        for task in tasks:
+            task.result()
+
+        return time.monotonic() - start
+
+    def report(self, elapsed: float) -> str:
+        """
+        Create a report of the results
+
+        :param elapsed: How long the test took in seconds
+        :return: The report
+        """
+        exchanges = sum(statistics.replies for statistics in self.statistics.values())
+        sent = sum(statistics.sent + statistics.retransmitted for statistics in self.statistics.values())
+        lost = sum(statistics.lost for statistics in self.statistics.values())
+        elapsed = max(elapsed, 1e-9)
+
+        lines = [
+            'Clients:   {} completed, {} incomplete in {:.3f} seconds ({:.0f} clients/s)'.format(
+                self.completed, self.incomplete, elapsed, self.completed / elapsed),
+            'Exchanges: {} replies ({:.0f}/s), {} packets sent, {} exchanges lost ({:.2f}% packet loss), '
+            '{} unexpected replies'.format(exchanges, exchanges / elapsed, sent, lost,
+                                           (sent - exchanges) / sent * 100 if sent else 0.0, self.unexpected),
+            '',
+            '{:<8} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+                'Exchange', 'Sent', 'Retrans', 'Replies', 'Lost', 'Failed', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'),
+        ]
+        lines += [statistics.report(name) for name, statistics in self.statistics.items()]
+        return '\n'.join(lines)
+
+
+def handle_args(args: Iterable[str]):
+    """
+    Handle the command line arguments.
+
+    :param args: Command line arguments
+    :return: The arguments object
+    """
+    parser = argparse.ArgumentParser(
+        description="A load generator that simulates many DHCPv6 clients to benchmark a DHCPv6 server",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument("-v", "--verbosity", action="count", default=2,
+                        help="increase output verbosity")
+    parser.add_argument("-s", "--server", action="store", metavar="ADDR", type=IPv6Address, default='::1',
+                        help="server address to send messages to")
+    parser.add_argument("-p", "--port", action="store", type=int, default=SERVER_PORT,
+                        help="server port to send messages to")
+    parser.add_argument("-b", "--bind", action="store", metavar="ADDR", type=IPv6Address, default='::',
+                        help="address to send messages from, replies to relays are sent to this address")
+    parser.add_argument("-B", "--bind-port", action="store", type=int,
+                        help="port to send messages from, the default is the relay port when simulating relays and "
+                             "the client port otherwise")
+    parser.add_argument("-n", "--clients", action="store", type=int, default=1000,
+                        help="the number of clients to simulate")
+    parser.add_argument("-c", "--concurrency", action="store", type=int, default=100,
+                        help="the number of clients that are active at the same time")
+    parser.add_argument("-r", "--rate", action="store", type=float, default=0,
+                        help="the number of clients to start per second, 0 starts them as fast as the concurrency "
+                             "allows")
+    parser.add_argument("-R", "--renew", action="store", type=int, default=1,
+                        help="the number of renew cycles after each client got its lease")
+    parser.add_argument("-t", "--timeout", action="store", type=float, default=1.0,
+                        help="seconds to wait for a reply before retransmitting")
+    parser.add_argument("-x", "--retries", action="store", type=int, default=2,
+                        help="the number of retransmissions before the exchange is counted as lost")
+    parser.add_argument("--ia", action="store", choices=('na', 'pd', 'both'), default='na',
+                        help="ask for addresses, prefixes or both")
+
+    relay_group = parser.add_argument_group("relays")
+    relay_group.add_argument("--relays", action="store", type=int, default=1,
+                             help="the number of relays to put clients behind, 0 sends messages directly, which "
+                                  "requires the server to allow unicast")
+    relay_group.add_argument("-L", "--link-address", action="store", type=IPv6Address, default='2001:db8::1',
+                             help="the link address of the first relay, every next relay uses the next /64")
+    relay_group.add_argument("-I", "--interface-id", action="store", metavar="TEMPLATE",
+                             help="add an Interface-ID option, {client} and {relay} are replaced by their numbers")
+    relay_group.add_argument("-E", "--remote-id", action="store", metavar="TEMPLATE",
+                             help="add a Remote-ID option, {client} and {relay} are replaced by their numbers")
+    relay_group.add_argument("--enterprise-number", action="store", type=int, default=DEFAULT_ENTERPRISE_NUMBER,
+                             help="the enterprise number of the Remote-ID option")
+
+    options = parser.parse_args(args)
+
+    if options.clients < 0 or options.concurrency < 1 or options.rate < 0 or options.renew < 0 \
+            or options.timeout <= 0 or options.retries < 0 or options.relays < 0:
+        parser.error("numeric options can't be negative, and concurrency and timeout must be positive")
+
+    if options.bind_port is None:
+        options.bind_port = SERVER_PORT if options.relays else CLIENT_PORT
+
+    return options
+
+
+def create_socket(options) -> socket.socket:
+    """
+    Create the UDP socket that all simulated clients share
+
+    :param options: Options from the main argument parser
+    :return: The bound socket
+    """
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+
+    # The server may be listening on a specific address on the same port
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind((str(options.bind), options.bind_port))
+    sock.setblocking(False)
+    return sock
+
+
+def main(args: Iterable[str]) -> int:
+    """
+    The main program
+
+    :param args: Command line arguments
+    :return: The program exit code
+    """
+    # Handle command line arguments
+    options = handle_args(args)
+    set_verbosity_logger(logger, options.verbosity)
+
+    sock = create_socket(options)
+    logger.info("Simulating %d clients from [%s]:%d to [%s]:%d", options.clients, options.bind,
+                sock.getsockname()[1], options.server, options.port)
+
+    loop = asyncio.new_event_loop()
+    try:
+        generator = LoadGenerator(options)
+        transport, protocol = loop.run_until_complete(loop.create_datagram_endpoint(lambda: generator, sock=sock))
+        try:
+            elapsed = loop.run_until_complete(generator.run())
+        finally:
+            transport.close()
+    finally:
+        loop.close()
+
+    print(generator.report(elapsed))
+
+    return 0 if not generator.incomplete else 2
+
+
+def run() -> int:
+    """
+    Run the main program and handle exceptions
+
+    :return: The program exit code
+    """
+    try:
+        return main(sys.argv[1:])
+    except KeyboardInterrupt:
+        return 1
+    except Exception as e:
+        logger.critical("Error: {}".format(e))
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(run())
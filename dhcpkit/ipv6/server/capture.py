@@ -0,0 +1,420 @@
+"""
+Record received and sent packets in pcapng format. This is much cheaper than logging every packet as text, so tracing
+can stay enabled in production. Workers put the raw packets on a bounded queue and a separate thread in the main
+process writes them to a rotating capture file.
+
+The server only sees the UDP payload, so the IPv6 and UDP headers in the capture are reconstructed from what the server
+knows about the packet.
+"""
+import logging
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from ipaddress import IPv6Network
+from multiprocessing.queues import Full
+
+from dhcpkit.ipv6 import All_DHCP_Relay_Agents_and_Servers, CLIENT_PORT, SERVER_PORT
+from dhcpkit.ipv6.messages import MSG_RELAY_FORW, RelayReplyMessage
+from dhcpkit.ipv6.options import ClientIdOption
+from dhcpkit.ipv6.server.listeners import IncomingPacketBundle
+from dhcpkit.ipv6.server.statistics import ServerStatistics
+from dhcpkit.ipv6.server.transaction_bundle import TransactionBundle
+from typing import Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+LINKTYPE_IPV6 = 229
+
+BLOCK_SECTION_HEADER = 0x0A0D0D0A
+BLOCK_INTERFACE_DESCRIPTION = 0x00000001
+BLOCK_ENHANCED_PACKET = 0x00000006
+
+OPTION_END = 0
+OPTION_COMMENT = 1
+OPTION_SHB_USERAPPL = 4
+OPTION_IF_NAME = 2
+OPTION_EPB_FLAGS = 2
+
+DIRECTION_INBOUND = 1
+DIRECTION_OUTBOUND = 2
+
+# A captured frame: timestamp, direction, interface name, source address, destination address, source port,
+# destination port, payload and message-ID
+CapturedFrame = Tuple[float, int, str, bytes, bytes, int, int, bytes, str]
+
+
+def internet_checksum(data: bytes) -> int:
+    """
+    Calculate the 16-bit one's complement checksum used by UDP
+
+    :param data: The data to calculate the checksum over
+    :return: The checksum
+    """
+    if len(data) % 2:
+        data += b'\x00'
+
+    total = sum(struct.unpack('!{}H'.format(len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+
+    return ~total & 0xFFFF or 0xFFFF
+
+
+def build_ipv6_udp_frame(source: bytes, destination: bytes, source_port: int, destination_port: int,
+                         payload: bytes) -> bytes:
+    """
+    Wrap the payload in IPv6 and UDP headers
+
+    :param source: The packed source address
+    :param destination: The packed destination address
+    :param source_port: The UDP source port
+    :param destination_port: The UDP destination port
+    :param payload: The UDP payload
+    :return: The IPv6 packet
+    """
+    udp_length = 8 + len(payload)
+    udp_header = struct.pack('!HHHH', source_port, destination_port, udp_length, 0)
+    pseudo_header = source + destination + struct.pack('!IxxxB', udp_length, 17)
+    checksum = internet_checksum(pseudo_header + udp_header + payload)
+
+    ipv6_header = struct.pack('!IHBB', 0x60000000, udp_length, 17, 64) + source + destination
+    udp_header = struct.pack('!HHHH', source_port, destination_port, udp_length, checksum)
+    return ipv6_header + udp_header + payload
+
+
+def pad32(data: bytes) -> bytes:
+    """
+    Pad the data to a multiple of 32 bits
+
+    :param data: The data to pad
+    :return: The padded data
+    """
+    return data + b'\x00' * (-len(data) % 4)
+
+
+def pcapng_option(code: int, value: bytes = b'') -> bytes:
+    """
+    Encode a pcapng option
+
+    :param code: The option code
+    :param value: The option value
+    :return: The encoded option
+    """
+    return struct.pack('<HH', code, len(value)) + pad32(value)
+
+
+def pcapng_block(block_type: int, body: bytes) -> bytes:
+    """
+    Encode a pcapng block
+
+    :param block_type: The block type
+    :param body: The block body, which will be padded if necessary
+    :return: The encoded block
+    """
+    body = pad32(body)
+    total_length = len(body) + 12
+    return struct.pack('<II', block_type, total_length) + body + struct.pack('<I', total_length)
+
+
+def pcapng_section_header() -> bytes:
+    """
+    Create a section header block, which starts every pcapng file
+
+    :return: The encoded block
+    """
+    body = struct.pack('<IHHq', 0x1A2B3C4D, 1, 0, -1)
+    body += pcapng_option(OPTION_SHB_USERAPPL, b'DHCPKit')
+    body += pcapng_option(OPTION_END)
+    return pcapng_block(BLOCK_SECTION_HEADER, body)
+
+
+def pcapng_interface_description(interface_name: str) -> bytes:
+    """
+    Create an interface description block for raw IPv6 packets
+
+    :param interface_name: The name of the interface
+    :return: The encoded block
+    """
+    body = struct.pack('<HHI', LINKTYPE_IPV6, 0, 0)
+    body += pcapng_option(OPTION_IF_NAME, interface_name.encode('utf-8'))
+    body += pcapng_option(OPTION_END)
+    return pcapng_block(BLOCK_INTERFACE_DESCRIPTION, body)
+
+
+def pcapng_enhanced_packet(interface_id: int, timestamp: float, packet: bytes, direction: int, comment: str) -> bytes:
+    """
+    Create an enhanced packet block
+
+    :param interface_id: The index of the interface description block of the interface
+    :param timestamp: The time the packet was captured
+    :param packet: The packet data
+    :param direction: Whether the packet was received or sent
+    :param comment: A comment to attach to the packet
+    :return: The encoded block
+    """
+    microseconds = int(timestamp * 1000000)
+    body = struct.pack('<IIIII', interface_id, microseconds >> 32, microseconds & 0xFFFFFFFF, len(packet), len(packet))
+    body += pad32(packet)
+    body += pcapng_option(OPTION_EPB_FLAGS, struct.pack('<I', direction))
+    if comment:
+        body += pcapng_option(OPTION_COMMENT, comment.encode('utf-8'))
+    body += pcapng_option(OPTION_END)
+    return pcapng_block(BLOCK_ENHANCED_PACKET, body)
+
+
+class PacketCapture:
+    """
+    The part of the packet capture that runs in the worker processes. It selects which packets to capture and puts
+    them on the capture queue without waiting.
+    """
+
+    def __init__(self, queue_size: int, statistics: ServerStatistics, duids: Iterable[bytes] = None,
+                 interfaces: Iterable[str] = None, subnets: Iterable[IPv6Network] = None):
+        """
+        Set up the capture queue and filters
+
+        :param queue_size: The maximum number of frames waiting to be written
+        :param statistics: The server statistics to count dropped frames in
+        :param duids: Only capture packets from clients with these DUIDs
+        :param interfaces: Only capture packets received on these interfaces
+        :param subnets: Only capture packets from clients on links in these subnets
+        """
+        self.queue = multiprocessing.Queue(queue_size)
+        self.statistics = statistics
+        self.duids = set(duids or [])
+        self.interfaces = set(interfaces or [])
+        self.subnets = list(subnets or [])
+
+    def matches(self, interface_name: str, bundle: Optional[TransactionBundle]) -> bool:
+        """
+        Determine whether packets of this transaction should be captured.
+
+        :param interface_name: The name of the interface the request was received on
+        :param bundle: The transaction bundle, or None if the packet could not be parsed
+        :return: Whether to capture
+        """
+        if self.interfaces and interface_name not in self.interfaces:
+            return False
+
+        if self.subnets:
+            if not bundle:
+                return False
+
+            link_address = bundle.link_address
+            if not any(link_address in subnet for subnet in self.subnets):
+                return False
+
+        if self.duids:
+            if not bundle:
+                return False
+
+            client_id = bundle.request.get_option_of_type(ClientIdOption)
+            if not client_id or client_id.duid.save() not in self.duids:
+                return False
+
+        return True
+
+    def put(self, frame: CapturedFrame):
+        """
+        Put a frame on the queue, or drop it if the queue is full.
+
+        :param frame: The frame to capture
+        """
+        try:
+            self.queue.put_nowait(frame)
+        except Full:
+            self.statistics.count_dropped_capture_frame()
+
+    def capture_incoming(self, interface_name: str, incoming_packet: IncomingPacketBundle):
+        """
+        Capture a received packet
+
+        :param interface_name: The name of the interface the packet was received on
+        :param incoming_packet: The received packet
+        """
+        data = incoming_packet.data
+        source_port = SERVER_PORT if data[:1] == bytes((MSG_RELAY_FORW,)) else CLIENT_PORT
+        if incoming_packet.received_over_multicast:
+            destination = All_DHCP_Relay_Agents_and_Servers
+        else:
+            destination = incoming_packet.link_address
+
+        self.put((time.time(), DIRECTION_INBOUND, interface_name,
+                  incoming_packet.source_address.packed, destination.packed, source_port, SERVER_PORT,
+                  data, incoming_packet.message_id))
+
+    def capture_outgoing(self, interface_name: str, incoming_packet: IncomingPacketBundle,
+                         outgoing_message: RelayReplyMessage):
+        """
+        Capture a sent packet
+
+        :param interface_name: The name of the interface the packet is sent on
+        :param incoming_packet: The received packet that this is a reply to
+        :param outgoing_message: The reply, including the wrapping RelayReplyMessage
+        """
+        reply = outgoing_message.relayed_message
+        destination_port = SERVER_PORT if isinstance(reply, RelayReplyMessage) else CLIENT_PORT
+
+        self.put((time.time(), DIRECTION_OUTBOUND, interface_name,
+                  incoming_packet.link_address.packed, outgoing_message.peer_address.packed,
+                  SERVER_PORT, destination_port, reply.save(), incoming_packet.message_id))
+
+
+class CaptureWriter:
+    """
+    Write captured frames to a rotating pcapng file from a separate thread in the main process
+    """
+
+    def __init__(self, filename: str, max_size: int, keep: int, capture: PacketCapture,
+                 statistics: ServerStatistics):
+        """
+        Prepare the writer
+
+        :param filename: The name of the capture file
+        :param max_size: Rotate the file when it grows larger than this, 0 to never rotate
+        :param keep: The number of rotated files to keep
+        :param capture: The packet capture whose queue to write from
+        :param statistics: The server statistics to count captured frames in
+        """
+        self.filename = filename
+        self.max_size = max_size
+        self.keep = keep
+        self.capture = capture
+        self.statistics = statistics
+
+        self.file = None
+        self.size = 0
+        self.interface_ids = {}
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='CaptureWriter', daemon=True)
+
+    def start(self):
+        """
+        Open the capture file and start writing frames. An existing capture file, for example from before a reload,
+        is appended to.
+        """
+        logger.info("Capturing packets to %s", self.filename)
+        self.open()
+        self.thread.start()
+
+    def stop(self, timeout: float = 5):
+        """
+        Write the remaining frames, stop the thread and close the capture file
+
+        :param timeout: The maximum number of seconds to wait for the remaining frames to be written
+        """
+        logger.info("Stopping packet capture to %s", self.filename)
+        try:
+            self.capture.queue.put(None, timeout=timeout)
+        except Full:
+            # The writer can't keep up or has died, don't let that stop a reload or shutdown
+            logger.warning("Capture queue to %s is still full, not writing the remaining frames", self.filename)
+            self.stop_event.set()
+
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            logger.error("Capture writer for %s did not stop in time, leaving it behind", self.filename)
+            self.stop_event.set()
+            return
+
+        self.file.close()
+
+    def open(self, truncate: bool = False):
+        """
+        Open the capture file. A new section is started when appending to an existing file.
+
+        :param truncate: Start with an empty file instead of appending to it
+        """
+        self.file = open(self.filename, 'wb' if truncate else 'ab')
+        self.size = self.file.tell()
+        self.interface_ids = {}
+        self.write(pcapng_section_header())
+
+    def rotate(self):
+        """
+        Rotate the capture files like the RotatingFileHandler does with log files. If renaming fails the current file
+        is reopened and appended to, so capturing continues.
+        """
+        self.file.close()
+
+        try:
+            if self.keep > 0:
+                for i in range(self.keep - 1, 0, -1):
+                    source = '{}.{}'.format(self.filename, i)
+                    if os.path.exists(source):
+                        os.replace(source, '{}.{}'.format(self.filename, i + 1))
+
+                os.replace(self.filename, self.filename + '.1')
+        except OSError:
+            self.open()
+            raise
+
+        self.open(truncate=True)
+
+    def write(self, block: bytes):
+        """
+        Write a block to the capture file
+
+        :param block: The encoded block
+        """
+        self.file.write(block)
+        self.size += len(block)
+
+    def write_frame(self, frame: CapturedFrame):
+        """
+        Write a captured frame to the capture file
+
+        :param frame: The captured frame
+        """
+        (timestamp, direction, interface_name, source, destination, source_port, destination_port,
+         payload, message_id) = frame
+
+        interface_id = self.interface_ids.get(interface_name)
+        if interface_id is None:
+            interface_id = len(self.interface_ids)
+            self.interface_ids[interface_name] = interface_id
+            self.write(pcapng_interface_description(interface_name))
+
+        packet = build_ipv6_udp_frame(source, destination, source_port, destination_port, payload)
+        self.write(pcapng_enhanced_packet(interface_id, timestamp, packet, direction, message_id))
+        self.statistics.count_captured_frame()
+
+        if self.max_size and self.size >= self.max_size:
+            self.rotate()
+
+    def run(self):
+        """
+        Write frames until we receive the sentinel
+        """
+        while True:
+            try:
+                frame = self.capture.queue.get()
+            except EOFError:
+                break
+
+            if frame is None or self.stop_event.is_set():
+                break
+
+            try:
+                self.write_frame(frame)
+
+                # Make sure the frames are on disk when the server is idle
+                if self.capture.queue.empty():
+                    self.file.flush()
+            except Exception as e:
+                logger.error("Error writing to capture file %s: %s", self.filename, e)
+
+                # Don't let a closed file stop the capture
+                if self.file.closed:
+                    try:
+                        self.open()
+                    except OSError as e:
+                        logger.error("Cannot reopen capture file %s: %s", self.filename, e)
+
+        try:
+            self.file.flush()
+        except (OSError, ValueError) as e:
+            logger.error("Error flushing capture file %s: %s", self.filename, e)
@@ -5,8 +5,12 @@ The basic configuration objects
 import grp
 import logging
 
+from ZConfig.datatypes import existing_dirpath
 from dhcpkit.common.server.config_elements import ConfigSection
+from dhcpkit.ipv6.server.capture import PacketCapture
+from dhcpkit.ipv6.server.listeners.factories import UDPListenerFactory
 from dhcpkit.ipv6.server.message_handler import MessageHandler
+from dhcpkit.ipv6.server.statistics import ServerStatistics
 from dhcpkit.ipv6.server.utils import determine_local_duid
 
 logger = logging.getLogger(__name__)
@@ -32,6 +36,20 @@ class MainConfig(ConfigSection):
         if not self.section.server_id:
             self.section.server_id = determine_local_duid()
 
+    def validate_config_section(self):
+        """
+        Validate the flight recorder size, and let the UDP listeners know whether they need to share their port with a
+        wildcard listener
+        """
+        if self.history_size < 0:
+            raise ValueError("The history size cannot be negative")
+
+        udp_listener_factories = [listener_factory for listener_factory in self.listener_factories
+                                  if isinstance(listener_factory, UDPListenerFactory)]
+        reuse_address = any(listener_factory.listens_on_wildcard for listener_factory in udp_listener_factories)
+        for listener_factory in udp_listener_factories:
+            listener_factory.reuse_address = reuse_address
+
     def create_message_handler(self) -> MessageHandler:
         """
         Create a message handler based on this configuration.
@@ -53,3 +71,34 @@ class StatisticsConfig(ConfigSection):
     """
     Configuration of the statistics gatherer
     """
+
+
+class CaptureConfig(ConfigSection):
+    """
+    Configuration of the packet capture
+    """
+
+    name_datatype = staticmethod(existing_dirpath)
+
+    def validate_config_section(self):
+        """
+        Validate the rotation settings
+        """
+        if self.keep < 0:
+            raise ValueError("The number of capture files to keep cannot be negative")
+
+        if self.queue_size < 1:
+            raise ValueError("The capture queue must have room for at least one packet")
+
+    def create_packet_capture(self, statistics: ServerStatistics) -> PacketCapture:
+        """
+        Create the packet capture that the workers use
+
+        :param statistics: The server statistics
+        :return: The packet capture
+        """
+        return PacketCapture(queue_size=self.queue_size,
+                             statistics=statistics,
+                             duids=self.duids,
+                             interfaces=self.interfaces,
+                             subnets=self.subnets)
@@ -92,7 +92,7 @@ def get_config_loader() -> ConfigLoader:
             # It's a package! Try to import
             try:
                 config_loader.importSchemaComponent(extension.__name__)
-                logger.debug("Configuration extension {} loaded".format(extension_name))
+                logger.debug("Configuration extension %s loaded", extension_name)
             except SchemaResourceError:
                 # Component missing, assume it's a package without a config component
                 pass
@@ -107,7 +107,7 @@ def load_config(config_filename: str) -> MainConfig:
     :param config_filename: The configuration file
     :return: The parsed config
     """
-    logger.debug("Loading configuration file {}".format(config_filename))
+    logger.debug("Loading configuration file %s", config_filename)
 
     config_loader = get_config_loader()
     config_filename = os.path.realpath(config_filename)
@@ -2,16 +2,23 @@
 A socket to control the DHCPKit server
 """
 import errno
+import json
 import logging
 import os
 import socket
 import time
+from collections import OrderedDict
 from typing import List, Optional, Union
 
 import dhcpkit
+from dhcpkit.ipv6.server.statistics import ServerStatistics, get_deltas
 
 logger = logging.getLogger(__name__)
 
+# Limits for how often statistics updates can be requested
+MIN_WATCH_INTERVAL = 0.1
+MAX_WATCH_INTERVAL = 3600.0
+
 
 class ControlConnection:
     """
@@ -25,6 +32,12 @@ class ControlConnection:
         self.buffer = b''
         self.last_activity = time.time()
 
+        # State for streaming statistics updates
+        self.watch_interval = None
+        self.watch_deadline = None
+        self.watch_time = None
+        self.watch_counters = None
+
         # Set socket options
         self.sock.setblocking(False)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 100 * 1024)
@@ -101,8 +114,78 @@ class ControlConnection:
         Close the socket nicely
         """
         logger.debug("Closing control connection")
+        self.stop_watch()
         self.sock.close()
 
+    @property
+    def watching(self) -> bool:
+        """
+        Whether this connection has subscribed to statistics updates
+
+        :return: Subscription state
+        """
+        return self.watch_interval is not None
+
+    def start_watch(self, interval: float, statistics: ServerStatistics):
+        """
+        Start sending the changes in the statistics counters every interval seconds
+
+        :param interval: The number of seconds between updates
+        :param statistics: The statistics to watch
+        """
+        self.watch_interval = interval
+        self.watch_time = time.monotonic()
+        self.watch_deadline = self.watch_time + interval
+        self.watch_counters = statistics.export_counters()
+
+    def stop_watch(self):
+        """
+        Stop sending statistics updates
+        """
+        self.watch_interval = None
+        self.watch_deadline = None
+        self.watch_time = None
+        self.watch_counters = None
+
+    def send_watch_update(self, statistics: ServerStatistics) -> bool:
+        """
+        Send the counters that changed since the previous update as a single line of JSON, together with the
+        current values of the gauges and the number of seconds the deltas were measured over.
+
+        :param statistics: The statistics to watch
+        :return: Whether the connection is still usable
+        """
+        now = time.monotonic()
+        counters = statistics.export_counters()
+
+        update = OrderedDict()
+        update['elapsed'] = round(now - self.watch_time, 6)
+        update['deltas'] = get_deltas(self.watch_counters, counters)
+        update['gauges'] = statistics.export_gauges()
+        data = json.dumps(update).encode('utf-8') + b'\n'
+
+        # Schedule the next update based on the previous deadline so we don't drift
+        self.watch_deadline = max(self.watch_deadline + self.watch_interval, now)
+
+        try:
+            sent = self.sock.send(data)
+        except BlockingIOError:
+            # The client isn't reading fast enough, keep the old counters so the next deltas include this period
+            logger.debug("Control connection isn't reading statistics updates, skipping one")
+            return True
+        except OSError:
+            # They have gone away
+            return False
+
+        if sent < len(data):
+            # We can't send half a line, the stream would be corrupted
+            logger.warning("Control connection isn't reading statistics updates fast enough, closing it")
+            return False
+
+        self.watch_time = now
+        self.watch_counters = counters
+        return True
+
     def acknowledge(self, feedback: str = None):
         """
         Acknowledge the command
@@ -132,13 +215,13 @@ class ControlSocket:
         self.listen_socket.setblocking(False)
 
         try:
-            logger.info("Creating control socket {}".format(socket_path))
+            logger.info("Creating control socket %s", socket_path)
             self.listen_socket.bind(socket_path)
         except FileNotFoundError:
             raise RuntimeError("The path to control socket {} doesn't exist".format(socket_path)) from None
         except OSError as e:
             if e.errno == errno.EADDRINUSE:
-                logger.debug("Control socket at {} exists, trying to see if it's still alive".format(socket_path))
+                logger.debug("Control socket at %s exists, trying to see if it's still alive", socket_path)
 
                 # Is this an old socket? Try to connect
                 try:
@@ -147,7 +230,7 @@ class ControlSocket:
                 except OSError as e2:
                     if e2.errno == errno.ECONNREFUSED:
                         # Nobody listening, just delete it and try again
-                        logger.debug("Replacing old control socket {}".format(socket_path))
+                        logger.debug("Replacing old control socket %s", socket_path)
                         os.unlink(socket_path)
                         self.listen_socket.bind(socket_path)
                     elif e2.errno == errno.ENOTSOCK:
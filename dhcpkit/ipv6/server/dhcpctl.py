@@ -2,13 +2,15 @@
 The remote control app for the server process
 """
 import argparse
+import json
 import logging.handlers
 import socket
 import sys
 from argparse import ArgumentDefaultsHelpFormatter
+from collections import OrderedDict
 from struct import pack
 
-from typing import Iterable, Optional
+from typing import Dict, Iterable, List, Optional
 
 from dhcpkit.common.logging.verbosity import set_verbosity_logger
 
@@ -141,6 +143,121 @@ class DHCPKitControlClient:
             else:
                 yield line
 
+    def watch_statistics(self, interval: float) -> Iterable[dict]:
+        """
+        Subscribe to statistics updates. The connection can't be used for other commands after this.
+
+        :param interval: The number of seconds between updates
+        :return: The updates as sent by the server
+        """
+        # Don't time out while waiting for the next update
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, pack('ll', int(interval) + 10, 0))
+
+        # Consume the acknowledgement
+        list(self.execute_command('stats-watch {}'.format(interval)))
+
+        while True:
+            line = self.receive_line()
+            if line is None:
+                # Connection closed
+                return
+
+            yield json.loads(line, object_pairs_hook=OrderedDict)
+
+    def close(self):
+        """
+        Close the connection without saying goodbye
+        """
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+def apply_deltas(totals: Dict[str, object], deltas: Dict[str, object]):
+    """
+    Update the totals with the deltas from a statistics update
+
+    :param totals: The totals to update
+    :param deltas: The deltas received from the server
+    """
+    for key, value in deltas.items():
+        if isinstance(value, dict):
+            apply_deltas(totals.setdefault(key, OrderedDict()), value)
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+
+def format_rates(totals: Dict[str, object], update: Dict[str, object], interval: float) -> List[str]:
+    """
+    Render a screen with the rates from a statistics update
+
+    :param totals: The counter totals, already including the update
+    :param update: The update received from the server
+    :param interval: The requested update interval
+    :return: The lines to show
+    """
+    elapsed = update['elapsed'] or interval
+    deltas = update['deltas']
+    gauges = update['gauges']
+
+    dropped = deltas.get('server', {}).get('dropped_packets', 0)
+    lines = [
+        "DHCPKit statistics every {:g}s - workers: {}, pending: {}, queued: {}, dropped: {:.1f}/s".format(
+            interval, gauges.get('workers', 0), gauges.get('pending_results', 0), gauges.get('task_queue_depth', 0),
+            dropped / elapsed),
+    ]
+
+    row_format = '  {:<32}{:>12}{:>14}'
+
+    def add_category(title: str, category_totals: Dict[str, object], category_deltas: Dict[str, object]):
+        """
+        Add the lines for one category
+        """
+        lines.extend(['', '{:<34}{:>12}{:>14}'.format(title, 'per second', 'total')])
+
+        rows = [('packets in', 'incoming_packets', None),
+                ('packets out', 'outgoing_packets', None),
+                ('unparsable', 'unparsable_packets', None),
+                ('handling errors', 'handling_errors', None)]
+        for direction, suffix in (('messages_in', 'in'), ('messages_out', 'out')):
+            for message_type in category_totals.get(direction, {}):
+                rows.append(('{} {}'.format(message_type, suffix), message_type, direction))
+
+        for label, name, direction in rows:
+            container_totals = category_totals.get(direction, {}) if direction else category_totals
+            container_deltas = category_deltas.get(direction, {}) if direction else category_deltas
+
+            total = container_totals.get(name, 0)
+            if direction and not total:
+                # Don't clutter the screen with message types that we never saw
+                continue
+
+            rate = container_deltas.get(name, 0) / elapsed
+            lines.append(row_format.format(label, '{:.1f}'.format(rate), total))
+
+    add_category('Global', totals.get('global', {}), deltas.get('global', {}))
+    for section, title in (('interfaces', 'Interface'), ('subnets', 'Subnet'), ('relays', 'Relay')):
+        for name, category_totals in totals.get(section, {}).items():
+            add_category('{} {}'.format(title, name), category_totals, deltas.get(section, {}).get(name, {}))
+
+    return lines
+
+
+def watch(conn: DHCPKitControlClient, interval: float):
+    """
+    Show the statistics rates like a live top view until interrupted
+
+    :param conn: The connection to the server
+    :param interval: The number of seconds between updates
+    """
+    # Start with the current totals, the updates only tell us what changed
+    totals = json.loads(''.join(conn.execute_command('stats-json')), object_pairs_hook=OrderedDict)
+
+    clear_screen = '\x1b[H\x1b[2J' if sys.stdout.isatty() else ''
+    for update in conn.watch_statistics(interval):
+        apply_deltas(totals, update['deltas'])
+        print(clear_screen + '\n'.join(format_rates(totals, update, interval)), flush=True)
+
 
 def handle_args(args: Iterable[str]):
     """
@@ -156,7 +273,9 @@ def handle_args(args: Iterable[str]):
     )
 
     parser.add_argument("command", action="store",
-                        help="The command to send to the server")
+                        help="The command to send to the server, or 'watch' to show live statistics")
+    parser.add_argument("arguments", action="store", nargs="*",
+                        help="Arguments for the command, like the update interval in seconds for 'watch'")
     parser.add_argument("-v", "--verbosity", action="count", default=0,
                         help="increase output verbosity")
     parser.add_argument("-c", "--control-socket", action="store", metavar="FILENAME",
@@ -180,7 +299,24 @@ def main(args: Iterable[str]):
     set_verbosity_logger(logger, args.verbosity)
 
     conn = DHCPKitControlClient(args.control_socket)
-    output = conn.execute_command(args.command)
+
+    if args.command in ('watch', 'stats-watch'):
+        interval = float(args.arguments[0]) if args.arguments else 1.0
+        try:
+            if args.command == 'watch':
+                watch(conn, interval)
+            else:
+                # Pass the raw updates through, one JSON document per line
+                for update in conn.watch_statistics(interval):
+                    print(json.dumps(update), flush=True)
+        except KeyboardInterrupt:
+            pass
+
+        # The connection is streaming, so just hang up
+        conn.close()
+        return
+
+    output = conn.execute_command(' '.join([args.command] + args.arguments))
     for line in output:
         print(line)
 
@@ -203,7 +339,7 @@ def run() -> int:
         main(sys.argv[1:])
         return 0
     except Exception as e:
-        logger.critical("Error: {}".format(e))
+        logger.critical("Error: %s", e)
         return 1
 
 
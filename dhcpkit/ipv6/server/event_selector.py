@@ -0,0 +1,72 @@
+"""
+The selector used by the main loop of the server. Every registered object gets a callback as its data, so events are
+dispatched without having to find out what kind of object became ready.
+
+On Linux listeners are registered in edge-triggered mode. The kernel then only reports a listener again when new data
+arrives, so a busy listener doesn't cause a wakeup for every packet. Such listeners must keep receiving until they
+have nothing left, or report through :attr:`~dhcpkit.ipv6.server.listeners.Listener.backlogged` that they stopped
+early and need another turn.
+"""
+import select
+import selectors
+
+from typing import Callable
+
+
+class CallbackSelectorMixin:
+    """
+    Registration of file objects with a callback as their data
+    """
+
+    # Whether this selector supports edge-triggered registration
+    supports_edge_triggered = False
+
+    def register_callback(self, fileobj, callback: Callable, edge_triggered: bool = False) -> selectors.SelectorKey:
+        """
+        Register a file object for read events with a callback that handles them
+
+        :param fileobj: The file object to watch
+        :param callback: The callable that will be called with the file object when it is ready
+        :param edge_triggered: Whether to only report the file object when new data arrives, if supported
+        :return: The selector key
+        """
+        # noinspection PyUnresolvedReferences
+        key = self.register(fileobj, selectors.EVENT_READ, callback)
+        if edge_triggered and self.supports_edge_triggered:
+            self.make_edge_triggered(key)
+        return key
+
+    def make_edge_triggered(self, key: selectors.SelectorKey):
+        """
+        Switch a registered file object to edge-triggered mode
+
+        :param key: The selector key of the file object
+        """
+        raise NotImplementedError
+
+
+class DefaultEventSelector(CallbackSelectorMixin, selectors.DefaultSelector):
+    """
+    The default selector of the platform with callbacks, everything is level-triggered
+    """
+
+
+if hasattr(selectors, 'EpollSelector'):
+    class EpollEventSelector(CallbackSelectorMixin, selectors.EpollSelector):
+        """
+        An epoll selector with callbacks that can register file objects in edge-triggered mode
+        """
+
+        supports_edge_triggered = True
+
+        def make_edge_triggered(self, key: selectors.SelectorKey):
+            """
+            Switch a registered file object to edge-triggered mode
+
+            :param key: The selector key of the file object
+            """
+            self._selector.modify(key.fd, select.EPOLLIN | select.EPOLLET)
+
+    EventSelector = EpollEventSelector
+else:
+    EventSelector = DefaultEventSelector
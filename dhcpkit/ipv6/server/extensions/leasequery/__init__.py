@@ -3,9 +3,10 @@ Implementation of the Leasequery and Bulk Leasequery extensions.
 """
 import codecs
 import logging
+import time
 from ipaddress import IPv6Address, IPv6Network
 
-from typing import Iterable, Iterator, List, Optional, Tuple, Union
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
 from dhcpkit.ipv6.duids import DUID
 from dhcpkit.ipv6.extensions.bulk_leasequery import LeasequeryDataMessage, LeasequeryDoneMessage, RelayIdOption, \
@@ -14,15 +15,29 @@ from dhcpkit.ipv6.extensions.leasequery import ClientDataOption, LQClientLink, L
     LeasequeryMessage, STATUS_NOT_ALLOWED, STATUS_UNKNOWN_QUERY_TYPE
 from dhcpkit.ipv6.extensions.prefix_delegation import IAPDOption, IAPrefixOption, OPTION_IAPREFIX, OPTION_IA_PD
 from dhcpkit.ipv6.extensions.remote_id import RemoteIdOption
-from dhcpkit.ipv6.messages import Message, RelayForwardMessage, ReplyMessage
-from dhcpkit.ipv6.options import IAAddressOption, IANAOption, IATAOption, OPTION_CLIENTID, OPTION_IAADDR, \
-    OPTION_IA_NA, OPTION_IA_TA, OPTION_ORO, OPTION_RELAY_MSG, OPTION_SERVERID, OPTION_STATUS_CODE, Option, \
-    STATUS_SUCCESS, STATUS_UNSPEC_FAIL, StatusCodeOption
+from dhcpkit.ipv6.messages import Message, RebindMessage, RelayForwardMessage, RenewMessage, ReplyMessage, \
+    RequestMessage, SolicitMessage
+from dhcpkit.ipv6.options import ClientIdOption, IAAddressOption, IANAOption, IATAOption, OPTION_CLIENTID, \
+    OPTION_IAADDR, OPTION_IA_NA, OPTION_IA_TA, OPTION_ORO, OPTION_RELAY_MSG, OPTION_SERVERID, OPTION_STATUS_CODE, \
+    Option, STATUS_SUCCESS, STATUS_UNSPEC_FAIL, StatusCodeOption
 from dhcpkit.ipv6.server.handlers import Handler, ReplyWithLeasequeryError
 from dhcpkit.ipv6.server.transaction_bundle import MessagesList, TransactionBundle
 
 logger = logging.getLogger(__name__)
 
+# An address lease: the address, the ends of the preferred and valid lifetimes and the encoded options
+AddressLease = Tuple[str, int, int, bytes]
+
+# A prefix lease: the first and last address, the ends of the preferred and valid lifetimes and the encoded options
+PrefixLease = Tuple[str, str, int, int, bytes]
+
+# Everything that a transaction tells us about a client, encoded so it is cheap to store or send to another process
+LeaseUpdate = NamedTuple('LeaseUpdate', [('client_id', str), ('link_address', str), ('timestamp', int),
+                                         ('options', bytes), ('relay_data', bytes),
+                                         ('remote_ids', Tuple[str, ...]), ('relay_ids', Tuple[str, ...]),
+                                         ('address_leases', Tuple[AddressLease, ...]),
+                                         ('prefix_leases', Tuple[PrefixLease, ...])])
+
 
 def create_cleanup_handlers() -> List[Handler]:
     """
@@ -103,7 +118,9 @@ class LeasequeryStore:
         Find all leases that match the given query.
 
         :param query: The query
-        :return: The number of leases and an iterator over tuples of link-address and corresponding client data
+        :return: The number of leases and an iterator over tuples of link-address and corresponding client data. Stores
+                 that stream their results may stop counting at 2, the handler only needs to know whether there are
+                 none, one or more.
         """
         raise NotImplementedError
 
@@ -327,7 +344,7 @@ class LeasequeryStore:
         if not out:
             return b''
 
-        return out.save()
+        return bytes(out.save())
 
     @staticmethod
     def decode_relay_messages(data: bytes) -> Optional[RelayForwardMessage]:
@@ -368,6 +385,46 @@ class LeasequeryStore:
 
         return LQRelayDataOption(peer_address, relay_chain)
 
+    def build_lease_update(self, bundle: TransactionBundle) -> LeaseUpdate:
+        """
+        Extract everything we need to store from the given transaction bundle.
+
+        :param bundle: The transaction to remember
+        :return: The update for the store
+        """
+        now = int(time.time())
+
+        # Client identification fields
+        client_id_option = bundle.request.get_option_of_type(ClientIdOption)
+        relay_chain = bundle.incoming_relay_messages[-1] if bundle.incoming_relay_messages else None
+
+        # Gather addresses and prefixes
+        address_leases = []
+        prefix_leases = []
+        if isinstance(bundle.request, (SolicitMessage, RequestMessage, RenewMessage, RebindMessage)):
+            if self.is_accepted(bundle.response):
+                # These messages update leases, so we need to process the result
+                address_leases = [(lease.address.exploded,
+                                   now + lease.preferred_lifetime,
+                                   now + lease.valid_lifetime,
+                                   self.encode_options(lease.options))
+                                  for lease in self.get_address_leases(bundle)]
+                prefix_leases = [(lease.prefix[0].exploded, lease.prefix[-1].exploded,
+                                  now + lease.preferred_lifetime,
+                                  now + lease.valid_lifetime,
+                                  self.encode_options(lease.options))
+                                 for lease in self.get_prefix_leases(bundle)]
+
+        return LeaseUpdate(client_id=self.encode_duid(client_id_option.duid),
+                           link_address=bundle.link_address.exploded,
+                           timestamp=now,
+                           options=self.encode_options(bundle.response.options),
+                           relay_data=self.encode_relay_messages(relay_chain),
+                           remote_ids=tuple(self.get_remote_ids(bundle)),
+                           relay_ids=tuple(self.get_relay_ids(bundle)),
+                           address_leases=tuple(address_leases),
+                           prefix_leases=tuple(prefix_leases))
+
 
 class LeasequeryHandler(Handler):
     """
@@ -9,7 +9,11 @@ from dhcpkit.common.server.config_datatypes import unsigned_int_16
 from dhcpkit.common.server.config_elements import ConfigElementFactory
 from dhcpkit.ipv6.option_registry import option_registry
 from dhcpkit.ipv6.server.extensions.leasequery import LeasequeryHandler
+from dhcpkit.ipv6.server.extensions.leasequery.memory import LeasequeryMemoryStore
 from dhcpkit.ipv6.server.extensions.leasequery.sqlite import LeasequerySqliteStore
+from dhcpkit.ipv6.server.extensions.leasequery.sqlite_cache import LeasequerySqliteWriteCache
+from dhcpkit.ipv6.server.extensions.leasequery.sqlite_expiry import LeasequerySqliteExpiry
+from dhcpkit.ipv6.server.extensions.leasequery.sqlite_writer import LeasequerySqliteWriter
 from dhcpkit.ipv6.server.handlers import HandlerFactory
 
 logger = logging.getLogger(__name__)
@@ -60,10 +64,76 @@ class LeasequerySqliteStoreFactory(ConfigElementFactory):
     def __init__(self, section):
         super().__init__(section)
 
+    def validate_config_section(self):
+        """
+        Validate the writer process, expiry and write cache settings
+        """
+        if self.group_commit_size < 1:
+            raise ValueError("group-commit-size must be at least 1")
+
+        if self.group_commit_interval < 0:
+            raise ValueError("group-commit-interval can't be negative")
+
+        if self.writer_queue_size < 1:
+            raise ValueError("writer-queue-size must be at least 1")
+
+        if self.writer_queue_timeout < 0:
+            raise ValueError("writer-queue-timeout can't be negative")
+
+        if self.expiry_interval < 0:
+            raise ValueError("expiry-interval can't be negative")
+
+        if self.expiry_batch_size < 1:
+            raise ValueError("expiry-batch-size must be at least 1")
+
+        if self.write_cache_slack < 0:
+            raise ValueError("write-cache-slack can't be negative")
+
+    def create(self):
+        """
+        Create a leasequery store.
+
+        :return: A leasequery store
+        """
+        writer = None
+        if self.writer_process:
+            writer = LeasequerySqliteWriter(batch_size=self.group_commit_size,
+                                            batch_interval=self.group_commit_interval,
+                                            queue_size=self.writer_queue_size,
+                                            queue_timeout=self.writer_queue_timeout)
+
+        expiry = None
+        if self.expiry_interval > 0:
+            expiry = LeasequerySqliteExpiry(interval=self.expiry_interval, batch_size=self.expiry_batch_size)
+
+        write_cache = None
+        if self.write_cache_size > 0:
+            write_cache = LeasequerySqliteWriteCache(size=self.write_cache_size, slack=self.write_cache_slack)
+
+        return LeasequerySqliteStore(self.name, writer=writer, expiry=expiry, write_cache=write_cache)
+
+
+class LeasequeryMemoryStoreFactory(ConfigElementFactory):
+    """
+    Factory for LeasequeryMemoryStore
+    """
+
+    name_datatype = staticmethod(existing_dirpath)
+
+    def __init__(self, section):
+        super().__init__(section)
+
+    def validate_config_section(self):
+        """
+        Validate the snapshot settings
+        """
+        if self.snapshot_interval <= 0:
+            raise ValueError("snapshot-interval must be positive")
+
     def create(self):
         """
         Create a leasequery store.
 
         :return: A leasequery store
         """
-        return LeasequerySqliteStore(self.name)
+        return LeasequeryMemoryStore(self.name, snapshot_interval=self.snapshot_interval)
@@ -0,0 +1,735 @@
+"""
+In-memory implementation of a leasequery store. All leases are kept in one process that is shared by all workers, with
+an index for every type of query. Every update is appended to a journal and the data is regularly written to a
+snapshot, so that the leases survive a restart.
+"""
+import bisect
+import fcntl
+import logging
+import os
+import pickle
+import shutil
+import signal
+import threading
+import time
+from ipaddress import IPv6Address, IPv6Network
+from multiprocessing.managers import BaseManager
+
+from typing import Dict, Hashable, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from dhcpkit.ipv6.extensions.bulk_leasequery import QUERY_BY_LINK_ADDRESS, QUERY_BY_RELAY_ID, QUERY_BY_REMOTE_ID, \
+    RelayIdOption
+from dhcpkit.ipv6.extensions.leasequery import CLTTimeOption, ClientDataOption, LQQueryOption, OPTION_LQ_RELAY_DATA, \
+    QUERY_BY_ADDRESS, QUERY_BY_CLIENT_ID, STATUS_MALFORMED_QUERY
+from dhcpkit.ipv6.extensions.prefix_delegation import IAPrefixOption
+from dhcpkit.ipv6.extensions.remote_id import RemoteIdOption
+from dhcpkit.ipv6.options import ClientIdOption, IAAddressOption, Option, OptionRequestOption
+from dhcpkit.ipv6.server.extensions.leasequery import AddressLease, LeaseUpdate, LeasequeryStore, PrefixLease
+from dhcpkit.ipv6.server.handlers import ReplyWithLeasequeryError
+from dhcpkit.ipv6.server.queue_logger import get_main_logging_queue, log_to_main_process
+from dhcpkit.ipv6.server.transaction_bundle import TransactionBundle
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+# A client is identified by its DUID and the link it is on, just like the rows of the SQLite store
+ClientKey = Tuple[str, str]
+
+# Everything we know about a client, as sent back to the workers
+StoredClient = NamedTuple('StoredClient', [('client_id', str), ('link_address', str), ('last_interaction', int),
+                                           ('options', bytes), ('relay_data', bytes),
+                                           ('address_leases', Tuple[AddressLease, ...]),
+                                           ('prefix_leases', Tuple[PrefixLease, ...])])
+
+
+class ClientRecord:
+    """
+    The leases and relay information of a single client
+    """
+
+    __slots__ = ('last_interaction', 'options', 'relay_data', 'remote_ids', 'relay_ids', 'addresses', 'prefixes')
+
+    def __init__(self):
+        self.last_interaction = -1
+        self.options = b''
+        self.relay_data = b''
+        self.remote_ids = frozenset()
+        self.relay_ids = frozenset()
+
+        # Lifetime ends and options, by address and by first and last address of the prefix
+        self.addresses = {}  # type: Dict[str, Tuple[int, int, bytes]]
+        self.prefixes = {}  # type: Dict[Tuple[str, str], Tuple[int, int, bytes]]
+
+
+class PrefixIndex:
+    """
+    An interval index for delegated prefixes. Prefixes are aligned, so the prefixes that contain an address can be
+    found by looking up the network of that address for every prefix length in use. A sorted list of first addresses
+    finds the prefixes inside a range.
+    """
+
+    def __init__(self):
+        self.starts = []  # type: List[int]
+        self.entries = {}  # type: Dict[int, Dict[int, Hashable]]
+        self.host_bits = {}  # type: Dict[int, int]
+
+    def __len__(self):
+        return sum(len(ends) for ends in self.entries.values())
+
+    def add(self, first: int, last: int, owner: Hashable):
+        """
+        Add a prefix to the index
+
+        :param first: The first address of the prefix
+        :param last: The last address of the prefix
+        :param owner: The owner of the prefix
+        """
+        ends = self.entries.get(first)
+        if ends is None:
+            ends = self.entries[first] = {}
+            bisect.insort(self.starts, first)
+
+        if last not in ends:
+            host_bits = (last - first).bit_length()
+            self.host_bits[host_bits] = self.host_bits.get(host_bits, 0) + 1
+
+        ends[last] = owner
+
+    def remove(self, first: int, last: int):
+        """
+        Remove a prefix from the index
+
+        :param first: The first address of the prefix
+        :param last: The last address of the prefix
+        """
+        ends = self.entries.get(first)
+        if ends is None or last not in ends:
+            return
+
+        del ends[last]
+        if not ends:
+            del self.entries[first]
+            del self.starts[bisect.bisect_left(self.starts, first)]
+
+        host_bits = (last - first).bit_length()
+        self.host_bits[host_bits] -= 1
+        if not self.host_bits[host_bits]:
+            del self.host_bits[host_bits]
+
+    def containing(self, address: int) -> List[Tuple[int, int, Hashable]]:
+        """
+        Find the prefixes that contain the given address
+
+        :param address: The address
+        :return: The first address, last address and owner of each prefix
+        """
+        found = []
+        for host_bits in self.host_bits:
+            first = address >> host_bits << host_bits
+            ends = self.entries.get(first)
+            if ends:
+                last = first | ((1 << host_bits) - 1)
+                owner = ends.get(last)
+                if owner is not None:
+                    found.append((first, last, owner))
+
+        return found
+
+    def overlapping(self, first: int, last: int) -> List[Tuple[int, int, Hashable]]:
+        """
+        Find the prefixes that overlap with the given range. Aligned prefixes overlap when one contains the other, so
+        these are the prefixes that contain the first address and the prefixes that start inside the range.
+
+        :param first: The first address of the range
+        :param last: The last address of the range
+        :return: The first address, last address and owner of each prefix
+        """
+        found = [prefix for prefix in self.containing(first) if prefix[0] < first]
+
+        start = bisect.bisect_left(self.starts, first)
+        end = bisect.bisect_right(self.starts, last)
+        for prefix_first in self.starts[start:end]:
+            for prefix_last, owner in self.entries[prefix_first].items():
+                found.append((prefix_first, prefix_last, owner))
+
+        return found
+
+
+def add_to_index(index: Dict[str, Set[ClientKey]], values: Iterable[str], key: ClientKey):
+    """
+    Add a client to a hash index
+
+    :param index: The index
+    :param values: The values to find the client by
+    :param key: The key of the client
+    """
+    for value in values:
+        index.setdefault(value, set()).add(key)
+
+
+def remove_from_index(index: Dict[str, Set[ClientKey]], values: Iterable[str], key: ClientKey):
+    """
+    Remove a client from a hash index
+
+    :param index: The index
+    :param values: The values that found the client
+    :param key: The key of the client
+    """
+    for value in values:
+        keys = index.get(value)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[value]
+
+
+def prefix_range(first_address: str, last_address: str) -> Tuple[int, int]:
+    """
+    Convert the stored form of a prefix to numbers
+
+    :param first_address: The first address of the prefix in exploded form
+    :param last_address: The last address of the prefix in exploded form
+    :return: The first and last address as numbers
+    """
+    return int(IPv6Address(first_address)), int(IPv6Address(last_address))
+
+
+class LeasequeryMemoryData:
+    """
+    The leases of all clients, with indexes for all the queries. This object lives in the manager process, the workers
+    talk to it through a proxy.
+    """
+
+    def __init__(self, filename: str, snapshot_interval: float = 300):
+        """
+        Load the leases from the snapshot and the journal.
+
+        :param filename: The name of the snapshot file, the journal is stored next to it
+        :param snapshot_interval: The number of seconds between snapshots
+        """
+        self.filename = filename
+        self.journal_filename = filename + '.journal'
+        self.snapshot_interval = snapshot_interval
+
+        # The manager handles every worker in a separate thread
+        self.lock = threading.Lock()
+
+        self.clients = {}  # type: Dict[ClientKey, ClientRecord]
+        self.by_client_id = {}  # type: Dict[str, Set[ClientKey]]
+        self.by_link_address = {}  # type: Dict[str, Set[ClientKey]]
+        self.by_remote_id = {}  # type: Dict[str, Set[ClientKey]]
+        self.by_relay_id = {}  # type: Dict[str, Set[ClientKey]]
+        self.by_address = {}  # type: Dict[str, ClientKey]
+        self.prefix_index = PrefixIndex()
+
+        self.journal = None
+        self.next_snapshot = time.monotonic() + self.snapshot_interval
+        self.snapshot_thread = None
+
+        self.load()
+
+    def locked_files(self) -> int:
+        """
+        Get exclusive access to the snapshot and journal files, even if the previous store is still writing a
+        snapshot after a reload.
+
+        :return: The file descriptor of the lock file, close it to release the lock
+        """
+        lock_file = os.open(self.filename + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def load(self):
+        """
+        Load the snapshot, apply the journals and then write a new snapshot to start with an empty journal
+        """
+        lock_file = self.locked_files()
+        try:
+            if os.path.exists(self.filename):
+                logger.info("Loading leasequery snapshot %s", self.filename)
+                with open(self.filename, 'rb') as snapshot_file:
+                    version, clients = pickle.load(snapshot_file)
+
+                if version == SNAPSHOT_VERSION:
+                    for client in clients:
+                        self.restore_client(client)
+                else:
+                    logger.warning("Ignoring leasequery snapshot %s with unknown version %s", self.filename, version)
+
+            for journal_filename in (self.journal_filename + '.old', self.journal_filename):
+                if os.path.exists(journal_filename):
+                    logger.info("Replaying leasequery journal %s", journal_filename)
+                    self.replay_journal(journal_filename)
+
+            clients = self.capture()
+            self.write_snapshot(clients)
+
+            # Continue with exactly what is in the snapshot, without the clients whose leases have all expired
+            self.clear()
+            for client in clients:
+                self.restore_client(client)
+
+            old_journal_filename = self.journal_filename + '.old'
+            if os.path.exists(old_journal_filename):
+                os.unlink(old_journal_filename)
+
+            self.journal = open(self.journal_filename, 'wb')
+        finally:
+            os.close(lock_file)
+
+        logger.info("Leasequery store contains %d clients", len(self.clients))
+
+    def clear(self):
+        """
+        Forget all clients
+        """
+        self.clients.clear()
+        self.by_client_id.clear()
+        self.by_link_address.clear()
+        self.by_remote_id.clear()
+        self.by_relay_id.clear()
+        self.by_address.clear()
+        self.prefix_index = PrefixIndex()
+
+    def replay_journal(self, journal_filename: str):
+        """
+        Apply all updates in a journal. A journal that is cut short by a crash ends with an incomplete record, which
+        is ignored.
+
+        :param journal_filename: The name of the journal file
+        """
+        with open(journal_filename, 'rb') as journal:
+            while True:
+                try:
+                    update = LeaseUpdate(*pickle.load(journal))
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, TypeError, ValueError, AttributeError):
+                    logger.warning("Ignoring incomplete record at the end of leasequery journal %s", journal_filename)
+                    break
+
+                self.apply(update)
+
+    def capture(self) -> List[tuple]:
+        """
+        Capture the current state for a snapshot, leaving out expired leases and clients without leases
+
+        :return: The clients as tuples that can be pickled
+        """
+        now = int(time.time())
+        clients = []
+        for key, client in self.clients.items():
+            address_leases = [(address,) + lease for address, lease in client.addresses.items() if lease[1] >= now]
+            prefix_leases = [prefix + lease for prefix, lease in client.prefixes.items() if lease[1] >= now]
+            if not address_leases and not prefix_leases:
+                continue
+
+            clients.append((key[0], key[1], client.last_interaction, client.options, client.relay_data,
+                            tuple(client.remote_ids), tuple(client.relay_ids),
+                            tuple(address_leases), tuple(prefix_leases)))
+
+        return clients
+
+    def write_snapshot(self, clients: List[tuple]):
+        """
+        Write a snapshot to a temporary file and move it into place, so there is always a complete snapshot
+
+        :param clients: The captured clients
+        """
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'wb') as snapshot_file:
+            pickle.dump((SNAPSHOT_VERSION, clients), snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+
+        os.replace(temp_filename, self.filename)
+
+    def start_snapshot(self):
+        """
+        Remove expired leases, capture the current state and write it to a snapshot in the background. Updates from now
+        on go to a new journal, the old journal is removed when the snapshot is complete. If the previous snapshot
+        failed its old journal is still needed, so the current journal is added to it.
+        """
+        if self.snapshot_thread and self.snapshot_thread.is_alive():
+            # Still busy with the previous one
+            return
+
+        self.next_snapshot = time.monotonic() + self.snapshot_interval
+
+        removed = self.remove_all_expired()
+        if removed:
+            logger.debug("Removed %d leasequery clients without unexpired leases", removed)
+
+        clients = self.capture()
+        self.journal.close()
+
+        old_journal_filename = self.journal_filename + '.old'
+        if os.path.exists(old_journal_filename):
+            with open(self.journal_filename, 'rb') as journal, open(old_journal_filename, 'ab') as old_journal:
+                shutil.copyfileobj(journal, old_journal)
+                old_journal.flush()
+                os.fsync(old_journal.fileno())
+            os.unlink(self.journal_filename)
+        else:
+            os.replace(self.journal_filename, old_journal_filename)
+
+        self.journal = open(self.journal_filename, 'wb')
+
+        self.snapshot_thread = threading.Thread(target=self.run_snapshot, args=(clients,),
+                                                name='LeasequerySnapshot', daemon=True)
+        self.snapshot_thread.start()
+
+    def run_snapshot(self, clients: List[tuple]):
+        """
+        Write a snapshot while the workers continue. The journal of the updates since the capture must stay.
+
+        :param clients: The captured clients
+        """
+        lock_file = self.locked_files()
+        try:
+            self.write_snapshot(clients)
+            os.unlink(self.journal_filename + '.old')
+
+            logger.debug("Wrote leasequery snapshot with %d clients", len(clients))
+        except OSError as e:
+            logger.error("Could not write leasequery snapshot %s: %s", self.filename, e)
+        finally:
+            os.close(lock_file)
+
+    def restore_client(self, client: tuple):
+        """
+        Restore a client from a snapshot
+
+        :param client: The client as stored in the snapshot
+        """
+        (client_id, link_address, last_interaction, options, relay_data, remote_ids, relay_ids,
+         address_leases, prefix_leases) = client
+
+        self.apply(LeaseUpdate(client_id, link_address, last_interaction, options, relay_data,
+                               remote_ids, relay_ids, address_leases, prefix_leases))
+
+    def remember(self, update: tuple):
+        """
+        Remember a lease update from a worker
+
+        :param update: The lease update
+        """
+        with self.lock:
+            pickle.dump(tuple(update), self.journal, protocol=pickle.HIGHEST_PROTOCOL)
+            self.journal.flush()
+
+            self.apply(LeaseUpdate(*update))
+
+            if time.monotonic() >= self.next_snapshot:
+                self.start_snapshot()
+
+    def apply(self, update: LeaseUpdate):
+        """
+        Apply a lease update, with the same semantics as the SQLite store
+
+        :param update: The lease update
+        """
+        key = (update.client_id, update.link_address)
+        client = self.clients.get(key)
+        if client is None:
+            if not update.address_leases and not update.prefix_leases:
+                # Not interesting enough to create a record for
+                return
+
+            client = self.clients[key] = ClientRecord()
+            add_to_index(self.by_client_id, [update.client_id], key)
+            add_to_index(self.by_link_address, [update.link_address], key)
+
+        client.last_interaction = update.timestamp
+        client.options = update.options
+        client.relay_data = update.relay_data
+
+        remote_ids = frozenset(update.remote_ids)
+        if remote_ids != client.remote_ids:
+            remove_from_index(self.by_remote_id, client.remote_ids - remote_ids, key)
+            add_to_index(self.by_remote_id, remote_ids - client.remote_ids, key)
+            client.remote_ids = remote_ids
+
+        relay_ids = frozenset(update.relay_ids)
+        if relay_ids != client.relay_ids:
+            remove_from_index(self.by_relay_id, client.relay_ids - relay_ids, key)
+            add_to_index(self.by_relay_id, relay_ids - client.relay_ids, key)
+            client.relay_ids = relay_ids
+
+        for address, preferred_lifetime_end, valid_lifetime_end, options in update.address_leases:
+            # This newer lease overrides the same address of another client
+            owner = self.by_address.get(address)
+            if owner is not None and owner != key:
+                del self.clients[owner].addresses[address]
+
+            self.by_address[address] = key
+            client.addresses[address] = (preferred_lifetime_end, valid_lifetime_end, options)
+
+        for first_address, last_address, preferred_lifetime_end, valid_lifetime_end, options in update.prefix_leases:
+            # This newer lease overrides overlapping prefixes of other clients
+            first, last = prefix_range(first_address, last_address)
+            for other_first, other_last, owner in self.prefix_index.overlapping(first, last):
+                if owner != key:
+                    self.prefix_index.remove(other_first, other_last)
+                    del self.clients[owner].prefixes[(IPv6Address(other_first).exploded,
+                                                      IPv6Address(other_last).exploded)]
+
+            self.prefix_index.add(first, last, key)
+            client.prefixes[(first_address, last_address)] = (preferred_lifetime_end, valid_lifetime_end, options)
+
+        self.remove_expired(key, client)
+
+    def remove_expired(self, key: ClientKey, client: ClientRecord):
+        """
+        Remove the expired leases of a client.
+
+        :param key: The key of the client
+        :param client: The client record
+        """
+        now = int(time.time())
+
+        for address, lease in list(client.addresses.items()):
+            if lease[1] < now:
+                del client.addresses[address]
+                del self.by_address[address]
+
+        for prefix, lease in list(client.prefixes.items()):
+            if lease[1] < now:
+                del client.prefixes[prefix]
+                self.prefix_index.remove(*prefix_range(*prefix))
+
+    def remove_all_expired(self) -> int:
+        """
+        Remove the expired leases of all clients, and the clients that have no leases left. Otherwise clients are only
+        cleaned up when they are updated, and clients that never come back would stay forever.
+
+        :return: The number of removed clients
+        """
+        removed = 0
+        for key, client in list(self.clients.items()):
+            self.remove_expired(key, client)
+            if not client.addresses and not client.prefixes:
+                remove_from_index(self.by_client_id, [key[0]], key)
+                remove_from_index(self.by_link_address, [key[1]], key)
+                remove_from_index(self.by_remote_id, client.remote_ids, key)
+                remove_from_index(self.by_relay_id, client.relay_ids, key)
+                del self.clients[key]
+                removed += 1
+
+        return removed
+
+    def find_keys(self, query_type: int, value: Optional[str], link_address: Optional[str]) -> Iterable[ClientKey]:
+        """
+        Find the clients that match a query
+
+        :param query_type: The type of query
+        :param value: The address, client-id, relay-id or remote-id to look for in stored form
+        :param link_address: Only find clients on this link, if given
+        :return: The keys of the clients
+        """
+        if query_type == QUERY_BY_ADDRESS:
+            keys = set()
+            owner = self.by_address.get(value)
+            if owner is not None:
+                keys.add(owner)
+            for first, last, owner in self.prefix_index.containing(int(IPv6Address(value))):
+                keys.add(owner)
+        elif query_type == QUERY_BY_CLIENT_ID:
+            keys = self.by_client_id.get(value, ())
+        elif query_type == QUERY_BY_RELAY_ID:
+            keys = self.by_relay_id.get(value, ())
+        elif query_type == QUERY_BY_REMOTE_ID:
+            keys = self.by_remote_id.get(value, ())
+        elif query_type == QUERY_BY_LINK_ADDRESS:
+            if link_address is None:
+                # Query by link-address with an unspecified address, I guess that means all leases
+                return list(self.clients)
+
+            return list(self.by_link_address.get(link_address, ()))
+        else:
+            return []
+
+        if link_address is not None:
+            return [key for key in keys if key[1] == link_address]
+
+        return list(keys)
+
+    def find_clients(self, query_type: int, value: Optional[str], link_address: Optional[str]) -> List[StoredClient]:
+        """
+        Find the clients that match a query and return their unexpired leases
+
+        :param query_type: The type of query
+        :param value: The address, client-id, relay-id or remote-id to look for in stored form
+        :param link_address: Only find clients on this link, if given
+        :return: The data of the clients
+        """
+        with self.lock:
+            now = int(time.time())
+
+            found = []
+            for key in self.find_keys(query_type, value, link_address):
+                client = self.clients[key]
+                found.append(StoredClient(
+                    key[0], key[1], client.last_interaction, client.options, client.relay_data,
+                    tuple((address,) + lease for address, lease in client.addresses.items() if lease[1] > now),
+                    tuple(prefix + lease for prefix, lease in client.prefixes.items() if lease[1] > now),
+                ))
+
+            return found
+
+
+def init_manager_process(logging_queue, lowest_log_level: int):
+    """
+    Send the log records of the manager process to the main process, and leave signals to the main process.
+
+    :param logging_queue: The queue to send the log records to, if any
+    :param lowest_log_level: The lowest log level that is going to be handled by the main process
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    log_to_main_process(logging_queue, lowest_log_level)
+
+
+class LeasequeryMemoryManager(BaseManager):
+    """
+    A custom manager that manages the shared leasequery data
+    """
+
+    def start(self, initializer=None, initargs=()):
+        """
+        Start the leasequery data manager
+        """
+        super().start(initializer=init_manager_process, initargs=get_main_logging_queue())
+
+
+LeasequeryMemoryManager.register('LeasequeryMemoryData', LeasequeryMemoryData)
+
+
+class LeasequeryMemoryStore(LeasequeryStore):
+    """
+    A leasequery store that keeps all leases in memory, in a process that is shared by all workers.
+    """
+
+    def __init__(self, filename: str, snapshot_interval: float = 300):
+        """
+        Start the manager process and load the leases.
+
+        :param filename: The name of the snapshot file, the journal is stored next to it
+        :param snapshot_interval: The number of seconds between snapshots
+        """
+        super().__init__()
+
+        self.filename = filename
+        """Name of the snapshot file"""
+
+        self.manager = LeasequeryMemoryManager()
+        self.manager.start()
+
+        # noinspection PyUnresolvedReferences
+        self.data = self.manager.LeasequeryMemoryData(filename, snapshot_interval)
+        """The proxy of the shared data"""
+
+    def __getstate__(self):
+        # The manager only exists in the main process, workers only need the proxy
+        state = self.__dict__.copy()
+        state['manager'] = None
+        return state
+
+    def remember_lease(self, bundle: TransactionBundle):
+        """
+        Remember the leases in the given transaction bundle so they can be queried later.
+
+        :param bundle: The transaction to remember
+        """
+        self.data.remember(tuple(self.build_lease_update(bundle)))
+
+    def find_leases(self, query: LQQueryOption) -> Tuple[int, Iterable[Tuple[IPv6Address, ClientDataOption]]]:
+        """
+        Find all leases that match the given query.
+
+        :param query: The query
+        :return: The number of leases and an iterator over tuples of link-address and corresponding client data
+        """
+        if query.query_type == QUERY_BY_ADDRESS:
+            address_option = query.get_option_of_type(IAAddressOption)
+            if not address_option:
+                raise ReplyWithLeasequeryError(STATUS_MALFORMED_QUERY, "Address queries must contain an address")
+
+            value = address_option.address.exploded
+        elif query.query_type == QUERY_BY_CLIENT_ID:
+            client_id_option = query.get_option_of_type(ClientIdOption)
+            if not client_id_option:
+                raise ReplyWithLeasequeryError(STATUS_MALFORMED_QUERY, "Client-ID queries must contain a client ID")
+
+            value = self.encode_duid(client_id_option.duid)
+        elif query.query_type == QUERY_BY_RELAY_ID:
+            relay_id_option = query.get_option_of_type(RelayIdOption)
+            if not relay_id_option:
+                raise ReplyWithLeasequeryError(STATUS_MALFORMED_QUERY, "Relay-ID queries must contain a relay ID")
+
+            value = self.encode_duid(relay_id_option.duid)
+        elif query.query_type == QUERY_BY_REMOTE_ID:
+            remote_id_option = query.get_option_of_type(RemoteIdOption)
+            if not remote_id_option:
+                raise ReplyWithLeasequeryError(STATUS_MALFORMED_QUERY, "Remote-ID queries must contain a remote ID")
+
+            value = self.encode_remote_id(remote_id_option)
+        elif query.query_type == QUERY_BY_LINK_ADDRESS:
+            value = None
+        else:
+            # We can't handle this query
+            return -1, []
+
+        link_address = None if query.link_address.is_unspecified else query.link_address.exploded
+        clients = self.data.find_clients(query.query_type, value, link_address)
+        if not clients:
+            # None found
+            return 0, []
+
+        oro = query.get_option_of_type(OptionRequestOption)
+        requested_options = oro.requested_options if oro else []
+        return len(clients), self.generate_client_data_options(clients, requested_options)
+
+    def generate_client_data_options(self, clients: Iterable[StoredClient], requested_options: Iterable[int]) \
+            -> Iterable[Tuple[IPv6Address, ClientDataOption]]:
+        """
+        Create a generator for the data of the specified clients
+
+        :param clients: The clients that we are interested in
+        :param requested_options: Option types explicitly requested by the leasequery client
+        :return: The client data options for those clients
+        """
+        relay_data_requested = OPTION_LQ_RELAY_DATA in requested_options
+        extra_data_requested = any([requested_option for requested_option in requested_options
+                                    if requested_option != OPTION_LQ_RELAY_DATA])
+
+        now = int(time.time())
+        for client in clients:
+            options = [ClientIdOption(self.decode_duid(client.client_id)),
+                       CLTTimeOption(now - client.last_interaction)]  # type: List[Option]
+
+            if extra_data_requested:
+                options += self.filter_requested_options(self.decode_options(client.options), requested_options)
+
+            if relay_data_requested:
+                relay_data_option = self.build_relay_data_option_from_relay_data(client.relay_data)
+                if relay_data_option:
+                    options.append(relay_data_option)
+
+            for address, preferred_lifetime_end, valid_lifetime_end, address_options in client.address_leases:
+                options.append(IAAddressOption(address=IPv6Address(address),
+                                               preferred_lifetime=max(0, preferred_lifetime_end - now),
+                                               valid_lifetime=max(0, valid_lifetime_end - now),
+                                               options=self.decode_options(address_options)))
+
+            for first_address, last_address, preferred_lifetime_end, valid_lifetime_end, prefix_options \
+                    in client.prefix_leases:
+                first, last = prefix_range(first_address, last_address)
+                options.append(IAPrefixOption(prefix=IPv6Network((first, 128 - (last - first).bit_length())),
+                                              preferred_lifetime=max(0, preferred_lifetime_end - now),
+                                              valid_lifetime=max(0, valid_lifetime_end - now),
+                                              options=self.decode_options(prefix_options)))
+
+            yield IPv6Address(client.link_address), ClientDataOption(options)
@@ -4,7 +4,9 @@ SQLIte based implementation of a leasequery store
 import logging
 import sqlite3
 import time
+from collections import defaultdict
 from ipaddress import IPv6Address, summarize_address_range
+from itertools import chain, islice
 
 from typing import Iterable, Iterator, List, Optional, Tuple
 
@@ -15,21 +17,34 @@ from dhcpkit.ipv6.extensions.leasequery import CLTTimeOption, ClientDataOption,
     QUERY_BY_ADDRESS, QUERY_BY_CLIENT_ID, STATUS_MALFORMED_QUERY
 from dhcpkit.ipv6.extensions.prefix_delegation import IAPrefixOption
 from dhcpkit.ipv6.extensions.remote_id import RemoteIdOption
-from dhcpkit.ipv6.messages import RebindMessage, RelayForwardMessage, RenewMessage, RequestMessage, SolicitMessage
 from dhcpkit.ipv6.options import ClientIdOption, IAAddressOption, Option, OptionRequestOption
-from dhcpkit.ipv6.server.extensions.leasequery import LeasequeryStore
+from dhcpkit.ipv6.server.extensions.leasequery import AddressLease, LeaseUpdate, LeasequeryStore, PrefixLease
+from dhcpkit.ipv6.server.extensions.leasequery.sqlite_cache import LeasequerySqliteWriteCache
+from dhcpkit.ipv6.server.extensions.leasequery.sqlite_expiry import LeasequerySqliteExpiry
+from dhcpkit.ipv6.server.extensions.leasequery.sqlite_writer import LeasequerySqliteWriter
 from dhcpkit.ipv6.server.handlers import ReplyWithLeasequeryError
 from dhcpkit.ipv6.server.transaction_bundle import TransactionBundle
 
 logger = logging.getLogger(__name__)
 
-
 class LeasequerySqliteStore(LeasequeryStore):
     """
     A leasequery store using a SQLite database.
     """
 
-    def __init__(self, filename: str):
+    client_data_chunk_size = 100
+    """The number of clients whose data is fetched from the database at once when answering a query"""
+
+    def __init__(self, filename: str, writer: LeasequerySqliteWriter = None, expiry: LeasequerySqliteExpiry = None,
+                 write_cache: LeasequerySqliteWriteCache = None):
+        """
+        Prepare the database.
+
+        :param filename: The name of the database file
+        :param writer: The writer process to send lease updates to, or None to let the workers write them
+        :param expiry: The timer that removes expired leases in the background, or None to only do that at startup
+        :param write_cache: The cache used to skip lease updates that don't change anything, or None to write them all
+        """
         super().__init__()
 
         self.sqlite_filename = filename
@@ -44,6 +59,21 @@ class LeasequerySqliteStore(LeasequeryStore):
         # These options are not allowed to be stored
         self.sensitive_options = []
 
+        self.write_cache = write_cache
+        """The last written state of recently seen clients, every process that writes keeps its own"""
+
+        self.writer = writer
+        """The writer process that applies the lease updates of all workers, if enabled"""
+
+        if self.writer:
+            self.writer.start(self)
+
+        self.expiry = expiry
+        """The timer that removes expired leases in the background, if enabled"""
+
+        if self.expiry:
+            self.expiry.start(self)
+
     def worker_init(self, sensitive_options: Iterable[int]):
         """
         Worker initialisation: open database connection
@@ -60,8 +90,11 @@ class LeasequerySqliteStore(LeasequeryStore):
         :return: The database connection
         """
         try:
-            logger.info("Opening Leasequery SQLite database {}".format(self.sqlite_filename))
+            logger.info("Opening Leasequery SQLite database %s", self.sqlite_filename)
             db = sqlite3.connect(self.sqlite_filename, isolation_level="IMMEDIATE")
+
+            # This only has effect on a new database, and must be set before anything is written to it
+            db.execute("PRAGMA auto_vacuum = INCREMENTAL")
             db.execute("PRAGMA journal_mode = WAL")
             db.execute("PRAGMA foreign_keys = ON")
 
@@ -77,44 +110,102 @@ class LeasequerySqliteStore(LeasequeryStore):
 
         :param bundle: The transaction to remember
         """
+        update = self.build_lease_update(bundle)
+
+        if self.writer:
+            self.writer.put(update)
+        else:
+            try:
+                with self.db:
+                    self.apply_lease_update(update)
+            except sqlite3.Error:
+                # The cache might remember things that were rolled back
+                if self.write_cache:
+                    self.write_cache.clear()
+                raise
+
+    def apply_lease_update(self, update: LeaseUpdate):
         """
-        Remember the leases in the given transaction bundle so they can be queried later.
+        Apply a lease update to the database. The caller is responsible for the transaction, so that the writer process
+        can apply many updates in a single transaction.
 
-        :param bundle: The transaction to remember
+        :param update: The update to apply
         """
-        # Client identification fields
-        client_id_option = bundle.request.get_option_of_type(ClientIdOption)
-        client_id_str = self.encode_duid(client_id_option.duid)
-        link_address_long = bundle.link_address.exploded
+        # Is this client interesting enough to create a record for if it doesn't exist?
+        interesting_client = bool(update.address_leases or update.prefix_leases)
 
-        # Gather addresses and prefixes
-        address_leases = []
-        prefix_leases = []
-        if isinstance(bundle.request, (SolicitMessage, RequestMessage, RenewMessage, RebindMessage)):
-            if self.is_accepted(bundle.response):
-                # These messages update leases, so we need to process the result
-                address_leases = list(self.get_address_leases(bundle))
-                prefix_leases = list(self.get_prefix_leases(bundle))
+        if self.write_cache and interesting_client:
+            if not self.writer:
+                # Other workers write to the database as well
+                self.write_cache.check_data_version(self.db)
 
-        # Is this client interesting enough to create a record for if it doesn't exist?
-        interesting_client = bool(address_leases or prefix_leases)
+            # See if we can skip this update, or only have to update the lifetimes
+            now = int(time.time())
+            cached_client = self.write_cache.lookup(update, now)
+            if cached_client:
+                if self.write_cache.is_current(cached_client, update, now):
+                    logger.log(DEBUG_HANDLING, "Skipping unchanged lease update for client %s",
+                               cached_client.client_row_id)
+                    return
+
+                if self.update_lifetimes(cached_client.client_row_id, update):
+                    self.write_cache.remember(update, cached_client.client_row_id)
+                    return
+
+                # Some of the leases have disappeared, do a full update
+                self.write_cache.forget(update.client_id, update.link_address)
+
+        elif self.write_cache:
+            # Updates without leases aren't cached, so the cache doesn't know about the changes they make
+            self.write_cache.forget(update.client_id, update.link_address)
 
         # Get the row id for this client, creating it if necessary
-        client_row_id = self.get_client_row_id(client_id_str, link_address_long, create=interesting_client)
+        client_row_id = self.get_client_row_id(update.client_id, update.link_address, create=interesting_client)
         if client_row_id is None:
             # No client row, nothing else to do
             return
 
         # Keep track of when we last communicated with this client
-        self.update_last_interaction(client_row_id, bundle.response.options, bundle.incoming_relay_messages[-1])
+        self.update_last_interaction(client_row_id, update.timestamp, update.options, update.relay_data)
 
         # Keep track of where the last request came from
-        self.replace_remote_ids(client_row_id, self.get_remote_ids(bundle))
-        self.replace_relay_ids(client_row_id, self.get_relay_ids(bundle))
+        self.replace_remote_ids(client_row_id, update.remote_ids)
+        self.replace_relay_ids(client_row_id, update.relay_ids)
 
         # These messages update leases, so we need to process the result
-        self.update_address_leases(client_row_id, address_leases)
-        self.update_prefix_leases(client_row_id, prefix_leases)
+        self.update_address_leases(client_row_id, update.address_leases)
+        self.update_prefix_leases(client_row_id, update.prefix_leases)
+
+        if self.write_cache and interesting_client:
+            self.write_cache.remember(update, client_row_id)
+
+    def update_lifetimes(self, client_row_id: int, update: LeaseUpdate) -> bool:
+        """
+        Only update the last interaction and the lifetimes of the leases, for when nothing else has changed.
+
+        :param client_row_id: The row id of the client
+        :param update: The update to apply
+        :return: Whether all the leases were still in the database
+        """
+        logger.log(DEBUG_HANDLING, "Updating lifetimes for client %s", client_row_id)
+        self.db.execute("UPDATE clients SET last_interaction=? WHERE id=?", (update.timestamp, client_row_id))
+
+        for address, preferred_lifetime_end, valid_lifetime_end, options in update.address_leases:
+            cur = self.db.execute("UPDATE addresses SET preferred_lifetime_end=?, valid_lifetime_end=? "
+                                  "WHERE client_fk=? AND address=?",
+                                  (preferred_lifetime_end, valid_lifetime_end, client_row_id, address))
+            if cur.rowcount != 1:
+                return False
+
+        for first_address, last_address, preferred_lifetime_end, valid_lifetime_end, options in update.prefix_leases:
+            cur = self.db.execute("UPDATE prefixes SET preferred_lifetime_end=?, valid_lifetime_end=? "
+                                  "WHERE client_fk=? AND first_address=? AND last_address=?",
+                                  (preferred_lifetime_end, valid_lifetime_end, client_row_id,
+                                   first_address, last_address))
+            if cur.rowcount != 1:
+                return False
+
+        return True
 
     def find_leases(self, query: LQQueryOption) -> Tuple[int, Iterable[Tuple[IPv6Address, ClientDataOption]]]:
         """
@@ -139,21 +230,45 @@ class LeasequerySqliteStore(LeasequeryStore):
                 # We can't handle this query
                 return -1, []
 
-            if not client_row_ids:
-                # None found
-                return 0, []
-
-            # Generate records for these client IDs
-            oro = query.get_option_of_type(OptionRequestOption)
-            requested_options = oro.requested_options if oro else []
-            return len(client_row_ids), self.generate_client_data_options(client_row_ids, requested_options)
+        # Only look ahead far enough to see whether there are none, one or more clients. The rest is streamed from the
+        # database while the response is being sent, so the first data message can go out before all are read.
+        client_row_ids = iter(client_row_ids)
+        first_client_row_ids = list(islice(client_row_ids, 2))
+        if not first_client_row_ids:
+            # None found
+            return 0, []
+
+        # Generate records for these client IDs
+        oro = query.get_option_of_type(OptionRequestOption)
+        requested_options = oro.requested_options if oro else []
+        return len(first_client_row_ids), self.generate_client_data_options(chain(first_client_row_ids,
+                                                                                  client_row_ids),
+                                                                            requested_options)
 
     def generate_client_data_options(self, client_row_ids: Iterable[int], requested_options: Iterable[int]) \
-            -> Iterable[Tuple[IPv6Address, ClientDataOption]]:
+            -> Iterator[Tuple[IPv6Address, ClientDataOption]]:
         """
-        Create a generator for the data of the specified client rows/
+        Create a generator for the data of the specified client rows. The row ids are read in chunks, and the data of
+        each chunk is fetched with one query per table, so memory use doesn't depend on the number of clients.
 
-        :param client_row_ids: The list of client rows what we are interested in
+        :param client_row_ids: The row ids of the clients what we are interested in
+        :param requested_options: Option types explicitly requested by the leasequery client
+        :return: The client data options for those rows
+        """
+        client_row_ids = iter(client_row_ids)
+        while True:
+            chunk = list(islice(client_row_ids, self.client_data_chunk_size))
+            if not chunk:
+                break
+
+            yield from self.generate_client_data_chunk(chunk, requested_options)
+
+    def generate_client_data_chunk(self, client_row_ids: List[int], requested_options: Iterable[int]) \
+            -> Iterator[Tuple[IPv6Address, ClientDataOption]]:
+        """
+        Create a generator for the data of one chunk of client rows.
+
+        :param client_row_ids: The row ids of the clients in this chunk
         :param requested_options: Option types explicitly requested by the leasequery client
         :return: The client data options for those rows
         """
@@ -170,9 +285,49 @@ class LeasequerySqliteStore(LeasequeryStore):
             selected_columns.append("relay_data")
 
         now = int(time.time())
-        client_cur = self.db.execute("SELECT {} FROM clients WHERE id IN ({})".format(
-            ', '.join(selected_columns),
-            ', '.join(map(str, client_row_ids))))
+        placeholders = ', '.join(['?'] * len(client_row_ids))
+
+        # Get all addresses of this chunk
+        address_options = defaultdict(list)
+        address_cur = self.db.execute("SELECT client_fk, address, preferred_lifetime_end, valid_lifetime_end, options "
+                                      "FROM addresses WHERE client_fk IN ({}) AND valid_lifetime_end>?"
+                                      .format(placeholders),
+                                      client_row_ids + [now])
+        for address_row in address_cur:
+            address_options[address_row['client_fk']].append(
+                IAAddressOption(address=IPv6Address(address_row['address']),
+                                preferred_lifetime=max(0, address_row['preferred_lifetime_end'] - now),
+                                valid_lifetime=max(0, address_row['valid_lifetime_end'] - now),
+                                options=self.decode_options(address_row['options']))
+            )
+
+        # Get all prefixes of this chunk
+        prefix_options = defaultdict(list)
+        prefix_cur = self.db.execute("SELECT client_fk, first_address, last_address, "
+                                     "preferred_lifetime_end, valid_lifetime_end, options "
+                                     "FROM prefixes WHERE client_fk IN ({}) AND valid_lifetime_end>?"
+                                     .format(placeholders),
+                                     client_row_ids + [now])
+        for prefix_row in prefix_cur:
+            prefixes = list(summarize_address_range(
+                IPv6Address(prefix_row['first_address']),
+                IPv6Address(prefix_row['last_address'])
+            ))
+            if len(prefixes) != 1:
+                logger.error("Ignoring invalid prefix range in leasequery db: %s - %s", prefix_row['first_address'],
+                             prefix_row['last_address'])
+                continue
+
+            prefix_options[prefix_row['client_fk']].append(
+                IAPrefixOption(prefix=prefixes[0],
+                               preferred_lifetime=max(0, prefix_row['preferred_lifetime_end'] - now),
+                               valid_lifetime=max(0, prefix_row['valid_lifetime_end'] - now),
+                               options=self.decode_options(prefix_row['options']))
+            )
+
+        client_cur = self.db.execute("SELECT {} FROM clients WHERE id IN ({})".format(', '.join(selected_columns),
+                                                                                     placeholders),
+                                     client_row_ids)
         for client_row in client_cur:
             # This is the first part of the tuple we yield
             link_address = IPv6Address(client_row['link_address'])
@@ -202,45 +357,19 @@ class LeasequerySqliteStore(LeasequeryStore):
             if relay_data_option:
                 options.append(relay_data_option)
 
-            # Add all addresses
-            address_cur = self.db.execute("SELECT address, preferred_lifetime_end, valid_lifetime_end, options "
-                                          "FROM addresses WHERE client_fk=? AND valid_lifetime_end>?",
-                                          (client_row['id'], now))
-            for address_row in address_cur:
-                options.append(IAAddressOption(address=IPv6Address(address_row['address']),
-                                               preferred_lifetime=max(0, address_row['preferred_lifetime_end'] - now),
-                                               valid_lifetime=max(0, address_row['valid_lifetime_end'] - now),
-                                               options=self.decode_options(address_row['options'])))
-
-            # Add all prefixes
-            prefix_cur = self.db.execute("SELECT first_address, last_address, "
-                                         "preferred_lifetime_end, valid_lifetime_end, options "
-                                         "FROM prefixes WHERE client_fk=? AND valid_lifetime_end>?",
-                                         (client_row['id'], now))
-            for prefix_row in prefix_cur:
-                prefixes = list(summarize_address_range(
-                    IPv6Address(prefix_row['first_address']),
-                    IPv6Address(prefix_row['last_address'])
-                ))
-                if len(prefixes) != 1:
-                    logger.error("Ignoring invalid prefix range in leasequery db: {} - {}".format(
-                        prefix_row['first_address'], prefix_row['last_address']))
-                    continue
-
-                options.append(IAPrefixOption(prefix=prefixes[0],
-                                              preferred_lifetime=max(0, prefix_row['preferred_lifetime_end'] - now),
-                                              valid_lifetime=max(0, prefix_row['valid_lifetime_end'] - now),
-                                              options=self.decode_options(prefix_row['options'])))
+            # Add all addresses and prefixes
+            options += address_options[client_row['id']]
+            options += prefix_options[client_row['id']]
 
             # We got everything, yield it
             yield link_address, ClientDataOption(options)
 
-    def find_client_by_address(self, query: LQQueryOption) -> List[int]:
+    def find_client_by_address(self, query: LQQueryOption) -> Iterator[int]:
         """
         Get the row ids of the clients we want to return.
 
         :param query: The query
-        :return: A list of row ids
+        :return: An iterator over the row ids, streamed from the database
         """
         # Get the requested address from the query
         address_option = query.get_option_of_type(IAAddressOption)
@@ -249,29 +378,53 @@ class LeasequerySqliteStore(LeasequeryStore):
 
         address = address_option.address.exploded
 
+        # Look up the prefixes that could contain this address by their exact range
+        prefix_ranges = self.get_containing_prefix_ranges(address_option.address)
+        prefix_condition = ' OR '.join(['(first_address=? AND last_address=?)'] * len(prefix_ranges)) or '0'
+        prefix_parameters = [boundary for prefix_range in prefix_ranges for boundary in prefix_range]
+
         if query.link_address.is_unspecified:
             cur = self.db.execute("SELECT client_fk FROM addresses WHERE address=?"
                                   " UNION "
-                                  "SELECT client_fk FROM prefixes WHERE ? BETWEEN first_address AND last_address",
-                                  (address, address))
-            return [row['client_fk'] for row in cur]
+                                  "SELECT client_fk FROM prefixes WHERE " + prefix_condition,
+                                  [address] + prefix_parameters)
+            return (row['client_fk'] for row in cur)
         else:
             cur = self.db.execute(
                 "SELECT id FROM clients WHERE link_address=? AND ("
                 "id IN (SELECT client_fk FROM addresses WHERE address=?)"
                 " OR "
-                "id IN (SELECT client_fk FROM prefixes WHERE ? BETWEEN first_address AND last_address)"
+                "id IN (SELECT client_fk FROM prefixes WHERE " + prefix_condition + ")"
                 ")",
-                (query.link_address.exploded, address, address)
+                [query.link_address.exploded, address] + prefix_parameters
             )
-            return [row['id'] for row in cur]
+            return (row['id'] for row in cur)
+
+    def get_containing_prefix_ranges(self, address: IPv6Address) -> List[Tuple[str, str]]:
+        """
+        Delegated prefixes are aligned, so a prefix of a given length that contains the address can only have one
+        first and last address. Determine those for every prefix length in the database, so that the prefixes can be
+        found with exact lookups instead of scanning all prefixes that start before the address.
+
+        :param address: The address to look for
+        :return: The first and last address of every prefix that could contain the address, in stored form
+        """
+        address = int(address)
 
-    def find_client_by_client_id(self, query: LQQueryOption) -> List[int]:
+        prefix_ranges = []
+        for row in self.db.execute("SELECT host_bits FROM prefix_lengths"):
+            first = address >> row['host_bits'] << row['host_bits']
+            last = first | ((1 << row['host_bits']) - 1)
+            prefix_ranges.append((IPv6Address(first).exploded, IPv6Address(last).exploded))
+
+        return prefix_ranges
+
+    def find_client_by_client_id(self, query: LQQueryOption) -> Iterator[int]:
         """
         Get the row ids of the clients we want to return.
 
         :param query: The query
-        :return: A list of row ids
+        :return: An iterator over the row ids, streamed from the database
         """
         # Get the requested client ID from the query
         client_id_option = query.get_option_of_type(ClientIdOption)
@@ -287,14 +440,14 @@ class LeasequerySqliteStore(LeasequeryStore):
             cur = self.db.execute("SELECT id FROM clients WHERE client_id=? AND link_address=?",
                                   (client_id_str, query.link_address.exploded))
 
-        return [row['id'] for row in cur]
+        return (row['id'] for row in cur)
 
-    def find_client_by_relay_id(self, query: LQQueryOption) -> List[int]:
+    def find_client_by_relay_id(self, query: LQQueryOption) -> Iterator[int]:
         """
         Get the row ids of the clients we want to return.
 
         :param query: The query
-        :return: A list of row ids
+        :return: An iterator over the row ids, streamed from the database
         """
         # Get the requested relay ID from the query
         relay_id_option = query.get_option_of_type(RelayIdOption)
@@ -307,20 +460,20 @@ class LeasequerySqliteStore(LeasequeryStore):
             cur = self.db.execute("SELECT client_fk FROM relay_ids WHERE relay_id=?",
                                   (relay_id_str,))
 
-            return [row['client_fk'] for row in cur]
+            return (row['client_fk'] for row in cur)
         else:
             cur = self.db.execute("SELECT id FROM clients "
                                   "WHERE link_address=? AND id IN (SELECT client_fk FROM relay_ids WHERE relay_id=?)",
                                   (query.link_address.exploded, relay_id_str))
 
-            return [row['id'] for row in cur]
+            return (row['id'] for row in cur)
 
-    def find_client_by_link_address(self, query: LQQueryOption) -> List[int]:
+    def find_client_by_link_address(self, query: LQQueryOption) -> Iterator[int]:
         """
         Get the row ids of the clients we want to return.
 
         :param query: The query
-        :return: A list of row ids
+        :return: An iterator over the row ids, streamed from the database
         """
         if query.link_address.is_unspecified:
             # Query by link-address with an unspecified address, I guess that means all leases
@@ -329,14 +482,14 @@ class LeasequerySqliteStore(LeasequeryStore):
             cur = self.db.execute("SELECT id FROM clients WHERE link_address=?",
                                   (query.link_address.exploded,))
 
-        return [row['id'] for row in cur]
+        return (row['id'] for row in cur)
 
-    def find_client_by_remote_id(self, query: LQQueryOption) -> List[int]:
+    def find_client_by_remote_id(self, query: LQQueryOption) -> Iterator[int]:
         """
         Get the row ids of the clients we want to return.
 
         :param query: The query
-        :return: A list of row ids
+        :return: An iterator over the row ids, streamed from the database
         """
         # Get the requested remote ID from the query
         remote_id_option = query.get_option_of_type(RemoteIdOption)
@@ -349,13 +502,13 @@ class LeasequerySqliteStore(LeasequeryStore):
             cur = self.db.execute("SELECT client_fk FROM remote_ids WHERE remote_id=?",
                                   (remote_id_str,))
 
-            return [row['client_fk'] for row in cur]
+            return (row['client_fk'] for row in cur)
         else:
             cur = self.db.execute("SELECT id FROM clients "
                                   "WHERE link_address=? AND id IN (SELECT client_fk FROM remote_ids WHERE remote_id=?)",
                                   (query.link_address.exploded, remote_id_str))
 
-            return [row['id'] for row in cur]
+            return (row['id'] for row in cur)
 
     def get_client_row_id(self, client_id_str: str, link_address_long: str, create: bool = True) -> Optional[int]:
         """
@@ -366,33 +519,31 @@ class LeasequerySqliteStore(LeasequeryStore):
         :param create: Should we create this record if it doesn't exist?
         :return: The row id
         """
-        with self.db:
-            if create:
-                # First make sure we have the client in our database
-                cur = self.db.execute("INSERT OR IGNORE INTO clients(client_id, link_address) "
-                                      "VALUES (?, ?)", (client_id_str, link_address_long))
-                if cur.rowcount == 1 and cur.lastrowid > 0:
-                    # We already know the new id
-                    return cur.lastrowid
-
-            # We don't know the id yet, go get it
-            cur = self.db.execute("SELECT id FROM clients WHERE client_id=? AND link_address=?",
-                                  (client_id_str, link_address_long))
-            row = cur.fetchone()
-            return row['id'] if row else None
+        if create:
+            # First make sure we have the client in our database
+            cur = self.db.execute("INSERT OR IGNORE INTO clients(client_id, link_address) "
+                                  "VALUES (?, ?)", (client_id_str, link_address_long))
+            if cur.rowcount == 1 and cur.lastrowid > 0:
+                # We already know the new id
+                return cur.lastrowid
+
+        # We don't know the id yet, go get it
+        cur = self.db.execute("SELECT id FROM clients WHERE client_id=? AND link_address=?",
+                              (client_id_str, link_address_long))
+        row = cur.fetchone()
+        return row['id'] if row else None
 
-    def update_last_interaction(self, client_row_id: int, options: Iterable[Option],
-                                relay_chain: Optional[RelayForwardMessage]):
+    def update_last_interaction(self, client_row_id: int, timestamp: int, options: bytes, relay_data: bytes):
         """
         Keep track of when we last communicated with this client.
 
         :param client_row_id: The row id of the client
-        :param options: Options of the last response
-        :param relay_chain: The incoming relay messages
+        :param timestamp: The time of the last response
+        :param options: Encoded options of the last response
+        :param relay_data: Encoded incoming relay messages
         """
         self.db.execute("UPDATE clients SET last_interaction=?, options=?, relay_data=? WHERE id=?",
-                        (int(time.time()), self.encode_options(options), self.encode_relay_messages(relay_chain),
-                         client_row_id,))
+                        (timestamp, options, relay_data, client_row_id))
 
     def replace_remote_ids(self, client_row_id: int, remote_ids: Iterable[str]):
         """
@@ -402,29 +553,29 @@ class LeasequerySqliteStore(LeasequeryStore):
         :param remote_ids: The new remote-ids
         """
         remote_ids = list(remote_ids)
-        with self.db:
-            # First see what we already have
-            rows = self.db.execute("SELECT remote_id FROM remote_ids WHERE client_fk=?", (client_row_id,))
-            for row in rows:
-                if row['remote_id'] in remote_ids:
-                    # New remote-id is already in the database, no need to do anything
-                    logger.log(DEBUG_HANDLING, "Keeping existing row in remote_ids "
-                                               "for client {} remote-id {}".format(client_row_id, row['remote_id']))
-                    remote_ids.remove(row['remote_id'])
-                else:
-                    # Record in the database is not what we want, delete it
-                    logger.log(DEBUG_HANDLING, "Deleting row from remote_ids "
-                                               "for client {} remote-id {}".format(client_row_id, row['remote_id']))
-                    self.db.execute("DELETE FROM remote_ids "
-                                    "WHERE client_fk=? AND remote_id=?", (client_row_id, row['remote_id']))
-
-            # Now create the ones we don't already have
-            for remote_id in remote_ids:
-                # Ignore if it already exists. Shouldn't happen, but better safe than sorry
-                logger.log(DEBUG_HANDLING, "Insert row into remote_ids "
-                                           "for client {} remote-id {}".format(client_row_id, remote_id))
-                self.db.execute("INSERT OR IGNORE INTO remote_ids (client_fk, remote_id) "
-                                "VALUES (?, ?)", (client_row_id, remote_id))
+
+        # First see what we already have
+        rows = self.db.execute("SELECT remote_id FROM remote_ids WHERE client_fk=?", (client_row_id,))
+        for row in rows:
+            if row['remote_id'] in remote_ids:
+                # New remote-id is already in the database, no need to do anything
+                logger.log(DEBUG_HANDLING, "Keeping existing row in remote_ids for client %s remote-id %s",
+                           client_row_id, row['remote_id'])
+                remote_ids.remove(row['remote_id'])
+            else:
+                # Record in the database is not what we want, delete it
+                logger.log(DEBUG_HANDLING, "Deleting row from remote_ids for client %s remote-id %s", client_row_id,
+                           row['remote_id'])
+                self.db.execute("DELETE FROM remote_ids "
+                                "WHERE client_fk=? AND remote_id=?", (client_row_id, row['remote_id']))
+
+        # Now create the ones we don't already have
+        for remote_id in remote_ids:
+            # Ignore if it already exists. Shouldn't happen, but better safe than sorry
+            logger.log(DEBUG_HANDLING, "Insert row into remote_ids for client %s remote-id %s", client_row_id,
+                       remote_id)
+            self.db.execute("INSERT OR IGNORE INTO remote_ids (client_fk, remote_id) "
+                            "VALUES (?, ?)", (client_row_id, remote_id))
 
     def replace_relay_ids(self, client_row_id: int, relay_ids: Iterable[str]):
         """
@@ -434,31 +585,31 @@ class LeasequerySqliteStore(LeasequeryStore):
         :param relay_ids: The new relay-ids
         """
         relay_ids = list(relay_ids)
-        with self.db:
-            # First see what we already have
-            rows = self.db.execute("SELECT relay_id FROM relay_ids WHERE client_fk=?", (client_row_id,))
-            for row in rows:
-                if row['relay_id'] in relay_ids:
-                    # New relay-id is already in the database, no need to do anything
-                    logger.log(DEBUG_HANDLING, "Keeping existing row in relay_ids "
-                                               "for client {} relay-id {}".format(client_row_id, row['relay_id']))
-                    relay_ids.remove(row['relay_id'])
-                else:
-                    # Record in the database is not what we want, delete it
-                    logger.log(DEBUG_HANDLING, "Deleting row from relay_ids "
-                                               "for client {} relay-id {}".format(client_row_id, row['relay_id']))
-                    self.db.execute("DELETE FROM relay_ids "
-                                    "WHERE client_fk=? AND relay_id=?", (client_row_id, row['relay_id']))
-
-            # Now create the ones we don't already have
-            for relay_id in relay_ids:
-                # Ignore if it already exists. Shouldn't happen, but better safe than sorry
-                logger.log(DEBUG_HANDLING, "Insert row into relay_ids "
-                                           "for client {} relay-id {}".format(client_row_id, relay_id))
-                self.db.execute("INSERT OR IGNORE INTO relay_ids (client_fk, relay_id) "
-                                "VALUES (?, ?)", (client_row_id, relay_id))
-
-    def update_address_leases(self, client_row_id: int, address_leases: Iterator[IAAddressOption]):
+
+        # First see what we already have
+        rows = self.db.execute("SELECT relay_id FROM relay_ids WHERE client_fk=?", (client_row_id,))
+        for row in rows:
+            if row['relay_id'] in relay_ids:
+                # New relay-id is already in the database, no need to do anything
+                logger.log(DEBUG_HANDLING, "Keeping existing row in relay_ids for client %s relay-id %s",
+                           client_row_id, row['relay_id'])
+                relay_ids.remove(row['relay_id'])
+            else:
+                # Record in the database is not what we want, delete it
+                logger.log(DEBUG_HANDLING, "Deleting row from relay_ids for client %s relay-id %s", client_row_id,
+                           row['relay_id'])
+                self.db.execute("DELETE FROM relay_ids "
+                                "WHERE client_fk=? AND relay_id=?", (client_row_id, row['relay_id']))
+
+        # Now create the ones we don't already have
+        for relay_id in relay_ids:
+            # Ignore if it already exists. Shouldn't happen, but better safe than sorry
+            logger.log(DEBUG_HANDLING, "Insert row into relay_ids for client %s relay-id %s", client_row_id,
+                       relay_id)
+            self.db.execute("INSERT OR IGNORE INTO relay_ids (client_fk, relay_id) "
+                            "VALUES (?, ?)", (client_row_id, relay_id))
+
+    def update_address_leases(self, client_row_id: int, address_leases: Iterable[AddressLease]):
         """
         Update address leases in the database and remove expired ones.
 
@@ -469,51 +620,39 @@ class LeasequerySqliteStore(LeasequeryStore):
         # Build a mapping from the input for easier checking
         new_leases = {}
         for address_lease in address_leases:
-            new_leases[address_lease.address.exploded] = address_lease
-
-        now = int(time.time())
-
-        with self.db:
-            # Remove all rows that contain the same address for another client, this newer one overrides it
-            for address, new_lease in new_leases.items():
-                self.db.execute("DELETE FROM addresses WHERE address=? AND client_fk<>?", (address, client_row_id))
-
-            # First see what we already have
-            rows = self.db.execute("SELECT address FROM addresses WHERE client_fk=?", (client_row_id,))
-            for row in rows:
-                if row['address'] in new_leases:
-                    # New relay-id is already in the database, update the lifetimes and options
-                    new_lease = new_leases[row['address']]
-
-                    logger.log(DEBUG_HANDLING, "Updating existing row in addresses "
-                                               "for client {} address {}".format(client_row_id, new_lease.address))
-                    self.db.execute("UPDATE addresses SET preferred_lifetime_end=?, valid_lifetime_end=?, options=? "
-                                    "WHERE client_fk=? AND address=?",
-                                    (now + new_lease.preferred_lifetime,
-                                     now + new_lease.valid_lifetime,
-                                     self.encode_options(new_lease.options),
-                                     client_row_id, row['address']))
-
-                    del new_leases[row['address']]
-
-            # Now create the ones we don't already have
-            for address, new_lease in new_leases.items():
-                # Ignore if it already exists. Shouldn't happen, but better safe than sorry
-                logger.log(DEBUG_HANDLING, "Insert row into addresses "
-                                           "for client {} address {}".format(client_row_id, new_lease.address))
-                self.db.execute("INSERT OR IGNORE INTO addresses (client_fk, address, preferred_lifetime_end, "
-                                "valid_lifetime_end, options) VALUES (?, ?, ?, ?, ?)",
-                                (client_row_id, address,
-                                 now + new_lease.preferred_lifetime,
-                                 now + new_lease.valid_lifetime,
-                                 self.encode_options(new_lease.options)))
-
-            # Remove all expired rows from the database
-            logger.log(DEBUG_HANDLING, "Deleting expired rows from addresses for {}".format(client_row_id, ))
-            self.db.execute("DELETE FROM addresses "
-                            "WHERE client_fk=? AND valid_lifetime_end<?", (client_row_id, now))
-
-    def update_prefix_leases(self, client_row_id: int, prefix_leases: Iterator[IAPrefixOption]):
+            new_leases[address_lease[0]] = address_lease
+
+        # Remove all rows that contain the same address for another client, this newer one overrides it
+        for address in new_leases:
+            self.delete_overridden_leases('addresses', "address=? AND client_fk<>?", [address, client_row_id])
+
+        # First see what we already have
+        rows = self.db.execute("SELECT address FROM addresses WHERE client_fk=?", (client_row_id,))
+        for row in rows:
+            if row['address'] in new_leases:
+                # New relay-id is already in the database, update the lifetimes and options
+                address, preferred_lifetime_end, valid_lifetime_end, options = new_leases.pop(row['address'])
+
+                logger.log(DEBUG_HANDLING, "Updating existing row in addresses for client %s address %s",
+                           client_row_id, address)
+                self.db.execute("UPDATE addresses SET preferred_lifetime_end=?, valid_lifetime_end=?, options=? "
+                                "WHERE client_fk=? AND address=?",
+                                (preferred_lifetime_end, valid_lifetime_end, options, client_row_id, address))
+
+        # Now create the ones we don't already have
+        for address, preferred_lifetime_end, valid_lifetime_end, options in new_leases.values():
+            # Ignore if it already exists. Shouldn't happen, but better safe than sorry
+            logger.log(DEBUG_HANDLING, "Insert row into addresses for client %s address %s", client_row_id, address)
+            self.db.execute("INSERT OR IGNORE INTO addresses (client_fk, address, preferred_lifetime_end, "
+                            "valid_lifetime_end, options) VALUES (?, ?, ?, ?, ?)",
+                            (client_row_id, address, preferred_lifetime_end, valid_lifetime_end, options))
+
+        # Remove all expired rows from the database
+        logger.log(DEBUG_HANDLING, "Deleting expired rows from addresses for %s", client_row_id)
+        self.db.execute("DELETE FROM addresses "
+                        "WHERE client_fk=? AND valid_lifetime_end<?", (client_row_id, int(time.time())))
+
+    def update_prefix_leases(self, client_row_id: int, prefix_leases: Iterable[PrefixLease]):
         """
         Update prefix leases in the database and remove expired ones.
 
@@ -524,59 +663,120 @@ class LeasequerySqliteStore(LeasequeryStore):
         # Build a mapping from the input for easier checking
         new_leases = {}
         for prefix_lease in prefix_leases:
-            new_leases[(prefix_lease.prefix[0].exploded, prefix_lease.prefix[-1].exploded)] = prefix_lease
+            new_leases[prefix_lease[:2]] = prefix_lease
+
+        # Remove all rows that contain overlapping prefixes for another client, this newer one overrides it. Aligned
+        # prefixes overlap if one contains the other, so look for the prefixes that contain the first address and for
+        # the prefixes that start inside this one.
+        for first_address, last_address in new_leases:
+            prefix_ranges = self.get_containing_prefix_ranges(IPv6Address(first_address))
+            prefix_condition = ' OR '.join(['(first_address=? AND last_address=?)'] * len(prefix_ranges))
+            prefix_parameters = [boundary for prefix_range in prefix_ranges for boundary in prefix_range]
+
+            self.delete_overridden_leases('prefixes',
+                                          "client_fk<>? AND ("
+                                          "first_address BETWEEN ? AND ? OR " + (prefix_condition or '0') +
+                                          ")",
+                                          [client_row_id, first_address, last_address] + prefix_parameters)
+
+        # First see what we already have
+        rows = self.db.execute("SELECT first_address, last_address FROM prefixes "
+                               "WHERE client_fk=?", (client_row_id,))
+        for row in rows:
+            prefix_idx = (row['first_address'], row['last_address'])
+            if prefix_idx in new_leases:
+                # New relay-id is already in the database, update the lifetimes and options
+                first_address, last_address, preferred_lifetime_end, valid_lifetime_end, options = \
+                    new_leases.pop(prefix_idx)
+
+                logger.log(DEBUG_HANDLING, "Updating existing row in prefixes for client %s prefix %s - %s",
+                           client_row_id, first_address, last_address)
+                self.db.execute("UPDATE prefixes SET preferred_lifetime_end=?, valid_lifetime_end=?, options=? "
+                                "WHERE client_fk=? AND first_address=? AND last_address=?",
+                                (preferred_lifetime_end, valid_lifetime_end, options,
+                                 client_row_id, first_address, last_address))
+
+        # Now create the ones we don't already have
+        for first_address, last_address, preferred_lifetime_end, valid_lifetime_end, options in new_leases.values():
+            # Ignore if it already exists. Shouldn't happen, but better safe than sorry
+            logger.log(DEBUG_HANDLING, "Insert row into prefixes for client %s prefix %s - %s", client_row_id,
+                       first_address, last_address)
+            self.db.execute("INSERT OR IGNORE INTO prefixes (client_fk, first_address, last_address, "
+                            "preferred_lifetime_end, valid_lifetime_end, options) VALUES (?, ?, ?, ?, ?, ?)",
+                            (client_row_id, first_address, last_address, preferred_lifetime_end, valid_lifetime_end,
+                             options))
+            self.remember_prefix_length(self.db, first_address, last_address)
+
+        # Remove all expired rows from the database
+        logger.log(DEBUG_HANDLING, "Deleting expired rows from prefixes for %s", client_row_id)
+        self.db.execute("DELETE FROM prefixes "
+                        "WHERE client_fk=? AND valid_lifetime_end<?", (client_row_id, int(time.time())))
+
+    def delete_overridden_leases(self, table: str, condition: str, parameters: list):
+        """
+        Delete the leases of other clients that a new lease overrides. The write cache has to forget those clients,
+        their leases in the database are no longer what it remembers.
+
+        :param table: The table to delete the leases from
+        :param condition: The condition that selects the overridden leases
+        :param parameters: The parameters of the condition
+        """
+        if self.write_cache:
+            rows = self.db.execute("SELECT client_id, link_address FROM clients "
+                                   "WHERE id IN (SELECT client_fk FROM {} WHERE {})".format(table, condition),
+                                   parameters)
+            for row in rows:
+                self.write_cache.forget(row['client_id'], row['link_address'])
 
-        now = int(time.time())
+        self.db.execute("DELETE FROM {} WHERE {}".format(table, condition), parameters)
 
-        with self.db:
-            # Remove all rows that contain overlapping prefixes for another client, this newer one overrides it
-            for prefix_idx, new_lease in new_leases.items():
-                first_address, last_address = prefix_idx
-                self.db.execute("DELETE FROM prefixes WHERE first_address<=? AND last_address>=? AND client_fk<>?",
-                                (last_address, first_address, client_row_id))
-
-            # First see what we already have
-            rows = self.db.execute("SELECT first_address, last_address FROM prefixes "
-                                   "WHERE client_fk=?", (client_row_id,))
-            for row in rows:
-                prefix_idx = (row['first_address'], row['last_address'])
-                if prefix_idx in new_leases:
-                    # New relay-id is already in the database, update the lifetimes and options
-                    new_lease = new_leases[prefix_idx]
-
-                    logger.log(DEBUG_HANDLING, "Updating existing row in prefixes "
-                                               "for client {} prefix {}".format(client_row_id, new_lease.prefix))
-                    self.db.execute("UPDATE prefixes SET preferred_lifetime_end=?, valid_lifetime_end=?, options=? "
-                                    "WHERE client_fk=? AND first_address=? AND last_address=?",
-                                    (now + new_lease.preferred_lifetime,
-                                     now + new_lease.valid_lifetime,
-                                     self.encode_options(new_lease.options),
-                                     client_row_id, prefix_idx[0], prefix_idx[1]))
-                    del new_leases[prefix_idx]
-
-            # Now create the ones we don't already have
-            for prefix_idx, new_lease in new_leases.items():
-                # Ignore if it already exists. Shouldn't happen, but better safe than sorry
-                logger.log(DEBUG_HANDLING, "Insert row into prefixes "
-                                           "for client {} prefix {}".format(client_row_id, new_lease.prefix))
-                self.db.execute("INSERT OR IGNORE INTO prefixes (client_fk, first_address, last_address, "
-                                "preferred_lifetime_end, valid_lifetime_end, options) VALUES (?, ?, ?, ?, ?, ?)",
-                                (client_row_id, prefix_idx[0], prefix_idx[1],
-                                 now + new_lease.preferred_lifetime,
-                                 now + new_lease.valid_lifetime,
-                                 self.encode_options(new_lease.options)))
-
-            # Remove all expired rows from the database
-            logger.log(DEBUG_HANDLING, "Deleting expired rows from prefixes for {}".format(client_row_id, ))
-            self.db.execute("DELETE FROM prefixes "
-                            "WHERE client_fk=? AND valid_lifetime_end<?", (client_row_id, now))
+    @staticmethod
+    def expire_leases(db: sqlite3.Connection, now: int, batch_size: int) -> int:
+        """
+        Remove a batch of expired leases, and the clients that have no leases left because of that, in a single short
+        transaction so that workers don't have to wait long for the database.
+
+        :param db: The database connection
+        :param now: Leases that expired before this timestamp are removed
+        :param batch_size: The maximum number of addresses and of prefixes to remove
+        :return: The number of leases removed, if that is at least the batch size there may be more
+        """
+        removed = 0
+        with db:
+            client_row_ids = set()
+            for table in ('addresses', 'prefixes'):
+                rows = db.execute("SELECT rowid, client_fk FROM {} WHERE valid_lifetime_end<? LIMIT ?".format(table),
+                                  (now, batch_size)).fetchall()
+                db.executemany("DELETE FROM {} WHERE rowid=?".format(table), [(row[0],) for row in rows])
+
+                client_row_ids.update(row[1] for row in rows)
+                removed += len(rows)
+
+            db.executemany("DELETE FROM clients WHERE id=? "
+                           "AND NOT EXISTS(SELECT 1 FROM addresses WHERE client_fk=clients.id) "
+                           "AND NOT EXISTS(SELECT 1 FROM prefixes WHERE client_fk=clients.id)",
+                           [(client_row_id,) for client_row_id in client_row_ids])
+
+        return removed
+
+    @staticmethod
+    def remember_prefix_length(db: sqlite3.Connection, first_address: str, last_address: str):
+        """
+        Make sure that the length of this prefix is in the prefix_lengths table
+
+        :param db: The database connection
+        :param first_address: The first address of the prefix in stored form
+        :param last_address: The last address of the prefix in stored form
+        """
+        host_bits = (int(IPv6Address(last_address)) - int(IPv6Address(first_address))).bit_length()
+        db.execute("INSERT OR IGNORE INTO prefix_lengths (host_bits) VALUES (?)", (host_bits,))
 
     def create_tables(self):
         """
         Create the tables required for this leasequery implementation
         """
         db = self.open_database()
-        user_version = 1
+        user_version = 2
 
         with db:
             # Check if the user version is recent enough
@@ -631,6 +831,7 @@ class LeasequerySqliteStore(LeasequeryStore):
 
             db.execute("CREATE INDEX IF NOT EXISTS addresses_address ON addresses(address)")
             db.execute("CREATE INDEX IF NOT EXISTS addresses_client_fk ON addresses(client_fk)")
+            db.execute("CREATE INDEX IF NOT EXISTS addresses_valid_lifetime_end ON addresses(valid_lifetime_end)")
 
             # Rules for this table:
             # - Prefixes are stored by first and last address so we can search the range:
@@ -649,6 +850,21 @@ class LeasequerySqliteStore(LeasequeryStore):
 
             db.execute("CREATE INDEX IF NOT EXISTS prefixes_range ON prefixes(first_address, last_address)")
             db.execute("CREATE INDEX IF NOT EXISTS prefixes_client_fk ON prefixes(client_fk)")
+            db.execute("CREATE INDEX IF NOT EXISTS prefixes_valid_lifetime_end ON prefixes(valid_lifetime_end)")
+
+            # Rules for this table:
+            # - host_bits is the number of bits after the prefix length, a /64 has 64 host bits
+            # - every prefix length that is stored in prefixes is in this table, there may be more
+            # Together with the prefixes_range index this finds the prefixes that contain an address with one exact
+            # lookup per prefix length, instead of a range scan over all prefixes that start before the address.
+            db.execute("CREATE TABLE IF NOT EXISTS prefix_lengths ("
+                       "host_bits INTEGER NOT NULL PRIMARY KEY"
+                       ")")
+
+            if current_version < 2:
+                # Version 1 didn't keep track of the prefix lengths
+                for row in list(db.execute("SELECT DISTINCT first_address, last_address FROM prefixes")):
+                    self.remember_prefix_length(db, row['first_address'], row['last_address'])
 
             # Rules for this table:
             # - remote_id is the hex representation of the remote-id in lower case
@@ -674,18 +890,23 @@ class LeasequerySqliteStore(LeasequeryStore):
 
             db.execute("PRAGMA user_version={}".format(user_version))
 
-        with db:
-            # Cleaning up
-            logger.debug("Cleaning up old records from the database and vacuuming")
+        # Cleaning up
+        logger.debug("Cleaning up old records from the database and vacuuming")
 
-            now = int(time.time())
+        now = int(time.time())
+        while self.expire_leases(db, now, batch_size=10000) >= 10000:
+            pass
 
-            db.execute("DELETE FROM addresses WHERE preferred_lifetime_end<? AND valid_lifetime_end<?", (now, now))
-            db.execute("DELETE FROM prefixes WHERE preferred_lifetime_end<? AND valid_lifetime_end<?", (now, now))
+        with db:
             db.execute("DELETE FROM clients WHERE NOT EXISTS(SELECT 1 FROM addresses WHERE client_fk=clients.id) "
                        "AND NOT EXISTS(SELECT 1 FROM prefixes WHERE client_fk=clients.id);")
 
         # Vacuum outside the transaction
-        db.execute("VACUUM")
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # Databases created before incremental vacuuming need a full vacuum once to switch
+            logger.info("Converting leasequery database to incremental vacuuming, this may take a while")
+            db.execute("VACUUM")
+        else:
+            db.executescript("PRAGMA incremental_vacuum;")
 
         db.close()
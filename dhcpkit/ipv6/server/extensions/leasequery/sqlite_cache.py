@@ -0,0 +1,163 @@
+"""
+A cache of what the leasequery SQLite store last wrote for each client, so that lease updates that don't change
+anything can be skipped. Most renewals confirm exactly the same leases, remote-ids and relay-ids, and only move the
+end of the lifetimes a bit further. With this cache those renewals only update the lifetimes, and only when they have
+moved more than a configurable slack since they were last written.
+"""
+import hashlib
+import logging
+import sqlite3
+from collections import OrderedDict
+
+from typing import NamedTuple, Optional, Tuple
+
+from dhcpkit.ipv6.server.extensions.leasequery import LeaseUpdate
+
+logger = logging.getLogger(__name__)
+
+# What we know about a client in the database: the fingerprint of everything except the lifetimes, the row id of the
+# client, the last interaction and the ends of the preferred and valid lifetimes of all its leases
+CachedClient = NamedTuple('CachedClient', [('fingerprint', bytes), ('client_row_id', int), ('timestamp', int),
+                                           ('lifetime_ends', Tuple[Tuple[int, int], ...])])
+
+
+class LeasequerySqliteWriteCache:
+    """
+    A cache of the last written state of the most recently seen clients.
+    """
+
+    def __init__(self, size: int = 10000, slack: float = 0):
+        """
+        Create an empty cache.
+
+        :param size: The maximum number of clients to remember
+        :param slack: The number of seconds that lifetimes and the last interaction may lag behind in the database
+        """
+        self.size = max(size, 1)
+        self.slack = slack
+
+        self.clients = OrderedDict()
+        """The cached clients by client-id and link-address, least recently used first"""
+
+        self.data_version = None
+        """The data version of the database when we last looked"""
+
+    @staticmethod
+    def get_fingerprint(update: LeaseUpdate) -> bytes:
+        """
+        Create a fingerprint of everything in a lease update except the lifetimes, which change on every renewal.
+
+        :param update: The lease update
+        :return: The fingerprint
+        """
+        parts = (update.options, update.relay_data, update.remote_ids, update.relay_ids,
+                 tuple((address, options)
+                       for address, preferred_lifetime_end, valid_lifetime_end, options in update.address_leases),
+                 tuple((first_address, last_address, options)
+                       for first_address, last_address, preferred_lifetime_end, valid_lifetime_end, options
+                       in update.prefix_leases))
+        return hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=16).digest()
+
+    @staticmethod
+    def get_lifetime_ends(update: LeaseUpdate) -> Tuple[Tuple[int, int], ...]:
+        """
+        Get the ends of the preferred and valid lifetimes of all leases in a lease update.
+
+        :param update: The lease update
+        :return: The ends of the lifetimes, in the same order as the leases
+        """
+        return tuple((lease[-3], lease[-2]) for lease in update.address_leases + update.prefix_leases)
+
+    def check_data_version(self, db: sqlite3.Connection):
+        """
+        Forget everything when another connection has changed the database since we last looked. Our own changes
+        don't change the data version.
+
+        :param db: Our database connection
+        """
+        data_version = db.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self.data_version:
+            if self.clients:
+                logger.debug("Leasequery database changed by someone else, forgetting %d cached clients",
+                             len(self.clients))
+                self.clients.clear()
+
+            self.data_version = data_version
+
+    def lookup(self, update: LeaseUpdate, now: int) -> Optional[CachedClient]:
+        """
+        Find the cached client for this update, but only if everything except the lifetimes is still the same and
+        none of its leases have expired in the database yet.
+
+        :param update: The lease update
+        :param now: The current time
+        :return: The cached client, or None if the database needs a full update
+        """
+        key = (update.client_id, update.link_address)
+        cached_client = self.clients.get(key)
+        if not cached_client:
+            return None
+
+        if cached_client.fingerprint != self.get_fingerprint(update) \
+                or any(valid_lifetime_end < now
+                       for preferred_lifetime_end, valid_lifetime_end in cached_client.lifetime_ends):
+            del self.clients[key]
+            return None
+
+        self.clients.move_to_end(key)
+        return cached_client
+
+    def is_current(self, cached_client: CachedClient, update: LeaseUpdate, now: int) -> bool:
+        """
+        Check whether the lifetimes and last interaction in the database are close enough to the ones in the update.
+        Shorter lifetimes are never close enough, and neither are leases that would expire from the database within
+        the slack.
+
+        :param cached_client: The cached client
+        :param update: The lease update for the same client
+        :param now: The current time
+        :return: Whether we can skip writing this update
+        """
+        if not cached_client.timestamp <= update.timestamp <= cached_client.timestamp + self.slack:
+            return False
+
+        for (old_preferred, old_valid), (new_preferred, new_valid) in zip(cached_client.lifetime_ends,
+                                                                          self.get_lifetime_ends(update)):
+            if old_valid < now + self.slack \
+                    or not old_preferred <= new_preferred <= old_preferred + self.slack \
+                    or not old_valid <= new_valid <= old_valid + self.slack:
+                return False
+
+        return True
+
+    def remember(self, update: LeaseUpdate, client_row_id: int):
+        """
+        Remember what was written to the database for this update.
+
+        :param update: The lease update that was written
+        :param client_row_id: The row id of the client
+        """
+        key = (update.client_id, update.link_address)
+        self.clients[key] = CachedClient(fingerprint=self.get_fingerprint(update),
+                                         client_row_id=client_row_id,
+                                         timestamp=update.timestamp,
+                                         lifetime_ends=self.get_lifetime_ends(update))
+        self.clients.move_to_end(key)
+
+        while len(self.clients) > self.size:
+            self.clients.popitem(last=False)
+
+    def forget(self, client_id: str, link_address: str):
+        """
+        Forget a client, for example because another client took over one of its leases.
+
+        :param client_id: The client-id as stored in the database
+        :param link_address: The link-address as stored in the database
+        """
+        self.clients.pop((client_id, link_address), None)
+
+    def clear(self):
+        """
+        Forget everything, for example because a transaction was rolled back.
+        """
+        self.clients.clear()
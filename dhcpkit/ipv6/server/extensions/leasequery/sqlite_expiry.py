@@ -0,0 +1,114 @@
+"""
+A timer that removes expired leases from the leasequery SQLite database while the server is running. Leases are
+removed in small batches with a short transaction each, so the workers never have to wait long for the database, and
+the freed pages are returned with an incremental vacuum instead of a full one.
+"""
+import logging
+import sqlite3
+import threading
+import time
+import weakref
+
+logger = logging.getLogger(__name__)
+
+
+class LeasequerySqliteExpiry:
+    """
+    The settings and the thread of the background expiry.
+    """
+
+    def __init__(self, interval: float = 60, batch_size: int = 1000, vacuum_pages: int = 1000):
+        """
+        Remember the settings. The thread is started by the store.
+
+        :param interval: The number of seconds between expiry runs
+        :param batch_size: The maximum number of addresses and of prefixes to remove in one transaction
+        :param vacuum_pages: The maximum number of free pages to return to the filesystem after each run
+        """
+        self.interval = interval
+        self.batch_size = max(batch_size, 1)
+        self.vacuum_pages = vacuum_pages
+
+        self.stop_event = None
+        self.thread = None
+
+    def __getstate__(self):
+        # The thread only runs in the main process, and can't be pickled anyway
+        state = self.__dict__.copy()
+        state['stop_event'] = None
+        state['thread'] = None
+        return state
+
+    def start(self, store):
+        """
+        Start the expiry thread. The thread stops by itself when the store goes away, on reload or on shutdown.
+
+        :param store: The store whose database to clean up
+        :type store: dhcpkit.ipv6.server.extensions.leasequery.sqlite.LeasequerySqliteStore
+        """
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(weakref.ref(store), self.stop_event),
+                                       name='LeasequeryExpiry', daemon=True)
+        self.thread.start()
+
+        weakref.finalize(store, self.stop_event.set)
+
+    def stop(self):
+        """
+        Stop the expiry thread and wait for it to finish
+        """
+        if self.thread:
+            self.stop_event.set()
+            self.thread.join()
+
+    def expire(self, store, db, stop_event: threading.Event) -> int:
+        """
+        Remove all expired leases, one batch at a time, and then return some free pages to the filesystem.
+
+        :param store: The store whose database to clean up
+        :type store: dhcpkit.ipv6.server.extensions.leasequery.sqlite.LeasequerySqliteStore
+        :param db: The database connection of this thread
+        :param stop_event: Stop between batches when this is set
+        :return: The number of leases removed
+        """
+        now = int(time.time())
+
+        total = 0
+        while not stop_event.is_set():
+            removed = store.expire_leases(db, now, self.batch_size)
+            total += removed
+            if removed < self.batch_size:
+                break
+
+        # Outside the transaction
+        db.executescript("PRAGMA incremental_vacuum({});".format(self.vacuum_pages))
+
+        if total:
+            logger.debug("Removed %d expired leases from the leasequery database", total)
+
+        return total
+
+    def run(self, store_ref: weakref.ref, stop_event: threading.Event):
+        """
+        Remove expired leases every interval until the store goes away.
+
+        :param store_ref: A weak reference to the store, so this thread doesn't keep it alive
+        :param stop_event: The event that tells us to stop
+        """
+        store = store_ref()
+        db = store.open_database()
+        del store
+
+        while not stop_event.wait(self.interval):
+            store = store_ref()
+            if store is None:
+                break
+
+            try:
+                self.expire(store, db, stop_event)
+            except sqlite3.Error as e:
+                logger.error("Could not remove expired leases from the leasequery database: %s", e)
+
+            del store
+
+        db.close()
@@ -0,0 +1,253 @@
+"""
+A separate process that writes lease updates to the leasequery SQLite database. When every worker writes its own
+updates all workers contend for the single write lock of the database, and every reply costs a transaction of its own.
+With a writer process the workers put compact lease update records on a bounded queue, and the writer process applies
+them in batches with a single transaction per batch.
+"""
+import logging
+import multiprocessing
+import signal
+import sqlite3
+import time
+import weakref
+from ctypes import c_uint64
+from multiprocessing import Value
+from multiprocessing.queues import Full
+from queue import Empty
+
+from dhcpkit.ipv6.server.queue_logger import get_main_logging_queue, log_to_main_process
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def stop_writer_process(queue: multiprocessing.Queue, process: multiprocessing.Process):
+    """
+    Tell the writer process to write the remaining updates and wait for it to finish. This is a separate function so
+    that it can be used as a finalizer.
+
+    :param queue: The queue that the writer process reads from
+    :param process: The writer process
+    """
+    if process.is_alive():
+        queue.put(None)
+        process.join()
+
+
+def find_writers(message_handler) -> List['LeasequerySqliteWriter']:
+    """
+    Find the writers of the leasequery stores in a message handler, so that the main process can report their counters.
+
+    :param message_handler: The message handler to search through, including its filters
+    :type message_handler: dhcpkit.ipv6.server.message_handler.MessageHandler
+    :return: The writers that were found
+    """
+    writers = []
+    todo = [message_handler]
+    while todo:
+        container = todo.pop(0)
+        todo += container.sub_filters
+
+        for handler in container.sub_handlers:
+            store = getattr(handler, 'store', None)
+            writer = getattr(store, 'writer', None)
+            if isinstance(writer, LeasequerySqliteWriter) and writer not in writers:
+                writers.append(writer)
+
+    return writers
+
+
+class LeasequerySqliteWriter:
+    """
+    The queue that workers put their lease updates on, and the process that writes them to the database.
+
+    :type waited: Synchronized
+    :type dropped: Synchronized
+    :type written: Synchronized
+    :type failed: Synchronized
+    :type batches: Synchronized
+    """
+
+    def __init__(self, batch_size: int = 100, batch_interval: float = 0.1, queue_size: int = 10000,
+                 queue_timeout: float = 1.0):
+        """
+        Create the queue and counters. The process is started by the store.
+
+        :param batch_size: The maximum number of updates to write in one transaction
+        :param batch_interval: The maximum time in seconds to wait for more updates before writing a batch
+        :param queue_size: The maximum number of updates waiting to be written
+        :param queue_timeout: How long a worker waits for space in a full queue before dropping an update
+        """
+        self.batch_size = max(batch_size, 1)
+        self.batch_interval = batch_interval
+        self.queue_timeout = queue_timeout
+
+        self.queue = multiprocessing.Queue(queue_size)
+
+        # Workers count the updates that had to wait for space in the queue, and the ones that didn't get any
+        self.waited = Value(c_uint64)
+        self.dropped = Value(c_uint64)
+
+        # The writer process counts what it wrote
+        self.written = Value(c_uint64)
+        self.failed = Value(c_uint64)
+        self.batches = Value(c_uint64)
+
+        self.process = None
+        self.finalizer = None
+
+    def __getstate__(self):
+        # The process only exists in the main process, and can't be pickled anyway
+        state = self.__dict__.copy()
+        state['process'] = None
+        state['finalizer'] = None
+        return state
+
+    def start(self, store):
+        """
+        Start the writer process. Log records are sent to the main process over the same queue as the workers use.
+
+        :param store: The store whose database to write to
+        :type store: dhcpkit.ipv6.server.extensions.leasequery.sqlite.LeasequerySqliteStore
+        """
+        log_queue, log_level = get_main_logging_queue()
+        self.process = multiprocessing.Process(target=self.run, args=(store, log_queue, log_level),
+                                               name='LeasequeryWriter', daemon=True)
+        self.process.start()
+
+        # Write the remaining updates when the store goes away, on reload or on shutdown
+        self.finalizer = weakref.finalize(self, stop_writer_process, self.queue, self.process)
+
+    def stop(self):
+        """
+        Write the remaining updates and stop the writer process
+        """
+        if self.finalizer:
+            self.finalizer()
+
+    def put(self, update: tuple):
+        """
+        Put a lease update on the queue. When the queue is full the worker waits for the writer process to catch up,
+        but not forever.
+
+        :param update: The lease update
+        :type update: dhcpkit.ipv6.server.extensions.leasequery.LeaseUpdate
+        """
+        try:
+            self.queue.put_nowait(update)
+            return
+        except Full:
+            with self.waited.get_lock():
+                self.waited.value += 1
+
+        try:
+            self.queue.put(update, timeout=self.queue_timeout)
+        except Full:
+            with self.dropped.get_lock():
+                self.dropped.value += 1
+
+            logger.warning("Leasequery writer can't keep up, dropping lease update for client %s on link %s",
+                           update.client_id, update.link_address)
+
+    def get_batch(self) -> Optional[List[tuple]]:
+        """
+        Wait for the next update, and then collect more until the batch is full or the batch interval has passed.
+
+        :return: The batch of updates, which is empty when it's time to stop, or None when the queue is gone
+        """
+        try:
+            update = self.queue.get()
+            if update is None:
+                return []
+
+            batch = [update]
+            deadline = time.monotonic() + self.batch_interval
+            while len(batch) < self.batch_size:
+                try:
+                    update = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except Empty:
+                    break
+
+                if update is None:
+                    # Write what we have, and put the sentinel back so we stop after that
+                    self.queue.put(None)
+                    break
+
+                batch.append(update)
+
+            return batch
+        except (EOFError, OSError):
+            return None
+
+    def write_batch(self, store, batch: List[tuple]):
+        """
+        Write a batch of updates in a single transaction. If that fails the updates are retried one by one so that a
+        single bad update doesn't take the whole batch down with it.
+
+        :param store: The store whose database to write to
+        :type store: dhcpkit.ipv6.server.extensions.leasequery.sqlite.LeasequerySqliteStore
+        :param batch: The updates to write
+        """
+        try:
+            with store.db:
+                for update in batch:
+                    store.apply_lease_update(update)
+
+            written = len(batch)
+        except sqlite3.Error as e:
+            logger.error("Could not write a batch of %d lease updates, retrying them separately: %s", len(batch), e)
+
+            # The cache might remember things that were rolled back
+            if store.write_cache:
+                store.write_cache.clear()
+
+            written = 0
+            for update in batch:
+                try:
+                    with store.db:
+                        store.apply_lease_update(update)
+
+                    written += 1
+                except sqlite3.Error as e:
+                    logger.error("Could not write lease update for client %s on link %s: %s",
+                                 update.client_id, update.link_address, e)
+
+                    if store.write_cache:
+                        store.write_cache.clear()
+
+        with self.written.get_lock():
+            self.written.value += written
+        with self.failed.get_lock():
+            self.failed.value += len(batch) - written
+        with self.batches.get_lock():
+            self.batches.value += 1
+
+    def run(self, store, log_queue: Optional[multiprocessing.Queue], log_level: int):
+        """
+        Write batches of updates until we are told to stop.
+
+        :param store: The store whose database to write to
+        :type store: dhcpkit.ipv6.server.extensions.leasequery.sqlite.LeasequerySqliteStore
+        :param log_queue: The queue to send log records to the main process, if any
+        :param log_level: The lowest log level that is going to be handled by the main process
+        """
+        # The main process tells us when to stop
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        log_to_main_process(log_queue, log_level)
+
+        store.db = store.open_database()
+
+        while True:
+            batch = self.get_batch()
+            if not batch:
+                break
+
+            self.write_batch(store, batch)
+
+        store.db.close()
+
+        logger.info("Leasequery writer wrote %d lease updates in %d batches, %d failed",
+                    self.written.value, self.batches.value, self.failed.value)
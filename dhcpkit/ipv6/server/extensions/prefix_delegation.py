@@ -57,7 +57,7 @@ class UnansweredIAPDOptionHandler(Handler):
                 # NoBinding in the Reply message.
 
                 prefixes = ', '.join(map(str, option.get_prefixes()))
-                logger.warning("No handler renewed {}: sending NoBinding status".format(prefixes))
+                logger.warning("No handler renewed %s: sending NoBinding status", prefixes)
 
                 bundle.response.options.append(IAPDOption(option.iaid, options=[
                     StatusCodeOption(STATUS_NO_BINDING, "No prefixes assigned to you")
@@ -80,7 +80,7 @@ class UnansweredIAPDOptionHandler(Handler):
                     raise CannotRespondError("Server is not authoritative and cannot reject rebind")
 
                 prefixes = ', '.join(map(str, option.get_prefixes()))
-                logger.warning("No handler answered rebind of {}: withdrawing prefixes".format(prefixes))
+                logger.warning("No handler answered rebind of %s: withdrawing prefixes", prefixes)
 
                 reply_suboptions = []
                 for suboption in option.get_options_of_type(IAPrefixOption):
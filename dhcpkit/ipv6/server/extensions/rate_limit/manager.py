@@ -41,9 +41,7 @@ class RateLimitCounters:
             # Don't allow more than the specified rate as burst size. No saving up!
             allowance = self.burst
 
-        logger.debug('{}: {} allowance = {:0.2f}'.format(
-            multiprocessing.current_process().name, key, allowance)
-        )
+        logger.debug("%s: %s allowance = %0.2f", multiprocessing.current_process().name, key, allowance)
 
         if allowance < 1:
             # Allowance exceeded, reject
@@ -120,7 +120,7 @@ class StaticAssignmentHandler(Handler):
             found_option = self.find_iapd_option_for_prefix(unanswered_iapd_options, assignment.prefix)
             if found_option:
                 # Answer to this option
-                logger.log(DEBUG_HANDLING, "Assigning prefix {}".format(assignment.prefix))
+                logger.log(DEBUG_HANDLING, "Assigning prefix %s", assignment.prefix)
                 response_option = IAPDOption(found_option.iaid, options=[
                     IAPrefixOption(prefix=assignment.prefix,
                                    preferred_lifetime=self.prefix_preferred_lifetime,
@@ -130,14 +130,14 @@ class StaticAssignmentHandler(Handler):
                 bundle.mark_handled(found_option)
             else:
                 logger.log(DEBUG_HANDLING,
-                           "Prefix {} reserved, but client did not ask for it".format(assignment.prefix))
+                           "Prefix %s reserved, but client did not ask for it", assignment.prefix)
 
         if assignment.address:
             unanswered_iana_options = bundle.get_unhandled_options(IANAOption)
             found_option = self.find_iana_option_for_address(unanswered_iana_options, assignment.address)
             if found_option:
                 # Answer to this option
-                logger.log(DEBUG_HANDLING, "Assigning address {}".format(assignment.address))
+                logger.log(DEBUG_HANDLING, "Assigning address %s", assignment.address)
                 response_option = IANAOption(found_option.iaid, options=[
                     IAAddressOption(address=assignment.address,
                                     preferred_lifetime=self.address_preferred_lifetime,
@@ -147,7 +147,7 @@ class StaticAssignmentHandler(Handler):
                 bundle.mark_handled(found_option)
             else:
                 logger.log(DEBUG_HANDLING,
-                           "Address {} reserved, but client did not ask for it".format(assignment.address))
+                           "Address %s reserved, but client did not ask for it", assignment.address)
 
     def handle_confirm(self, bundle: TransactionBundle):
         """
@@ -189,13 +189,13 @@ class StaticAssignmentHandler(Handler):
                 for suboption in option.get_options_of_type(IAPrefixOption):
                     if suboption.prefix == assignment.prefix:
                         # This is the correct option, renew it
-                        logger.log(DEBUG_HANDLING, "Renewing prefix {}".format(assignment.prefix))
+                        logger.log(DEBUG_HANDLING, "Renewing prefix %s", assignment.prefix)
                         response_suboptions.append(IAPrefixOption(prefix=assignment.prefix,
                                                                   preferred_lifetime=self.prefix_preferred_lifetime,
                                                                   valid_lifetime=self.prefix_valid_lifetime))
                     else:
                         # This isn't right
-                        logger.log(DEBUG_HANDLING, "Withdrawing prefix {}".format(suboption.prefix))
+                        logger.log(DEBUG_HANDLING, "Withdrawing prefix %s", suboption.prefix)
                         response_suboptions.append(IAPrefixOption(prefix=suboption.prefix,
                                                                   preferred_lifetime=0, valid_lifetime=0))
 
@@ -208,13 +208,13 @@ class StaticAssignmentHandler(Handler):
             for suboption in option.get_options_of_type(IAAddressOption):
                 if suboption.address == assignment.address:
                     # This is the correct option, renew it
-                    logger.log(DEBUG_HANDLING, "Renewing address {}".format(assignment.address))
+                    logger.log(DEBUG_HANDLING, "Renewing address %s", assignment.address)
                     response_suboptions.append(IAAddressOption(address=assignment.address,
                                                                preferred_lifetime=self.address_preferred_lifetime,
                                                                valid_lifetime=self.address_valid_lifetime))
                 else:
                     # This isn't right
-                    logger.log(DEBUG_HANDLING, "Withdrawing address {}".format(suboption.address))
+                    logger.log(DEBUG_HANDLING, "Withdrawing address %s", suboption.address)
                     response_suboptions.append(IAAddressOption(address=suboption.address,
                                                                preferred_lifetime=0, valid_lifetime=0))
 
@@ -101,7 +101,7 @@ class CSVStaticAssignmentHandler(StaticAssignmentHandler):
         :return: A dictionary mapping identifiers to assignments
         """
         assignments = dict(self.parse_csv_file(csv_filename))
-        logger.info("Loaded {} assignments from {}".format(len(assignments), csv_filename))
+        logger.info("Loaded %s assignments from %s", len(assignments), csv_filename)
         return assignments
 
     @staticmethod
@@ -113,7 +113,7 @@ class CSVStaticAssignmentHandler(StaticAssignmentHandler):
         :return: An list of identifiers and their assignment
         """
 
-        logger.debug("Loading assignments from {}".format(csv_filename))
+        logger.debug("Loading assignments from %s", csv_filename)
 
         with open(csv_filename) as csv_file:
             # Auto-detect the CSV dialect
@@ -208,10 +208,10 @@ class CSVStaticAssignmentHandler(StaticAssignmentHandler):
                                          "linklayer-id-str")
 
                     # Store the normalised id
-                    logger.debug("Loaded assignment for {}".format(row_id))
+                    logger.debug("Loaded assignment for %s", row_id)
                     yield row_id, Assignment(address=address, prefix=prefix)
 
                 except KeyError:
                     raise ValueError("Assignment CSV must have columns 'id', 'address' and 'prefix'")
                 except ValueError as e:
-                    logger.error("Ignoring {} line {} with invalid value: {}".format(csv_file, reader.line_num, e))
+                    logger.error("Ignoring %s line %s with invalid value: %s", csv_file, reader.line_num, e)
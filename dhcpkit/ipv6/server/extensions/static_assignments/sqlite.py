@@ -63,12 +63,12 @@ def build_sqlite() -> int:
 
     logger.addHandler(stdout_handler)
 
-    logger.info("Reading assignments from CSV file {}".format(args.source))
+    logger.info("Reading assignments from CSV file %s", args.source)
     csv_mtime = os.stat(args.source).st_mtime_ns
-    logger.debug("CSV file modification time: {} ns".format(csv_mtime))
+    logger.debug("CSV file modification time: %s ns", csv_mtime)
     assignments = CSVStaticAssignmentHandler.parse_csv_file(args.source)
 
-    logger.info("Writing assignments to SQLite file {}".format(args.destination))
+    logger.info("Writing assignments to SQLite file %s", args.destination)
     db = sqlite3.connect(args.destination, isolation_level='IMMEDIATE')
     cur = db.cursor()
     cur.execute("CREATE TABLE IF NOT EXISTS assignments ("
@@ -110,11 +110,11 @@ def build_sqlite() -> int:
 
     cur.execute("SELECT COUNT(1) FROM assignments")
     total_count = cur.fetchone()[0]
-    logger.info("Database contains {} assignments".format(total_count))
+    logger.info("Database contains %s assignments", total_count)
 
     cur.execute("SELECT COUNT(1) FROM assignments WHERE csv_mtime=?", [csv_mtime])
     updated_count = cur.fetchone()[0]
-    logger.info("Added/updated {} assignments".format(updated_count))
+    logger.info("Added/updated %s assignments", updated_count)
 
     safety_limit = total_count * 0.7
     do_delete = True
@@ -127,7 +127,7 @@ def build_sqlite() -> int:
 
     if do_delete:
         cur.execute("DELETE FROM assignments WHERE csv_mtime<?", [csv_mtime])
-        logger.info("Deleted {} old assignments".format(cur.rowcount))
+        logger.info("Deleted %s old assignments", cur.rowcount)
 
     db.commit()
 
@@ -166,7 +166,7 @@ class SqliteStaticAssignmentHandler(StaticAssignmentHandler):
         """
         Open the SQLite database in each worker
         """
-        logger.info("Opening SQLite database {}".format(self.sqlite_filename))
+        logger.info("Opening SQLite database %s", self.sqlite_filename)
         self.db = sqlite3.connect(self.sqlite_filename, check_same_thread=False)
 
     def get_assignment(self, bundle: TransactionBundle) -> Assignment:
@@ -2,7 +2,8 @@
 Filters to apply to transaction bundles
 """
 import logging
-from typing import Iterable, List, Type
+from collections import OrderedDict
+from typing import Hashable, Iterable, List, Tuple, Type
 
 from cached_property import cached_property
 from dhcpkit.common.server.config_elements import ConfigElementFactory
@@ -19,6 +20,15 @@ class Filter:
     Base class for filters
     """
 
+    # The handlers of a filter normally only depend on which filters match, which allows the message handler to cache
+    # the complete list of handlers for each combination of matching filters. Filters that return different handlers
+    # each time, for example because they depend on the current time, must set this to False.
+    cacheable = True
+
+    # Sibling filters of the same type can be compiled into an index that determines which of them match in one go,
+    # see :class:`FilterIndex`
+    index_class = None
+
     def __init__(self, filter_condition: object,
                  sub_filters: Iterable['Filter'] = None, sub_handlers: Iterable[Handler] = None):
         """
@@ -35,6 +45,9 @@ class Filter:
         self.sub_filters = list(sub_filters or [])
         self.sub_handlers = list(sub_handlers or [])
 
+        # Compile the sub-filters for fast decisions
+        self.sub_filter_decider = SubFilterDecider(self.sub_filters)
+
     def worker_init(self):
         """
         Separate initialisation that will be called in each worker process that is created. Things that can't be forked
@@ -79,7 +92,7 @@ class Filter:
         if not self.match(bundle):
             return []
 
-        logger.log(DEBUG_HANDLING, "Filter {} matched".format(self.filter_description, bundle))
+        logger.log(DEBUG_HANDLING, "Filter %s matched", self.filter_description)
 
         # Collect handlers
         handlers = []
@@ -94,6 +107,145 @@ class Filter:
 
         return handlers
 
+    def get_decision(self, bundle: TransactionBundle) -> Hashable:
+        """
+        Determine which filters in this part of the tree match the request in the bundle. The result identifies which
+        handlers have to be applied, and can be passed to :meth:`get_handlers_for_decision` to get them.
+
+        :param bundle: The transaction bundle
+        :return: None if this filter doesn't match, otherwise a tuple with the decisions of the sub-filters
+        """
+        if not self.cacheable:
+            # Let the filter decide the old-fashioned way and remember the result
+            return tuple(self.get_handlers(bundle))
+
+        if not self.match(bundle):
+            return None
+
+        return self.get_matched_decision(bundle)
+
+    def get_matched_decision(self, bundle: TransactionBundle) -> Hashable:
+        """
+        The part of :meth:`get_decision` after this filter has matched, which is used directly when a
+        :class:`FilterIndex` has already determined that this filter matches.
+
+        :param bundle: The transaction bundle
+        :return: A tuple with the decisions of the sub-filters
+        """
+        logger.log(DEBUG_HANDLING, "Filter %s matched", self.filter_description)
+
+        return self.sub_filter_decider.get_decisions(bundle)
+
+    def get_handlers_for_decision(self, decision: Hashable) -> List[Handler]:
+        """
+        Get all handlers that have to be applied for a decision made by :meth:`get_decision`.
+
+        :param decision: The decision
+        :return: The list of handlers to apply
+        """
+        if not self.cacheable:
+            return list(decision)
+
+        if decision is None:
+            return []
+
+        # Handlers on more-specific filters take precedence over handlers on the outer filters, just like in
+        # get_handlers()
+        handlers = []
+        for sub_filter, sub_decision in zip(self.sub_filters, decision):
+            handlers += sub_filter.get_handlers_for_decision(sub_decision)
+
+        handlers += self.sub_handlers
+
+        return handlers
+
+
+class FilterIndex:
+    """
+    Base class for indexes over sibling filters of the same type. Instead of asking each filter whether it matches, the
+    index determines all matching filters at once.
+    """
+
+    def __init__(self, filters: Iterable[Tuple[int, Filter]]):
+        """
+        Compile the index.
+
+        :param filters: The filters to index, with their position among their siblings
+        """
+
+    @classmethod
+    def can_index(cls, sub_filter: Filter) -> bool:
+        """
+        Check whether the given filter can be handled by this index. Subclasses of the filter class that provide their
+        own matching logic can't be indexed.
+
+        :param sub_filter: The filter to check
+        :return: Whether this index can handle it
+        """
+        raise NotImplementedError
+
+    def get_matches(self, bundle: TransactionBundle) -> Iterable[int]:
+        """
+        Determine which of the indexed filters match the request in the bundle.
+
+        :param bundle: The transaction bundle
+        :return: The positions of the matching filters
+        """
+        raise NotImplementedError
+
+
+class SubFilterDecider:
+    """
+    Determine the decisions of a list of sibling filters, using indexes for groups of filters that support them.
+    """
+
+    # Indexing isn't worth the trouble for fewer filters than this
+    min_index_size = 2
+
+    def __init__(self, sub_filters: List[Filter]):
+        self.sub_filters = sub_filters
+
+        # Group filters by their index class
+        groups = OrderedDict()
+        for position, sub_filter in enumerate(sub_filters):
+            index_class = sub_filter.index_class
+            if sub_filter.cacheable and index_class and index_class.can_index(sub_filter):
+                groups.setdefault(index_class, []).append((position, sub_filter))
+
+        self.indexes = []
+        indexed_positions = set()
+        for index_class, filters in groups.items():
+            if len(filters) < self.min_index_size:
+                continue
+
+            self.indexes.append(index_class(filters))
+            indexed_positions.update([position for position, sub_filter in filters])
+
+        # The rest is evaluated one by one
+        self.unindexed = [(position, sub_filter) for position, sub_filter in enumerate(sub_filters)
+                          if position not in indexed_positions]
+
+    def get_decisions(self, bundle: TransactionBundle) -> Tuple[Hashable, ...]:
+        """
+        Get the decisions of all sub-filters, see :meth:`Filter.get_decision`.
+
+        :param bundle: The transaction bundle
+        :return: A tuple with the decision of each sub-filter
+        """
+        if not self.indexes:
+            return tuple([sub_filter.get_decision(bundle) for sub_filter in self.sub_filters])
+
+        decisions = [None] * len(self.sub_filters)
+
+        for index in self.indexes:
+            for position in index.get_matches(bundle):
+                decisions[position] = self.sub_filters[position].get_matched_decision(bundle)
+
+        for position, sub_filter in self.unindexed:
+            decisions[position] = sub_filter.get_decision(bundle)
+
+        return tuple(decisions)
+
 
 class FilterFactory(ConfigElementFactory):
     """
@@ -1,8 +1,47 @@
 """
 Filter on marks that have been placed on the incoming message
 """
-from dhcpkit.ipv6.server.filters import Filter, FilterFactory
+from dhcpkit.ipv6.server.filters import Filter, FilterFactory, FilterIndex
 from dhcpkit.ipv6.server.transaction_bundle import TransactionBundle
+from typing import Dict, Iterable, List, Tuple
+
+
+class MarkedWithFilterIndex(FilterIndex):
+    """
+    Find all marked-with filters that match the marks on a request with a dictionary lookup per mark
+    """
+
+    def __init__(self, filters: Iterable[Tuple[int, Filter]]):
+        super().__init__(filters)
+
+        self.marks = {}
+        """:type: Dict[str, List[int]]"""
+
+        for position, sub_filter in filters:
+            self.marks.setdefault(sub_filter.filter_condition, []).append(position)
+
+    @classmethod
+    def can_index(cls, sub_filter: Filter) -> bool:
+        """
+        We can index marked-with filters that use the standard matching
+
+        :param sub_filter: The filter to check
+        :return: Whether this index can handle it
+        """
+        return type(sub_filter).match is MarkedWithFilter.match
+
+    def get_matches(self, bundle: TransactionBundle) -> Iterable[int]:
+        """
+        Determine which of the indexed filters match the marks
+
+        :param bundle: The transaction bundle
+        :return: The positions of the matching filters
+        """
+        matches = []
+        for mark in bundle.marks:
+            matches += self.marks.get(mark, [])
+
+        return sorted(matches)
 
 
 class MarkedWithFilter(Filter):
@@ -10,6 +49,8 @@ class MarkedWithFilter(Filter):
     Filter on marks that have been placed on the incoming message
     """
 
+    index_class = MarkedWithFilterIndex
+
     def match(self, bundle: TransactionBundle) -> bool:
         """
         Check if the configured mark is in the set
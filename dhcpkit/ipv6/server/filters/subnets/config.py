@@ -4,9 +4,61 @@ Filter on subnet that the link address is in
 from ipaddress import IPv6Network
 
 from cached_property import cached_property
-from dhcpkit.ipv6.server.filters import Filter, FilterFactory
+from dhcpkit.ipv6.server.filters import Filter, FilterFactory, FilterIndex
 from dhcpkit.ipv6.server.transaction_bundle import TransactionBundle
 from dhcpkit.utils import camelcase_to_dash
+from typing import Dict, Iterable, List, Tuple
+
+
+class SubnetFilterIndex(FilterIndex):
+    """
+    Find all subnet filters that match a link address. Prefixes are stored in a hash table per prefix length, so a
+    lookup takes one probe per distinct prefix length instead of one test per prefix.
+    """
+
+    def __init__(self, filters: Iterable[Tuple[int, Filter]]):
+        super().__init__(filters)
+
+        # Prefix length -> network address -> positions of filters
+        self.prefixes = {}
+        """:type: Dict[int, Dict[int, List[int]]]"""
+
+        for position, sub_filter in filters:
+            for prefix in sub_filter.filter_condition:
+                positions = self.prefixes.setdefault(prefix.prefixlen, {}).setdefault(int(prefix.network_address), [])
+                if position not in positions:
+                    positions.append(position)
+
+        # Pre-compute the masks for each prefix length
+        self.masks = [(((1 << prefix_length) - 1) << (128 - prefix_length), self.prefixes[prefix_length])
+                      for prefix_length in sorted(self.prefixes)]
+
+    @classmethod
+    def can_index(cls, sub_filter: Filter) -> bool:
+        """
+        We can index subnet filters that use the standard matching
+
+        :param sub_filter: The filter to check
+        :return: Whether this index can handle it
+        """
+        return type(sub_filter).match is SubnetFilter.match
+
+    def get_matches(self, bundle: TransactionBundle) -> Iterable[int]:
+        """
+        Determine which of the indexed filters match the link address
+
+        :param bundle: The transaction bundle
+        :return: The positions of the matching filters
+        """
+        address = int(bundle.link_address)
+
+        matches = set()
+        for mask, networks in self.masks:
+            positions = networks.get(address & mask)
+            if positions:
+                matches.update(positions)
+
+        return sorted(matches)
 
 
 class SubnetFilter(Filter):
@@ -14,6 +66,8 @@ class SubnetFilter(Filter):
     Filter on subnet that the link address is in
     """
 
+    index_class = SubnetFilterIndex
+
     @cached_property
     def filter_description(self) -> str:
         """
@@ -0,0 +1,206 @@
+"""
+A flight recorder that keeps the most recent transactions of each worker in shared memory. When investigating a single
+client the main process can find its transactions without having to enable verbose logging for the whole server.
+
+Every worker writes fixed-size records into its own ring buffer, so recording a transaction is just packing a few
+values into shared memory.
+"""
+import struct
+from ctypes import c_char, c_uint32
+from datetime import datetime
+from ipaddress import IPv6Address
+from multiprocessing import Array, Value
+
+from dhcpkit.ipv6.message_registry import message_registry
+from dhcpkit.ipv6.options import ClientIdOption, StatusCodeOption
+from dhcpkit.ipv6.server.transaction_bundle import TransactionBundle
+from dhcpkit.utils import camelcase_to_underscore, normalise_hex
+from typing import Dict, List, Optional
+
+OUTCOME_REPLIED = 1
+OUTCOME_NO_RESPONSE = 2
+OUTCOME_ERROR = 3
+OUTCOME_UNPARSABLE = 4
+
+outcome_names = {
+    OUTCOME_REPLIED: 'replied',
+    OUTCOME_NO_RESPONSE: 'no response',
+    OUTCOME_ERROR: 'error',
+    OUTCOME_UNPARSABLE: 'unparsable',
+}
+
+# Timestamp, latency, message-ID, request type, up to 4 response types, outcome, status code, DUID length, DUID,
+# link address, peer address and handler names
+RECORD = struct.Struct('<dd8sB4sBHB130s16s16s256s')
+
+NO_STATUS = 0xFFFF
+
+
+def get_message_type_name(message_type: int) -> str:
+    """
+    Get a readable name for the given message type
+
+    :param message_type: The message type number
+    :return: The name, like 'solicit' or 'leasequery-reply'
+    """
+    message_class = message_registry.get(message_type)
+    if not message_class:
+        return str(message_type)
+
+    name = camelcase_to_underscore(message_class.__name__)
+    if name.endswith('_message'):
+        name = name[:-8]
+    return name.replace('_', '-')
+
+
+class FlightRecorder:
+    """
+    Ring buffers of recent transactions in shared memory, one for each worker
+    """
+
+    def __init__(self, workers: int, size: int):
+        """
+        Allocate the shared memory
+
+        :param workers: The number of worker processes
+        :param size: The number of transactions to remember per worker
+        """
+        self.size = size
+        self.rings = [Array(c_char, size * RECORD.size) for _ in range(workers)]
+        self.positions = [Value(c_uint32, lock=False) for _ in range(workers)]
+        self.next_ring = Value(c_uint32)
+
+        # Set in the worker process
+        self.ring_index = None
+
+    def claim_ring(self):
+        """
+        Claim a ring buffer for the current worker process. Workers that replace a crashed worker may end up sharing
+        a ring, which is safe because writes are done while holding the lock of the ring.
+        """
+        with self.next_ring.get_lock():
+            self.ring_index = self.next_ring.value % len(self.rings)
+            self.next_ring.value += 1
+
+    def record(self, timestamp: float, latency: float, message_id: str, outcome: int,
+               bundle: Optional[TransactionBundle]):
+        """
+        Record a transaction in the ring buffer of this worker
+
+        :param timestamp: When the request was received
+        :param latency: How long it took to handle the request
+        :param message_id: The message-ID used in logging
+        :param outcome: The outcome of the transaction
+        :param bundle: The transaction bundle, or None if the request couldn't be parsed
+        """
+        request_type = 0
+        response_types = b''
+        status_code = NO_STATUS
+        duid = b''
+        link_address = b''
+        peer_address = b''
+        handlers = b''
+
+        if bundle and bundle.request:
+            request_type = bundle.request.message_type
+
+            client_id = bundle.request.get_option_of_type(ClientIdOption)
+            if client_id:
+                duid = client_id.duid.save()
+
+            if bundle.incoming_relay_messages:
+                link_address = bundle.incoming_relay_messages[0].link_address.packed
+                peer_address = bundle.incoming_relay_messages[0].peer_address.packed
+
+            response_types = bytes([response.message_type for response in bundle.responses][:4])
+            if bundle.responses:
+                status = bundle.responses[0].get_option_of_type(StatusCodeOption)
+                if status:
+                    status_code = status.status_code
+
+            if bundle.handler_chain:
+                handlers = bundle.handler_chain.description.encode('utf-8')
+
+        ring = self.rings[self.ring_index]
+        position = self.positions[self.ring_index]
+        with ring.get_lock():
+            RECORD.pack_into(ring.get_obj(), position.value * RECORD.size,
+                             timestamp, latency, message_id.encode('ascii', errors='replace'),
+                             request_type, response_types, outcome, status_code, len(duid), duid,
+                             link_address, peer_address, handlers)
+            position.value = (position.value + 1) % self.size
+
+    def find(self, duid: bytes = None, address: IPv6Address = None) -> List[Dict[str, object]]:
+        """
+        Find the recorded transactions of a client in all ring buffers
+
+        :param duid: The DUID of the client
+        :param address: The link or peer address of the client
+        :return: The matching transactions, oldest first
+        """
+        packed_address = address.packed if address else None
+
+        found = []
+        for ring in self.rings:
+            with ring.get_lock():
+                data = ring.get_obj().raw
+
+            for offset in range(0, len(data), RECORD.size):
+                (timestamp, latency, message_id, request_type, response_types, outcome, status_code, duid_length,
+                 record_duid, link_address, peer_address, handlers) = RECORD.unpack_from(data, offset)
+
+                if not timestamp:
+                    # Never used
+                    continue
+
+                record_duid = record_duid[:duid_length]
+                if duid is not None and record_duid != duid:
+                    continue
+
+                if packed_address is not None and packed_address not in (link_address, peer_address):
+                    continue
+
+                found.append({
+                    'timestamp': timestamp,
+                    'latency': latency,
+                    'message_id': message_id.rstrip(b'\x00').decode('ascii'),
+                    'request': get_message_type_name(request_type) if request_type else None,
+                    'responses': [get_message_type_name(message_type)
+                                  for message_type in response_types.rstrip(b'\x00')],
+                    'outcome': outcome_names.get(outcome, str(outcome)),
+                    'status_code': status_code if status_code != NO_STATUS else None,
+                    'duid': normalise_hex(record_duid) if record_duid else None,
+                    'link_address': str(IPv6Address(link_address)) if request_type else None,
+                    'peer_address': str(IPv6Address(peer_address)) if request_type else None,
+                    'handlers': handlers.rstrip(b'\x00').decode('utf-8', errors='replace'),
+                })
+
+        found.sort(key=lambda transaction: transaction['timestamp'])
+        return found
+
+
+def format_transaction(transaction: Dict[str, object]) -> str:
+    """
+    Format a recorded transaction as a single line
+
+    :param transaction: The transaction as returned by :meth:`FlightRecorder.find`
+    :return: A readable line
+    """
+    timestamp = datetime.fromtimestamp(transaction['timestamp']).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+    output = '{} {} {}'.format(timestamp, transaction['message_id'], transaction['request'] or 'unknown')
+    if transaction['responses']:
+        output += ' -> {}'.format(', '.join(transaction['responses']))
+    output += ' ({}'.format(transaction['outcome'])
+    if transaction['status_code'] is not None:
+        output += ', status {}'.format(transaction['status_code'])
+    output += ', {:.3f}ms)'.format(transaction['latency'] * 1000)
+
+    if transaction['duid']:
+        output += ' duid {}'.format(transaction['duid'])
+    if transaction['peer_address']:
+        output += ' from {} via {}'.format(transaction['peer_address'], transaction['link_address'])
+    if transaction['handlers']:
+        output += ' handlers: {}'.format(transaction['handlers'])
+
+    return output
@@ -94,18 +94,18 @@ def create_file(name, args):
     full_name = os.path.join(args.output_dir, name)
 
     if args.dry_run:
-        logger.info("Dry-run, would have written to {}".format(full_name))
+        logger.info("Dry-run, would have written to %s", full_name)
         return io.StringIO()
 
     if os.path.exists(full_name) and not args.force:
-        logger.info("Skipping existing file, would have written to {}".format(full_name))
+        logger.info("Skipping existing file, would have written to %s", full_name)
         return None
 
     # Make the directory, just to be sure
     os.makedirs(os.path.dirname(full_name), exist_ok=True)
 
     # Create and return the file
-    logger.info("Creating {}".format(full_name))
+    logger.info("Creating %s", full_name)
     return open(full_name, 'w')
 
 
@@ -528,7 +528,7 @@ def run() -> int:
         # Run the server
         return main(sys.argv[1:])
     except Exception as e:
-        logger.critical("Error: {}".format(e))
+        logger.critical("Error: %s", e)
         return 1
 
 
@@ -3,6 +3,7 @@ Handlers to apply to transaction bundles
 """
 
 import logging
+from typing import Iterable, Iterator, List
 
 from dhcpkit.common.server.config_elements import ConfigElementFactory
 from dhcpkit.ipv6.messages import RelayForwardMessage, RelayReplyMessage
@@ -116,6 +117,70 @@ class Handler:
         """
 
 
+class HandlerChain:
+    """
+    The handlers to apply to a request, with per-phase lists that only contain the handlers that actually implement
+    that phase. This avoids calling the empty methods of the base class for every request.
+
+    :type handlers: Tuple[Handler]
+    :type analyse_pre_handlers: List[Handler]
+    :type pre_handlers: List[Handler]
+    :type handle_handlers: List[Handler]
+    :type post_handlers: List[Handler]
+    :type analyse_post_handlers: List[Handler]
+    :type description: str
+    """
+
+    def __init__(self, handlers: Iterable[Handler], description_handlers: Iterable[Handler] = None):
+        """
+        Create the per-phase lists
+
+        :param handlers: The handlers in the chain
+        :param description_handlers: The handlers to mention in the description, defaults to all of them
+        """
+        self.handlers = tuple(handlers)
+        self.description = ', '.join([type(handler).__name__
+                                      for handler in (self.handlers if description_handlers is None
+                                                      else description_handlers)])
+
+        self.analyse_pre_handlers = self.get_phase_handlers('analyse_pre')
+        self.pre_handlers = self.get_phase_handlers('pre')
+        self.handle_handlers = self.get_phase_handlers('handle')
+        self.post_handlers = self.get_phase_handlers('post')
+        self.analyse_post_handlers = self.get_phase_handlers('analyse_post')
+
+    def __iter__(self) -> Iterator[Handler]:
+        return iter(self.handlers)
+
+    def __len__(self) -> int:
+        return len(self.handlers)
+
+    @staticmethod
+    def implements_phase(handler: Handler, phase: str) -> bool:
+        """
+        Check whether the handler does something in the given phase. Anything that isn't the no-op implementation of
+        the base class counts as an implementation.
+
+        :param handler: The handler to check
+        :param phase: The name of the method for the phase
+        :return: Whether it needs to be called
+        """
+        if phase in getattr(handler, '__dict__', {}):
+            # Set on the instance
+            return True
+
+        return getattr(type(handler), phase, None) is not getattr(Handler, phase)
+
+    def get_phase_handlers(self, phase: str) -> List[Handler]:
+        """
+        Get the handlers that implement the given phase, in order
+
+        :param phase: The name of the method for the phase
+        :return: The handlers to call in that phase
+        """
+        return [handler for handler in self.handlers if self.implements_phase(handler, phase)]
+
+
 class RelayHandler(Handler):
     """
     A base class for handlers that work on option in the relay messages chain.
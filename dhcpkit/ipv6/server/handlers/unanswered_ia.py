@@ -59,7 +59,7 @@ class UnansweredIAOptionHandler(Handler):
                     raise CannotRespondError("Server is not authoritative and cannot reject confirm")
 
                 addresses = ', '.join(map(str, option.get_addresses()))
-                logger.warning("No handler confirmed {}: sending NotOnLink status".format(addresses))
+                logger.warning("No handler confirmed %s: sending NotOnLink status", addresses)
 
                 force_status(bundle.response.options,
                              StatusCodeOption(STATUS_NOT_ON_LINK, "Those addresses are not appropriate on this link"))
@@ -73,7 +73,7 @@ class UnansweredIAOptionHandler(Handler):
                 addresses = ', '.join(map(str, option.get_addresses()))
 
                 if self.authoritative:
-                    logger.warning("No handler renewed {}: withdrawing addresses".format(addresses))
+                    logger.warning("No handler renewed %s: withdrawing addresses", addresses)
 
                     reply_suboptions = []
                     for suboption in option.get_options_of_type(IAAddressOption):
@@ -82,7 +82,7 @@ class UnansweredIAOptionHandler(Handler):
 
                     bundle.response.options.append(ia_class(option.iaid, options=reply_suboptions))
                 else:
-                    logger.warning("No handler renewed {}: sending NoBinding status".format(addresses))
+                    logger.warning("No handler renewed %s: sending NoBinding status", addresses)
 
                     bundle.response.options.append(ia_class(option.iaid, options=[
                         StatusCodeOption(STATUS_NO_BINDING, "No addresses assigned to you")
@@ -103,7 +103,7 @@ class UnansweredIAOptionHandler(Handler):
                     raise CannotRespondError("Server is not authoritative and cannot reject rebind")
 
                 addresses = ', '.join(map(str, option.get_addresses()))
-                logger.warning("No handler answered rebind of {}: withdrawing addresses".format(addresses))
+                logger.warning("No handler answered rebind of %s: withdrawing addresses", addresses)
 
                 reply_suboptions = []
                 for suboption in option.get_options_of_type(IAAddressOption):
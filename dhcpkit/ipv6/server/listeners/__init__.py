@@ -8,7 +8,7 @@ from ipaddress import IPv6Address
 
 from dhcpkit.ipv6.messages import RelayReplyMessage
 from dhcpkit.ipv6.options import Option
-from typing import Iterable, Optional, Tuple
+from typing import Iterable, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +32,16 @@ def increase_message_counter():
     return message_counter
 
 
+def format_message_id(message_number: int) -> str:
+    """
+    Format a message number as it is shown in the logs
+
+    :param message_number: The number from the message counter
+    :return: The message-ID
+    """
+    return '#{:06X}'.format(message_number)
+
+
 class ListenerError(Exception):
     """
     Base class for listener errors
@@ -71,7 +81,7 @@ class IncomingPacketBundle:
     properties should have a default value, and the constructor must be called with keyword arguments only.
     """
 
-    def __init__(self, *, message_id: str = '??????', data: bytes = b'',
+    def __init__(self, *, message_id: str = None, message_number: int = None, data: bytes = b'',
                  source_address: IPv6Address = None, link_address: IPv6Address = None, interface_index: int = -1,
                  received_over_multicast: bool = False, received_over_tcp: bool = False, marks: Iterable[str] = None,
                  relay_options: Iterable[Option] = None):
@@ -79,6 +89,8 @@ class IncomingPacketBundle:
         Store the provided data
 
         :param message_id: An identifier for logging to correlate log-messages
+        :param message_number: The number to create the message_id from when it is needed, which is cheaper for the
+                               listeners than formatting the message_id themselves
         :param data: The bytes received from the listener
         :param source_address: The IPv6 address of the sender
         :param link_address: The IPv6 address to identify the link that the packet was received over
@@ -88,23 +100,42 @@ class IncomingPacketBundle:
         :param marks: A list of marks, usually set by the listener based on the configuration
         :param relay_options: Extra relay options from the interface
         """
-        self.message_id = message_id
+        self._message_id = message_id
+        self.message_number = message_number
         self.data = data
         self.source_address = source_address
         self.link_address = link_address or IPv6Address(0)
         self.interface_index = interface_index
         self.received_over_multicast = received_over_multicast
         self.received_over_tcp = received_over_tcp
-        self.marks = list(marks or [])
-        self.relay_options = list(relay_options or [])
+        # Tuples are immutable, which lets listeners share the same marks and relay options between packets
+        self.marks = tuple(marks or ())
+        self.relay_options = tuple(relay_options or ())
+
+    @property
+    def message_id(self) -> str:
+        """
+        The identifier for logging, formatted from the message number when it is first needed
+
+        :return: The message-ID
+        """
+        if self._message_id is None:
+            if self.message_number is None:
+                self._message_id = '??????'
+            else:
+                self._message_id = format_message_id(self.message_number)
+
+        return self._message_id
 
     def __getstate__(self):
-        return (self.message_id, self.data, self.source_address, self.link_address, self.interface_index,
-                self.received_over_multicast, self.received_over_tcp, self.marks, self.relay_options)
+        return (self._message_id, self.message_number, self.data, self.source_address, self.link_address,
+                self.interface_index, self.received_over_multicast, self.received_over_tcp, self.marks,
+                self.relay_options)
 
     def __setstate__(self, state):
-        (self.message_id, self.data, self.source_address, self.link_address, self.interface_index,
-         self.received_over_multicast, self.received_over_tcp, self.marks, self.relay_options) = state
+        (self._message_id, self.message_number, self.data, self.source_address, self.link_address,
+         self.interface_index, self.received_over_multicast, self.received_over_tcp, self.marks,
+         self.relay_options) = state
 
 
 class Replier:
@@ -128,8 +159,24 @@ class Replier:
 class Listener:
     """
     A class to represent something listening for incoming requests.
+
+    :type edge_triggered: bool
     """
 
+    # Listeners that keep receiving until their socket has nothing left, or that say they are backlogged when they
+    # stop early, can be watched in edge-triggered mode
+    edge_triggered = False
+
+    @property
+    def name(self) -> str:
+        """
+        A short description of this listener, used for keeping statistics per listener. Listeners that come and go,
+        like TCP connections, should share their name with their siblings.
+
+        :return: The name of this listener
+        """
+        return type(self).__name__
+
     def recv_request(self) -> Tuple[IncomingPacketBundle, Replier]:
         """
         Receive incoming messages
@@ -138,6 +185,62 @@ class Listener:
         """
         raise NotImplementedError
 
+    def recv_requests(self) -> List[Tuple[IncomingPacketBundle, Replier]]:
+        """
+        Receive all incoming messages that are available after a readiness event. Listeners that can receive multiple
+        messages in one go, like TCP connections, should override this. The default receives a single message.
+
+        :return: A list of incoming packet data and replier objects
+        """
+        return [self.recv_request()]
+
+    @property
+    def backlogged(self) -> bool:
+        """
+        Whether this listener still has received requests that it didn't return yet, or might have more data waiting
+        on its socket. Listeners that limit how many requests they return at once, to give other listeners a fair
+        turn, use this to be called again even though their socket isn't reported as readable. This is checked after
+        each call to :meth:`recv_requests`.
+
+        :return: Whether there are requests waiting
+        """
+        return False
+
+    def set_worker_pool(self, pool):
+        """
+        Tell this listener which worker pool handles its requests, or None when the pool stops. Listeners that can
+        wait for the workers instead of having requests dropped, like replaying a capture file, use it to see how busy
+        the workers are.
+
+        :param pool: The worker pool
+        :type pool: dhcpkit.ipv6.server.nonblocking_pool.NonBlockingPool
+        """
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """
+        The time (from :func:`time.monotonic`) at which this listener wants :meth:`expired` to be checked, or None.
+
+        :return: The deadline
+        """
+        return None
+
+    def expired(self, now: float) -> bool:
+        """
+        Check whether this listener should be closed, for example because it has been idle for too long. This is called
+        when the deadline has passed.
+
+        :param now: The current time (from :func:`time.monotonic`)
+        :return: Whether to close this listener
+        """
+        return False
+
+    def close(self):
+        """
+        Close this listener. This is called when a listener expires or is dropped by a reload. Listeners that don't
+        expire and whose sockets may be recycled by a reload, like UDP listeners, don't implement this.
+        """
+
     def fileno(self) -> int:
         """
         The fileno of the listening socket, so this object can be used by select()
@@ -160,6 +263,15 @@ class ListenerCreator:
         """
         raise NotImplementedError
 
+    @property
+    def open_listeners(self) -> int:
+        """
+        The number of listeners created by this object that are still open, for the statistics
+
+        :return: The number of open listeners
+        """
+        return 0
+
     def fileno(self) -> int:
         """
         The fileno of the listening socket, so this object can be used by select()
@@ -44,10 +44,49 @@ class ListenerFactory(ConfigElementFactory):
 class UDPListenerFactory(ListenerFactory):
     """
     Base class for UDP listener factories
+
+    :type reuse_address: bool
     """
     sock_type = socket.SOCK_DGRAM
     sock_proto = socket.IPPROTO_UDP
 
+    # Set by the main configuration when a listener on the wildcard address is configured
+    reuse_address = False
+
+    @property
+    def listens_on_wildcard(self) -> bool:
+        """
+        Whether this listener listens on the wildcard address, which requires address re-use on all UDP listeners.
+
+        :return: Whether this is a wildcard listener
+        """
+        return False
+
+    def recycle_socket(self, sock: socket.socket) -> socket.socket:
+        """
+        Prepare a socket of a previous configuration for re-use. It gets the address re-use setting of the current
+        configuration, so a wildcard listener can be added or removed by a reload.
+
+        :param sock: An existing socket that matched
+        :return: The same socket
+        """
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, int(self.reuse_address))
+        return sock
+
+    def create_socket(self) -> socket.socket:
+        """
+        Create a new UDP socket. When a listener on the wildcard address is configured, address re-use is enabled so
+        that it can be combined with listeners on specific addresses. The kernel delivers unicast packets to the most
+        specific socket. Address re-use is not enabled otherwise, because then another process could bind to the same
+        address and port without us noticing, and packets would be delivered to only one of us.
+
+        :return: An unbound socket
+        """
+        sock = socket.socket(socket.AF_INET6, self.sock_type, self.sock_proto)
+        if self.reuse_address:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        return sock
+
 
 class TCPListenerFactory(ListenerFactory):
     """
@@ -0,0 +1,122 @@
+"""
+A listener for Relay-Forward messages from a local test harness. It listens on a loopback address on any port, so it
+doesn't need root privileges or real network interfaces, and it sends the Relay-Reply messages back to the port that
+the Relay-Forward came from.
+"""
+import logging
+import socket
+
+from dhcpkit.common.server.logging import DEBUG_PACKETS
+from dhcpkit.ipv6.messages import MSG_RELAY_FORW, RelayReplyMessage
+from dhcpkit.ipv6.server.listeners import IgnoreMessage, IncomingPacketBundle, ListeningSocketError, Replier
+from dhcpkit.ipv6.server.listeners.udp import UDPListener, UDPReplier
+from typing import Iterable, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class LoopbackRelayListener(UDPListener):
+    """
+    A listener on a loopback address that only accepts Relay-Forward messages. The interface name is not a real
+    interface, it is what the handlers see the requests coming in on.
+
+    :type repliers: Dict[int, LoopbackRelayReplier]
+    """
+
+    # Test harnesses use whatever port is convenient
+    required_port = None
+
+    def __init__(self, interface_name: str, listen_socket: socket.socket, marks: Iterable[str] = None):
+        """
+        Initialise listener.
+
+        :param interface_name: The name of the interface that the handlers see the requests coming in on
+        :param listen_socket: The socket we are listening on, bound to a loopback address
+        :param marks: Marks attached to this listener
+        """
+        super().__init__(interface_name, listen_socket, marks=marks)
+
+        if not self.listen_address.is_loopback:
+            raise ListeningSocketError("Relay injection is only allowed on a loopback address")
+
+        self.listen_port = self.listen_socket.getsockname()[1]
+
+        # A test harness usually sends from one port, so there will only be a few of these
+        self.repliers = {}
+
+    @property
+    def name(self) -> str:
+        """
+        A short description of this listener, used for keeping statistics per listener.
+
+        :return: The name of this listener
+        """
+        return 'loopback {}/[{}]:{}'.format(self.interface_name, self.listen_address, self.listen_port)
+
+    def receive(self, flags: int = 0) -> Tuple[IncomingPacketBundle, Replier]:
+        """
+        Receive a single incoming message, which must be a Relay-Forward message
+
+        :param flags: The flags to pass to recvmsg
+        :return: The incoming packet data and a replier object
+        """
+        packet_bundle, replier = super().receive(flags)
+        if not packet_bundle.data or packet_bundle.data[0] != MSG_RELAY_FORW:
+            raise IgnoreMessage("{}: Loopback relay listener only accepts Relay-Forward messages".format(
+                packet_bundle.message_id))
+
+        return packet_bundle, replier
+
+    def get_replier(self, sender: Tuple) -> Replier:
+        """
+        Get the replier that sends replies back to the port that the packet came from
+
+        :param sender: The socket address that the packet came from
+        :return: The replier
+        """
+        replier = self.repliers.get(sender[1])
+        if replier is None:
+            replier = LoopbackRelayReplier(self.reply_socket, sender[1])
+            self.repliers[sender[1]] = replier
+
+        return replier
+
+
+class LoopbackRelayReplier(UDPReplier):
+    """
+    A class to send Relay-Reply messages back to the test harness
+
+    :type port: int
+    """
+
+    def __init__(self, reply_socket: socket.socket, port: int):
+        """
+        Initialise the replier
+
+        :param reply_socket: The socket to send replies from
+        :param port: The port to send replies to
+        """
+        super().__init__(reply_socket)
+        self.port = port
+
+    def send_reply(self, outgoing_message: RelayReplyMessage) -> bool:
+        """
+        Send a reply to the test harness. The interface-id is not a real interface, so it isn't looked up.
+
+        :param outgoing_message: The message to send, including a wrapping RelayReplyMessage
+        :return: Whether sending was successful
+        """
+        destination_address = str(outgoing_message.peer_address)
+        data = outgoing_message.relayed_message.save()
+
+        sent_length = self.reply_socket.sendto(data, (destination_address, self.port))
+        success = len(data) == sent_length
+
+        if success:
+            logger.log(DEBUG_PACKETS, "Sent %s to %s port %s", outgoing_message.inner_message.__class__.__name__,
+                       destination_address, self.port)
+        else:
+            logger.error("Could not send %s to %s port %s", outgoing_message.inner_message.__class__.__name__,
+                         destination_address, self.port)
+
+        return success
@@ -0,0 +1,3 @@
+"""
+Factory for a listener that accepts Relay-Forward messages from a local test harness
+"""
@@ -0,0 +1,61 @@
+"""
+Factory for a listener that accepts Relay-Forward messages from a local test harness
+"""
+import logging
+import socket
+
+from dhcpkit.ipv6.server.listeners import Listener
+from dhcpkit.ipv6.server.listeners.factories import UDPListenerFactory
+from dhcpkit.ipv6.server.listeners.loopback import LoopbackRelayListener
+from typing import Iterable
+
+logger = logging.getLogger(__name__)
+
+
+class LoopbackRelayListenerFactory(UDPListenerFactory):
+    """
+    Factory for a listener that accepts Relay-Forward messages from a local test harness
+    """
+
+    @property
+    def listen_port(self) -> int:
+        """
+        The port to listen on comes from the configuration
+
+        :return: The port number
+        """
+        return self.port
+
+    def validate_config_section(self):
+        """
+        Validate the address and port
+        """
+        if not self.address.is_loopback:
+            raise ValueError("The loopback relay listener address must be a loopback address")
+
+        if not self.port:
+            raise ValueError("The loopback relay listener needs a port")
+
+    def create(self, old_listeners: Iterable[Listener] = None) -> LoopbackRelayListener:
+        """
+        Create a listener of this class based on the configuration in the config section.
+
+        :param old_listeners: A list of existing listeners in case we can recycle them
+        :return: A listener object
+        """
+        # Try recycling
+        old_listeners = list(old_listeners or [])
+        for old_listener in old_listeners:
+            if not isinstance(old_listener, LoopbackRelayListener):
+                continue
+
+            if self.match_socket(sock=old_listener.listen_socket, address=self.address):
+                logger.debug("Recycling existing socket for [%s]:%d", self.address, self.port)
+                sock = self.recycle_socket(old_listener.listen_socket)
+                break
+        else:
+            logger.debug("Creating socket for [%s]:%d", self.address, self.port)
+            sock = self.create_socket()
+            sock.bind((str(self.address), self.port))
+
+        return LoopbackRelayListener(self.interface, sock, marks=self.marks)
@@ -92,12 +92,12 @@ class MulticastInterfaceUDPListenerFactory(UDPListenerFactory):
                 continue
 
             if self.match_socket(sock=old_listener.listen_socket, address=mc_address, interface=interface_index):
-                logger.debug("Recycling existing multicast socket on {}".format(self.name))
-                mc_sock = old_listener.listen_socket
+                logger.debug("Recycling existing multicast socket on %s", self.name)
+                mc_sock = self.recycle_socket(old_listener.listen_socket)
                 break
         else:
-            logger.debug("Listening for multicast requests on {}".format(self.name))
-            mc_sock = socket.socket(socket.AF_INET6, self.sock_type, self.sock_proto)
+            logger.debug("Listening for multicast requests on %s", self.name)
+            mc_sock = self.create_socket()
             mc_sock.bind((str(mc_address), self.listen_port, 0, interface_index))
             mc_sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP,
                                pack('16sI', mc_address.packed, interface_index))
@@ -110,17 +110,17 @@ class MulticastInterfaceUDPListenerFactory(UDPListenerFactory):
                 continue
 
             if self.match_socket(sock=old_listener.listen_socket, address=self.reply_from, interface=interface_index):
-                logger.debug("  - Recycling existing reply socket for {} on {}".format(self.reply_from, self.name))
-                ll_sock = old_listener.listen_socket
+                logger.debug("  - Recycling existing reply socket for %s on %s", self.reply_from, self.name)
+                ll_sock = self.recycle_socket(old_listener.listen_socket)
                 break
 
             if self.match_socket(sock=old_listener.reply_socket, address=self.reply_from, interface=interface_index):
-                logger.debug("  - Recycling existing reply socket for {} on {}".format(self.reply_from, self.name))
-                ll_sock = old_listener.reply_socket
+                logger.debug("  - Recycling existing reply socket for %s on %s", self.reply_from, self.name)
+                ll_sock = self.recycle_socket(old_listener.reply_socket)
                 break
         else:
-            logger.debug("  - Sending replies from {}".format(self.reply_from))
-            ll_sock = socket.socket(socket.AF_INET6, self.sock_type, self.sock_proto)
+            logger.debug("  - Sending replies from %s", self.reply_from)
+            ll_sock = self.create_socket()
             ll_sock.bind((str(self.reply_from), self.listen_port, 0, interface_index))
 
         return UDPListener(interface_name=self.name, listen_socket=mc_sock, reply_socket=ll_sock,
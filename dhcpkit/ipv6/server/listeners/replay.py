@@ -0,0 +1,555 @@
+"""
+A listener that replays DHCPv6 requests from a pcap or pcapng file. The requests go through the worker pool and the
+handlers like requests from the network do, and the replies are discarded. This makes it possible to test the
+performance of the whole server with recorded traffic, without needing a network or clients.
+"""
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from ipaddress import IPv6Address
+
+from dhcpkit.common.server.logging import DEBUG_PACKETS
+from dhcpkit.ipv6 import SERVER_PORT
+from dhcpkit.ipv6.message_registry import message_registry
+from dhcpkit.ipv6.messages import RelayReplyMessage
+from dhcpkit.ipv6.options import InterfaceIdOption
+from dhcpkit.ipv6.server.capture import BLOCK_ENHANCED_PACKET, BLOCK_INTERFACE_DESCRIPTION, BLOCK_SECTION_HEADER, \
+    LINKTYPE_IPV6
+from dhcpkit.ipv6.server.listeners import IgnoreMessage, IncomingPacketBundle, Listener, Replier, \
+    increase_message_counter
+from dhcpkit.ipv6.server.nonblocking_pool import NonBlockingPool
+from typing import BinaryIO, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+BLOCK_SIMPLE_PACKET = 0x00000003
+OPTION_IF_TSRESOL = 9
+
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88A8)
+
+# IPv6 extension headers that we can skip to find the UDP header
+EXTENSION_HEADERS = (0, 43, 60)
+IPPROTO_UDP = 17
+
+# A pcapng file starts with a section header block, which has a palindromic block type
+PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+
+# Byte order and timestamp resolution per pcap magic number
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1e-6),
+    b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9),
+    b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+}
+
+# The number of requests to return at once and to keep ready
+RECEIVE_BATCH_SIZE = 64
+QUEUE_SIZE = 1000
+
+# The number of requests per worker that may be waiting in the worker pool, and how often to check for room when it is
+# full. Replaying waits for the workers instead of having requests dropped or queued without limit.
+PENDING_PER_WORKER = 4
+BACKPRESSURE_INTERVAL = 0.01
+
+UDPPacket = NamedTuple('UDPPacket', [('source', bytes), ('source_port', int),
+                                     ('destination', bytes), ('destination_port', int),
+                                     ('payload', bytes)])
+
+
+def read_pcap_frames(capture_file: BinaryIO, magic: bytes) -> Iterator[Tuple[float, int, bytes]]:
+    """
+    Read the frames from a classic pcap file
+
+    :param capture_file: The file, positioned after the magic number
+    :param magic: The magic number that the file started with
+    :return: The timestamp, link type and contents of each frame
+    """
+    byte_order, resolution = PCAP_MAGIC[magic]
+    header = capture_file.read(20)
+    if len(header) < 20:
+        raise ValueError("Truncated pcap file header")
+
+    link_type = struct.unpack(byte_order + 'HHiIII', header)[5] & 0xFFFF
+    record_header = struct.Struct(byte_order + 'IIII')
+
+    while True:
+        header = capture_file.read(record_header.size)
+        if len(header) < record_header.size:
+            return
+
+        seconds, fraction, captured_length, original_length = record_header.unpack(header)
+        frame = capture_file.read(captured_length)
+        if len(frame) < captured_length:
+            return
+
+        yield seconds + fraction * resolution, link_type, frame
+
+
+def read_pcapng_frames(capture_file: BinaryIO) -> Iterator[Tuple[float, int, bytes]]:
+    """
+    Read the frames from a pcapng file
+
+    :param capture_file: The file, positioned after the block type of the first section header block
+    :return: The timestamp, link type and contents of each frame
+    :raises ValueError: When a block is too short for its type or refers to an interface that wasn't described
+    """
+    block_type = BLOCK_SECTION_HEADER
+    byte_order = '<'
+    interfaces = []  # type: List[Tuple[int, float]]
+    timestamp = 0.0
+
+    while True:
+        if block_type == BLOCK_SECTION_HEADER:
+            # The byte order magic tells us how to read the length
+            header = capture_file.read(8)
+            if len(header) < 8:
+                return
+
+            byte_order = '<' if header[4:8] == b'\x4d\x3c\x2b\x1a' else '>'
+            total_length = struct.unpack(byte_order + 'I', header[:4])[0]
+            body = header[4:] + capture_file.read(max(total_length - 16, 0))
+            interfaces = []
+        else:
+            header = capture_file.read(4)
+            if len(header) < 4:
+                return
+
+            total_length = struct.unpack(byte_order + 'I', header)[0]
+            body = capture_file.read(max(total_length - 12, 0))
+
+        if total_length < 12 or len(body) < total_length - 12 or len(capture_file.read(4)) < 4:
+            return
+
+        if block_type == BLOCK_INTERFACE_DESCRIPTION:
+            if len(body) < 8:
+                raise ValueError("Truncated pcapng interface description block")
+
+            link_type = struct.unpack_from(byte_order + 'H', body)[0]
+            interfaces.append((link_type, get_pcapng_resolution(body[8:], byte_order)))
+
+        elif block_type == BLOCK_ENHANCED_PACKET:
+            if len(body) < 20:
+                raise ValueError("Truncated pcapng enhanced packet block")
+
+            interface_id, high, low, captured_length = struct.unpack_from(byte_order + 'IIII', body)
+            if interface_id >= len(interfaces):
+                raise ValueError("Enhanced packet block for undescribed interface {}".format(interface_id))
+
+            link_type, resolution = interfaces[interface_id]
+            timestamp = ((high << 32) | low) * resolution
+            yield timestamp, link_type, body[20:20 + captured_length]
+
+        elif block_type == BLOCK_SIMPLE_PACKET and interfaces:
+            if len(body) < 4:
+                raise ValueError("Truncated pcapng simple packet block")
+
+            # No timestamp, so pretend it arrived together with the previous packet
+            original_length = struct.unpack_from(byte_order + 'I', body)[0]
+            yield timestamp, interfaces[0][0], body[4:4 + original_length]
+
+        header = capture_file.read(4)
+        if len(header) < 4:
+            return
+
+        block_type = struct.unpack(byte_order + 'I', header)[0]
+
+
+def get_pcapng_resolution(options: bytes, byte_order: str) -> float:
+    """
+    Find the timestamp resolution in the options of an interface description block
+
+    :param options: The options of the block
+    :param byte_order: The byte order of the section
+    :return: The resolution in seconds
+    """
+    offset = 0
+    while offset + 4 <= len(options):
+        code, length = struct.unpack_from(byte_order + 'HH', options, offset)
+        if code == OPTION_IF_TSRESOL and length >= 1 and offset + 4 < len(options):
+            value = options[offset + 4]
+            return 2 ** -(value & 0x7F) if value & 0x80 else 10 ** -value
+        if code == 0:
+            break
+        offset += 4 + length + (-length % 4)
+
+    return 1e-6
+
+
+def read_capture_frames(capture_file: BinaryIO) -> Iterator[Tuple[float, int, bytes]]:
+    """
+    Read the frames from a pcap or pcapng file
+
+    :param capture_file: The file to read from
+    :return: The timestamp, link type and contents of each frame
+    """
+    magic = capture_file.read(4)
+    if magic == PCAPNG_MAGIC:
+        yield from read_pcapng_frames(capture_file)
+    elif magic in PCAP_MAGIC:
+        yield from read_pcap_frames(capture_file, magic)
+    else:
+        raise ValueError("Not a pcap or pcapng file")
+
+
+def parse_udp_frame(link_type: int, frame: bytes) -> Optional[UDPPacket]:
+    """
+    Find the IPv6 UDP packet in a captured frame
+
+    :param link_type: The link type of the frame
+    :param frame: The captured frame
+    :return: The UDP packet, or None if the frame doesn't contain an unfragmented IPv6 UDP packet
+    """
+    if link_type == LINKTYPE_ETHERNET:
+        offset = 12
+        ethertype = struct.unpack_from('!H', frame, offset)[0] if len(frame) >= 14 else 0
+        while ethertype in ETHERTYPE_VLAN and len(frame) >= offset + 8:
+            offset += 4
+            ethertype = struct.unpack_from('!H', frame, offset)[0]
+        if ethertype != ETHERTYPE_IPV6:
+            return None
+        offset += 2
+    elif link_type in (LINKTYPE_RAW, LINKTYPE_IPV6):
+        offset = 0
+    elif link_type == LINKTYPE_LINUX_SLL:
+        if len(frame) < 16 or struct.unpack_from('!H', frame, 14)[0] != ETHERTYPE_IPV6:
+            return None
+        offset = 16
+    elif link_type == LINKTYPE_LINUX_SLL2:
+        if len(frame) < 20 or struct.unpack_from('!H', frame, 0)[0] != ETHERTYPE_IPV6:
+            return None
+        offset = 20
+    elif link_type == LINKTYPE_NULL:
+        # The address family is in host byte order and differs between systems, so just look at the IP version
+        offset = 4
+    else:
+        return None
+
+    if len(frame) < offset + 40 or frame[offset] >> 4 != 6:
+        return None
+
+    next_header = frame[offset + 6]
+    source = frame[offset + 8:offset + 24]
+    destination = frame[offset + 24:offset + 40]
+    offset += 40
+
+    while next_header in EXTENSION_HEADERS and len(frame) >= offset + 8:
+        next_header, length = frame[offset], frame[offset + 1]
+        offset += (length + 1) * 8
+
+    if next_header != IPPROTO_UDP or len(frame) < offset + 8:
+        return None
+
+    source_port, destination_port, udp_length = struct.unpack_from('!HHH', frame, offset)
+    return UDPPacket(source, source_port, destination, destination_port, frame[offset + 8:offset + udp_length])
+
+
+class SinkReplier(Replier):
+    """
+    A replier that discards the replies
+    """
+
+    can_send_multiple = True
+
+    def send_reply(self, outgoing_message: RelayReplyMessage) -> bool:
+        """
+        Pretend to send a reply to the client
+
+        :param outgoing_message: The message to send, including a wrapping RelayReplyMessage
+        :return: Whether sending was successful
+        """
+        logger.log(DEBUG_PACKETS, "Discarded %s to %s", outgoing_message.inner_message.__class__.__name__,
+                   outgoing_message.peer_address)
+        return True
+
+
+class ReplayListener(Listener):
+    """
+    A listener that replays the DHCPv6 requests in a capture file. A separate thread reads the file and queues the
+    requests at the right time, and wakes up the main loop through a socket pair.
+
+    :type filename: str
+    :type interface_name: str
+    :type link_address: IPv6Address
+    :type speed: float
+    :type repeat: int
+    :type packets: queue.Queue
+    :type pool: NonBlockingPool
+    """
+
+    def __init__(self, filename: str, interface_name: str, link_address: IPv6Address, speed: float = 1.0,
+                 repeat: int = 1, marks: Iterable[str] = None):
+        """
+        Initialise listener.
+
+        :param filename: The pcap or pcapng file to replay
+        :param interface_name: The interface name to present to the handlers
+        :param link_address: The link address to present to the handlers
+        :param speed: How much faster than the original to replay, 0 for as fast as possible
+        :param repeat: How many times to replay the file, 0 for forever
+        :param marks: Marks attached to this listener
+        """
+        self.filename = filename
+        self.interface_name = interface_name
+        self.link_address = link_address
+        self.speed = speed
+        self.repeat = repeat
+        self.marks = tuple(marks or ())
+        self.relay_options = (InterfaceIdOption(interface_id=interface_name.encode('utf-8')),)
+        self.replier = SinkReplier()
+
+        self.packets = queue.Queue(QUEUE_SIZE)
+        self.pool = None
+        self.stopping = threading.Event()
+        self.feeder = threading.Thread(target=self.run, name='Replay {}'.format(self.filename), daemon=True)
+
+        # The feeder writes to one side, the main loop waits for the other side. Start off readable, the feeder is
+        # started the first time the main loop looks at us.
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.wakeup_w.send(b'\x00')
+
+        self.source_addresses = {}
+
+    @property
+    def name(self) -> str:
+        """
+        A short description of this listener, used for keeping statistics per listener.
+
+        :return: The name of this listener
+        """
+        return 'replay {}'.format(os.path.basename(self.filename))
+
+    def set_worker_pool(self, pool: Optional[NonBlockingPool]):
+        """
+        Remember the worker pool, so we can wait for the workers to catch up.
+
+        :param pool: The worker pool, or None when it stops
+        """
+        self.pool = pool
+
+    @property
+    def room(self) -> int:
+        """
+        How many more requests the worker pool can take before we have to wait for the workers to catch up
+
+        :return: The number of requests
+        """
+        pool = self.pool
+        if pool is None:
+            return RECEIVE_BATCH_SIZE
+
+        return pool.worker_count * PENDING_PER_WORKER - pool.pending_tasks
+
+    def wake_up(self):
+        """
+        Wake up the main loop
+        """
+        try:
+            self.wakeup_w.send(b'\x00')
+        except BlockingIOError:
+            # Plenty of wakeups waiting already
+            pass
+
+    def queue_packet(self, packet: UDPPacket) -> bool:
+        """
+        Queue a request for the main loop. Wait while the queue is full or the workers have enough requests to work
+        on, and wake up the main loop when the workers have room for the requests that are still queued.
+
+        :param packet: The packet to queue
+        :return: Whether the packet was queued, False when we are stopping
+        """
+        while not self.stopping.is_set():
+            room = self.room
+            if room > self.packets.qsize():
+                try:
+                    self.packets.put_nowait(packet)
+                    self.wake_up()
+                    return True
+                except queue.Full:
+                    pass
+            elif room > 0:
+                self.wake_up()
+
+            self.stopping.wait(BACKPRESSURE_INTERVAL)
+
+        return False
+
+    def wait_until_taken(self):
+        """
+        Keep waking up the main loop until it has taken all queued requests
+        """
+        while not self.packets.empty() and not self.stopping.is_set():
+            if self.room > 0:
+                self.wake_up()
+
+            self.stopping.wait(BACKPRESSURE_INTERVAL)
+
+    def read_requests(self) -> Iterator[Tuple[float, UDPPacket]]:
+        """
+        Read the requests to the server from the capture file, with the time they were captured. Replies that a
+        server sent to a relay are also sent to the server port, those are skipped.
+
+        :return: The timestamp and packet for each request
+        """
+        with open(self.filename, 'rb') as capture_file:
+            for timestamp, link_type, frame in read_capture_frames(capture_file):
+                packet = parse_udp_frame(link_type, frame)
+                if not packet or packet.destination_port != SERVER_PORT or not packet.payload:
+                    continue
+
+                message_class = message_registry.get(packet.payload[0])
+                if message_class and message_class.from_server_to_client:
+                    continue
+
+                yield timestamp, packet
+
+    def run(self):
+        """
+        Queue the requests from the capture file at the right time
+        """
+        start = time.monotonic()
+        count = 0
+        rounds = 0
+        try:
+            while not self.repeat or rounds < self.repeat:
+                rounds += 1
+                round_count = count
+                round_start = time.monotonic()
+                first_timestamp = None
+                for timestamp, packet in self.read_requests():
+                    if self.speed:
+                        if first_timestamp is None:
+                            first_timestamp = timestamp
+
+                        delay = round_start + (timestamp - first_timestamp) / self.speed - time.monotonic()
+                        if delay > 0 and self.stopping.wait(delay):
+                            return
+
+                    if not self.queue_packet(packet):
+                        return
+
+                    count += 1
+
+                if count == round_count:
+                    logger.warning("No requests to replay in %s", self.filename)
+                    break
+
+        except (OSError, ValueError) as e:
+            logger.error("Error while replaying %s: %s", self.filename, e)
+            return
+
+        self.wait_until_taken()
+
+        elapsed = time.monotonic() - start
+        logger.info("Finished replaying %d requests from %s in %.3f seconds (%.0f/s)", count, self.filename,
+                    elapsed, count / elapsed if elapsed else 0)
+
+    def recv_request(self) -> Tuple[IncomingPacketBundle, Replier]:
+        """
+        Receive incoming messages
+
+        :return: The incoming packet data and a replier object
+        """
+        requests = self.recv_requests()
+        if not requests:
+            raise IgnoreMessage("No replayed requests waiting")
+
+        return requests[0]
+
+    def recv_requests(self) -> List[Tuple[IncomingPacketBundle, Replier]]:
+        """
+        Take the requests that the feeder has queued, up to :data:`RECEIVE_BATCH_SIZE` at a time and only as many as
+        the worker pool has room for
+
+        :return: A list of incoming packet data and replier objects
+        """
+        if self.feeder.ident is None and not self.stopping.is_set():
+            self.feeder.start()
+
+        # Consume the wakeups before looking at the queue, so we can't miss requests
+        try:
+            self.wakeup_r.recv(65536)
+        except BlockingIOError:
+            pass
+
+        requests = []
+        limit = min(RECEIVE_BATCH_SIZE, self.room)
+        while len(requests) < limit:
+            try:
+                packet = self.packets.get_nowait()
+            except queue.Empty:
+                break
+
+            requests.append(self.create_bundle(packet))
+
+        return requests
+
+    def create_bundle(self, packet: UDPPacket) -> Tuple[IncomingPacketBundle, Replier]:
+        """
+        Create the incoming packet bundle for a replayed packet
+
+        :param packet: The packet from the capture file
+        :return: The incoming packet data and a replier object
+        """
+        message_number = increase_message_counter()
+
+        source_address = self.source_addresses.get(packet.source)
+        if source_address is None:
+            source_address = IPv6Address(packet.source)
+            self.source_addresses[packet.source] = source_address
+
+        logger.log(DEBUG_PACKETS, "#%06X: Replaying message from %s port %s on %s", message_number,
+                   source_address, packet.source_port, self.interface_name)
+
+        packet_bundle = IncomingPacketBundle(message_number=message_number,
+                                             data=packet.payload,
+                                             source_address=source_address,
+                                             link_address=self.link_address,
+                                             interface_index=0,
+                                             received_over_multicast=packet.destination[0] == 0xFF,
+                                             received_over_tcp=False,
+                                             marks=self.marks,
+                                             relay_options=self.relay_options)
+
+        return packet_bundle, self.replier
+
+    @property
+    def backlogged(self) -> bool:
+        """
+        Whether there are more requests queued than we returned, and the worker pool has room for them. Otherwise the
+        feeder wakes up the main loop when the workers have caught up.
+
+        :return: Whether there are requests waiting
+        """
+        return self.room > 0 and not self.packets.empty()
+
+    def close(self):
+        """
+        Stop replaying
+        """
+        self.stopping.set()
+        if self.feeder.is_alive():
+            self.feeder.join()
+
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+    def fileno(self) -> int:
+        """
+        The fileno of the wakeup socket, so this object can be used by select()
+
+        :return: The file descriptor
+        """
+        return self.wakeup_r.fileno()
@@ -0,0 +1,3 @@
+"""
+Factory for a listener that replays DHCPv6 requests from a capture file
+"""
@@ -0,0 +1,44 @@
+"""
+Factory for a listener that replays DHCPv6 requests from a capture file
+"""
+import logging
+
+from ZConfig.datatypes import existing_file
+from dhcpkit.ipv6.server.listeners import Listener
+from dhcpkit.ipv6.server.listeners.factories import ListenerFactory
+from dhcpkit.ipv6.server.listeners.replay import PCAPNG_MAGIC, PCAP_MAGIC, ReplayListener
+from typing import Iterable
+
+logger = logging.getLogger(__name__)
+
+
+class ReplayPcapListenerFactory(ListenerFactory):
+    """
+    Factory for a listener that replays DHCPv6 requests from a capture file
+    """
+
+    name_datatype = staticmethod(existing_file)
+
+    def validate_config_section(self):
+        """
+        Validate the replay settings
+        """
+        if self.speed < 0:
+            raise ValueError("The replay speed can't be negative")
+
+        with open(self.name, 'rb') as capture_file:
+            magic = capture_file.read(4)
+        if magic != PCAPNG_MAGIC and magic not in PCAP_MAGIC:
+            raise ValueError("{} is not a pcap or pcapng file".format(self.name))
+
+    def create(self, old_listeners: Iterable[Listener] = None) -> ReplayListener:
+        """
+        Create a listener of this class based on the configuration in the config section. Replay listeners are never
+        recycled, a reload starts replaying from the beginning.
+
+        :param old_listeners: A list of existing listeners in case we can recycle them
+        :return: A listener object
+        """
+        logger.debug("Replaying requests from %s", self.name)
+        return ReplayListener(filename=self.name, interface_name=self.interface, link_address=self.link_address,
+                              speed=self.speed, repeat=self.repeat, marks=self.marks)
@@ -5,10 +5,16 @@ together.
 """
 import logging
 import multiprocessing
+import os
+import selectors
 import socket
+import threading
+import time
 import weakref
+from collections import deque
 from ipaddress import IPv6Address, IPv6Network
 from multiprocessing import Lock
+from multiprocessing.managers import ValueProxy
 from struct import pack, unpack_from
 
 from dhcpkit.common.server.logging import DEBUG_PACKETS
@@ -17,19 +23,48 @@ from dhcpkit.ipv6.messages import RelayReplyMessage
 from dhcpkit.ipv6.options import InterfaceIdOption
 from dhcpkit.ipv6.server.listeners import ClosedListener, IncomingPacketBundle, IncompleteMessage, Listener, \
     ListenerCreator, ListeningSocketError, Replier, increase_message_counter
+from dhcpkit.ipv6.server.statistics import ServerStatistics
 from dhcpkit.ipv6.utils import is_global_unicast
-from typing import Iterable, Optional, Tuple
+from typing import Iterable, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+# Room for the largest possible message plus its length prefix, and then some so that many small messages can be
+# received with a single system call
+RECEIVE_BUFFER_SIZE = 2 * (2 + 65535)
+
+# Replies are combined into chunks of this size before sending them
+STREAM_CHUNK_SIZE = 65536
+
+# Workers have to wait when this much data is waiting to be sent
+STREAM_HIGH_WATER = 16 * 1024 * 1024
+
+# Give up on a client that doesn't accept any data for this many seconds
+STREAM_TIMEOUT = 300
+
+# How long to wait before trying again when another worker is sending on the same connection
+STREAM_LOCK_RETRY = 0.01
+
+# The maximum number of seconds that an exiting worker waits for its replies to be sent
+STREAM_EXIT_TIMEOUT = 30
+
+# The maximum number of requests taken from one connection before other connections get their turn
+REQUESTS_PER_TURN = 10
+
 
 class TCPConnection(Listener):
     """
     A TCP connection listener for DHCPv6 messages
+
+    :type more_waiting: bool
     """
 
+    # We say that we are backlogged when there may be data left on the socket
+    edge_triggered = True
+
     def __init__(self, interface_name: str, connected_socket: socket.socket, write_lock: Lock,
-                 global_address: IPv6Address, marks: Iterable[str] = None):
+                 global_address: IPv6Address, marks: Iterable[str] = None, idle_timeout: float = 0,
+                 max_connection_time: float = 0, activity: ValueProxy = None):
         """
         Initialise listener.
 
@@ -37,13 +72,24 @@ class TCPConnection(Listener):
         :param connected_socket: The socket we are listening on and will send replies to
         :param global_address: The global address on the listening interface
         :param marks: Marks attached to this listener
+        :param idle_timeout: Close the connection after this many seconds without activity, 0 for never
+        :param max_connection_time: Close the connection after it has been open this many seconds, 0 for never
+        :param activity: A shared value where workers record when they last sent something on this connection
         """
         self.interface_name = interface_name
         self.interface_id = interface_name.encode('utf-8')
         self.connected_socket = connected_socket
         self.global_address = global_address
-        self.marks = list(marks or [])
+        self.marks = tuple(marks or ())
+        self.relay_options = (InterfaceIdOption(interface_id=self.interface_id),)
         self.write_lock = write_lock
+        self.idle_timeout = idle_timeout
+        self.max_connection_time = max_connection_time
+        self.activity = activity
+
+        # Keep track of time for the timeouts
+        self.created = time.monotonic()
+        self.last_activity = self.created
 
         # Check that we have IPv6 TCP sockets
         if self.connected_socket.family != socket.AF_INET6 or self.connected_socket.proto != socket.IPPROTO_TCP:
@@ -62,33 +108,62 @@ class TCPConnection(Listener):
         self.client_address = IPv6Address(peer_sockname[0].split('%')[0])
         self.client_port = peer_sockname[1]
 
-        # Prepare buffer for received data
-        self.buffer = b''
+        # Prepare buffer for received data, messages are consumed from buffer_start and data is received at buffer_end
+        self.buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self.buffer_view = memoryview(self.buffer)
+        self.buffer_start = 0
+        self.buffer_end = 0
+
+        # Whether the socket might have more data than we have received
+        self.more_waiting = False
+
+        # Closed connections might still be referenced for a while, they shouldn't count as open
+        self.closed = False
 
-    def packet_from_buffer(self):
+    @property
+    def name(self) -> str:
         """
-        Create a packet and replier from the data in the buffer
+        A short description of this listener, used for keeping statistics per listener. All connections on the same
+        interface share the same name.
 
-        :return: The incoming packet data and a replier object
+        :return: The name of this listener
+        """
+        return 'tcp {}'.format(self.interface_name)
+
+    def message_in_buffer(self) -> bool:
+        """
+        Check whether there is a complete message in the buffer
+
+        :return: Whether a complete message is available
+        """
+        available = self.buffer_end - self.buffer_start
+        if available < 2:
+            return False
+
+        message_length = unpack_from('!H', self.buffer, self.buffer_start)[0]
+        return available >= 2 + message_length
+
+    def packet_from_buffer(self) -> Tuple[IncomingPacketBundle, Replier]:
         """
+        Create a packet and replier from the first complete message in the buffer. The caller must check with
+        :meth:`message_in_buffer` that one is available.
 
-        # Copy the message and remove it from the buffer
-        message_length = unpack_from('!H', self.buffer)[0]
-        data = self.buffer[2:2 + message_length]
-        self.buffer = self.buffer[2 + message_length:]
+        :return: The incoming packet data and a replier object
+        """
 
-        # Create the message-ID
-        message_counter = increase_message_counter()
-        message_id = '#{:06X}'.format(message_counter)
+        # Copy the message and mark it as consumed
+        message_length = unpack_from('!H', self.buffer, self.buffer_start)[0]
+        message_start = self.buffer_start + 2
+        data = bytes(self.buffer[message_start:message_start + message_length])
+        self.buffer_start = message_start + message_length
 
-        logger.log(DEBUG_PACKETS, "{message_id}: Received message from {client_addr} port {port}".format(
-            message_id=message_id,
-            client_addr=str(self.client_address),
-            port=self.client_port))
+        # The message-ID is only formatted when something needs it
+        message_number = increase_message_counter()
 
-        interface_id_option = InterfaceIdOption(interface_id=self.interface_id)
+        logger.log(DEBUG_PACKETS, "#%06X: Received message from %s port %s", message_number, self.client_address,
+                   self.client_port)
 
-        packet_bundle = IncomingPacketBundle(message_id=message_id,
+        packet_bundle = IncomingPacketBundle(message_number=message_number,
                                              data=data,
                                              source_address=self.client_address,
                                              link_address=self.global_address,
@@ -96,32 +171,55 @@ class TCPConnection(Listener):
                                              received_over_multicast=False,
                                              received_over_tcp=True,
                                              marks=self.marks,
-                                             relay_options=[interface_id_option])
+                                             relay_options=self.relay_options)
 
         # Create a replier
-        replier = TCPReplier(self.connected_socket, self.write_lock)
+        replier = TCPReplier(self.connected_socket, self.write_lock, self.activity)
 
         return packet_bundle, replier
 
-    def recv_data_into_buffer(self, amount: int) -> int:
+    def compact_buffer(self):
+        """
+        Move the unconsumed data to the start of the buffer to make room at the end. Only a partial message is left
+        when this is called, so this copies little data.
         """
-        Receive data into the buffer and do proper error handling
+        if self.buffer_start == self.buffer_end:
+            self.buffer_start = self.buffer_end = 0
+        elif self.buffer_start > 0:
+            remaining = self.buffer_end - self.buffer_start
+            self.buffer[:remaining] = self.buffer[self.buffer_start:self.buffer_end]
+            self.buffer_start = 0
+            self.buffer_end = remaining
+
+    def recv_data_into_buffer(self) -> int:
+        """
+        Receive data directly into the free space at the end of the buffer and do proper error handling
 
-        :param amount: How much data do we want?
         :return: How much data did we receive?
         """
-        data = self.connected_socket.recv(amount)
-        if data == b'':
-            logger.info("TCP connection to {client_addr} port {port} closed".format(
-                client_addr=str(self.client_address),
-                port=self.client_port))
+        self.compact_buffer()
+
+        try:
+            space = len(self.buffer) - self.buffer_end
+            received = self.connected_socket.recv_into(self.buffer_view[self.buffer_end:], 0, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            # Nothing left to receive
+            self.more_waiting = False
+            raise IncompleteMessage
+
+        # If we filled the buffer there may be more
+        self.more_waiting = received == space
+
+        if received == 0:
+            logger.info("TCP connection to %s port %s closed", self.client_address, self.client_port)
 
             raise ClosedListener
 
-        self.buffer += data
+        self.buffer_end += received
+        self.last_activity = time.monotonic()
 
         # Return how much data we added
-        return len(data)
+        return received
 
     def recv_request(self) -> Tuple[IncomingPacketBundle, Replier]:
         """
@@ -129,31 +227,99 @@ class TCPConnection(Listener):
 
         :return: The incoming packet data and a replier object
         """
+        if not self.message_in_buffer():
+            self.recv_data_into_buffer()
 
-        # Do we know how much data we need to receive?
-        buffer_length = len(self.buffer)
-        if buffer_length < 2:
-            # Not yet, let's see if we can receive the message length
-            buffer_length += self.recv_data_into_buffer(2 - buffer_length)
+        if self.message_in_buffer():
+            return self.packet_from_buffer()
 
-        if buffer_length >= 2:
-            # Yes, we have the message length in the buffer
-            message_length = unpack_from('!H', self.buffer)[0]
+        # Apparently we don't have a complete message yet
+        raise IncompleteMessage
+
+    def recv_requests(self) -> List[Tuple[IncomingPacketBundle, Replier]]:
+        """
+        Receive data once and extract the complete messages from the buffer. At most :data:`REQUESTS_PER_TURN`
+        messages are returned, the rest stays in the buffer until the next turn. No new data is received while there
+        are complete messages in the buffer, so a client that sends too much is slowed down by TCP flow control.
+
+        :return: A list of incoming packet data and replier objects
+        """
+        if not self.message_in_buffer():
+            self.recv_data_into_buffer()
+        else:
+            # We didn't look, new data may have arrived since the last time
+            self.more_waiting = True
 
-            # Receive extra data into the buffer
-            we_already_have = buffer_length - 2
-            remaining_data = message_length - we_already_have
-            if remaining_data > 0:
-                buffer_length += self.recv_data_into_buffer(remaining_data)
+        requests = []
+        while len(requests) < REQUESTS_PER_TURN and self.message_in_buffer():
+            requests.append(self.packet_from_buffer())
 
-            # Check if we have a complete message
-            we_already_have = buffer_length - 2
-            if we_already_have >= message_length:
-                # We have a new message, return it
-                return self.packet_from_buffer()
+        if not requests:
+            # Apparently we don't have a complete message yet
+            raise IncompleteMessage
 
-        # Apparently we don't have a complete message yet
-        raise IncompleteMessage
+        return requests
+
+    @property
+    def backlogged(self) -> bool:
+        """
+        Whether there are complete messages waiting in the buffer, or data waiting on the socket that we haven't
+        received yet
+
+        :return: Whether there are requests waiting
+        """
+        return self.more_waiting or self.message_in_buffer()
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """
+        The time at which this connection times out, unless there is activity before then
+
+        :return: The deadline
+        """
+        deadlines = []
+        if self.idle_timeout:
+            deadlines.append(self.last_activity + self.idle_timeout)
+        if self.max_connection_time:
+            deadlines.append(self.created + self.max_connection_time)
+        return min(deadlines) if deadlines else None
+
+    def expired(self, now: float) -> bool:
+        """
+        Check whether this connection has been open or idle for too long. Replies that the workers are still sending
+        count as activity.
+
+        :param now: The current time
+        :return: Whether to close this connection
+        """
+        if self.max_connection_time and now >= self.created + self.max_connection_time:
+            logger.warning("TCP connection to %s port %s has been open for %d seconds, closing",
+                           self.client_address, self.client_port, self.max_connection_time)
+            return True
+
+        if self.idle_timeout and now >= self.last_activity + self.idle_timeout:
+            # Only check what the workers are doing when it matters, it takes a round trip to the manager
+            if self.activity is not None:
+                self.last_activity = max(self.last_activity, self.activity.value)
+
+            if now >= self.last_activity + self.idle_timeout:
+                logger.info("TCP connection to %s port %s has been idle for %d seconds, closing",
+                            self.client_address, self.client_port, self.idle_timeout)
+                return True
+
+        return False
+
+    def close(self):
+        """
+        Close the connection
+        """
+        self.closed = True
+        try:
+            self.connected_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # Already gone
+            pass
+        self.connected_socket.close()
 
     def fileno(self) -> int:
         """
@@ -164,6 +330,322 @@ class TCPConnection(Listener):
         return self.connected_socket.fileno()
 
 
+class TCPStream:
+    """
+    The data that is still waiting to be sent to one TCP client for one request, as chunks of complete messages
+    """
+
+    def __init__(self, replier: 'TCPReplier'):
+        """
+        Initialise an empty stream.
+
+        :param replier: The replier of the request, which keeps the socket and the lock
+        """
+        self.replier = replier
+        self.reply_socket = replier.reply_socket
+        self.reply_lock = replier.reply_lock
+
+        # Never wait for the client
+        self.reply_socket.setblocking(False)
+
+        self.chunks = deque()
+        self.current = None
+        self.offset = 0
+        self.pending = 0
+        self.locked = False
+        self.last_progress = time.monotonic()
+
+    def append(self, data: bytes):
+        """
+        Add complete messages to the stream, combining small messages into larger chunks
+
+        :param data: The messages, including their length prefix
+        """
+        if self.chunks and len(self.chunks[-1]) + len(data) <= STREAM_CHUNK_SIZE:
+            self.chunks[-1] += data
+        else:
+            self.chunks.append(bytearray(data))
+        self.pending += len(data)
+
+    def unlock(self):
+        """
+        Release the reply lock if we hold it
+        """
+        if self.locked:
+            self.reply_lock.release()
+            self.locked = False
+
+    def send(self):
+        """
+        Send as much as the socket accepts without blocking. The reply lock is held from the first to the last byte of
+        each chunk, so a chunk is never mixed with messages sent by other workers.
+        """
+        while self.current is not None or self.chunks:
+            if not self.locked:
+                if not self.reply_lock.acquire(False):
+                    # Someone else is sending on this connection, try again later
+                    break
+                self.locked = True
+
+            if self.current is None:
+                self.current = memoryview(self.chunks.popleft())
+                self.offset = 0
+
+            try:
+                sent = self.reply_socket.send(self.current[self.offset:])
+            except BlockingIOError:
+                # Back-pressure from the client
+                break
+
+            self.offset += sent
+            self.pending -= sent
+            self.last_progress = time.monotonic()
+
+            if self.offset >= len(self.current):
+                self.current.release()
+                self.current = None
+                self.unlock()
+
+                # Let the main process know that this connection isn't idle
+                if self.replier.activity is not None:
+                    try:
+                        self.replier.activity.value = self.last_progress
+                    except (OSError, EOFError):
+                        # The manager is gone, we're probably shutting down
+                        pass
+
+    @property
+    def empty(self) -> bool:
+        """
+        Whether everything has been sent
+
+        :return: Whether the stream is done
+        """
+        return self.current is None and not self.chunks
+
+
+class StreamWriter:
+    """
+    A thread in a worker process that sends replies to TCP clients while the worker goes on handling other requests.
+    Sockets are written to without blocking when they are writable, so a slow client only slows down its own stream.
+    When the total amount of unsent data grows too large the worker has to wait, so memory use stays bounded.
+    """
+
+    def __init__(self, high_water: int = STREAM_HIGH_WATER, timeout: float = STREAM_TIMEOUT,
+                 statistics: ServerStatistics = None):
+        """
+        Prepare the writer thread.
+
+        :param high_water: The amount of unsent data at which workers have to wait before adding more
+        :param timeout: Give up on a client that hasn't accepted any data for this many seconds
+        :param statistics: The statistics to count dropped streams in
+        """
+        self.high_water = high_water
+        self.timeout = timeout
+        self.statistics = statistics
+
+        self.pid = os.getpid()
+        self.condition = threading.Condition()
+        self.streams = {}
+        self.buffered = 0
+        self.running = True
+
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+
+        self.thread = threading.Thread(target=self.run, name='StreamWriter', daemon=True)
+
+    def start(self):
+        """
+        Start the writer thread
+        """
+        self.thread.start()
+
+    def wake(self):
+        """
+        Wake up the writer thread
+        """
+        try:
+            self.wake_w.send(b'\x00')
+        except BlockingIOError:
+            # Already plenty of wake-ups pending
+            pass
+
+    def stop(self, timeout: float = STREAM_EXIT_TIMEOUT):
+        """
+        Wait for the remaining data to be sent and stop the writer thread. Streams that are not finished in time are
+        dropped.
+
+        :param timeout: The maximum number of seconds to wait for the remaining data
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.streams and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+
+        self.running = False
+        self.wake()
+        self.thread.join(max(deadline - time.monotonic(), 1))
+
+        if self.thread.is_alive():
+            logger.error("TCP stream writer did not stop, %d streams are not finished", len(self.streams))
+            return
+
+        for key, stream in list(self.streams.items()):
+            logger.error("Worker is stopping, not sending the rest of the reply to %s port %s",
+                         stream.replier.client_address, stream.replier.client_port)
+            self.drop(key, stream)
+
+    def write(self, replier: 'TCPReplier', data: bytes):
+        """
+        Queue data to be sent to a client. This only blocks when too much data is already waiting to be sent.
+
+        :param replier: The replier of the request that this is a reply to
+        :param data: Complete messages, including their length prefix
+        """
+        with self.condition:
+            while self.buffered >= self.high_water:
+                self.condition.wait()
+
+            # The stream keeps a reference to the replier, so its id stays unique while the stream exists
+            stream = self.streams.get(id(replier))
+            if stream is None:
+                stream = TCPStream(replier)
+                self.streams[id(replier)] = stream
+
+            stream.append(data)
+            self.buffered += len(data)
+
+        self.wake()
+
+    def drop(self, key: int, stream: TCPStream):
+        """
+        Forget a stream and its unsent data, and let the replier know so the worker doesn't add more
+
+        :param key: The key of the stream
+        :param stream: The stream
+        """
+        stream.unlock()
+        stream.replier.failed = True
+
+        if self.statistics:
+            self.statistics.count_dropped_stream()
+
+        with self.condition:
+            if self.streams.get(key) is stream:
+                del self.streams[key]
+            self.buffered -= stream.pending
+            self.condition.notify_all()
+
+    def run(self):
+        """
+        Send data to all clients that can receive it
+        """
+        sel = selectors.DefaultSelector()
+        sel.register(self.wake_r, selectors.EVENT_READ)
+        registered = {}
+
+        while self.running:
+            with self.condition:
+                streams = list(self.streams.items())
+
+            # Try to make progress on every stream and see which ones need to wait for the socket or the lock
+            now = time.monotonic()
+            timeout = None
+            for key, stream in streams:
+                try:
+                    with self.condition:
+                        pending = stream.pending
+                        try:
+                            stream.send()
+                        finally:
+                            if stream.pending != pending:
+                                self.buffered -= pending - stream.pending
+                                self.condition.notify_all()
+
+                        # Check while holding the lock, the worker might be adding more data
+                        finished = stream.empty
+                        if finished:
+                            del self.streams[key]
+                            self.condition.notify_all()
+                except OSError as e:
+                    logger.error("Could not send to %s port %s: %s", stream.replier.client_address,
+                                 stream.replier.client_port, e)
+                    self.drop(key, stream)
+                    continue
+
+                if finished:
+                    logger.log(DEBUG_PACKETS, "Finished sending to %s port %s",
+                               stream.replier.client_address, stream.replier.client_port)
+                elif now - stream.last_progress > self.timeout:
+                    logger.error("Giving up sending to %s port %s after %d seconds without progress",
+                                 stream.replier.client_address, stream.replier.client_port, self.timeout)
+                    self.drop(key, stream)
+                elif not stream.locked:
+                    # Waiting for another worker to release the lock
+                    timeout = STREAM_LOCK_RETRY
+                elif timeout is None:
+                    # Waiting for the socket, but wake up in time to enforce the timeout
+                    timeout = self.timeout
+
+            # Only watch the sockets of streams that are waiting for the socket
+            waiting = {key: stream for key, stream in streams if self.streams.get(key) is stream and stream.locked}
+            for key in list(registered):
+                if key not in waiting:
+                    sel.unregister(registered.pop(key))
+            for key, stream in waiting.items():
+                if key not in registered:
+                    sel.register(stream.reply_socket, selectors.EVENT_WRITE)
+                    registered[key] = stream.reply_socket
+
+            for key, mask in sel.select(timeout):
+                if key.fileobj is self.wake_r:
+                    try:
+                        while self.wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+
+        sel.close()
+
+
+# The stream writer of this process, and the statistics it counts dropped streams in
+stream_writer = None
+stream_statistics = None
+
+
+def get_stream_writer() -> StreamWriter:
+    """
+    Get the stream writer of this process, and start it if necessary
+
+    :return: The stream writer
+    """
+    global stream_writer
+    if stream_writer is None or stream_writer.pid != os.getpid():
+        stream_writer = StreamWriter(statistics=stream_statistics)
+        stream_writer.start()
+    return stream_writer
+
+
+def stop_stream_writer():
+    """
+    Send the remaining replies of this process and stop its stream writer
+    """
+    if stream_writer is not None and stream_writer.pid == os.getpid():
+        stream_writer.stop()
+
+
+def setup_stream_writer(statistics: ServerStatistics):
+    """
+    Prepare the stream writer of a worker process.
+
+    :param statistics: The statistics to count dropped streams in
+    """
+    global stream_statistics
+    stream_statistics = statistics
+
+
 class TCPReplier(Replier):
     """
     A class to send replies to the client
@@ -172,9 +654,13 @@ class TCPReplier(Replier):
     # Whether multiple replies can be sent over this replier
     can_send_multiple = True
 
-    def __init__(self, reply_socket: socket.socket, reply_lock: Lock):
+    def __init__(self, reply_socket: socket.socket, reply_lock: Lock, activity: ValueProxy = None):
         self.reply_socket = reply_socket
         self.reply_lock = reply_lock
+        self.activity = activity
+
+        # Set by the stream writer when it gives up on sending to the client
+        self.failed = False
 
         # Remember the sender
         peer_sockname = self.reply_socket.getpeername()
@@ -183,37 +669,26 @@ class TCPReplier(Replier):
 
     def send_reply(self, outgoing_message: RelayReplyMessage) -> bool:
         """
-        Send a reply to the client
+        Queue a reply to the client. The stream writer sends it when the client is ready to receive it, so a slow
+        client doesn't keep the worker busy.
 
         :param outgoing_message: The message to send, including a wrapping RelayReplyMessage
-        :return: Whether sending was successful
+        :return: Whether the reply was queued, False when sending an earlier reply to this client failed
         """
+        if self.failed:
+            return False
+
         # Construct reply
         reply = outgoing_message.relayed_message
         message_data = reply.save()
         data = pack('!H', len(message_data)) + message_data
 
-        try:
-            with self.reply_lock:
-                # Make sure we don't get stuck
-                self.reply_socket.settimeout(300)
-                self.reply_socket.sendall(data)
-                self.reply_socket.settimeout(None)
-
-            logger.log(DEBUG_PACKETS, "Sent {message_type} to {client_addr} port {port}".format(
-                message_type=outgoing_message.inner_message.__class__.__name__,
-                client_addr=str(self.client_address),
-                port=self.client_port))
+        get_stream_writer().write(self, data)
 
-            return True
-        except OSError as e:
-            logger.error("Could not send {message_type} to {client_addr} port {port}: {exception}".format(
-                message_type=outgoing_message.inner_message.__class__.__name__,
-                client_addr=str(self.client_address),
-                port=self.client_port,
-                exception=e))
+        logger.log(DEBUG_PACKETS, "Queued %s for %s port %s", outgoing_message.inner_message.__class__.__name__,
+                   self.client_address, self.client_port)
 
-            return False
+        return True
 
 
 class TCPConnectionListener(ListenerCreator):
@@ -229,7 +704,8 @@ class TCPConnectionListener(ListenerCreator):
     """
 
     def __init__(self, interface_name: str, listen_socket: socket.socket, global_address: IPv6Address = None,
-                 marks: Iterable[str] = None, max_connections: int = 10, allow_from: Iterable[IPv6Network] = None):
+                 marks: Iterable[str] = None, max_connections: int = 10, allow_from: Iterable[IPv6Network] = None,
+                 max_connections_per_peer: int = 0, idle_timeout: float = 0, max_connection_time: float = 0):
         """
         Initialise TCP listener.
 
@@ -237,12 +713,20 @@ class TCPConnectionListener(ListenerCreator):
         :param listen_socket: The socket we are listening on, may be a unicast or multicast socket
         :param global_address: The global address on the listening interface
         :param marks: Marks attached to this listener
+        :param max_connections: The maximum number of open connections
+        :param allow_from: Only accept connections from these networks, all when empty
+        :param max_connections_per_peer: The maximum number of open connections from a single address, 0 for no limit
+        :param idle_timeout: Close connections after this many seconds without activity, 0 for never
+        :param max_connection_time: Close connections after they have been open this many seconds, 0 for never
         """
         self.interface_name = interface_name
         self.interface_id = interface_name.encode('utf-8')
         self.marks = list(marks or [])
         self.max_connections = max_connections
         self.allow_from = list(allow_from or [])
+        self.max_connections_per_peer = max_connections_per_peer
+        self.idle_timeout = idle_timeout
+        self.max_connection_time = max_connection_time
 
         # Make sure the listening socket is non-blocking
         self.listen_socket = listen_socket
@@ -275,8 +759,16 @@ class TCPConnectionListener(ListenerCreator):
         # Create a manager for the locks
         self.manager = multiprocessing.Manager()
 
-        # Keep weak references to sockets so we can see how many are still alive
-        self.open_sockets = weakref.WeakSet()
+        # Keep weak references to connections so we can see how many are still alive
+        self.open_connections = weakref.WeakSet()
+
+    def get_open_connections(self) -> List[TCPConnection]:
+        """
+        Get the connections that are still open
+
+        :return: The open connections
+        """
+        return [connection for connection in self.open_connections if not connection.closed]
 
     def create_listener(self) -> Optional[TCPConnection]:
         """
@@ -290,44 +782,61 @@ class TCPConnectionListener(ListenerCreator):
             # Something went wrong before we could accept the socket
             return None
 
-        if len(self.open_sockets) >= self.max_connections:
+        open_connections = self.get_open_connections()
+        if len(open_connections) >= self.max_connections:
             # Too many connections, shut it down
-            logger.warning(
-                "More than {max_connections} open TCP connections, "
-                "rejecting connection from {client_addr} port {port}".format(
-                    max_connections=self.max_connections,
-                    client_addr=client[0],
-                    port=client[1]
-                )
-            )
+            logger.warning("More than %s open TCP connections, rejecting connection from %s port %s",
+                           self.max_connections, client[0], client[1])
 
             connected_socket.shutdown(socket.SHUT_RDWR)
             connected_socket.close()
             return None
 
+        client_address = IPv6Address(client[0].split('%')[0])
+
         if self.allow_from:
             # Restricted access
-            client_address = IPv6Address(client[0].split('%')[0])
             if not any([client_address in allowed_range for allowed_range in self.allow_from]):
-                logger.error("Rejecting TCP connection from {client_addr} port {port}".format(
-                    client_addr=client[0],
-                    port=client[1]))
+                logger.error("Rejecting TCP connection from %s port %s", client[0], client[1])
+
+                connected_socket.shutdown(socket.SHUT_RDWR)
+                connected_socket.close()
+                return None
+
+        if self.max_connections_per_peer:
+            peer_connections = sum([1 for connection in open_connections
+                                    if connection.client_address == client_address])
+            if peer_connections >= self.max_connections_per_peer:
+                logger.warning("More than %s open TCP connections from %s, rejecting connection from port %s",
+                               self.max_connections_per_peer, client[0], client[1])
 
                 connected_socket.shutdown(socket.SHUT_RDWR)
                 connected_socket.close()
                 return None
 
         # Ok, allowed
-        logger.info("Incoming TCP connection from {client_addr} port {port}".format(
-            client_addr=client[0],
-            port=client[1]))
+        logger.info("Incoming TCP connection from %s port %s", client[0], client[1])
+
+        lock = self.manager.Lock()
+        activity = self.manager.Value('d', 0.0) if self.idle_timeout else None
+        connection = TCPConnection(interface_name=self.interface_name, connected_socket=connected_socket,
+                                   write_lock=lock, global_address=self.global_address, marks=self.marks,
+                                   idle_timeout=self.idle_timeout, max_connection_time=self.max_connection_time,
+                                   activity=activity)
 
         # Add a weak reference to the set
-        self.open_sockets.add(connected_socket)
+        self.open_connections.add(connection)
 
-        lock = self.manager.Lock()
-        return TCPConnection(interface_name=self.interface_name, connected_socket=connected_socket, write_lock=lock,
-                             global_address=self.global_address, marks=self.marks)
+        return connection
+
+    @property
+    def open_listeners(self) -> int:
+        """
+        The number of open connections
+
+        :return: The number of open connections
+        """
+        return len(self.get_open_connections())
 
     def fileno(self) -> int:
         """
@@ -5,17 +5,30 @@ UDP implementations of listeners and repliers
 import logging
 import socket
 from ipaddress import IPv6Address
+from struct import Struct
 
 from dhcpkit.common.server.logging import DEBUG_PACKETS
 from dhcpkit.ipv6 import CLIENT_PORT, SERVER_PORT
 from dhcpkit.ipv6.messages import RelayReplyMessage
 from dhcpkit.ipv6.options import InterfaceIdOption
-from dhcpkit.ipv6.server.listeners import IncomingPacketBundle, Listener, ListeningSocketError, Replier, \
-    increase_message_counter
-from typing import Iterable, Tuple
+from dhcpkit.ipv6.server.listeners import IgnoreMessage, IncomingPacketBundle, Listener, ListeningSocketError, \
+    Replier, increase_message_counter
+from typing import Dict, Iterable, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+# The number of source addresses to remember per listener before starting over
+SOURCE_ADDRESS_CACHE_SIZE = 1024
+
+# The maximum number of packets to receive from one listener before giving the other listeners a turn
+RECEIVE_BATCH_SIZE = 64
+
+# Large enough for any UDP packet
+RECEIVE_BUFFER_SIZE = 65536
+
+# The contents of an IPV6_PKTINFO control message: the IPv6 address and the interface index
+IN6_PKTINFO = Struct('=16sI')
+PKTINFO_SPACE = socket.CMSG_SPACE(IN6_PKTINFO.size)
 
 class UDPListener(Listener):
     """
@@ -29,15 +42,28 @@ class UDPListener(Listener):
     :type reply_socket: socket.socket
     :type reply_address: IPv6Address
     :type global_address: IPv6Address
+    :type received_over_multicast: bool
+    :type relay_options: Tuple[InterfaceIdOption]
+    :type source_addresses: Dict[str, IPv6Address]
+    :type wildcard: bool
+    :type destinations: Dict[bytes, Optional[Tuple[int, str, IPv6Address, Tuple[InterfaceIdOption], UDPReplier]]]
+    :type more_waiting: bool
     """
 
+    # We keep receiving until the socket is empty or say that we are backlogged
+    edge_triggered = True
+
+    # The port that the sockets must be bound to, or None to allow any port
+    required_port = SERVER_PORT
+
     def __init__(self, interface_name: str, listen_socket: socket.socket, reply_socket: socket.socket = None,
                  global_address: IPv6Address = None, marks: Iterable[str] = None):
         """
         Initialise listener.
 
-        :param interface_name: The name of the interface
-        :param listen_socket: The socket we are listening on, may be a unicast or multicast socket
+        :param interface_name: The name of the interface, or ``*`` when listening on the wildcard address
+        :param listen_socket: The socket we are listening on, may be a unicast, multicast or wildcard socket. Wildcard
+                              sockets must have ``IPV6_RECVPKTINFO`` enabled.
         :param reply_socket: The socket replies are sent from, must be a unicast socket
         :param global_address: The global address on the listening interface
         :param marks: Marks attached to this listener
@@ -46,7 +72,7 @@ class UDPListener(Listener):
         self.interface_id = interface_name.encode('utf-8')
         self.listen_socket = listen_socket
         self.reply_socket = reply_socket
-        self.marks = list(marks or [])
+        self.marks = tuple(marks or ())
         if self.reply_socket is None:
             self.reply_socket = self.listen_socket
 
@@ -59,8 +85,9 @@ class UDPListener(Listener):
         reply_sockname = self.reply_socket.getsockname()
 
         # Check that we are on the right port
-        if listen_sockname[1] != SERVER_PORT or reply_sockname[1] != SERVER_PORT:
-            raise ListeningSocketError("Listen and reply sockets have to be on port {}".format(SERVER_PORT))
+        if self.required_port is not None \
+                and (listen_sockname[1] != self.required_port or reply_sockname[1] != self.required_port):
+            raise ListeningSocketError("Listen and reply sockets have to be on port {}".format(self.required_port))
 
         # Check that they are both on the same interface
         if listen_sockname[3] != reply_sockname[3]:
@@ -70,6 +97,11 @@ class UDPListener(Listener):
         self.listen_address = IPv6Address(listen_sockname[0].split('%')[0])
         self.reply_address = IPv6Address(reply_sockname[0].split('%')[0])
 
+        # A wildcard listener determines the address and interface of each packet from its ancillary data
+        self.wildcard = self.listen_address.is_unspecified
+        if self.wildcard and self.reply_socket != self.listen_socket:
+            raise ListeningSocketError("Wildcard listening addresses can't use separate reply sockets")
+
         if global_address:
             self.global_address = global_address
         elif not self.listen_address.is_link_local and not self.listen_address.is_multicast:
@@ -77,9 +109,10 @@ class UDPListener(Listener):
         else:
             raise ListeningSocketError("Cannot determine global address on interface {}".format(self.interface_name))
 
-        # We only support fixed address binding
-        if self.listen_address.is_unspecified or self.reply_address.is_unspecified:
-            raise ListeningSocketError("This server only supports listening on explicit address, not on wildcard")
+        # Otherwise we only support fixed address binding
+        if not self.wildcard and (self.listen_address.is_unspecified or self.reply_address.is_unspecified):
+            raise ListeningSocketError("Listen and reply sockets have to be both bound to an explicit address or "
+                                       "both to the wildcard address")
 
         # Multicast listeners must have link-local reply addresses
         if self.listen_address.is_multicast and not self.reply_address.is_link_local:
@@ -89,40 +122,184 @@ class UDPListener(Listener):
         if not self.listen_address.is_multicast and self.reply_socket != self.listen_socket:
             raise ListeningSocketError("Unicast listening addresses can't use separate reply sockets")
 
-    def recv_request(self) -> Tuple[IncomingPacketBundle, Replier]:
+        # These are the same for every packet, so determine them once
+        self.received_over_multicast = self.listen_address.is_multicast
+        self.relay_options = (InterfaceIdOption(interface_id=self.interface_id),)
+        self.replier = UDPReplier(self.reply_socket, set_source_address=self.wildcard)
+
+        # Replies go out on the interface we listen on, so the replier doesn't have to look it up for every reply
+        if not self.wildcard:
+            if self.interface_index:
+                self.replier.reply_interfaces[self.interface_id] = (self.interface_index, self.interface_name)
+            else:
+                self.replier.get_reply_interface(self.interface_id)
+
+        # Clients send more than one packet, so remember their parsed addresses for a while
+        self.source_addresses = {}
+
+        # And for wildcard listeners the packet info of the addresses that packets are sent to
+        self.destinations = {}
+        self.ancillary_size = PKTINFO_SPACE if self.wildcard else 0
+
+        # Receive into the same buffer every time, only the actual packet gets copied
+        self.buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self.buffer_view = memoryview(self.buffer)
+
+        # Whether we stopped receiving before the socket was empty
+        self.more_waiting = False
+
+    @property
+    def name(self) -> str:
         """
-        Receive incoming messages
+        A short description of this listener, used for keeping statistics per listener.
+
+        :return: The name of this listener
+        """
+        return 'udp {}/{}'.format(self.interface_name, self.listen_address)
+
+    def get_destination(self, ancillary_data: List[Tuple[int, int, bytes]]) \
+            -> Tuple[int, str, IPv6Address, Tuple[InterfaceIdOption], 'UDPReplier']:
+        """
+        Determine where a packet received on a wildcard socket was sent to from its packet info.
+
+        :param ancillary_data: The ancillary data as returned by recvmsg
+        :return: The interface index, interface name, destination address, relay options and replier
+        :raises IgnoreMessage: If the packet was not sent to a unicast address
+        """
+        for level, kind, data in ancillary_data:
+            if level == socket.IPPROTO_IPV6 and kind == socket.IPV6_PKTINFO:
+                break
+        else:
+            raise IgnoreMessage("Packet without destination information received on wildcard socket")
+
+        # The same addresses are used over and over again
+        destination = self.destinations.get(data, False)
+        if destination is False:
+            if len(self.destinations) >= SOURCE_ADDRESS_CACHE_SIZE:
+                self.destinations.clear()
+
+            packed_address, interface_index = IN6_PKTINFO.unpack(data)
+            address = IPv6Address(packed_address)
+            if address.is_multicast:
+                # The kernel also delivers multicast packets for groups that other sockets have joined, and those are
+                # already handled by the multicast listeners
+                destination = None
+            else:
+                try:
+                    interface_name = socket.if_indextoname(interface_index)
+                except OSError:
+                    interface_name = str(interface_index)
+
+                # Replies to this destination go out on the interface it was received on
+                interface_id = interface_name.encode('utf-8')
+                replier = UDPReplier(self.reply_socket, set_source_address=True,
+                                     reply_interfaces={interface_id: (interface_index, interface_name)})
+
+                destination = (interface_index, interface_name, address,
+                               (InterfaceIdOption(interface_id=interface_id),), replier)
+
+            self.destinations[data] = destination
+
+        if destination is None:
+            raise IgnoreMessage("Ignoring multicast packet received on wildcard socket")
+
+        return destination
+
+    def receive(self, flags: int = 0) -> Tuple[IncomingPacketBundle, Replier]:
+        """
+        Receive a single incoming message into the receive buffer
 
+        :param flags: The flags to pass to recvmsg
         :return: The incoming packet data and a replier object
         """
-        data, sender = self.listen_socket.recvfrom(65536)
+        length, ancillary_data, msg_flags, sender = self.listen_socket.recvmsg_into([self.buffer],
+                                                                                    self.ancillary_size, flags)
+        data = bytes(self.buffer_view[:length])
 
-        # Create the message-ID
-        message_counter = increase_message_counter()
-        message_id = '#{:06X}'.format(message_counter)
+        if self.wildcard:
+            interface_index, interface_name, link_address, relay_options, replier = \
+                self.get_destination(ancillary_data)
+        else:
+            interface_index = self.interface_index
+            interface_name = self.interface_name
+            link_address = self.global_address
+            relay_options = self.relay_options
+            replier = self.get_replier(sender)
+
+        # The message-ID is only formatted when something needs it
+        message_number = increase_message_counter()
 
-        logger.log(DEBUG_PACKETS, "{message_id}: Received message from {client_addr} port {port} on {interface}".format(
-            message_id=message_id,
-            client_addr=sender[0],
-            port=sender[1],
-            interface=self.interface_name))
+        logger.log(DEBUG_PACKETS, "#%06X: Received message from %s port %s on %s", message_number, sender[0], sender[1],
+                   interface_name)
 
-        interface_id_option = InterfaceIdOption(interface_id=self.interface_id)
+        source_address = self.source_addresses.get(sender[0])
+        if source_address is None:
+            if len(self.source_addresses) >= SOURCE_ADDRESS_CACHE_SIZE:
+                self.source_addresses.clear()
 
-        packet_bundle = IncomingPacketBundle(message_id=message_id,
+            source_address = IPv6Address(sender[0].split('%')[0])
+            self.source_addresses[sender[0]] = source_address
+
+        packet_bundle = IncomingPacketBundle(message_number=message_number,
                                              data=data,
-                                             source_address=IPv6Address(sender[0].split('%')[0]),
-                                             link_address=self.global_address,
-                                             interface_index=self.interface_index,
-                                             received_over_multicast=self.listen_address.is_multicast,
+                                             source_address=source_address,
+                                             link_address=link_address,
+                                             interface_index=interface_index,
+                                             received_over_multicast=self.received_over_multicast,
                                              received_over_tcp=False,
                                              marks=self.marks,
-                                             relay_options=[interface_id_option])
-
-        replier = UDPReplier(self.reply_socket)
+                                             relay_options=relay_options)
 
         return packet_bundle, replier
 
+    def get_replier(self, sender: Tuple) -> Replier:
+        """
+        Get the replier for a packet. All packets share the same replier, but listeners that reply to the port that a
+        packet came from can override this.
+
+        :param sender: The socket address that the packet came from
+        :return: The replier
+        """
+        return self.replier
+
+    def recv_request(self) -> Tuple[IncomingPacketBundle, Replier]:
+        """
+        Receive incoming messages
+
+        :return: The incoming packet data and a replier object
+        """
+        return self.receive()
+
+    def recv_requests(self) -> List[Tuple[IncomingPacketBundle, Replier]]:
+        """
+        Receive all the messages that are waiting on the socket without blocking, up to :data:`RECEIVE_BATCH_SIZE`
+        so that other listeners get their turn.
+
+        :return: The incoming packets and their repliers
+        """
+        requests = []
+        for _ in range(RECEIVE_BATCH_SIZE):
+            try:
+                requests.append(self.receive(socket.MSG_DONTWAIT))
+            except BlockingIOError:
+                self.more_waiting = False
+                break
+            except IgnoreMessage as e:
+                logger.log(DEBUG_PACKETS, "%s", e)
+        else:
+            self.more_waiting = True
+
+        return requests
+
+    @property
+    def backlogged(self) -> bool:
+        """
+        Whether the last call to :meth:`recv_requests` stopped before the socket was empty
+
+        :return: Whether there may be packets waiting
+        """
+        return self.more_waiting
+
     def fileno(self) -> int:
         """
         The fileno of the listening socket, so this object can be used by select()
@@ -135,10 +312,61 @@ class UDPListener(Listener):
 class UDPReplier(Replier):
     """
     A class to send replies to the client
+
+    :type reply_interfaces: Dict[bytes, Tuple[int, str]]
     """
 
-    def __init__(self, reply_socket: socket.socket):
+    def __init__(self, reply_socket: socket.socket, set_source_address: bool = False,
+                 reply_interfaces: Dict[bytes, Tuple[int, str]] = None):
+        """
+        Initialise the replier
+
+        :param reply_socket: The socket to send replies from
+        :param set_source_address: Send replies from the link-address of the outgoing message, which is necessary for
+                                   sockets bound to the wildcard address
+        :param reply_interfaces: Interface-ID option contents mapped to the interface index and name, as far as the
+                                 listener already knows them
+        """
         self.reply_socket = reply_socket
+        self.set_source_address = set_source_address
+        self.reply_interfaces = dict(reply_interfaces or {})
+
+    def get_reply_interface(self, interface_id: bytes) -> Tuple[int, str]:
+        """
+        Get the interface index and name to send a reply on based on the contents of an interface-id option.
+
+        :param interface_id: The interface-id from the outgoing relay options
+        :return: The interface index (0 if unknown) and the interface name for logging
+        """
+        reply_interface = self.reply_interfaces.get(interface_id)
+        if reply_interface is None:
+            interface_name = interface_id.decode(encoding='utf-8', errors='replace')
+            try:
+                interface_index = socket.if_nametoindex(interface_id)
+            except OSError:
+                # Don't remember failures, the interface might appear later
+                return 0, interface_name
+
+            reply_interface = (interface_index, interface_name)
+            self.reply_interfaces[interface_id] = reply_interface
+
+        return reply_interface
+
+    def send_data(self, data: bytes, destination: Tuple[str, int, int, int], link_address: IPv6Address) -> int:
+        """
+        Send the data of a reply to its destination
+
+        :param data: The reply
+        :param destination: The socket address to send the reply to, including the interface index
+        :param link_address: The address to send from when setting the source address
+        :return: The number of bytes sent
+        """
+        if self.set_source_address:
+            packet_info = IN6_PKTINFO.pack(link_address.packed, destination[3])
+            return self.reply_socket.sendmsg([data], [(socket.IPPROTO_IPV6, socket.IPV6_PKTINFO, packet_info)],
+                                             0, destination)
+        else:
+            return self.reply_socket.sendto(data, destination)
 
     def send_reply(self, outgoing_message: RelayReplyMessage) -> bool:
         """
@@ -154,31 +382,39 @@ class UDPReplier(Replier):
         data = reply.save()
 
         # Try to determine the interface index from the outgoing relay options
-        interface_index = 0
-        interface_name = 'unknown'
         interface_id_option = outgoing_message.get_option_of_type(InterfaceIdOption)
         if interface_id_option:
-            try:
-                interface_name = interface_id_option.interface_id.decode(encoding='utf-8', errors='replace')
-                interface_index = socket.if_nametoindex(interface_id_option.interface_id)
-            except OSError:
-                pass
+            interface_id = interface_id_option.interface_id
+            interface_index, interface_name = self.get_reply_interface(interface_id)
+        else:
+            interface_id = None
+            interface_index, interface_name = 0, 'unknown'
+
+        try:
+            sent_length = self.send_data(data, (destination_address, port, 0, interface_index),
+                                         outgoing_message.link_address)
+        except OSError:
+            if interface_id not in self.reply_interfaces:
+                raise
+
+            # The interface might have been re-created with a different index, so look it up again
+            del self.reply_interfaces[interface_id]
+            new_interface_index, interface_name = self.get_reply_interface(interface_id)
+            if new_interface_index == interface_index:
+                raise
+
+            logger.debug("Interface %s changed from index %d to %d", interface_name, interface_index,
+                         new_interface_index)
+            sent_length = self.send_data(data, (destination_address, port, 0, new_interface_index),
+                                         outgoing_message.link_address)
 
-        destination = (destination_address, port, 0, interface_index)
-        sent_length = self.reply_socket.sendto(data, destination)
         success = len(data) == sent_length
 
         if success:
-            logger.log(DEBUG_PACKETS, "Sent {message_type} to {client_addr} port {port} on {interface}".format(
-                message_type=outgoing_message.inner_message.__class__.__name__,
-                client_addr=destination_address,
-                port=port,
-                interface=interface_name))
+            logger.log(DEBUG_PACKETS, "Sent %s to %s port %s on %s", outgoing_message.inner_message.__class__.__name__,
+                       destination_address, port, interface_name)
         else:
-            logger.error("Could not send {message_type} to {client_addr} port {port} on {interface}".format(
-                message_type=outgoing_message.inner_message.__class__.__name__,
-                client_addr=destination_address,
-                port=port,
-                interface=interface_name))
+            logger.error("Could not send %s to %s port %s on %s", outgoing_message.inner_message.__class__.__name__,
+                         destination_address, port, interface_name)
 
         return success
@@ -31,13 +31,27 @@ class UnicastUDPListenerFactory(UDPListenerFactory):
 
         super().__init__(section)
 
+    @property
+    def listens_on_wildcard(self) -> bool:
+        """
+        Whether this listener listens on the wildcard address.
+
+        :return: Whether this is a wildcard listener
+        """
+        return self.name.is_unspecified
+
     def validate_config_section(self):
         """
         Validate the interface information
         """
+        # The wildcard address listens on all interfaces
+        if self.name.is_unspecified:
+            self.found_interface = '*'
+            return
+
         # Validate what the user supplied
         if not is_global_unicast(self.name) and self.name != IPv6Address('::1'):
-            raise ValueError("The listener address must be a global unicast address")
+            raise ValueError("The listener address must be a global unicast address or the wildcard address")
 
         for interface_name in netifaces.interfaces():
             interface_addresses = [IPv6Address(addr_info['addr'].split('%')[0])
@@ -65,12 +79,15 @@ class UnicastUDPListenerFactory(UDPListenerFactory):
                 continue
 
             if self.match_socket(sock=old_listener.listen_socket, address=self.name):
-                logger.debug("Recycling existing socket for {} on {}".format(self.name, self.found_interface))
-                sock = old_listener.listen_socket
+                logger.debug("Recycling existing socket for %s on %s", self.name, self.found_interface)
+                sock = self.recycle_socket(old_listener.listen_socket)
                 break
         else:
-            logger.debug("Creating socket for {} on {}".format(self.name, self.found_interface))
-            sock = socket.socket(socket.AF_INET6, self.sock_type, self.sock_proto)
+            logger.debug("Creating socket for %s on %s", self.name, self.found_interface)
+            sock = self.create_socket()
+            if self.name.is_unspecified:
+                # We need to know where each packet was sent to
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RECVPKTINFO, 1)
             sock.bind((str(self.name), self.listen_port))
 
         return UDPListener(self.found_interface, sock, marks=self.marks)
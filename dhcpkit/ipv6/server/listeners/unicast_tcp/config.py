@@ -61,15 +61,17 @@ class UnicastTCPListenerFactory(TCPListenerFactory):
                 continue
 
             if self.match_socket(sock=old_listener.listen_socket, address=self.address):
-                logger.debug("Recycling existing TCP socket for {} on {}".format(self.address, self.found_interface))
+                logger.debug("Recycling existing TCP socket for %s on %s", self.address, self.found_interface)
                 sock = old_listener.listen_socket
                 break
         else:
-            logger.debug("Creating TCP socket for {} on {}".format(self.address, self.found_interface))
+            logger.debug("Creating TCP socket for %s on %s", self.address, self.found_interface)
             sock = socket.socket(socket.AF_INET6, self.sock_type, self.sock_proto)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             sock.bind((str(self.address), self.listen_port))
             sock.listen(10)
 
         return TCPConnectionListener(interface_name=self.found_interface, listen_socket=sock, marks=self.marks,
-                                     allow_from=self.allow_from)
+                                     max_connections=self.max_connections, allow_from=self.allow_from,
+                                     max_connections_per_peer=self.max_connections_per_peer,
+                                     idle_timeout=self.idle_timeout, max_connection_time=self.max_connection_time)
@@ -10,10 +10,10 @@ import multiprocessing
 import multiprocessing.queues
 import os
 import pwd
-import selectors
 import signal
 import sys
 import time
+from ipaddress import IPv6Address
 from multiprocessing import forkserver
 from multiprocessing.util import get_logger
 from urllib.parse import urlparse
@@ -21,21 +21,31 @@ from urllib.parse import urlparse
 import dhcpkit
 from ZConfig import ConfigurationSyntaxError, DataConversionError
 from dhcpkit.common.privileges import drop_privileges, restore_privileges
+from dhcpkit.common.server.config_datatypes import hex_bytes
 from dhcpkit.common.server.logging.config_elements import set_verbosity_logger
 from dhcpkit.ipv6.server import config_parser, queue_logger
+from dhcpkit.ipv6.server.capture import CaptureWriter
 from dhcpkit.ipv6.server.config_elements import MainConfig
-from dhcpkit.ipv6.server.control_socket import ControlConnection, ControlSocket
+from dhcpkit.ipv6.server.control_socket import ControlConnection, ControlSocket, MAX_WATCH_INTERVAL, \
+    MIN_WATCH_INTERVAL
+from dhcpkit.ipv6.server.event_selector import EventSelector
+from dhcpkit.ipv6.server.extensions.leasequery.sqlite_writer import find_writers
+from dhcpkit.ipv6.server.flight_recorder import FlightRecorder, format_transaction
 from dhcpkit.ipv6.server.listeners import ClosedListener, IgnoreMessage, Listener, ListenerCreator
+from dhcpkit.ipv6.server.metrics import MetricsServer
 from dhcpkit.ipv6.server.nonblocking_pool import NonBlockingPool
-from dhcpkit.ipv6.server.queue_logger import WorkerQueueHandler
+from dhcpkit.ipv6.server.queue_logger import LogRateLimiter, WorkerQueueHandler
 from dhcpkit.ipv6.server.statistics import ServerStatistics
 from dhcpkit.ipv6.server.worker import handle_message, setup_worker
-from typing import Iterable, Optional
+from typing import Iterable, List, Optional, Union
 
 logger = logging.getLogger()
 
 logging_thread = None
 
+# Control commands that don't take any arguments
+COMMANDS_WITHOUT_ARGUMENTS = ('help', 'stats', 'stats-json', 'reload', 'shutdown', 'quit')
+
 
 @atexit.register
 def stop_logging_thread():
@@ -60,6 +70,56 @@ def error_callback(exception):
     logger.error(message)
 
 
+def dispatch_requests(listener: Listener, pool: NonBlockingPool, statistics: ServerStatistics) -> int:
+    """
+    Receive the requests that are available on the listener and submit them to the worker pool
+
+    :param listener: The listener to receive from
+    :param pool: The worker pool
+    :param statistics: The server statistics
+    :return: The number of received requests
+    """
+    requests = listener.recv_requests()
+    if not requests:
+        return 0
+
+    # Update stats
+    statistics.count_listener_packet(listener.name, len(requests))
+
+    # Dispatch them all at once
+    results = pool.apply_async_batch(handle_message, requests, error_callback=error_callback)
+    if results is None:
+        statistics.count_dropped_packet(len(requests))
+
+    return len(requests)
+
+
+def get_next_deadline(listeners: Iterable[Union[Listener, ListenerCreator]]) -> Optional[float]:
+    """
+    Determine when the first listener times out. Activity only moves deadlines further away, so when this time comes
+    the listeners only need to be checked again.
+
+    :param listeners: The listeners and listener creators
+    :return: The earliest deadline, if any
+    """
+    deadlines = [listener.deadline for listener in listeners if isinstance(listener, Listener)]
+    deadlines = [deadline for deadline in deadlines if deadline is not None]
+    return min(deadlines) if deadlines else None
+
+
+def get_expired_listeners(listeners: Iterable[Union[Listener, ListenerCreator]], now: float) -> List[Listener]:
+    """
+    Find the listeners that have been idle or open for too long
+
+    :param listeners: The listeners and listener creators
+    :param now: The current time
+    :return: The listeners to close
+    """
+    return [listener for listener in listeners
+            if isinstance(listener, Listener) and listener.deadline is not None
+            and listener.deadline <= now and listener.expired(now)]
+
+
 def handle_args(args: Iterable[str]):
     """
     Handle the command line arguments.
@@ -110,7 +170,7 @@ def create_pidfile(args, config: MainConfig) -> Optional[str]:
             pass
 
         with open(pid_filename, 'w') as pidfile:
-            logger.info("Writing PID-file {}".format(pid_filename))
+            logger.info("Writing PID-file %s", pid_filename)
             pidfile.write("{}\n".format(os.getpid()))
         os.umask(old_umask)
 
@@ -150,6 +210,196 @@ def create_control_socket(args, config: MainConfig) -> ControlSocket:
         return control_socket
 
 
+def create_metrics_server(config: MainConfig, statistics: ServerStatistics,
+                          old_metrics_server: Optional[MetricsServer]) -> Optional[MetricsServer]:
+    """
+    Create an OpenMetrics HTTP listener when configured to do so.
+
+    :param config: The server configuration
+    :param statistics: The statistics to export
+    :param old_metrics_server: The metrics server from the previous configuration, which is re-used if possible
+    :return: The metrics server
+    """
+    if old_metrics_server:
+        if old_metrics_server.address == config.metrics_address and old_metrics_server.port == config.metrics_port:
+            # Nothing changed, keep the existing one
+            return old_metrics_server
+
+        old_metrics_server.stop()
+
+    if config.metrics_port is None:
+        return None
+
+    metrics_server = MetricsServer(config.metrics_address, config.metrics_port, statistics)
+    metrics_server.start()
+    return metrics_server
+
+
+def create_capture_writer(config: MainConfig, statistics: ServerStatistics) -> Optional[CaptureWriter]:
+    """
+    Create a packet capture writer when configured to do so.
+
+    :param config: The server configuration
+    :param statistics: The statistics to count captured and dropped frames in
+    :return: The capture writer
+    """
+    if not config.capture:
+        return None
+
+    capture = config.capture.create_packet_capture(statistics)
+    capture_writer = CaptureWriter(filename=config.capture.name,
+                                   max_size=config.capture.size,
+                                   keep=config.capture.keep,
+                                   capture=capture,
+                                   statistics=statistics)
+    capture_writer.start()
+    return capture_writer
+
+
+def create_flight_recorder(config: MainConfig, old_flight_recorder: Optional[FlightRecorder]) \
+        -> Optional[FlightRecorder]:
+    """
+    Create a flight recorder when configured to do so.
+
+    :param config: The server configuration
+    :param old_flight_recorder: The flight recorder from the previous configuration, which is re-used if possible
+    :return: The flight recorder
+    """
+    if not config.history_size:
+        return None
+
+    if old_flight_recorder and old_flight_recorder.size == config.history_size \
+            and len(old_flight_recorder.rings) == config.workers:
+        # Nothing changed, keep the history
+        return old_flight_recorder
+
+    return FlightRecorder(workers=config.workers, size=config.history_size)
+
+
+def handle_control_commands(control_connection: ControlConnection, sel: EventSelector, statistics: ServerStatistics,
+                            flight_recorder: Optional[FlightRecorder], control_watchers: List[ControlConnection],
+                            signal_w: int):
+    """
+    Handle the commands that were received on a control connection
+
+    :param control_connection: The control connection that has data waiting
+    :param sel: The selector that the control connection is registered with
+    :param statistics: The server statistics
+    :param flight_recorder: The flight recorder, if enabled
+    :param control_watchers: The list of control connections that watch the statistics
+    :param signal_w: The signal pipe, to simulate signals
+    """
+    control_start = time.monotonic()
+    commands = control_connection.get_commands()
+    for command in commands:
+        arguments = []
+        if command:
+            logger.debug("Received control command '%s'", command)
+
+            # Separate the command from its arguments
+            command, *arguments = command.split() or ['']
+
+            if arguments and command in COMMANDS_WITHOUT_ARGUMENTS:
+                logger.warning("Rejecting control command '%s' with unexpected arguments", command)
+                control_connection.reject()
+                continue
+
+        if command == 'help':
+            control_connection.send("Recognised commands:")
+            control_connection.send("  help")
+            control_connection.send("  stats")
+            control_connection.send("  stats-json")
+            control_connection.send("  stats-watch [<interval>|off]")
+            control_connection.send("  history <duid>|<address>")
+            control_connection.send("  reload")
+            control_connection.send("  shutdown")
+            control_connection.send("  quit")
+            control_connection.acknowledge()
+
+        elif command == 'stats':
+            control_connection.send(str(statistics))
+            control_connection.acknowledge()
+
+        elif command == 'stats-json':
+            control_connection.send(json.dumps(statistics.export()))
+            control_connection.acknowledge()
+
+        elif command == 'stats-watch':
+            if arguments == ['off']:
+                control_connection.stop_watch()
+                control_connection.acknowledge('Stopped sending statistics')
+                continue
+
+            try:
+                if len(arguments) > 1:
+                    raise ValueError("Expected at most one argument")
+
+                interval = float(arguments[0]) if arguments else 1.0
+                if not MIN_WATCH_INTERVAL <= interval <= MAX_WATCH_INTERVAL:
+                    raise ValueError
+            except ValueError:
+                logger.warning("Rejecting invalid control command 'stats-watch %s'", ' '.join(arguments))
+                control_connection.reject()
+                continue
+
+            # Watching again only changes the interval
+            control_connection.start_watch(interval, statistics)
+            if control_connection not in control_watchers:
+                control_watchers.append(control_connection)
+            control_connection.acknowledge('Sending statistics every {} seconds'.format(interval))
+
+        elif command == 'history':
+            if not flight_recorder:
+                control_connection.acknowledge('History is disabled')
+                continue
+
+            try:
+                if len(arguments) != 1:
+                    raise ValueError("Expected one argument")
+
+                try:
+                    transactions = flight_recorder.find(address=IPv6Address(arguments[0]))
+                except ValueError:
+                    # Not an address, try it as a DUID
+                    transactions = flight_recorder.find(duid=hex_bytes(arguments[0]))
+            except ValueError:
+                control_connection.acknowledge('Usage: history <duid>|<address>')
+                continue
+
+            for transaction in transactions:
+                control_connection.send(format_transaction(transaction))
+            control_connection.acknowledge('{} transactions'.format(len(transactions)))
+
+        elif command == 'reload':
+            # Simulate a SIGHUP to reload
+            os.write(signal_w, bytes([signal.SIGHUP]))
+            control_connection.acknowledge('Reloading')
+
+        elif command == 'shutdown':
+            # Simulate a SIGTERM to reload
+            control_connection.acknowledge('Shutting down')
+            control_connection.close()
+            sel.unregister(control_connection)
+
+            os.write(signal_w, bytes([signal.SIGTERM]))
+            break
+
+        elif command == 'quit' or command is None:
+            if command == 'quit':
+                # User nicely signing off
+                control_connection.acknowledge()
+
+            control_connection.close()
+            sel.unregister(control_connection)
+            break
+
+        else:
+            logger.warning("Rejecting unknown control command '%s'", command)
+            control_connection.reject()
+
+    statistics.count_control_time(len(commands), time.monotonic() - control_start)
+
+
 def main(args: Iterable[str]) -> int:
     """
     The main program loop
@@ -192,10 +442,10 @@ def main(args: Iterable[str]) -> int:
 
     # Initialise the logger
     config.logging.configure(logger, verbosity=args.verbosity)
-    logger.info("Starting Python DHCPv6 server v{}".format(dhcpkit.__version__))
+    logger.info("Starting Python DHCPv6 server v%s", dhcpkit.__version__)
 
     # Create our selector
-    sel = selectors.DefaultSelector()
+    sel = EventSelector()
 
     # Convert signals to messages on a pipe
     signal_r, signal_w = os.pipe()
@@ -203,7 +453,6 @@ def main(args: Iterable[str]) -> int:
     flags = flags | os.O_NONBLOCK
     fcntl.fcntl(signal_w, fcntl.F_SETFL, flags)
     signal.set_wakeup_fd(signal_w)
-    sel.register(signal_r, selectors.EVENT_READ)
 
     # Ignore normal signal handling by attaching dummy handlers (SIG_IGN will not put messages on the pipe)
     signal.signal(signal.SIGINT, lambda signum, frame: None)
@@ -223,7 +472,123 @@ def main(args: Iterable[str]) -> int:
     statistics = ServerStatistics()
     listeners = []
     control_socket = None
+    control_watchers = []
+    metrics_server = None
+    capture_writer = None
+    flight_recorder = None
+    pool = None
     stopping = False
+    running = False
+    count_exception = False
+
+    # Listeners that need a turn without waiting for an event, and when we need to check connections for timeouts
+    backlog = {}
+    next_expiry_check = None
+
+    def handle_listener(listener: Listener):
+        """
+        Receive the requests from a listener and submit them to the worker pool
+
+        :param listener: The listener that has data waiting
+        """
+        nonlocal message_count
+
+        try:
+            message_count += dispatch_requests(listener, pool, statistics)
+        except IgnoreMessage:
+            # Message isn't complete, leave it for now
+            pass
+        except ClosedListener:
+            # This listener is closed (at least TCP shutdown for incoming data), so forget about it
+            sel.unregister(listener)
+            listeners.remove(listener)
+            listener.close()
+            return
+
+        if listener.backlogged:
+            backlog[listener] = True
+
+    def handle_listener_creator(listener_creator: ListenerCreator):
+        """
+        Activity on a listener creator means that we have a new listener
+
+        :param listener_creator: The listener creator that has a new listener waiting
+        """
+        nonlocal next_expiry_check
+
+        new_listener = listener_creator.create_listener()
+        if new_listener:
+            new_listener.set_worker_pool(pool)
+            sel.register_callback(new_listener, handle_listener, edge_triggered=new_listener.edge_triggered)
+            listeners.append(new_listener)
+
+            deadline = new_listener.deadline
+            if deadline is not None and (next_expiry_check is None or deadline < next_expiry_check):
+                next_expiry_check = deadline
+
+    def handle_signal(signal_pipe: int):
+        """
+        Handle a signal notification
+
+        :param signal_pipe: The pipe that signal numbers are written to
+        """
+        nonlocal config, running, stopping, count_exception
+
+        signal_nr = os.read(signal_pipe, 1)
+        if signal_nr[0] in (signal.SIGHUP,):
+            # SIGHUP tells the server to reload
+            try:
+                # Read the new configuration
+                config = config_parser.load_config(config_file)
+            except (ConfigurationSyntaxError, DataConversionError) as e:
+                # Make the config exceptions a bit more readable
+                msg = "Not reloading: " + str(e.message)
+                if e.lineno and e.lineno != -1:
+                    msg += ' on line {}'.format(e.lineno)
+                if e.url:
+                    parts = urlparse(e.url)
+                    msg += ' in {}'.format(parts.path)
+                logger.critical(msg)
+                return
+
+            except ValueError as e:
+                logger.critical("Not reloading: %s", e)
+                return
+
+            logger.info("DHCPv6 server restarting after configuration change")
+            running = False
+            stopping = False
+
+        elif signal_nr[0] in (signal.SIGINT, signal.SIGTERM):
+            logger.debug("Received termination request")
+
+            running = False
+            stopping = True
+
+        elif signal_nr[0] in (signal.SIGUSR1,):
+            # The USR1 signal is used to indicate initialisation errors in worker processes
+            count_exception = True
+
+    def handle_control_socket(control_socket: ControlSocket):
+        """
+        Accept a new control connection
+
+        :param control_socket: The control socket with a connection request
+        """
+        control_connection = control_socket.accept()
+        if control_connection:
+            # We got a connection, listen to events
+            sel.register_callback(control_connection, handle_control_connection)
+
+    def handle_control_connection(control_connection: ControlConnection):
+        """
+        Let the control connection handle received data
+
+        :param control_connection: The control connection that has data waiting
+        """
+        handle_control_commands(control_connection, sel, statistics, flight_recorder, control_watchers, signal_w)
+
+    sel.register_callback(signal_r, handle_signal)
 
     while not stopping:
         # Safety first: assume we want to quit when we break the inner loop unless told otherwise
@@ -244,7 +609,9 @@ def main(args: Iterable[str]) -> int:
         logging_thread.start()
 
         # Use the logging queue in the main process as well so messages don't get out of order
-        logging_handler = WorkerQueueHandler(logging_queue)
+        log_rate_limiter = LogRateLimiter(config.logging.rate_limit,
+                                          config.logging.rate_limit_burst) if config.logging.rate_limit else None
+        logging_handler = WorkerQueueHandler(logging_queue, rate_limiter=log_rate_limiter, statistics=statistics)
         logging_handler.setLevel(lowest_log_level)
         logger.handlers = [logging_handler]
 
@@ -271,7 +638,16 @@ def main(args: Iterable[str]) -> int:
 
         control_socket = create_control_socket(args=args, config=config)
         if control_socket:
-            sel.register(control_socket, selectors.EVENT_READ)
+            sel.register_callback(control_socket, handle_control_socket)
+
+        # Create a metrics listener
+        metrics_server = create_metrics_server(config=config, statistics=statistics, old_metrics_server=metrics_server)
+
+        # Start capturing packets, the workers of the previous configuration are gone so we can start a new capture
+        if capture_writer:
+            capture_writer.stop()
+
+        capture_writer = create_capture_writer(config=config, statistics=statistics)
 
         # And Drop privileges again
         drop_privileges(config.user, config.group, permanent=False)
@@ -287,12 +663,23 @@ def main(args: Iterable[str]) -> int:
 
             # Seems we don't need this one anymore
             sel.unregister(key.fileobj)
+            if isinstance(key.fileobj, Listener):
+                key.fileobj.close()
 
         # Collect all the file descriptors we want to listen to
         existing_listeners = [key.fileobj for key in sel.get_map().values()]
         for listener in listeners:
-            if listener not in existing_listeners:
-                sel.register(listener, selectors.EVENT_READ)
+            if listener in existing_listeners:
+                continue
+
+            if isinstance(listener, ListenerCreator):
+                sel.register_callback(listener, handle_listener_creator)
+            else:
+                sel.register_callback(listener, handle_listener, edge_triggered=listener.edge_triggered)
+
+        # Forget the turns and timeouts of the old listeners
+        backlog.clear()
+        next_expiry_check = get_next_deadline(listeners)
 
         # Configuration tree
         try:
@@ -301,17 +688,36 @@ def main(args: Iterable[str]) -> int:
             if args.verbosity >= 3:
                 logger.exception("Error initialising DHCPv6 server")
             else:
-                logger.critical("Error initialising DHCPv6 server: {}".format(e))
+                logger.critical("Error initialising DHCPv6 server: %s", e)
             return 1
 
         # Make sure we have space to store all the interface statistics
         statistics.set_categories(config.statistics)
 
+        # And for the history of the workers
+        flight_recorder = create_flight_recorder(config=config, old_flight_recorder=flight_recorder)
+
         # Start worker processes
         my_pid = os.getpid()
         with NonBlockingPool(processes=config.workers,
+                             max_pending_tasks=config.max_pending_requests,
                              initializer=setup_worker,
-                             initargs=(message_handler, logging_queue, lowest_log_level, statistics, my_pid)) as pool:
+                             initargs=(message_handler, logging_queue, lowest_log_level, statistics, my_pid,
+                                       config.logging.batch_size, config.logging.batch_interval,
+                                       config.logging.rate_limit, config.logging.rate_limit_burst,
+                                       capture_writer.capture if capture_writer else None,
+                                       flight_recorder)) as pool:
+
+            # Let the statistics report on the state of the pool and the connections
+            statistics.pool = pool
+            statistics.listener_creators = [listener for listener in listeners
+                                            if isinstance(listener, ListenerCreator)]
+            statistics.set_lease_writers(find_writers(message_handler))
+
+            # Let listeners that can wait see how busy the workers are
+            for listener in listeners:
+                if isinstance(listener, Listener):
+                    listener.set_worker_pool(pool)
 
             logger.info("Python DHCPv6 server is ready to handle requests")
 
@@ -321,136 +727,73 @@ def main(args: Iterable[str]) -> int:
 
                 # noinspection PyBroadException
                 try:
-                    events = sel.select()
-                    for key, mask in events:
-                        if isinstance(key.fileobj, Listener):
-                            try:
-                                packet, replier = key.fileobj.recv_request()
-
-                                # Update stats
-                                message_count += 1
-
-                                # Dispatch
-                                pool.apply_async(handle_message, args=(packet, replier), error_callback=error_callback)
-                            except IgnoreMessage:
-                                # Message isn't complete, leave it for now
-                                pass
-                            except ClosedListener:
-                                # This listener is closed (at least TCP shutdown for incoming data), so forget about it
-                                sel.unregister(key.fileobj)
-                                listeners.remove(key.fileobj)
-
-                        elif isinstance(key.fileobj, ListenerCreator):
-                            # Activity on this object means we have a new listener
-                            new_listener = key.fileobj.create_listener()
-                            if new_listener:
-                                sel.register(new_listener, selectors.EVENT_READ)
-                                listeners.append(new_listener)
-
-                        # Handle signal notifications
-                        elif key.fileobj == signal_r:
-                            signal_nr = os.read(signal_r, 1)
-                            if signal_nr[0] in (signal.SIGHUP,):
-                                # SIGHUP tells the server to reload
-                                try:
-                                    # Read the new configuration
-                                    config = config_parser.load_config(config_file)
-                                except (ConfigurationSyntaxError, DataConversionError) as e:
-                                    # Make the config exceptions a bit more readable
-                                    msg = "Not reloading: " + str(e.message)
-                                    if e.lineno and e.lineno != -1:
-                                        msg += ' on line {}'.format(e.lineno)
-                                    if e.url:
-                                        parts = urlparse(e.url)
-                                        msg += ' in {}'.format(parts.path)
-                                    logger.critical(msg)
-                                    continue
-
-                                except ValueError as e:
-                                    logger.critical("Not reloading: " + str(e))
-                                    continue
-
-                                logger.info("DHCPv6 server restarting after configuration change")
-                                running = False
-                                stopping = False
-                                continue
-
-                            elif signal_nr[0] in (signal.SIGINT, signal.SIGTERM):
-                                logger.debug("Received termination request")
-
-                                running = False
-                                stopping = True
-                                break
-
-                            elif signal_nr[0] in (signal.SIGUSR1,):
-                                # The USR1 signal is used to indicate initialisation errors in worker processes
-                                count_exception = True
-
-                        elif isinstance(key.fileobj, ControlSocket):
-                            # A new control connection request
-                            control_connection = key.fileobj.accept()
-                            if control_connection:
-                                # We got a connection, listen to events
-                                sel.register(control_connection, selectors.EVENT_READ)
-
-                        elif isinstance(key.fileobj, ControlConnection):
-                            # Let the connection handle received data
-                            control_connection = key.fileobj
-                            commands = control_connection.get_commands()
-                            for command in commands:
-                                if command:
-                                    logger.debug("Received control command '{}'".format(command))
-
-                                if command == 'help':
-                                    control_connection.send("Recognised commands:")
-                                    control_connection.send("  help")
-                                    control_connection.send("  stats")
-                                    control_connection.send("  stats-json")
-                                    control_connection.send("  reload")
-                                    control_connection.send("  shutdown")
-                                    control_connection.send("  quit")
-                                    control_connection.acknowledge()
-
-                                elif command == 'stats':
-                                    control_connection.send(str(statistics))
-                                    control_connection.acknowledge()
-
-                                elif command == 'stats-json':
-                                    control_connection.send(json.dumps(statistics.export()))
-                                    control_connection.acknowledge()
-
-                                elif command == 'reload':
-                                    # Simulate a SIGHUP to reload
-                                    os.write(signal_w, bytes([signal.SIGHUP]))
-                                    control_connection.acknowledge('Reloading')
-
-                                elif command == 'shutdown':
-                                    # Simulate a SIGTERM to reload
-                                    control_connection.acknowledge('Shutting down')
-                                    control_connection.close()
-                                    sel.unregister(control_connection)
-
-                                    os.write(signal_w, bytes([signal.SIGTERM]))
-                                    break
-
-                                elif command == 'quit' or command is None:
-                                    if command == 'quit':
-                                        # User nicely signing off
-                                        control_connection.acknowledge()
+                    # Wake up in time for the next statistics update
+                    timeout = None
+                    if control_watchers:
+                        control_watchers = [watcher for watcher in control_watchers if watcher.watching]
+                        if control_watchers:
+                            next_deadline = min([watcher.watch_deadline for watcher in control_watchers])
+                            timeout = max(next_deadline - time.monotonic(), 0)
+
+                    # Wake up in time to close connections that time out
+                    if next_expiry_check is not None:
+                        expiry_timeout = max(next_expiry_check - time.monotonic(), 0)
+                        if timeout is None or expiry_timeout < timeout:
+                            timeout = expiry_timeout
+
+                    # Don't wait if some listeners still have requests waiting for their turn
+                    if backlog:
+                        timeout = 0
+
+                    events = sel.select(timeout)
+                    statistics.count_wakeup(len(events))
+
+                    # Give the listeners that have been waiting their turn first
+                    backlogged = list(backlog)
+                    backlog.clear()
+                    for listener in backlogged:
+                        handle_listener(listener)
+
+                    # Then call the handlers of the objects that are ready, skipping listeners that just had their turn
+                    if backlogged:
+                        had_turn = set(backlogged)
+                        events = [(key, mask) for key, mask in events if key.fileobj not in had_turn]
 
+                    for key, mask in events:
+                        key.data(key.fileobj)
+
+                    # Close connections that have been idle or open for too long
+                    if next_expiry_check is not None and time.monotonic() >= next_expiry_check:
+                        now = time.monotonic()
+                        for connection in get_expired_listeners(listeners, now):
+                            sel.unregister(connection)
+                            listeners.remove(connection)
+                            backlog.pop(connection, None)
+                            connection.close()
+
+                        next_expiry_check = get_next_deadline(listeners)
+
+                    # Send statistics updates that are due
+                    if control_watchers:
+                        control_start = time.monotonic()
+                        for control_connection in control_watchers:
+                            if control_connection.watching and control_connection.watch_deadline <= control_start:
+                                if not control_connection.send_watch_update(statistics):
                                     control_connection.close()
                                     sel.unregister(control_connection)
-                                    break
 
-                                else:
-                                    logger.warning("Rejecting unknown control command '{}'".format(command))
-                                    control_connection.reject()
+                        statistics.count_control_time(0, time.monotonic() - control_start)
 
                 except Exception as e:
                     # Catch-all exception handler
-                    logger.exception("Caught unexpected exception {!r}".format(e))
+                    logger.exception("Caught unexpected exception %r", e)
                     count_exception = True
 
+                    # Events that we didn't get to are not reported again for edge-triggered listeners
+                    for listener in listeners:
+                        if isinstance(listener, Listener) and listener.edge_triggered:
+                            backlog[listener] = True
+
                 if count_exception:
                     now = time.monotonic()
 
@@ -464,31 +807,42 @@ def main(args: Iterable[str]) -> int:
 
                     # Did we receive too many exceptions shortly after each other?
                     if len(exception_history) > config.max_exceptions:
-                        logger.critical("Received more than {} exceptions in {} seconds, "
-                                        "exiting".format(config.max_exceptions, config.exception_window))
+                        logger.critical("Received more than %s exceptions in %s seconds, exiting",
+                                        config.max_exceptions, config.exception_window)
                         running = False
                         stopping = True
 
             pool.close()
             pool.join()
 
+            statistics.pool = None
+            for listener in listeners:
+                if isinstance(listener, Listener):
+                    listener.set_worker_pool(None)
+
         # Regain root so we can delete the PID file and control socket
         restore_privileges()
         try:
             if pid_filename:
                 os.unlink(pid_filename)
-                logger.info("Removing PID-file {}".format(pid_filename))
+                logger.info("Removing PID-file %s", pid_filename)
         except OSError:
             pass
 
         try:
             if control_socket:
                 os.unlink(control_socket.socket_path)
-                logger.info("Removing control socket {}".format(control_socket.socket_path))
+                logger.info("Removing control socket %s", control_socket.socket_path)
         except OSError:
             pass
 
-    logger.info("Shutting down Python DHCPv6 server v{}".format(dhcpkit.__version__))
+    if metrics_server:
+        metrics_server.stop()
+
+    if capture_writer:
+        capture_writer.stop()
+
+    logger.info("Shutting down Python DHCPv6 server v%s", dhcpkit.__version__)
 
     return 0
 
@@ -503,7 +857,7 @@ def run() -> int:
         # Run the server
         return main(sys.argv[1:])
     except Exception as e:
-        logger.exception("Error: {}".format(e))
+        logger.exception("Error: %s", e)
         return 1
 
 
@@ -3,7 +3,7 @@ The code to handle a message
 """
 import logging
 import multiprocessing
-from typing import Iterable, List, Optional
+from typing import Hashable, Iterable, List, Optional, Tuple
 
 from dhcpkit.common.server.logging import DEBUG_HANDLING
 from dhcpkit.ipv6.duids import DUID
@@ -15,9 +15,9 @@ from dhcpkit.ipv6.messages import AdvertiseMessage, ConfirmMessage, DeclineMessa
 from dhcpkit.ipv6.options import ClientIdOption, IAAddressOption, IANAOption, IATAOption, STATUS_USE_MULTICAST, \
     ServerIdOption, StatusCodeOption
 from dhcpkit.ipv6.server.extension_registry import server_extension_registry
-from dhcpkit.ipv6.server.filters import Filter
-from dhcpkit.ipv6.server.handlers import CannotRespondError, Handler, ReplyWithLeasequeryError, ReplyWithStatusError, \
-    UseMulticastError
+from dhcpkit.ipv6.server.filters import Filter, SubFilterDecider
+from dhcpkit.ipv6.server.handlers import CannotRespondError, Handler, HandlerChain, ReplyWithLeasequeryError, \
+    ReplyWithStatusError, UseMulticastError
 from dhcpkit.ipv6.server.handlers.client_id import ClientIdHandler
 from dhcpkit.ipv6.server.handlers.interface_id import InterfaceIdOptionHandler
 from dhcpkit.ipv6.server.handlers.rapid_commit import RapidCommitHandler
@@ -30,6 +30,9 @@ from dhcpkit.ipv6.server.transaction_bundle import TransactionBundle
 
 logger = logging.getLogger(__name__)
 
+# The maximum number of different handler chains to remember
+HANDLER_CACHE_SIZE = 1024
+
 
 class MessageHandler:
     """
@@ -48,12 +51,18 @@ class MessageHandler:
         self.setup_handlers = self.get_setup_handlers()
         self.cleanup_handlers = self.get_cleanup_handlers()
 
+        # Compile the sub-filters for fast decisions
+        self.sub_filter_decider = SubFilterDecider(self.sub_filters)
+
+        # The handler chains that we have already built, keyed by the filter decisions that lead to them
+        self.handler_cache = {}
+
     def worker_init(self):
         """
         Separate initialisation that will be called in each worker process that is created. Things that can't be forked
         (think database connections etc) have to be initialised here.
         """
-        logger.debug("Initialising MessageHandler in {}".format(multiprocessing.current_process().name))
+        logger.debug("Initialising MessageHandler in %s", multiprocessing.current_process().name)
 
         # Cascade to sub-filters and sub-handlers
         for sub_filter in self.sub_filters:
@@ -90,6 +99,48 @@ class MessageHandler:
 
         return handlers
 
+    def get_cached_handlers(self, bundle: TransactionBundle) -> HandlerChain:
+        """
+        Get all handlers that are going to be applied to the request in the bundle. This gives the same result as
+        :meth:`get_handlers`, but only evaluates the filters and re-uses the handler chain if we have seen the same
+        combination of matching filters before.
+
+        :param bundle: The transaction bundle
+        :return: The chain of handlers to apply
+        """
+        decisions = self.sub_filter_decider.get_decisions(bundle)
+
+        handlers = self.handler_cache.get(decisions)
+        if handlers is None:
+            handlers = self.build_handlers(decisions)
+
+            # Don't let the cache grow without bounds if filters generate many different decisions
+            if len(self.handler_cache) >= HANDLER_CACHE_SIZE:
+                self.handler_cache.clear()
+
+            self.handler_cache[decisions] = handlers
+
+        return handlers
+
+    def build_handlers(self, decisions: Tuple[Hashable, ...]) -> HandlerChain:
+        """
+        Build the handler chain for the given decisions of the sub-filters
+
+        :param decisions: The decisions as returned by :meth:`Filter.get_decision` for each sub-filter
+        :return: The chain of handlers to apply
+        """
+        # The configured handlers, without the setup and cleanup handlers that every chain has
+        configured_handlers = []
+        """:type: [Handler]"""
+
+        for sub_filter, decision in zip(self.sub_filters, decisions):
+            configured_handlers += sub_filter.get_handlers_for_decision(decision)
+
+        configured_handlers += self.sub_handlers
+
+        handlers = self.setup_handlers + configured_handlers + self.cleanup_handlers
+        return HandlerChain(handlers, description_handlers=configured_handlers)
+
     def get_setup_handlers(self) -> List[Handler]:
         """
         Build a list of setup handlers and cache it
@@ -114,9 +165,8 @@ class MessageHandler:
             if create_setup_handlers:
                 setup_handlers = create_setup_handlers()
                 for setup_handler in setup_handlers:
-                    logger.log(DEBUG_HANDLING, "Extension {} added {} to setup phase".format(
-                        extension_name, setup_handler.__class__.__name__
-                    ))
+                    logger.log(DEBUG_HANDLING, "Extension %s added %s to setup phase", extension_name,
+                               setup_handler.__class__.__name__)
                 handlers += setup_handlers
 
         return handlers
@@ -143,9 +193,8 @@ class MessageHandler:
             if create_cleanup_handlers:
                 cleanup_handlers = create_cleanup_handlers()
                 for cleanup_handler in cleanup_handlers:
-                    logger.log(DEBUG_HANDLING, "Extension {} added {} to cleanup phase".format(
-                        extension_name, cleanup_handler.__class__.__name__
-                    ))
+                    logger.log(DEBUG_HANDLING, "Extension %s added %s to cleanup phase", extension_name,
+                               cleanup_handler.__class__.__name__)
                 handlers += cleanup_handlers
 
         # Confirm/Release/Decline messages always need a status
@@ -256,47 +305,48 @@ class MessageHandler:
         statistics.count_message_in(bundle.request.message_type)
 
         # Log what we are doing (low-detail, so not DEBUG_HANDLING here)
-        logger.debug("Handling {}".format(bundle))
+        logger.debug("Handling %s", bundle)
 
-        # Collect the handlers
-        handlers = self.get_handlers(bundle)
+        # Collect the handlers, and remember them for the flight recorder
+        handlers = self.get_cached_handlers(bundle)
+        bundle.handler_chain = handlers
 
         # Analyse pre
-        for handler in handlers:
+        for handler in handlers.analyse_pre_handlers:
             # noinspection PyBroadException
             try:
                 handler.analyse_pre(bundle)
             except:
                 # Ignore all errors, analysis isn't that important
-                logger.exception("{} pre analysis failed".format(handler.__class__.__name__))
+                logger.exception("%s pre analysis failed", handler.__class__.__name__)
 
         try:
             # Pre-process the request
-            for handler in handlers:
+            for handler in handlers.pre_handlers:
                 handler.pre(bundle)
 
             # Init the response
             self.init_response(bundle)
 
             # Process the request
-            for handler in handlers:
-                logger.log(DEBUG_HANDLING, "Applying {}".format(handler))
+            for handler in handlers.handle_handlers:
+                logger.log(DEBUG_HANDLING, "Applying %s", handler)
                 handler.handle(bundle)
 
             # Post-process the request
-            for handler in handlers:
+            for handler in handlers.post_handlers:
                 handler.post(bundle)
 
         except ForOtherServerError as e:
             # Specific form of CannotRespondError that should have its own log message
             message = str(e) or 'Message is for another server'
-            logger.debug("{}: ignoring".format(message))
+            logger.debug("%s: ignoring", message)
             statistics.count_for_other_server()
             bundle.response = None
 
         except CannotRespondError as e:
             message = str(e) or 'Cannot respond to this message'
-            logger.warning("{}: ignoring".format(message))
+            logger.warning("%s: ignoring", message)
             statistics.count_do_not_respond()
             bundle.response = None
 
@@ -312,7 +362,7 @@ class MessageHandler:
             else:
                 bundle.response = self.construct_plain_status_reply(bundle, e.option)
 
-            logger.warning("Replying with {}".format(e))
+            logger.warning("Replying with %s", e)
 
             # Update the right counter based on the status code
             if e.option.status_code == STATUS_UNKNOWN_QUERY_TYPE:
@@ -325,16 +375,16 @@ class MessageHandler:
                 statistics.count_other_error()
 
         # Analyse post
-        for handler in handlers:
+        for handler in handlers.analyse_post_handlers:
             # noinspection PyBroadException
             try:
                 handler.analyse_post(bundle)
             except:
                 # Ignore all errors, analysis isn't that important
-                logger.exception("{} post analysis failed".format(handler.__class__.__name__))
+                logger.exception("%s post analysis failed", handler.__class__.__name__)
 
         if bundle.response:
-            logger.log(DEBUG_HANDLING, "Responding with {}".format(bundle.response.__class__.__name__))
+            logger.log(DEBUG_HANDLING, "Responding with %s", bundle.response.__class__.__name__)
 
             # Count the outgoing message type
             statistics.count_message_out(bundle.response.message_type)
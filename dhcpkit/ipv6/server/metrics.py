@@ -0,0 +1,288 @@
+"""
+An HTTP listener that exports the server statistics in the OpenMetrics text format, so that monitoring systems like
+Prometheus can scrape them directly instead of going through the control socket.
+"""
+import logging
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from ipaddress import IPv6Address
+from socketserver import ThreadingMixIn
+
+from dhcpkit.ipv6.message_registry import message_registry
+from dhcpkit.ipv6.server.statistics import ServerStatistics, Statistics
+from dhcpkit.utils import camelcase_to_underscore
+from typing import Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+METRIC_PREFIX = 'dhcpkit_'
+
+# Close connections of clients that don't send a complete request in time
+REQUEST_TIMEOUT = 10
+
+counter_descriptions = (
+    ('incoming_packets', "Packets received"),
+    ('outgoing_packets', "Packets sent"),
+    ('unparsable_packets', "Received packets that could not be parsed"),
+    ('handling_errors', "Requests that caused an error while handling them"),
+    ('for_other_server', "Requests that were meant for another server"),
+    ('do_not_respond', "Requests that were not answered"),
+    ('use_multicast', "Requests that were answered with a use-multicast status"),
+    ('unknown_query_type', "Leasequeries with an unknown query type"),
+    ('malformed_query', "Leasequeries that were malformed"),
+    ('not_allowed', "Leasequeries that were not allowed"),
+    ('other_error', "Requests that were answered with another error status"),
+)
+
+
+def escape_label_value(value: str) -> str:
+    """
+    Escape a label value as required by the OpenMetrics text format
+
+    :param value: The raw value
+    :return: The escaped value
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    """
+    Format a list of labels for a sample line
+
+    :param labels: The label names and values
+    :return: The formatted labels including the curly braces, or an empty string if there are no labels
+    """
+    labels = ','.join(['{}="{}"'.format(name, escape_label_value(str(value))) for name, value in labels])
+    return '{' + labels + '}' if labels else ''
+
+
+def format_value(value) -> str:
+    """
+    Format a sample value
+
+    :param value: The value, an int or a float
+    :return: The formatted value
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+def get_message_type_name(message_type: int) -> str:
+    """
+    Get a label-friendly name for the given message type
+
+    :param message_type: The message type number
+    :return: The name, like 'solicit' or 'leasequery_reply'
+    """
+    name = camelcase_to_underscore(message_registry[message_type].__name__)
+    if name.endswith('_message'):
+        name = name[:-8]
+    return name
+
+
+def get_categories(statistics: ServerStatistics) -> List[Tuple[List[Tuple[str, str]], Statistics]]:
+    """
+    Get the statistics objects of all categories with the labels that identify them
+
+    :param statistics: The server statistics
+    :return: A list of labels and corresponding statistics
+    """
+    categories = [([('category', 'global')], statistics.global_stats)]
+
+    for category_name, category_data in (('interface', statistics.interface_stats),
+                                          ('subnet', statistics.subnet_stats),
+                                          ('relay', statistics.relay_stats)):
+        # Take a snapshot, a reload in the main loop may change the categories while we are being scraped
+        for key, stats in sorted(list(category_data.items()), key=lambda item: item[0]):
+            categories.append(([('category', category_name), (category_name, str(key))], stats))
+
+    return categories
+
+
+def render_openmetrics(statistics: ServerStatistics) -> str:
+    """
+    Render the server statistics in the OpenMetrics text format
+
+    :param statistics: The server statistics
+    :return: The exposition text
+    """
+    categories = get_categories(statistics)
+    lines = []
+
+    def add_family(name: str, metric_type: str, description: str):
+        """
+        Add the metadata lines of a metric family
+        """
+        lines.append('# TYPE {}{} {}'.format(METRIC_PREFIX, name, metric_type))
+        lines.append('# HELP {}{} {}'.format(METRIC_PREFIX, name, description))
+
+    def add_sample(name: str, labels: Iterable[Tuple[str, str]], value):
+        """
+        Add a sample line
+        """
+        lines.append('{}{}{} {}'.format(METRIC_PREFIX, name, format_labels(labels), format_value(value)))
+
+    # The simple counters
+    for counter_name, description in counter_descriptions:
+        add_family(counter_name, 'counter', description)
+        for labels, stats in categories:
+            add_sample(counter_name + '_total', labels, getattr(stats, counter_name).value)
+
+    # Counters per message type
+    for counter_name, description in (('messages_in', "Messages received per message type"),
+                                      ('messages_out', "Messages sent per message type")):
+        add_family(counter_name, 'counter', description)
+        for labels, stats in categories:
+            counters = getattr(stats, counter_name)  # type: Dict[int, object]
+            for message_type, counter in counters.items():
+                add_sample(counter_name + '_total',
+                           labels + [('message_type', get_message_type_name(message_type))],
+                           counter.value)
+
+    # The handling time histogram
+    add_family('handling_time_seconds', 'histogram', "Time spent by workers handling requests")
+    for labels, stats in categories:
+        count = 0
+        for bucket, counter in stats.handling_time_buckets.items():
+            count += counter.value
+            add_sample('handling_time_seconds_bucket', labels + [('le', format_value(bucket))], count)
+        add_sample('handling_time_seconds_count', labels, count)
+        add_sample('handling_time_seconds_sum', labels, stats.handling_time_sum.value)
+
+    # Information about the master process and the worker pool
+    add_family('workers', 'gauge', "Worker processes")
+    add_sample('workers', [], statistics.worker_count)
+    add_family('pending_results', 'gauge', "Requests dispatched to the workers that haven't been handled yet")
+    add_sample('pending_results', [], statistics.pending_results)
+    add_family('task_queue_depth', 'gauge', "Requests waiting in the task queue of the worker pool")
+    add_sample('task_queue_depth', [], statistics.task_queue_depth)
+    add_family('open_connections', 'gauge', "Open connections from clients, like Bulk Leasequery clients over TCP")
+    add_sample('open_connections', [], statistics.open_connections)
+    add_family('dropped_packets', 'counter', "Packets dropped because the worker pool was full")
+    add_sample('dropped_packets_total', [], statistics.dropped_packets)
+
+    # Instrumentation of the main loop of the master process
+    add_family('select_wakeups', 'counter', "Wakeups of the main loop")
+    add_sample('select_wakeups_total', [], statistics.wakeups)
+    add_family('select_events', 'counter', "Events handled by the main loop")
+    add_sample('select_events_total', [], statistics.events)
+    add_family('last_wakeup_events', 'gauge', "Events handled in the most recent wakeup of the main loop")
+    add_sample('last_wakeup_events', [], statistics.last_wakeup_events)
+    add_family('listener_packets', 'counter', "Packets received per listener")
+    # Take a snapshot, the main loop adds new listeners while we are being scraped
+    for listener_name, count in list(statistics.listener_packets.items()):
+        add_sample('listener_packets_total', [('listener', listener_name)], count)
+    add_family('control_commands', 'counter', "Commands received on control connections")
+    add_sample('control_commands_total', [], statistics.control_commands)
+    add_family('control_seconds', 'counter', "Time the main loop spent on control connections")
+    add_sample('control_seconds_total', [], statistics.control_time)
+
+    # Log records that never made it to the log handlers
+    add_family('suppressed_log_records', 'counter', "Log records suppressed by the rate limiter")
+    add_sample('suppressed_log_records_total', [], statistics.suppressed_log_records.value)
+    add_family('dropped_log_records', 'counter', "Log records dropped because the logging queue was full")
+    add_sample('dropped_log_records_total', [], statistics.dropped_log_records.value)
+
+    # Packet capture
+    add_family('captured_frames', 'counter', "Frames written to the packet capture file")
+    add_sample('captured_frames_total', [], statistics.captured_frames)
+    add_family('dropped_capture_frames', 'counter', "Frames not captured because the capture queue was full")
+    add_sample('dropped_capture_frames_total', [], statistics.dropped_capture_frames.value)
+
+    # TCP replies
+    add_family('dropped_streams', 'counter', "TCP reply streams that could not be sent completely")
+    add_sample('dropped_streams_total', [], statistics.dropped_streams.value)
+
+    # Leasequery writer processes
+    add_family('leasequery_updates_waited', 'counter', "Lease updates that waited for space in the writer queue")
+    add_sample('leasequery_updates_waited_total', [], statistics.get_lease_writer_counter('waited'))
+    add_family('leasequery_updates_dropped', 'counter', "Lease updates dropped because the writer queue stayed full")
+    add_sample('leasequery_updates_dropped_total', [], statistics.get_lease_writer_counter('dropped'))
+    add_family('leasequery_updates_written', 'counter', "Lease updates written to the database by the writer")
+    add_sample('leasequery_updates_written_total', [], statistics.get_lease_writer_counter('written'))
+    add_family('leasequery_updates_failed', 'counter', "Lease updates the writer could not write to the database")
+    add_sample('leasequery_updates_failed_total', [], statistics.get_lease_writer_counter('failed'))
+    add_family('leasequery_update_batches', 'counter', "Transactions in which the writer wrote lease updates")
+    add_sample('leasequery_update_batches_total', [], statistics.get_lease_writer_counter('batches'))
+
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve the statistics on GET requests
+    """
+
+    server_version = 'DHCPKit'
+    timeout = REQUEST_TIMEOUT
+
+    def do_GET(self):
+        """
+        Render the statistics
+        """
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = render_openmetrics(self.server.statistics).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, log_format, *args):
+        """
+        Send access logs to our own logger instead of stderr
+        """
+        logger.debug("Metrics request from %s: " + log_format, self.address_string(), *args)
+
+
+class MetricsHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    An IPv6 HTTP server that knows where to find the statistics. Every request is handled in its own thread, so a
+    client that doesn't send anything can't block other scrapes or stopping the server.
+    """
+
+    address_family = socket.AF_INET6
+    daemon_threads = True
+
+    def __init__(self, server_address: Tuple[str, int], statistics: ServerStatistics):
+        self.statistics = statistics
+        super().__init__(server_address, MetricsRequestHandler)
+
+
+class MetricsServer:
+    """
+    Run the HTTP server in its own thread so that scraping never blocks the main loop of the server
+    """
+
+    def __init__(self, address: IPv6Address, port: int, statistics: ServerStatistics):
+        self.address = address
+        self.port = port
+
+        logger.info("Creating metrics listener on [%s]:%s", address, port)
+        self.http_server = MetricsHTTPServer((str(address), port), statistics)
+
+        self.thread = threading.Thread(target=self.http_server.serve_forever, name='MetricsServer', daemon=True)
+
+    def start(self):
+        """
+        Start serving requests
+        """
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop serving requests and close the listening socket
+        """
+        logger.info("Closing metrics listener on [%s]:%s", self.address, self.port)
+        self.http_server.shutdown()
+        self.http_server.server_close()
+        self.thread.join()
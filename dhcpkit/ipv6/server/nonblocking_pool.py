@@ -2,34 +2,106 @@
 A multiprocessing pool that doesn't block when full. If we don't do this then the queue fills up with old messages and
 the workers keep answering those while the client has probably already given up, instead of answering recent messages.
 """
+import sys
 from multiprocessing.pool import ApplyResult, Pool, RUN
-from queue import Full
 
 from dhcpkit.ipv6.server.listeners import IncomingPacketBundle, Replier
-from typing import Any, Callable, Dict, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 
 class NonBlockingPool(Pool):
     """
-    A multiprocessing pool that doesn't block when full
+    A multiprocessing pool that doesn't block when full. The pool is full when the number of pending tasks reaches
+    ``max_pending_tasks``, new tasks are refused until the workers catch up. A limit of 0 never refuses tasks.
     """
 
+    def __init__(self, *args, max_pending_tasks: int = 0, **kwargs):
+        self.max_pending_tasks = max_pending_tasks
+        super().__init__(*args, **kwargs)
+
+    # noinspection PyProtectedMember
+    def create_result(self, callback: Callable[[Any], None] = None,
+                      error_callback: Callable[[Exception], None] = None) -> ApplyResult:
+        """
+        Create a result object that is registered in the cache of this pool.
+
+        :param callback: Called with the result when the task is successful
+        :param error_callback: Called with the exception when the task fails
+        :return: The result object
+        """
+        if sys.version_info >= (3, 8):
+            # Since Python 3.8 results need the pool itself
+            return ApplyResult(self, callback, error_callback)
+        else:
+            return ApplyResult(self._cache, callback, error_callback)
+
     # noinspection PyProtectedMember
     def apply_async(self, func: Callable, args: Tuple[IncomingPacketBundle, Replier] = (), kwds: Dict[str, Any] = None,
                     callback: Callable[[Any], None] = None, error_callback: Callable[[Exception], None] = None):
         """
         Asynchronous version of `apply()` method.
         """
+        results = self.apply_async_batch(func, [args], kwds, callback, error_callback)
+        return results[0] if results else None
+
+    # noinspection PyProtectedMember
+    def apply_async_batch(self, func: Callable, args_list: Iterable[Tuple[IncomingPacketBundle, Replier]],
+                          kwds: Dict[str, Any] = None, callback: Callable[[Any], None] = None,
+                          error_callback: Callable[[Exception], None] = None) -> Optional[List[ApplyResult]]:
+        """
+        Submit a task for each of the given argument tuples with a single put on the task queue. Either all tasks are
+        accepted or none of them, when they would take the number of pending tasks over ``max_pending_tasks``.
+
+        :param func: The function to call in the worker
+        :param args_list: The arguments for each task
+        :param kwds: The keyword arguments for every task
+        :param callback: Called with the result when a task is successful
+        :param error_callback: Called with the exception when a task fails
+        :return: The result objects, or None if the pool is full
+        """
         if self._state != RUN:
             raise ValueError("Pool not running")
 
-        try:
-            result = ApplyResult(self._cache, callback, error_callback)
-            self._taskqueue.put(([(result._job, None, func, args, kwds or {})], None), block=False)
-        except Full:
+        args_list = list(args_list)
+        if self.max_pending_tasks and self.pending_tasks + len(args_list) > self.max_pending_tasks:
             return None
 
-        return result
+        results = []
+        tasks = []
+        for args in args_list:
+            result = self.create_result(callback, error_callback)
+            results.append(result)
+            tasks.append((result._job, None, func, args, kwds or {}))
+
+        self._taskqueue.put((tasks, None))
+        return results
+
+    @property
+    def worker_count(self) -> int:
+        """
+        The number of worker processes in this pool.
+
+        :return: The number of workers
+        """
+        return self._processes
+
+    @property
+    def pending_tasks(self) -> int:
+        """
+        The number of tasks that have been submitted but whose result hasn't been received yet.
+
+        :return: The number of pending tasks
+        """
+        return len(self._cache)
+
+    @property
+    def queued_tasks(self) -> int:
+        """
+        The number of tasks that are waiting in the task queue, not yet picked up by the task handler thread.
+
+        :return: The number of queued tasks
+        """
+        return self._taskqueue.qsize()
 
     def __reduce__(self):
         raise NotImplementedError(
@@ -1,9 +1,129 @@
 """
 Adapt the QueueListener so that it respects the log levels of the handlers. Based on the Python 3.5 implementation.
+
+Workers send their log records to the main process in batches, and a rate limiter prevents a storm of similar log
+messages from saturating the main process.
 """
+import logging
+import threading
+import time
+from logging import LogRecord
 from logging.handlers import QueueHandler, QueueListener
 from multiprocessing.queues import Full, Queue
 
+from typing import Dict, Hashable, List, Optional, Tuple
+
+
+class LogRateLimiter:
+    """
+    A token bucket per kind of log message. Every bucket is refilled with `rate` tokens per second up to a maximum of
+    `burst` tokens, and every log message takes a token from its bucket. Messages are suppressed while their bucket is
+    empty, and the number of suppressed messages is reported when the bucket has been refilled.
+    """
+
+    # When we have more buckets than this, forget the ones that are full and have nothing to report
+    max_buckets = 1000
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+
+        # Each bucket is a list of [tokens, last update, suppressed count, log level, logger name, message]
+        self.buckets = {}  # type: Dict[Hashable, list]
+        self.suppressed_keys = set()
+
+    def refill(self, bucket: list, now: float):
+        """
+        Add the tokens that the bucket gained since the last update
+
+        :param bucket: The bucket to refill
+        :param now: The current time
+        """
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+
+    def allow(self, record: LogRecord, now: float) -> Tuple[bool, int]:
+        """
+        Determine whether the given record may be logged
+
+        :param record: The log record
+        :param now: The current time
+        :return: Whether the record may be logged and how many similar records were suppressed before it
+        """
+        msg = record.msg if isinstance(record.msg, str) else str(record.msg)
+        key = (record.name, msg)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                self.prune(now)
+
+            bucket = [self.burst, now, 0, record.levelno, record.name, msg]
+            self.buckets[key] = bucket
+        else:
+            self.refill(bucket, now)
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            suppressed = bucket[2]
+            if suppressed:
+                bucket[2] = 0
+                self.suppressed_keys.discard(key)
+            return True, suppressed
+
+        bucket[2] += 1
+        self.suppressed_keys.add(key)
+        return False, 0
+
+    def prune(self, now: float):
+        """
+        Forget the buckets that are full and have no suppressed messages to report
+
+        :param now: The current time
+        """
+        for key, bucket in list(self.buckets.items()):
+            self.refill(bucket, now)
+            if bucket[0] >= self.burst and not bucket[2]:
+                del self.buckets[key]
+
+    def get_summaries(self, now: float) -> List[LogRecord]:
+        """
+        Create summary records for message kinds whose suppression has ended
+
+        :param now: The current time
+        :return: A list of log records reporting the number of suppressed messages
+        """
+        summaries = []
+        for key in list(self.suppressed_keys):
+            bucket = self.buckets[key]
+            self.refill(bucket, now)
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                summaries.append(create_summary_record(bucket[4], bucket[3], bucket[5], bucket[2]))
+                bucket[2] = 0
+                self.suppressed_keys.discard(key)
+
+        return summaries
+
+
+def create_summary_record(name: str, level: int, msg, suppressed: int) -> LogRecord:
+    """
+    Create a log record that reports how many similar messages were suppressed
+
+    :param name: The name of the logger of the suppressed messages
+    :param level: The log level of the suppressed messages
+    :param msg: The message (or message format) of the suppressed messages
+    :param suppressed: The number of suppressed messages
+    :return: A log record that is ready for queuing
+    """
+    message = "{} similar messages suppressed: {}".format(suppressed, msg)
+    return logging.makeLogRecord({
+        'name': name,
+        'levelno': level,
+        'levelname': logging.getLevelName(level),
+        'msg': message,
+        'message': message,
+    })
+
 
 class QueueLevelListener(QueueListener):
     """
@@ -14,8 +134,14 @@ class QueueLevelListener(QueueListener):
         """
         Handle a record.
 
-        This just loops through the handlers offering them the record to handle.
+        This just loops through the handlers offering them the record to handle. Workers send a list of records
+        at once, in which case they are all handled in order.
         """
+        if isinstance(record, list):
+            for single_record in record:
+                self.handle(single_record)
+            return
+
         record = self.prepare(record)
         for handler in self.handlers:
             if record.levelno >= handler.level:
@@ -50,17 +176,88 @@ class QueueLevelListener(QueueListener):
 
 class WorkerQueueHandler(QueueHandler):
     """
-    A logging handler that queues messages and doesn't cause exceptions when the queue is full.
+    A logging handler that queues messages and doesn't cause exceptions when the queue is full. Records are collected
+    until the batch is full, the batch interval has passed since the oldest record in the batch, or the handler is
+    flushed, and then queued all at once. Records of level ERROR and higher are queued immediately.
     """
 
-    def __init__(self, queue: Queue):
+    def __init__(self, queue: Queue, batch_size: int = 1, rate_limiter: Optional[LogRateLimiter] = None,
+                 statistics=None, batch_interval: float = 1.0):
+        """
+        Initialise the handler.
+
+        :param queue: The queue to send the log records to
+        :param batch_size: The maximum number of records to send together
+        :param rate_limiter: The rate limiter to protect the main process against storms of log messages
+        :param statistics: The server statistics to count suppressed and dropped records in
+        :param batch_interval: The maximum number of seconds that a record waits for its batch to fill up
+        :type statistics: dhcpkit.ipv6.server.statistics.ServerStatistics
+        """
         super().__init__(queue)
         self.log_id = None
+        self.batch_size = max(batch_size, 1)
+        self.batch_interval = batch_interval
+        self.rate_limiter = rate_limiter
+        self.statistics = statistics
+        self.buffer = []
+        self.flush_timer = None
+
+    def emit(self, record: LogRecord):
+        """
+        Add a record to the batch, unless the rate limiter suppresses it. Suppressed records are never formatted.
+
+        :param record: The log record
+        """
+        try:
+            if self.rate_limiter:
+                allowed, suppressed = self.rate_limiter.allow(record, time.monotonic())
+                if not allowed:
+                    if self.statistics:
+                        self.statistics.count_suppressed_log_records(1)
+                    return
+
+                if suppressed:
+                    self.buffer.append(create_summary_record(record.name, record.levelno, record.msg, suppressed))
+
+            self.buffer.append(self.prepare(record))
+
+            if len(self.buffer) >= self.batch_size or record.levelno >= logging.ERROR:
+                self.flush()
+            elif self.flush_timer is None:
+                # Don't let the first record of this batch wait for the next one forever
+                self.flush_timer = threading.Timer(self.batch_interval, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """
+        Queue the collected records, including summaries of suppressed records
+        """
+        self.acquire()
+        try:
+            if self.flush_timer:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+            if self.rate_limiter and self.rate_limiter.suppressed_keys:
+                self.buffer.extend(self.rate_limiter.get_summaries(time.monotonic()))
+
+            if self.buffer:
+                batch = self.buffer
+                self.buffer = []
+                self.enqueue(batch)
+        finally:
+            self.release()
 
     def prepare(self, record):
         """
         Prepares a record for queuing. The object returned by this method is
         enqueued. This implementation adds the log_id if it is set.
+
+        Records only get here if they pass the level of this handler, so the message is only formatted for records
+        that are actually going to be logged.
         """
         record = super().prepare(record)
 
@@ -72,15 +269,50 @@ class WorkerQueueHandler(QueueHandler):
 
         return record
 
-    def enqueue(self, record):
+    def enqueue(self, batch: List[LogRecord]):
         """
-        Enqueue a record.
+        Enqueue a batch of records.
 
         Try three times rapidly, then just drop it.
         """
         for _ in (1, 2, 3):
             try:
-                self.queue.put_nowait(record)
+                self.queue.put_nowait(batch)
                 return
             except Full:
                 pass
+
+        if self.statistics:
+            self.statistics.count_dropped_log_records(len(batch))
+
+
+def get_main_logging_queue() -> Tuple[Optional[Queue], int]:
+    """
+    Find the queue that this process sends its log records to. Helper processes that are started by handlers or stores
+    in the main process can use it to log the same way as the workers.
+
+    :return: The logging queue, or None if there isn't one, and the lowest log level that is going to be handled
+    """
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, WorkerQueueHandler):
+            return handler.queue, handler.level
+
+    return None, logging.NOTSET
+
+
+def log_to_main_process(logging_queue: Optional[Queue], lowest_log_level: int):
+    """
+    Send the log records of a helper process to the main process.
+
+    :param logging_queue: The queue to send the log records to, or None to leave logging alone
+    :param lowest_log_level: The lowest log level that is going to be handled by the main process
+    """
+    if not logging_queue:
+        return
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(lowest_log_level)
+
+    logging_handler = WorkerQueueHandler(logging_queue)
+    logging_handler.setLevel(lowest_log_level)
+    root_logger.handlers = [logging_handler]
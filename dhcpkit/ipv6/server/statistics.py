@@ -1,8 +1,9 @@
 """
 Statistics about the server in shared memory
 """
+from bisect import bisect_left
 from collections import OrderedDict
-from ctypes import c_uint64
+from ctypes import c_double, c_uint64
 from multiprocessing import Value
 from multiprocessing.sharedctypes import Synchronized
 
@@ -12,6 +13,12 @@ from dhcpkit.ipv6.server.transaction_bundle import TransactionBundle
 from dhcpkit.utils import camelcase_to_underscore
 from typing import Dict, Hashable, Iterable, List
 
+HANDLING_TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, float('inf'))
+"""Upper bounds (in seconds) of the buckets of the handling time histogram"""
+
+LEASE_WRITER_COUNTERS = ('waited', 'dropped', 'written', 'failed', 'batches')
+"""The counters that the leasequery writer processes keep"""
+
 
 def create_update_method(counter_name):
     """
@@ -53,6 +60,31 @@ def create_update_dict_method(counter_name):
     return count_method
 
 
+def create_update_histogram_method(buckets_name: str, sum_name: str):
+    """
+    Create a method that adds an observation to a histogram on the Statistics class
+
+    :param buckets_name: The name of the dictionary with the bucket counters
+    :param sum_name: The name of the counter that keeps the sum of all observations
+    :return: The generated method
+    """
+
+    def count_method(self, value):
+        """
+        Count the observed value in the right bucket and add it to the sum
+        """
+        buckets = getattr(self, buckets_name)
+        counter = buckets[HANDLING_TIME_BUCKETS[bisect_left(HANDLING_TIME_BUCKETS, value)]]
+        with counter.get_lock():
+            counter.value += 1
+
+        total = getattr(self, sum_name)
+        with total.get_lock():
+            total.value += value
+
+    return count_method
+
+
 def create_count_method(method_name: str):
     """
     Create a counting method for the StatisticsSet class
@@ -91,6 +123,29 @@ def create_count_dict_method(method_name: str):
     return count_method
 
 
+def get_deltas(previous: Dict[str, object], current: Dict[str, object]) -> Dict[str, object]:
+    """
+    Compare two exports of the counters and return only the ones that changed, with the amount they changed.
+
+    :param previous: The older export
+    :param current: The newer export
+    :return: The changed counters, in the same structure as the exports
+    """
+    out = OrderedDict()
+    for key, value in current.items():
+        previous_value = previous.get(key) if previous else None
+        if isinstance(value, dict):
+            sub_deltas = get_deltas(previous_value, value)
+            if sub_deltas:
+                out[key] = sub_deltas
+        else:
+            delta = value - (previous_value or 0)
+            if delta:
+                out[key] = delta
+
+    return out
+
+
 class Statistics:
     """
     A set of statistics about DHCPv6
@@ -111,6 +166,9 @@ class Statistics:
 
     :type messages_in: Dict[int, Synchronized]
     :type messages_out: Dict[int, Synchronized]
+
+    :type handling_time_buckets: Dict[float, Synchronized]
+    :type handling_time_sum: Synchronized
     """
 
     def __init__(self):
@@ -147,6 +205,12 @@ class Statistics:
             if message_class.from_server_to_client and issubclass(message_class, ClientServerMessage):
                 self.messages_out[message_class.message_type] = Value(c_uint64)
 
+        # Histogram of how long it took to handle messages, each bucket only counts its own observations
+        self.handling_time_buckets = OrderedDict()
+        for bucket in HANDLING_TIME_BUCKETS:
+            self.handling_time_buckets[bucket] = Value(c_uint64)
+        self.handling_time_sum = Value(c_double)
+
     def __str__(self):
         lines = [
             "Packets",
@@ -217,6 +281,26 @@ class Statistics:
                 message_type_name = message_type_name[:-8]
             out['messages_out'][message_type_name] = counter.value
 
+        out['handling_time'] = self.export_handling_time()
+
+        return out
+
+    def export_handling_time(self) -> Dict[str, object]:
+        """
+        Export the handling time histogram with cumulative bucket counts, like Prometheus and OpenMetrics expect them
+
+        :return: The histogram in a processable format
+        """
+        buckets = OrderedDict()
+        count = 0
+        for bucket, counter in self.handling_time_buckets.items():
+            count += counter.value
+            buckets[str(bucket)] = count
+
+        out = OrderedDict()
+        out['buckets'] = buckets
+        out['count'] = count
+        out['sum'] = self.handling_time_sum.value
         return out
 
     count_incoming_packet = create_update_method('incoming_packets')
@@ -232,6 +316,7 @@ class Statistics:
     count_other_error = create_update_method('other_error')
     count_message_in = create_update_dict_method('messages_in')
     count_message_out = create_update_dict_method('messages_out')
+    count_handling_time = create_update_histogram_method('handling_time_buckets', 'handling_time_sum')
 
 
 class StatisticsSet:
@@ -255,6 +340,7 @@ class StatisticsSet:
     count_other_error = create_count_method('count_other_error')
     count_message_in = create_count_dict_method('count_message_in')
     count_message_out = create_count_dict_method('count_message_out')
+    count_handling_time = create_count_dict_method('count_handling_time')
 
 
 class ServerStatistics:
@@ -265,8 +351,27 @@ class ServerStatistics:
     :type interface_stats: Dict[str, Statistics]
     :type subnet_stats: Dict[IPv6Network, Statistics]
     :type relay_stats: Dict[IPv6Address, Statistics]
+    :type pool: NonBlockingPool
+    :type listener_creators: List[ListenerCreator]
+    :type dropped_packets: int
+    :type wakeups: int
+    :type events: int
+    :type last_wakeup_events: int
+    :type listener_packets: Dict[str, int]
+    :type control_commands: int
+    :type control_time: float
+    :type suppressed_log_records: Synchronized
+    :type dropped_log_records: Synchronized
+    :type captured_frames: int
+    :type dropped_capture_frames: Synchronized
+    :type dropped_streams: Synchronized
+    :type lease_writers: List[dhcpkit.ipv6.server.extensions.leasequery.sqlite_writer.LeasequerySqliteWriter]
+    :type lease_writer_totals: Dict[str, int]
     """
 
+    # Values in the server export that are a snapshot instead of an ever increasing counter
+    server_gauges = ('workers', 'pending_results', 'task_queue_depth', 'last_wakeup_events', 'open_connections')
+
     def __init__(self):
         self.global_stats = Statistics()
 
@@ -275,6 +380,180 @@ class ServerStatistics:
         self.subnet_stats = {}
         self.relay_stats = {}
 
+        # The master process keeps track of dispatching requests to the worker pool. These are plain numbers because
+        # they are only updated and read by the master process.
+        self.pool = None
+        self.listener_creators = []
+        self.dropped_packets = 0
+        self.wakeups = 0
+        self.events = 0
+        self.last_wakeup_events = 0
+        self.listener_packets = OrderedDict()
+        self.control_commands = 0
+        self.control_time = 0.0
+
+        # Log records that never reached the main process, counted by all processes
+        self.suppressed_log_records = Value(c_uint64)
+        self.dropped_log_records = Value(c_uint64)
+
+        # Packet capture: frames are written by the main process, workers count the frames they couldn't queue
+        self.captured_frames = 0
+        self.dropped_capture_frames = Value(c_uint64)
+
+        # TCP replies that workers could not send completely
+        self.dropped_streams = Value(c_uint64)
+
+        # The leasequery writer processes keep their own counters, and we keep what the replaced ones counted
+        self.lease_writers = []
+        self.lease_writer_totals = OrderedDict([(name, 0) for name in LEASE_WRITER_COUNTERS])
+
+    def __getstate__(self):
+        # The pool, listeners and writers only exist in the master process, and can't be pickled anyway
+        state = self.__dict__.copy()
+        state['pool'] = None
+        state['listener_creators'] = []
+        state['lease_writers'] = []
+        return state
+
+    def count_dropped_packet(self, count: int = 1):
+        """
+        Count packets that were dropped because the worker pool was full. Only called in the master process.
+
+        :param count: The number of dropped packets
+        """
+        self.dropped_packets += count
+
+    def count_suppressed_log_records(self, count: int):
+        """
+        Count log records that were suppressed by the rate limiter
+
+        :param count: The number of suppressed records
+        """
+        with self.suppressed_log_records.get_lock():
+            self.suppressed_log_records.value += count
+
+    def count_dropped_log_records(self, count: int):
+        """
+        Count log records that were dropped because the logging queue was full
+
+        :param count: The number of dropped records
+        """
+        with self.dropped_log_records.get_lock():
+            self.dropped_log_records.value += count
+
+    def count_captured_frame(self):
+        """
+        Count a frame written to the capture file. Only called in the main process.
+        """
+        self.captured_frames += 1
+
+    def count_dropped_capture_frame(self):
+        """
+        Count a frame that could not be captured because the capture queue was full
+        """
+        with self.dropped_capture_frames.get_lock():
+            self.dropped_capture_frames.value += 1
+
+    def count_dropped_stream(self):
+        """
+        Count a TCP reply stream that could not be sent completely
+        """
+        with self.dropped_streams.get_lock():
+            self.dropped_streams.value += 1
+
+    def set_lease_writers(self, writers: Iterable):
+        """
+        Report on the leasequery writers of a new configuration. The writers that are being replaced are stopped first,
+        so that everything they wrote is still counted. Only called in the master process.
+
+        :param writers: The writers of the leasequery stores of the current configuration
+        :type writers: Iterable[dhcpkit.ipv6.server.extensions.leasequery.sqlite_writer.LeasequerySqliteWriter]
+        """
+        writers = list(writers)
+        for writer in self.lease_writers:
+            if writer in writers:
+                continue
+
+            writer.stop()
+            for name in LEASE_WRITER_COUNTERS:
+                self.lease_writer_totals[name] += getattr(writer, name).value
+
+        self.lease_writers = writers
+
+    def get_lease_writer_counter(self, name: str) -> int:
+        """
+        Get a counter of the leasequery writers, including the writers of previous configurations
+
+        :param name: The name of the counter, one of LEASE_WRITER_COUNTERS
+        :return: The total count
+        """
+        return self.lease_writer_totals[name] + sum([getattr(writer, name).value for writer in self.lease_writers])
+
+    def count_wakeup(self, events: int):
+        """
+        Count a wakeup of the main loop of the master process.
+
+        :param events: The number of events that the selector returned
+        """
+        self.wakeups += 1
+        self.events += events
+        self.last_wakeup_events = events
+
+    def count_listener_packet(self, listener_name: str, count: int = 1):
+        """
+        Count packets received by the master process
+
+        :param listener_name: The name of the listener that received the packets
+        :param count: The number of packets received
+        """
+        self.listener_packets[listener_name] = self.listener_packets.get(listener_name, 0) + count
+
+    def count_control_time(self, commands: int, duration: float):
+        """
+        Count the time the master process spent on control connections instead of dispatching requests
+
+        :param commands: The number of commands handled
+        :param duration: The time it took in seconds
+        """
+        self.control_commands += commands
+        self.control_time += duration
+
+    @property
+    def worker_count(self) -> int:
+        """
+        The number of worker processes in the pool
+
+        :return: The number of workers
+        """
+        return self.pool.worker_count if self.pool else 0
+
+    @property
+    def open_connections(self) -> int:
+        """
+        The number of open connections, like TCP connections from Bulk Leasequery clients
+
+        :return: The number of open connections
+        """
+        return sum([creator.open_listeners for creator in self.listener_creators])
+
+    @property
+    def pending_results(self) -> int:
+        """
+        The number of requests that have been dispatched to the pool but haven't been handled yet
+
+        :return: The number of outstanding requests
+        """
+        return self.pool.pending_tasks if self.pool else 0
+
+    @property
+    def task_queue_depth(self) -> int:
+        """
+        The number of requests that are waiting in the task queue of the pool
+
+        :return: The number of queued requests
+        """
+        return self.pool.queued_tasks if self.pool else 0
+
     def set_categories(self, category_settings):
         """
         Create space for the given interfaces
@@ -365,6 +644,35 @@ class ServerStatistics:
         lines += get_category_lines('Subnet', self.subnet_stats)
         lines += get_category_lines('Relay', self.relay_stats)
 
+        lines += [
+            '',
+            'Server',
+            '- Workers: {}'.format(self.worker_count),
+            '- Pending results: {}'.format(self.pending_results),
+            '- Task queue depth: {}'.format(self.task_queue_depth),
+            '- Open connections: {}'.format(self.open_connections),
+            '- Dropped packets: {}'.format(self.dropped_packets),
+            '- Wakeups: {}'.format(self.wakeups),
+            '- Events: {}'.format(self.events),
+            '- Events in last wakeup: {}'.format(self.last_wakeup_events),
+            '- Control commands: {}'.format(self.control_commands),
+            '- Control time: {:.6f}s'.format(self.control_time),
+            '- Suppressed log records: {}'.format(self.suppressed_log_records.value),
+            '- Dropped log records: {}'.format(self.dropped_log_records.value),
+            '- Captured frames: {}'.format(self.captured_frames),
+            '- Dropped capture frames: {}'.format(self.dropped_capture_frames.value),
+            '- Dropped TCP streams: {}'.format(self.dropped_streams.value),
+            '- Leasequery updates waited: {}'.format(self.get_lease_writer_counter('waited')),
+            '- Leasequery updates dropped: {}'.format(self.get_lease_writer_counter('dropped')),
+            '- Leasequery updates written: {}'.format(self.get_lease_writer_counter('written')),
+            '- Leasequery updates failed: {}'.format(self.get_lease_writer_counter('failed')),
+            '- Leasequery update batches: {}'.format(self.get_lease_writer_counter('batches')),
+            'Received packets per listener',
+        ]
+
+        for name, count in self.listener_packets.items():
+            lines += ['- {}: {}'.format(name, count)]
+
         return '\n'.join(lines)
 
     def export(self) -> Dict[str, int]:
@@ -397,4 +705,56 @@ class ServerStatistics:
         out['subnets'] = get_category_data(self.subnet_stats)
         out['relays'] = get_category_data(self.relay_stats)
 
+        out['server'] = self.export_server()
+
+        return out
+
+    def export_counters(self) -> Dict[str, object]:
+        """
+        Export the counters, leaving out the gauges of the master process because their values can go down
+
+        :return: The counters in a processable format
+        """
+        out = self.export()
+        for name in self.server_gauges:
+            del out['server'][name]
+        return out
+
+    def export_gauges(self) -> Dict[str, int]:
+        """
+        Export only the gauges of the master process
+
+        :return: The gauges in a processable format
+        """
+        server = self.export_server()
+        return OrderedDict([(name, server[name]) for name in self.server_gauges])
+
+    def export_server(self) -> Dict[str, int]:
+        """
+        Export the statistics of the master process
+
+        :return: The counters in a processable format
+        """
+        out = OrderedDict()
+        out['workers'] = self.worker_count
+        out['pending_results'] = self.pending_results
+        out['task_queue_depth'] = self.task_queue_depth
+        out['open_connections'] = self.open_connections
+        out['dropped_packets'] = self.dropped_packets
+        out['wakeups'] = self.wakeups
+        out['events'] = self.events
+        out['last_wakeup_events'] = self.last_wakeup_events
+        out['listener_packets'] = OrderedDict(self.listener_packets)
+        out['control_commands'] = self.control_commands
+        out['control_time'] = self.control_time
+        out['suppressed_log_records'] = self.suppressed_log_records.value
+        out['dropped_log_records'] = self.dropped_log_records.value
+        out['captured_frames'] = self.captured_frames
+        out['dropped_capture_frames'] = self.dropped_capture_frames.value
+        out['dropped_streams'] = self.dropped_streams.value
+        out['leasequery_updates_waited'] = self.get_lease_writer_counter('waited')
+        out['leasequery_updates_dropped'] = self.get_lease_writer_counter('dropped')
+        out['leasequery_updates_written'] = self.get_lease_writer_counter('written')
+        out['leasequery_updates_failed'] = self.get_lease_writer_counter('failed')
+        out['leasequery_update_batches'] = self.get_lease_writer_counter('batches')
         return out
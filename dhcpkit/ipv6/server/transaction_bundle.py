@@ -29,6 +29,7 @@ class TransactionBundle:
     :type handled_options: List[Option]
     :type marks: Set[str]
     :type handler_data: Dict[Handler, object]
+    :type handler_chain: HandlerChain
     """
 
     def __init__(self, incoming_message: Message, received_over_multicast: bool, received_over_tcp: bool = False,
@@ -78,6 +79,9 @@ class TransactionBundle:
         self.handler_data = {}
         """A place for handlers to store data related to this transaction"""
 
+        self.handler_chain = None
+        """The chain of handlers that the message handler applied to this transaction"""
+
     def __str__(self) -> str:
         client_id = self.request.get_option_of_type(ClientIdOption)
         if client_id:
@@ -239,7 +243,7 @@ class TransactionBundle:
 
         for response in self.responses:
             if not response.from_server_to_client:
-                logger.error("A server should not send {} to a client".format(response.__class__.__name__))
+                logger.error("A server should not send %s to a client", response.__class__.__name__)
                 continue
 
             if self.outgoing_relay_messages:
@@ -31,7 +31,7 @@ def determine_local_duid() -> LinkLayerDUID:
                 # Assume it's ethernet, build a DUID
                 duid = LinkLayerDUID(hardware_type=1, link_layer_address=ll_addr)
 
-                logger.debug("Using server DUID based on {} link address: {}".format(interface_name, link_address))
+                logger.debug("Using server DUID based on %s link address: %s", interface_name, link_address)
 
                 return duid
             except ValueError:
@@ -7,13 +7,19 @@ import os
 import re
 import signal
 import sys
+import time
 from multiprocessing import Queue, current_process
+from multiprocessing.util import Finalize
 
 from dhcpkit.ipv6.messages import Message, RelayForwardMessage, RelayReplyMessage
 from dhcpkit.ipv6.options import InterfaceIdOption, Option, RelayMessageOption
+from dhcpkit.ipv6.server.capture import PacketCapture
+from dhcpkit.ipv6.server.flight_recorder import FlightRecorder, OUTCOME_ERROR, OUTCOME_NO_RESPONSE, OUTCOME_REPLIED, \
+    OUTCOME_UNPARSABLE
 from dhcpkit.ipv6.server.listeners import IncomingPacketBundle, Replier
+from dhcpkit.ipv6.server.listeners.tcp import setup_stream_writer, stop_stream_writer
 from dhcpkit.ipv6.server.message_handler import MessageHandler
-from dhcpkit.ipv6.server.queue_logger import WorkerQueueHandler
+from dhcpkit.ipv6.server.queue_logger import LogRateLimiter, WorkerQueueHandler
 from dhcpkit.ipv6.server.statistics import ServerStatistics
 from dhcpkit.ipv6.server.transaction_bundle import TransactionBundle
 from typing import Iterable
@@ -30,9 +36,17 @@ current_message_handler = None
 shared_statistics = None
 """:type: ServerStatistics"""
 
+packet_capture = None
+""":type: PacketCapture"""
+
+flight_recorder = None
+""":type: FlightRecorder"""
+
 
 def setup_worker(message_handler: MessageHandler, logging_queue: Queue, lowest_log_level: int,
-                 statistics: ServerStatistics, master_pid: int):
+                 statistics: ServerStatistics, master_pid: int, log_batch_size: int = 1, log_batch_interval: float = 1,
+                 log_rate_limit: float = 0, log_rate_limit_burst: int = 1, capture: PacketCapture = None,
+                 recorder: FlightRecorder = None):
     """
     This function will be called after a new worker process has been created. Its purpose is to set the global
     variables in this specific worker process so that they can be reused across multiple requests. Otherwise we would
@@ -43,6 +57,12 @@ def setup_worker(message_handler: MessageHandler, logging_queue: Queue, lowest_l
     :param lowest_log_level: The lowest log level that is going to be handled by the main process
     :param statistics: Container for shared memory with statistics counters
     :param master_pid: The PID of the master process, in case we have critical errors while initialising
+    :param log_batch_size: The maximum number of log records to send to the main process at once
+    :param log_batch_interval: The maximum number of seconds that log records wait for their batch to fill up
+    :param log_rate_limit: The number of similar log records per second to allow, or 0 for no limit
+    :param log_rate_limit_burst: The number of similar log records to allow in a burst
+    :param capture: The packet capture to record packets in, if enabled
+    :param recorder: The flight recorder to remember recent transactions in, if enabled
     """
     try:
         # Let's shorten the process name a bit by removing everything except the "Worker-x" bit at the end
@@ -54,13 +74,16 @@ def setup_worker(message_handler: MessageHandler, logging_queue: Queue, lowest_l
         signal.signal(signal.SIGTERM, lambda signum, frame: None)
         signal.signal(signal.SIGHUP, lambda signum, frame: None)
 
-        # Save the logger, don't let it filter, send everything to the queue
+        # Save the logger, and let it filter on the lowest level that the main process handles so that we don't even
+        # create records for messages that nobody is going to see
         global logger
         logger = logging.getLogger()
-        logger.setLevel(logging.NOTSET)
+        logger.setLevel(lowest_log_level)
 
         global logging_handler
-        logging_handler = WorkerQueueHandler(logging_queue)
+        log_rate_limiter = LogRateLimiter(log_rate_limit, log_rate_limit_burst) if log_rate_limit else None
+        logging_handler = WorkerQueueHandler(logging_queue, batch_size=log_batch_size, rate_limiter=log_rate_limiter,
+                                             statistics=statistics, batch_interval=log_batch_interval)
         logging_handler.setLevel(lowest_log_level)
         logger.addHandler(logging_handler)
 
@@ -71,11 +94,26 @@ def setup_worker(message_handler: MessageHandler, logging_queue: Queue, lowest_l
         global shared_statistics
         shared_statistics = statistics
 
+        # Finish sending TCP replies when the pool stops this worker, instead of cutting them off
+        setup_stream_writer(statistics)
+        Finalize(None, shutdown_worker, exitpriority=10)
+
+        global packet_capture
+        packet_capture = capture
+
+        global flight_recorder
+        flight_recorder = recorder
+        if flight_recorder:
+            flight_recorder.claim_ring()
+
         # Run the per-process startup code for the message handler and its children
         message_handler.worker_init()
+
+        # Don't keep the initialisation log records waiting for the first request
+        logging_handler.flush()
     except Exception as e:
         if logger:
-            logger.error("Error initialising worker: {}".format(e))
+            logger.error("Error initialising worker: %s", e)
 
         # Signal our predicament
         os.kill(master_pid, signal.SIGUSR1)
@@ -85,6 +123,16 @@ def setup_worker(message_handler: MessageHandler, logging_queue: Queue, lowest_l
         raise e
 
 
+def shutdown_worker():
+    """
+    This function will be called when a worker process exits. It sends the remaining replies and log records.
+    """
+    stop_stream_writer()
+
+    if logging_handler:
+        logging_handler.flush()
+
+
 def parse_incoming_request(incoming_packet: IncomingPacketBundle) -> TransactionBundle:
     """
     Parse the incoming packet and add a RelayServerMessage around it containing the meta-data received from the
@@ -166,6 +214,9 @@ def handle_message(incoming_packet: IncomingPacketBundle, replier: Replier):
     :param replier: The object that will send replies for us
     :returns: The packet to reply with and the destination
     """
+    # Measure how long it takes to handle this request
+    start_time = time.monotonic()
+
     # Set the log_id to make it easier to correlate log messages
     logging_handler.log_id = incoming_packet.message_id
 
@@ -175,12 +226,21 @@ def handle_message(incoming_packet: IncomingPacketBundle, replier: Replier):
     # Until we parsed the packet we can only update global and interface statistics
     statistics = shared_statistics.get_update_set(interface_name=interface_name)
 
+    # Keep track of what happened for the flight recorder
+    bundle = None
+    outcome = OUTCOME_NO_RESPONSE
+
     try:
         try:
             # Parse the packet
             bundle = parse_incoming_request(incoming_packet)
         except Exception as e:
-            logger.error("Error while parsing request: {}".format(e))
+            logger.error("Error while parsing request: %s", e)
+            outcome = OUTCOME_UNPARSABLE
+
+            # Capture the unparsable packet if we are not filtering on what's inside
+            if packet_capture and packet_capture.matches(interface_name, None):
+                packet_capture.capture_incoming(interface_name, incoming_packet)
 
             # Count the packet on the statistics counters that we have
             statistics.count_incoming_packet()
@@ -191,6 +251,10 @@ def handle_message(incoming_packet: IncomingPacketBundle, replier: Replier):
         statistics = shared_statistics.get_update_set(interface_name=interface_name, bundle=bundle)
         statistics.count_incoming_packet()
 
+        capture = packet_capture and packet_capture.matches(interface_name, bundle)
+        if capture:
+            packet_capture.capture_incoming(interface_name, incoming_packet)
+
         try:
             current_message_handler.handle(bundle, statistics)
 
@@ -198,15 +262,33 @@ def handle_message(incoming_packet: IncomingPacketBundle, replier: Replier):
                 verify_response(outgoing_message)
                 statistics.count_outgoing_packet()
 
+                if capture:
+                    packet_capture.capture_outgoing(interface_name, incoming_packet, outgoing_message)
+
                 try:
-                    replier.send_reply(outgoing_message)
+                    if not replier.send_reply(outgoing_message):
+                        logger.warning("Could not send %s, not sending any more replies",
+                                       outgoing_message.__class__.__name__)
+                        outcome = OUTCOME_ERROR
+                        break
+
+                    outcome = OUTCOME_REPLIED
                 except ValueError as e:
-                    logger.error("Handler returned invalid message: {}".format(e))
+                    logger.error("Handler returned invalid message: %s", e)
+                    outcome = OUTCOME_ERROR
 
         except Exception as e:
-            logger.exception("Error while handling request: {}".format(e))
+            logger.exception("Error while handling request: %s", e)
             statistics.count_handling_error()
+            outcome = OUTCOME_ERROR
 
     finally:
-        # Always reset the log_id when leaving
+        # Record the handling time on the most specific set of statistics that we have
+        latency = time.monotonic() - start_time
+        statistics.count_handling_time(latency)
+
+        if flight_recorder:
+            flight_recorder.record(time.time() - latency, latency, incoming_packet.message_id, outcome, bundle)
+
+        # Always reset the log_id when leaving, the log records are sent to the main process in batches
         logging_handler.log_id = None
@@ -39,8 +39,8 @@ class Registry(collections.UserDict):
                 name = entry_point.name
 
             if name in self.data:
-                logger.warning("Multiple entry points found for {} {}, using {}".format(
-                    self.__class__.__name__, name, self.data[name]))
+                logger.warning("Multiple entry points found for %s %s, using %s", self.__class__.__name__, name,
+                               self.data[name])
                 continue
 
             try:
@@ -53,13 +53,11 @@ class Registry(collections.UserDict):
                 self.by_name[alternative_name] = loaded
             except pkg_resources.VersionConflict as e:
                 # Wrong version, report
-                logger.critical("Entry point {} for {} is not compatible: {}".format(
-                    entry_point, self.__class__.__name__, e))
+                logger.critical("Entry point %s for %s is not compatible: %s", entry_point, self.__class__.__name__, e)
                 continue
             except ImportError:
                 # Ok, this one isn't working, skip it
-                logger.exception("Entry point {} for {} could not be loaded".format(
-                    entry_point, self.__class__.__name__))
+                logger.exception("Entry point %s for %s could not be loaded", entry_point, self.__class__.__name__)
                 continue
 
     def get_name(self, item: object) -> str:
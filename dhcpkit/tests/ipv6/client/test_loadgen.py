@@ -0,0 +1,155 @@
+"""
+Test the load generator
+"""
+import asyncio
+import unittest
+from ipaddress import IPv6Address, IPv6Network
+
+from dhcpkit.ipv6.client.loadgen import LoadGenerator, SimulatedClient, handle_args, percentile
+from dhcpkit.ipv6.duids import LinkLayerDUID
+from dhcpkit.ipv6.extensions.remote_id import RemoteIdOption
+from dhcpkit.ipv6.messages import AdvertiseMessage, Message, RelayForwardMessage, RenewMessage, ReplyMessage, \
+    RequestMessage, SolicitMessage
+from dhcpkit.ipv6.options import ClientIdOption, IAAddressOption, IANAOption, InterfaceIdOption, ServerIdOption, \
+    STATUS_NO_ADDRS_AVAIL, StatusCodeOption
+
+server_duid = LinkLayerDUID(hardware_type=1, link_layer_address=bytes.fromhex('002436ef1d89'))
+
+
+class FakeTransport:
+    """
+    A transport that answers like a DHCPv6 server, or drops the first few messages
+    """
+
+    def __init__(self, generator: LoadGenerator, drop: int = 0, fail: bool = False):
+        self.generator = generator
+        self.drop = drop
+        self.fail = fail
+        self.received = []
+
+    def sendto(self, data: bytes, destination):
+        length, message = Message.parse(bytes(data))
+        self.received.append(message)
+
+        if self.drop:
+            self.drop -= 1
+            return
+
+        relay_message = message
+        if isinstance(message, RelayForwardMessage):
+            message = message.inner_message
+
+        ia_na = message.get_option_of_type(IANAOption)
+        if self.fail:
+            ia_na = IANAOption(iaid=ia_na.iaid, options=[StatusCodeOption(STATUS_NO_ADDRS_AVAIL)])
+        elif not ia_na.options:
+            ia_na = IANAOption(iaid=ia_na.iaid, options=[IAAddressOption(IPv6Address('2001:db8::1234'), 300, 600)])
+
+        reply_class = AdvertiseMessage if isinstance(message, SolicitMessage) else ReplyMessage
+        reply = reply_class(message.transaction_id, options=[
+            message.get_option_of_type(ClientIdOption),
+            ServerIdOption(duid=server_duid),
+            ia_na,
+        ])
+        if isinstance(relay_message, RelayForwardMessage):
+            reply = relay_message.wrap_response(reply)
+
+        asyncio.get_event_loop().call_soon(self.generator.datagram_received, bytes(reply.save()), ('::1', 547))
+
+
+class LoadGeneratorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def run_generator(self, args, **kwargs) -> LoadGenerator:
+        generator = LoadGenerator(handle_args(args))
+        generator.connection_made(FakeTransport(generator, **kwargs))
+        self.loop.run_until_complete(generator.run())
+        return generator
+
+    def test_life_cycle(self):
+        generator = self.run_generator(['-n', '10', '-c', '3', '-R', '2', '-I', 'port{client}', '-E', 'relay{relay}',
+                                        '--relays', '2'])
+
+        self.assertEqual(generator.completed, 10)
+        self.assertEqual(generator.incomplete, 0)
+        self.assertEqual([(statistics.sent, statistics.replies) for statistics in generator.statistics.values()],
+                         [(10, 10), (10, 10), (20, 20)])
+        self.assertFalse(generator.pending)
+
+        # The clients go through their life cycle
+        received = generator.transport.received
+        inner_messages = [type(message.inner_message) for message in received
+                          if message.inner_message.get_option_of_type(ClientIdOption).duid ==
+                          SimulatedClient(3, 1).duid]
+        self.assertEqual(inner_messages, [SolicitMessage, RequestMessage, RenewMessage, RenewMessage])
+
+        # And the relays add their options
+        message = received[0]
+        self.assertIn(message.link_address, IPv6Network('2001:db8::/64'))
+        self.assertEqual(message.get_option_of_type(InterfaceIdOption).interface_id, b'port0')
+        self.assertEqual(message.get_option_of_type(RemoteIdOption).remote_id, b'relay0')
+        self.assertEqual(message.peer_address, SimulatedClient(0, 0).link_local_address)
+
+        # The request asks for the address from the advertise
+        request = [message.inner_message for message in received if isinstance(message.inner_message,
+                                                                                 RequestMessage)][0]
+        self.assertEqual(request.get_option_of_type(ServerIdOption).duid, server_duid)
+        self.assertEqual(request.get_option_of_type(IANAOption).get_option_of_type(IAAddressOption).address,
+                         IPv6Address('2001:db8::1234'))
+
+    def test_direct(self):
+        generator = self.run_generator(['-n', '2', '-R', '0', '--relays', '0'])
+        self.assertEqual(generator.completed, 2)
+        self.assertIsInstance(generator.transport.received[0], SolicitMessage)
+
+    def test_retransmit(self):
+        generator = self.run_generator(['-n', '1', '-R', '0', '-t', '0.01', '-x', '2'], drop=2)
+        self.assertEqual(generator.completed, 1)
+        self.assertEqual(generator.statistics['Solicit'].retransmitted, 2)
+        self.assertEqual(generator.statistics['Solicit'].replies, 1)
+
+    def test_lost(self):
+        generator = self.run_generator(['-n', '1', '-t', '0.01', '-x', '1'], drop=2)
+        self.assertEqual(generator.incomplete, 1)
+        self.assertEqual(generator.statistics['Solicit'].lost, 1)
+        self.assertEqual(generator.statistics['Request'].sent, 0)
+        self.assertIn('1 exchanges lost', generator.report(1.0))
+
+    def test_failed(self):
+        generator = self.run_generator(['-n', '2'], fail=True)
+        self.assertEqual(generator.incomplete, 2)
+        self.assertEqual(generator.statistics['Solicit'].failed, 2)
+
+    def test_unexpected(self):
+        generator = LoadGenerator(handle_args([]))
+        generator.datagram_received(b'\x07abc', ('::1', 547))
+        generator.datagram_received(b'\xff', ('::1', 547))
+        self.assertEqual(generator.unexpected, 2)
+
+
+class SimulatedClientTestCase(unittest.TestCase):
+    def test_identity(self):
+        client = SimulatedClient(0x123456, 3)
+        self.assertEqual(client.duid, LinkLayerDUID(hardware_type=1, link_layer_address=bytes.fromhex('020000123456')))
+        self.assertEqual(client.link_local_address, IPv6Address('fe80::ff:fe12:3456'))
+        self.assertEqual(client.iaid, bytes.fromhex('00123456'))
+
+
+class PercentileTestCase(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile(values, 1.0), 100)
+        self.assertEqual(percentile(values, 0.0), 1)
+        self.assertEqual(percentile([], 0.5), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,398 @@
+"""
+Testing of the in-memory LeaseQuery store
+"""
+import os
+import pickle
+import time
+import unittest
+from ipaddress import IPv6Address, IPv6Network
+from tempfile import TemporaryDirectory
+
+from dhcpkit.ipv6.duids import LinkLayerDUID
+from dhcpkit.ipv6.extensions.bulk_leasequery import QUERY_BY_LINK_ADDRESS, QUERY_BY_RELAY_ID, QUERY_BY_REMOTE_ID, \
+    RelayIdOption
+from dhcpkit.ipv6.extensions.dns import OPTION_DNS_SERVERS, RecursiveNameServersOption
+from dhcpkit.ipv6.extensions.leasequery import CLTTimeOption, ClientDataOption, LQQueryOption, LQRelayDataOption, \
+    OPTION_LQ_RELAY_DATA, QUERY_BY_ADDRESS, QUERY_BY_CLIENT_ID
+from dhcpkit.ipv6.extensions.prefix_delegation import IAPDOption, IAPrefixOption
+from dhcpkit.ipv6.extensions.remote_id import RemoteIdOption
+from dhcpkit.ipv6.messages import RelayForwardMessage, SolicitMessage
+from dhcpkit.ipv6.options import ClientIdOption, IAAddressOption, IANAOption, InterfaceIdOption, \
+    OptionRequestOption, RelayMessageOption
+from dhcpkit.ipv6.server.extensions.leasequery import LeaseUpdate
+from dhcpkit.ipv6.server.extensions.leasequery.memory import LeasequeryMemoryData, LeasequeryMemoryStore, PrefixIndex
+from dhcpkit.ipv6.server.handlers import ReplyWithLeasequeryError
+from dhcpkit.ipv6.server.transaction_bundle import TransactionBundle
+from dhcpkit.tests.ipv6.messages.test_confirm_message import confirm_message
+from dhcpkit.tests.ipv6.messages.test_reply_message import reply_message
+
+
+def lease_update(client_id: str, link_address: str = '2001:0db8:0000:0000:0000:0000:0000:0001',
+                 addresses=(), prefixes=(), remote_ids=(), relay_ids=(), lifetime: int = 3600) -> LeaseUpdate:
+    """
+    Create a lease update for testing the data without going through a transaction bundle
+
+    :return: The lease update
+    """
+    now = int(time.time())
+    return LeaseUpdate(client_id, link_address, now, b'', b'', tuple(remote_ids), tuple(relay_ids),
+                       tuple((IPv6Address(address).exploded, now + lifetime, now + lifetime, b'')
+                             for address in addresses),
+                       tuple((IPv6Network(prefix)[0].exploded, IPv6Network(prefix)[-1].exploded,
+                              now + lifetime, now + lifetime, b'')
+                             for prefix in prefixes))
+
+
+class PrefixIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = PrefixIndex()
+        for owner, prefix in enumerate(['2001:db8::/48', '2001:db8:1::/56', '2001:db8:1:100::/56', '2001:db8:2::/64']):
+            prefix = IPv6Network(prefix)
+            self.index.add(int(prefix[0]), int(prefix[-1]), owner)
+
+    def owners(self, found) -> set:
+        return {owner for first, last, owner in found}
+
+    def test_containing(self):
+        self.assertEqual(self.owners(self.index.containing(int(IPv6Address('2001:db8::1')))), {0})
+        self.assertEqual(self.owners(self.index.containing(int(IPv6Address('2001:db8:1:1ff::1')))), {2})
+        self.assertEqual(self.owners(self.index.containing(int(IPv6Address('2001:db8:2::1')))), {3})
+        self.assertEqual(self.owners(self.index.containing(int(IPv6Address('2001:db8:3::1')))), set())
+
+    def test_overlapping(self):
+        prefix = IPv6Network('2001:db8:1::/48')
+        self.assertEqual(self.owners(self.index.overlapping(int(prefix[0]), int(prefix[-1]))), {1, 2})
+
+        prefix = IPv6Network('2001:db8:1:180::/57')
+        self.assertEqual(self.owners(self.index.overlapping(int(prefix[0]), int(prefix[-1]))), {2})
+
+        prefix = IPv6Network('2001:db8::/32')
+        self.assertEqual(self.owners(self.index.overlapping(int(prefix[0]), int(prefix[-1]))), {0, 1, 2, 3})
+
+    def test_remove(self):
+        prefix = IPv6Network('2001:db8:1::/56')
+        self.index.remove(int(prefix[0]), int(prefix[-1]))
+        self.index.remove(int(prefix[0]), int(prefix[-1]))
+
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.owners(self.index.containing(int(IPv6Address('2001:db8:1::1')))), set())
+        self.assertEqual(len(self.index.starts), 3)
+
+
+class LeasequeryMemoryDataTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, 'lq.snapshot')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def find(self, data: LeasequeryMemoryData, query_type: int, value: str = None, link_address: str = None) -> set:
+        return {client.client_id for client in data.find_clients(query_type, value, link_address)}
+
+    def test_indexes(self):
+        data = LeasequeryMemoryData(self.filename)
+        data.remember(lease_update('0001', addresses=['2001:db8::1'], prefixes=['2001:db8:1::/48'],
+                                   remote_ids=['9:01'], relay_ids=['ff']))
+        data.remember(lease_update('0002', link_address='2001:0db8:0000:0000:0000:0000:0000:0002',
+                                   addresses=['2001:db8::2'], remote_ids=['9:02'], relay_ids=['ff']))
+
+        self.assertEqual(self.find(data, QUERY_BY_ADDRESS, '2001:0db8:0000:0000:0000:0000:0000:0001'), {'0001'})
+        self.assertEqual(self.find(data, QUERY_BY_ADDRESS, '2001:0db8:0001:0000:0000:0000:0000:0001'), {'0001'})
+        self.assertEqual(self.find(data, QUERY_BY_ADDRESS, '2001:0db8:0002:0000:0000:0000:0000:0001'), set())
+        self.assertEqual(self.find(data, QUERY_BY_CLIENT_ID, '0002'), {'0002'})
+        self.assertEqual(self.find(data, QUERY_BY_REMOTE_ID, '9:02'), {'0002'})
+        self.assertEqual(self.find(data, QUERY_BY_RELAY_ID, 'ff'), {'0001', '0002'})
+        self.assertEqual(self.find(data, QUERY_BY_RELAY_ID, 'ff', '2001:0db8:0000:0000:0000:0000:0000:0002'), {'0002'})
+        self.assertEqual(self.find(data, QUERY_BY_LINK_ADDRESS, None, '2001:0db8:0000:0000:0000:0000:0000:0001'),
+                         {'0001'})
+        self.assertEqual(self.find(data, QUERY_BY_LINK_ADDRESS), {'0001', '0002'})
+        self.assertEqual(self.find(data, -1), set())
+
+        # Changed relay information replaces the old
+        data.remember(lease_update('0001', addresses=['2001:db8::1'], remote_ids=['9:03']))
+        self.assertEqual(self.find(data, QUERY_BY_REMOTE_ID, '9:01'), set())
+        self.assertEqual(self.find(data, QUERY_BY_REMOTE_ID, '9:03'), {'0001'})
+        self.assertEqual(self.find(data, QUERY_BY_RELAY_ID, 'ff'), {'0002'})
+        self.assertNotIn('9:01', data.by_remote_id)
+
+    def test_no_leases(self):
+        data = LeasequeryMemoryData(self.filename)
+        data.remember(lease_update('0001'))
+        self.assertEqual(len(data.clients), 0)
+
+    def test_address_moves_to_other_client(self):
+        data = LeasequeryMemoryData(self.filename)
+        data.remember(lease_update('0001', addresses=['2001:db8::1', '2001:db8::2']))
+        data.remember(lease_update('0002', addresses=['2001:db8::2']))
+
+        clients = data.find_clients(QUERY_BY_CLIENT_ID, '0001', None)
+        self.assertEqual([lease[0] for lease in clients[0].address_leases],
+                         ['2001:0db8:0000:0000:0000:0000:0000:0001'])
+        self.assertEqual(self.find(data, QUERY_BY_ADDRESS, '2001:0db8:0000:0000:0000:0000:0000:0002'), {'0002'})
+
+    def test_overlapping_prefix_moves_to_other_client(self):
+        data = LeasequeryMemoryData(self.filename)
+        data.remember(lease_update('0001', prefixes=['2001:db8:1::/56', '2001:db8:2::/56']))
+        data.remember(lease_update('0002', prefixes=['2001:db8:1::/48']))
+
+        clients = data.find_clients(QUERY_BY_CLIENT_ID, '0001', None)
+        self.assertEqual([lease[0] for lease in clients[0].prefix_leases],
+                         ['2001:0db8:0002:0000:0000:0000:0000:0000'])
+        self.assertEqual(self.find(data, QUERY_BY_ADDRESS, '2001:0db8:0001:0000:0000:0000:0000:0001'), {'0002'})
+        self.assertEqual(len(data.prefix_index), 2)
+
+    def test_expired_leases(self):
+        data = LeasequeryMemoryData(self.filename)
+        data.remember(lease_update('0001', addresses=['2001:db8::1'], prefixes=['2001:db8:1::/48'], lifetime=-10))
+
+        self.assertEqual(len(data.by_address), 0)
+        self.assertEqual(len(data.prefix_index), 0)
+
+        clients = data.find_clients(QUERY_BY_CLIENT_ID, '0001', None)
+        self.assertEqual(len(clients), 1)
+        self.assertEqual(clients[0].address_leases, ())
+        self.assertEqual(clients[0].prefix_leases, ())
+
+        # Clients without leases don't survive a restart
+        data.journal.close()
+        data = LeasequeryMemoryData(self.filename)
+        self.assertEqual(len(data.clients), 0)
+
+    def test_journal_replay(self):
+        data = LeasequeryMemoryData(self.filename)
+        data.remember(lease_update('0001', addresses=['2001:db8::1'], remote_ids=['9:01']))
+        data.remember(lease_update('0002', prefixes=['2001:db8:1::/48']))
+
+        # Pretend to crash halfway through writing the next update
+        data.journal.write(pickle.dumps(tuple(lease_update('0003', addresses=['2001:db8::3'])))[:-10])
+        data.journal.close()
+
+        with self.assertLogs('dhcpkit.ipv6.server.extensions.leasequery.memory', 'WARNING') as cm:
+            data = LeasequeryMemoryData(self.filename)
+
+        self.assertRegex(cm.output[0], 'Ignoring incomplete record')
+        self.assertEqual(set(data.by_client_id), {'0001', '0002'})
+        self.assertEqual(self.find(data, QUERY_BY_REMOTE_ID, '9:01'), {'0001'})
+        self.assertEqual(self.find(data, QUERY_BY_ADDRESS, '2001:0db8:0001:0000:0000:0000:0000:0001'), {'0002'})
+
+        # The journal has been folded into a new snapshot
+        self.assertEqual(os.path.getsize(self.filename + '.journal'), 0)
+
+    def test_periodic_snapshot(self):
+        data = LeasequeryMemoryData(self.filename, snapshot_interval=3600)
+        data.remember(lease_update('0001', addresses=['2001:db8::1']))
+
+        # Time for a snapshot, the update that triggers it goes into the old journal
+        data.next_snapshot = 0
+        data.remember(lease_update('0002', addresses=['2001:db8::2']))
+        data.snapshot_thread.join()
+        data.remember(lease_update('0003', addresses=['2001:db8::3']))
+
+        self.assertFalse(os.path.exists(self.filename + '.journal.old'))
+        with open(self.filename, 'rb') as snapshot_file:
+            version, clients = pickle.load(snapshot_file)
+        self.assertEqual({client[0] for client in clients}, {'0001', '0002'})
+
+        # The rest is in the new journal
+        data.journal.close()
+        data = LeasequeryMemoryData(self.filename)
+        self.assertEqual(set(data.by_client_id), {'0001', '0002', '0003'})
+
+    def test_failed_snapshots(self):
+        data = LeasequeryMemoryData(self.filename, snapshot_interval=3600)
+        data.remember(lease_update('0001', addresses=['2001:db8::1']))
+
+        def fail(clients):
+            raise OSError("Disk full")
+
+        data.write_snapshot = fail
+        with self.assertLogs('dhcpkit.ipv6.server.extensions.leasequery.memory', 'ERROR'):
+            for client_id in ('0002', '0003'):
+                data.next_snapshot = 0
+                data.remember(lease_update(client_id, addresses=['2001:db8::' + client_id]))
+                data.snapshot_thread.join()
+
+        # The old journal of the first failed snapshot still has the first clients
+        data.remember(lease_update('0004', addresses=['2001:db8::4']))
+        data.journal.close()
+        data = LeasequeryMemoryData(self.filename)
+        self.assertEqual(set(data.by_client_id), {'0001', '0002', '0003', '0004'})
+
+    def test_remove_expired_clients(self):
+        data = LeasequeryMemoryData(self.filename, snapshot_interval=3600)
+        data.remember(lease_update('0001', addresses=['2001:db8::1'], remote_ids=['9:01'], lifetime=-10))
+        data.remember(lease_update('0002', addresses=['2001:db8::2'], remote_ids=['9:01']))
+        self.assertEqual(len(data.clients), 2)
+
+        # Clients that are never updated again are removed when it is time for a snapshot
+        data.next_snapshot = 0
+        data.remember(lease_update('0003', addresses=['2001:db8::3']))
+        data.snapshot_thread.join()
+
+        self.assertEqual(set(data.by_client_id), {'0002', '0003'})
+        self.assertEqual(set(data.clients), {('0002', '2001:0db8:0000:0000:0000:0000:0000:0001'),
+                                             ('0003', '2001:0db8:0000:0000:0000:0000:0000:0001')})
+        self.assertEqual(self.find(data, QUERY_BY_REMOTE_ID, '9:01'), {'0002'})
+
+    def test_interrupted_snapshot(self):
+        data = LeasequeryMemoryData(self.filename)
+        data.remember(lease_update('0001', addresses=['2001:db8::1']))
+        data.journal.close()
+
+        # The snapshot was never written, so the old journal is still there
+        os.replace(self.filename + '.journal', self.filename + '.journal.old')
+        data = LeasequeryMemoryData(self.filename)
+        self.assertEqual(set(data.by_client_id), {'0001'})
+        self.assertFalse(os.path.exists(self.filename + '.journal.old'))
+
+    def test_unknown_snapshot_version(self):
+        with open(self.filename, 'wb') as snapshot_file:
+            pickle.dump((-1, []), snapshot_file)
+
+        with self.assertLogs('dhcpkit.ipv6.server.extensions.leasequery.memory', 'WARNING') as cm:
+            LeasequeryMemoryData(self.filename)
+
+        self.assertRegex(cm.output[0], 'unknown version')
+
+
+class LeasequeryMemoryStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.relayed_solicit_message = RelayForwardMessage(
+            hop_count=1,
+            link_address=IPv6Address('2001:db8:ffff:1::1'),
+            peer_address=IPv6Address('fe80::3631:c4ff:fe3c:b2f1'),
+            options=[
+                RelayMessageOption(relayed_message=RelayForwardMessage(
+                    hop_count=0,
+                    link_address=IPv6Address('::'),
+                    peer_address=IPv6Address('fe80::3631:c4ff:fe3c:b2f1'),
+                    options=[
+                        RelayMessageOption(relayed_message=SolicitMessage(
+                            transaction_id=bytes.fromhex('f350d6'),
+                            options=[
+                                ClientIdOption(duid=LinkLayerDUID(hardware_type=1,
+                                                                  link_layer_address=bytes.fromhex('3431c43cb2f1'))),
+                                IANAOption(iaid=bytes.fromhex('c43cb2f1')),
+                                IAPDOption(iaid=bytes.fromhex('c43cb2f1')),
+                                OptionRequestOption(requested_options=[
+                                    OPTION_DNS_SERVERS,
+                                ]),
+                            ],
+                        )),
+                        InterfaceIdOption(interface_id=b'Fa2/3'),
+                    ])
+                ),
+                InterfaceIdOption(interface_id=b'Gi0/0/0'),
+                RemoteIdOption(enterprise_number=9, remote_id=bytes.fromhex('020000000000000a0003000124e9b36e8100')),
+                RelayIdOption(duid=LinkLayerDUID(hardware_type=1, link_layer_address=bytes.fromhex('121212121212'))),
+            ],
+        )
+
+        self.bundle = TransactionBundle(self.relayed_solicit_message, received_over_multicast=False)
+        self.bundle.response = reply_message
+
+        self.tmp_dir = TemporaryDirectory()
+        self.store = LeasequeryMemoryStore(os.path.join(self.tmp_dir.name, 'lq.snapshot'))
+        self.store.worker_init([])
+
+    def tearDown(self):
+        self.store.manager.shutdown()
+        self.tmp_dir.cleanup()
+
+    def test_getstate(self):
+        self.assertIsNone(self.store.__getstate__()['manager'])
+
+    def test_remember_lease_non_interesting(self):
+        bundle = TransactionBundle(confirm_message, received_over_multicast=False)
+        bundle.response = reply_message
+        self.store.remember_lease(bundle)
+
+        nr_found, results = self.store.find_leases(LQQueryOption(QUERY_BY_LINK_ADDRESS))
+        self.assertEqual(nr_found, 0)
+
+    def test_queries(self):
+        self.store.remember_lease(self.bundle)
+
+        ia_address = self.bundle.response.get_option_of_type(IANAOption).get_option_of_type(IAAddressOption)
+        ia_prefix = self.bundle.response.get_option_of_type(IAPDOption).get_option_of_type(IAPrefixOption)
+        client_id_option = self.bundle.response.get_option_of_type(ClientIdOption)
+        relay_id_option = self.relayed_solicit_message.get_option_of_type(RelayIdOption)
+        remote_id_option = self.relayed_solicit_message.get_option_of_type(RemoteIdOption)
+
+        queries = {
+            'address': LQQueryOption(QUERY_BY_ADDRESS, options=[ia_address]),
+            'prefix': LQQueryOption(QUERY_BY_ADDRESS, options=[IAAddressOption(ia_prefix.prefix[1])]),
+            'client-id': LQQueryOption(QUERY_BY_CLIENT_ID, options=[client_id_option]),
+            'relay-id': LQQueryOption(QUERY_BY_RELAY_ID, options=[relay_id_option]),
+            'remote-id': LQQueryOption(QUERY_BY_REMOTE_ID, options=[remote_id_option]),
+            'link-address': LQQueryOption(QUERY_BY_LINK_ADDRESS, link_address=self.bundle.link_address),
+            'all': LQQueryOption(QUERY_BY_LINK_ADDRESS),
+            'on link': LQQueryOption(QUERY_BY_ADDRESS, link_address=self.bundle.link_address, options=[ia_address]),
+        }
+
+        for name, query in queries.items():
+            with self.subTest(msg=name):
+                nr_found, results = self.store.find_leases(query)
+                results = list(results)
+
+                self.assertEqual(nr_found, 1)
+                self.assertEqual(len(results), 1)
+
+                link_address, client_data = results[0]
+                self.assertEqual(link_address, self.bundle.link_address)
+                self.assertIsInstance(client_data, ClientDataOption)
+                self.assertEqual({option.__class__ for option in client_data.options},
+                                 {CLTTimeOption, ClientIdOption, IAAddressOption, IAPrefixOption})
+                self.assertEqual(client_data.get_option_of_type(IAPrefixOption).prefix, ia_prefix.prefix)
+
+    def test_query_with_extra_and_relay_data(self):
+        self.store.remember_lease(self.bundle)
+
+        client_id_option = self.bundle.response.get_option_of_type(ClientIdOption)
+        query = LQQueryOption(QUERY_BY_CLIENT_ID, options=[client_id_option,
+                                                           OptionRequestOption([OPTION_DNS_SERVERS,
+                                                                                OPTION_LQ_RELAY_DATA])])
+
+        nr_found, results = self.store.find_leases(query)
+        link_address, client_data = list(results)[0]
+        self.assertEqual(len(client_data.options), 6)
+        self.assertIsInstance(client_data.get_option_of_type(RecursiveNameServersOption), RecursiveNameServersOption)
+        self.assertIsInstance(client_data.get_option_of_type(LQRelayDataOption), LQRelayDataOption)
+
+    def test_queries_on_wrong_link(self):
+        self.store.remember_lease(self.bundle)
+
+        ia_address = self.bundle.response.get_option_of_type(IANAOption).get_option_of_type(IAAddressOption)
+        client_id_option = self.bundle.response.get_option_of_type(ClientIdOption)
+
+        for query in (LQQueryOption(QUERY_BY_ADDRESS, link_address=IPv6Address('3ffe::'), options=[ia_address]),
+                      LQQueryOption(QUERY_BY_CLIENT_ID, link_address=IPv6Address('3ffe::'),
+                                    options=[client_id_option]),
+                      LQQueryOption(QUERY_BY_LINK_ADDRESS, link_address=IPv6Address('3ffe::'))):
+            with self.subTest(msg=query.query_type):
+                nr_found, results = self.store.find_leases(query)
+                self.assertEqual(nr_found, 0)
+                self.assertEqual(list(results), [])
+
+    def test_query_by_unknown(self):
+        nr_found, results = self.store.find_leases(LQQueryOption(-1))
+        self.assertEqual(nr_found, -1)
+        self.assertEqual(list(results), [])
+
+    def test_malformed_queries(self):
+        messages = {
+            QUERY_BY_ADDRESS: 'Address queries must contain an address',
+            QUERY_BY_CLIENT_ID: 'Client-ID queries must contain a client ID',
+            QUERY_BY_RELAY_ID: 'Relay-ID queries must contain a relay ID',
+            QUERY_BY_REMOTE_ID: 'Remote-ID queries must contain a remote ID',
+        }
+
+        for query_type, message in messages.items():
+            with self.subTest(msg=message):
+                with self.assertRaisesRegex(ReplyWithLeasequeryError, message):
+                    self.store.find_leases(LQQueryOption(query_type))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,133 @@
+"""
+Testing of the write cache of the SQLite LeaseQuery store
+"""
+import os
+import sqlite3
+import time
+import unittest
+from tempfile import TemporaryDirectory
+
+from dhcpkit.ipv6.server.extensions.leasequery import LeaseUpdate
+from dhcpkit.ipv6.server.extensions.leasequery.sqlite import LeasequerySqliteStore
+from dhcpkit.ipv6.server.extensions.leasequery.sqlite_cache import LeasequerySqliteWriteCache
+
+LINK_ADDRESS = '2001:0db8:ffff:0001:0000:0000:0000:0001'
+
+
+def lease_update(client_id: str = '000300010001', timestamp: int = None, lifetime: int = 3600,
+                 remote_ids=('00000009abcd',), number: int = 1) -> LeaseUpdate:
+    timestamp = timestamp or int(time.time())
+    return LeaseUpdate(client_id, LINK_ADDRESS, timestamp, b'', b'', tuple(remote_ids), (),
+                       (('2001:0db8:0000:0000:0000:0000:0000:{:04x}'.format(number),
+                         timestamp + lifetime // 2, timestamp + lifetime, b''),),
+                       (('2001:0db8:{:04x}:0000:0000:0000:0000:0000'.format(number),
+                         '2001:0db8:{:04x}:00ff:ffff:ffff:ffff:ffff'.format(number),
+                         timestamp + lifetime // 2, timestamp + lifetime, b''),))
+
+
+class LeasequerySqliteWriteCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, 'lq.sqlite')
+
+        self.store = LeasequerySqliteStore(self.filename, write_cache=LeasequerySqliteWriteCache(slack=300))
+        self.store.worker_init([])
+
+    def tearDown(self):
+        self.store.db.close()
+        self.tmp_dir.cleanup()
+
+    def apply(self, update: LeaseUpdate) -> int:
+        changes = self.store.db.total_changes
+        with self.store.db:
+            self.store.apply_lease_update(update)
+        return self.store.db.total_changes - changes
+
+    def valid_lifetime_end(self, table: str = 'addresses') -> int:
+        return self.store.db.execute("SELECT valid_lifetime_end FROM {}".format(table)).fetchone()[0]
+
+    def test_skip_unchanged(self):
+        now = int(time.time())
+        self.assertGreater(self.apply(lease_update(timestamp=now)), 0)
+        self.assertEqual(self.apply(lease_update(timestamp=now)), 0)
+        self.assertEqual(self.apply(lease_update(timestamp=now + 60)), 0)
+        self.assertEqual(self.valid_lifetime_end(), now + 3600)
+
+    def test_coalesce_lifetimes(self):
+        now = int(time.time())
+        self.apply(lease_update(timestamp=now))
+
+        # Past the slack only the client and the lifetimes of the address and the prefix are updated
+        self.assertEqual(self.apply(lease_update(timestamp=now + 301)), 3)
+        self.assertEqual(self.valid_lifetime_end(), now + 3901)
+        self.assertEqual(self.valid_lifetime_end('prefixes'), now + 3901)
+
+        # And that is the new starting point
+        self.assertEqual(self.apply(lease_update(timestamp=now + 600)), 0)
+
+    def test_shorter_lifetime(self):
+        now = int(time.time())
+        self.apply(lease_update(timestamp=now))
+        self.assertEqual(self.apply(lease_update(timestamp=now, lifetime=1800)), 3)
+        self.assertEqual(self.valid_lifetime_end(), now + 1800)
+
+    def test_expires_within_slack(self):
+        now = int(time.time())
+        self.apply(lease_update(timestamp=now - 3500))
+        self.assertEqual(self.apply(lease_update(timestamp=now - 3400)), 3)
+
+    def test_changed_remote_ids(self):
+        now = int(time.time())
+        self.apply(lease_update(timestamp=now))
+        self.assertGreater(self.apply(lease_update(timestamp=now, remote_ids=('00000009dcba',))), 0)
+
+        rows = self.store.db.execute("SELECT remote_id FROM remote_ids")
+        self.assertEqual([row['remote_id'] for row in rows], ['00000009dcba'])
+
+    def test_lease_taken_over(self):
+        now = int(time.time())
+        self.apply(lease_update(timestamp=now))
+
+        # Another client gets the same address, which removes it from the first client
+        self.apply(lease_update(client_id='000300010002', timestamp=now))
+        self.assertNotIn(('000300010001', LINK_ADDRESS), self.store.write_cache.clients)
+
+        # So when the first client gets it back it has to be written again
+        self.assertGreater(self.apply(lease_update(timestamp=now)), 0)
+        rows = self.store.db.execute("SELECT client_id FROM clients WHERE id IN (SELECT client_fk FROM addresses)")
+        self.assertEqual([row['client_id'] for row in rows], ['000300010001'])
+
+    def test_lease_disappeared(self):
+        now = int(time.time())
+        self.apply(lease_update(timestamp=now))
+
+        with self.store.db:
+            self.store.db.execute("DELETE FROM prefixes")
+
+        # Our own connection, so the cache doesn't know, but updating the lifetimes notices the missing prefix
+        self.apply(lease_update(timestamp=now + 301))
+        self.assertEqual(self.valid_lifetime_end('prefixes'), now + 3901)
+
+    def test_changed_by_other_connection(self):
+        now = int(time.time())
+        self.apply(lease_update(timestamp=now))
+
+        db = sqlite3.connect(self.filename)
+        with db:
+            db.execute("DELETE FROM remote_ids")
+        db.close()
+
+        self.assertGreater(self.apply(lease_update(timestamp=now)), 0)
+        self.assertEqual(self.store.db.execute("SELECT COUNT(*) FROM remote_ids").fetchone()[0], 1)
+
+    def test_size(self):
+        self.store.write_cache.size = 2
+        for number in range(3):
+            self.apply(lease_update(client_id='00030001000{}'.format(number), number=number))
+
+        self.assertEqual(list(self.store.write_cache.clients), [('000300010001', LINK_ADDRESS),
+                                                                ('000300010002', LINK_ADDRESS)])
+
+
+if __name__ == '__main__':  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,100 @@
+"""
+Testing of the background expiry of the SQLite LeaseQuery store
+"""
+import gc
+import os
+import sqlite3
+import time
+import unittest
+from tempfile import TemporaryDirectory
+
+from dhcpkit.ipv6.server.extensions.leasequery.sqlite import LeasequerySqliteStore
+from dhcpkit.ipv6.server.extensions.leasequery.sqlite_expiry import LeasequerySqliteExpiry
+
+
+class LeasequerySqliteExpiryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, 'lq.sqlite')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def add_clients(self, store: LeasequerySqliteStore, count: int, valid_lifetime_end: int):
+        with store.db:
+            for number in range(count):
+                cur = store.db.execute("INSERT INTO clients (client_id, link_address) VALUES (?, '::')",
+                                       ('{:04x}{}'.format(number, valid_lifetime_end),))
+                store.db.execute("INSERT INTO addresses (client_fk, address, valid_lifetime_end) VALUES (?, ?, ?)",
+                                 (cur.lastrowid, '{:04x}'.format(number), valid_lifetime_end))
+                store.db.execute("INSERT INTO prefixes (client_fk, first_address, last_address, valid_lifetime_end) "
+                                 "VALUES (?, ?, ?, ?)",
+                                 (cur.lastrowid, '{:04x}'.format(number), '{:04x}'.format(number), valid_lifetime_end))
+
+    def count_rows(self, store: LeasequerySqliteStore, table: str) -> int:
+        return store.db.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+
+    def test_expire_leases(self):
+        store = LeasequerySqliteStore(self.filename)
+        store.worker_init([])
+
+        now = int(time.time())
+        self.add_clients(store, 25, now - 10)
+        self.add_clients(store, 5, now + 3600)
+
+        self.assertEqual(store.expire_leases(store.db, now, 10), 20)
+        self.assertEqual(self.count_rows(store, 'addresses'), 20)
+        self.assertEqual(self.count_rows(store, 'prefixes'), 20)
+        self.assertEqual(self.count_rows(store, 'clients'), 20)
+
+        self.assertEqual(store.expire_leases(store.db, now, 10), 20)
+        self.assertEqual(store.expire_leases(store.db, now, 10), 10)
+        self.assertEqual(store.expire_leases(store.db, now, 10), 0)
+        self.assertEqual(self.count_rows(store, 'clients'), 5)
+
+    def test_expiry_thread(self):
+        store = LeasequerySqliteStore(self.filename)
+        store.worker_init([])
+        self.add_clients(store, 25, int(time.time()) - 10)
+
+        expiry = LeasequerySqliteExpiry(interval=0.01, batch_size=10)
+        expiry.start(store)
+
+        deadline = time.monotonic() + 5
+        while self.count_rows(store, 'clients') and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        expiry.stop()
+        self.assertFalse(expiry.thread.is_alive())
+        self.assertEqual(self.count_rows(store, 'clients'), 0)
+        self.assertIsNone(expiry.__getstate__()['thread'])
+
+    def test_thread_stops_with_store(self):
+        expiry = LeasequerySqliteExpiry(interval=0.01)
+        LeasequerySqliteStore(self.filename, expiry=expiry)
+        gc.collect()
+
+        expiry.thread.join(5)
+        self.assertFalse(expiry.thread.is_alive())
+
+    def test_incremental_vacuum(self):
+        store = LeasequerySqliteStore(self.filename)
+        store.worker_init([])
+        self.assertEqual(store.db.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+
+    def test_convert_old_database(self):
+        db = sqlite3.connect(self.filename)
+        db.execute("CREATE TABLE something (id INTEGER)")
+        db.close()
+
+        with self.assertLogs('dhcpkit.ipv6.server.extensions.leasequery.sqlite', 'INFO') as cm:
+            store = LeasequerySqliteStore(self.filename)
+
+        self.assertRegex(cm.output[-1], 'Converting leasequery database to incremental vacuuming')
+
+        store.worker_init([])
+        self.assertEqual(store.db.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    unittest.main()
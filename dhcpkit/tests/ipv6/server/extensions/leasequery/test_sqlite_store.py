@@ -5,8 +5,9 @@ import os
 import sqlite3
 import time
 import unittest
-from ipaddress import IPv6Address
+from ipaddress import IPv6Address, IPv6Network
 from tempfile import TemporaryDirectory
+from unittest.mock import patch
 
 from typing import Iterable, Type
 
@@ -21,6 +22,7 @@ from dhcpkit.ipv6.extensions.remote_id import RemoteIdOption
 from dhcpkit.ipv6.messages import RelayForwardMessage, SolicitMessage
 from dhcpkit.ipv6.options import ClientIdOption, ElapsedTimeOption, IAAddressOption, IANAOption, InterfaceIdOption, \
     Option, OptionRequestOption, RelayMessageOption
+from dhcpkit.ipv6.server.extensions.leasequery import LeaseUpdate
 from dhcpkit.ipv6.server.extensions.leasequery.sqlite import LeasequerySqliteStore
 from dhcpkit.ipv6.server.handlers import ReplyWithLeasequeryError
 from dhcpkit.ipv6.server.transaction_bundle import TransactionBundle
@@ -118,6 +120,10 @@ class LeasequerySqliteStoreTestCase(unittest.TestCase):
                     "valid_lifetime_end INTEGER NOT NULL DEFAULT -1, "
                     "options BLOB NOT NULL DEFAULT '', "
                     "UNIQUE (client_fk, first_address, last_address))"},
+            {'type': "table", 'name': "prefix_lengths",
+             'seen': False,
+             'sql': "CREATE TABLE prefix_lengths ("
+                    "host_bits INTEGER NOT NULL PRIMARY KEY)"},
             {'type': "table", 'name': "remote_ids",
              'seen': False,
              'sql': "CREATE TABLE remote_ids ("
@@ -139,6 +145,12 @@ class LeasequerySqliteStoreTestCase(unittest.TestCase):
             {'type': "index", 'name': "addresses_address",
              'seen': False,
              'sql': "CREATE INDEX addresses_address ON addresses(address)"},
+            {'type': "index", 'name': "addresses_valid_lifetime_end",
+             'seen': False,
+             'sql': "CREATE INDEX addresses_valid_lifetime_end ON addresses(valid_lifetime_end)"},
+            {'type': "index", 'name': "prefixes_valid_lifetime_end",
+             'seen': False,
+             'sql': "CREATE INDEX prefixes_valid_lifetime_end ON prefixes(valid_lifetime_end)"},
             {'type': "index", 'name': "prefixes_range",
              'seen': False,
              'sql': "CREATE INDEX prefixes_range ON prefixes(first_address, last_address)"},
@@ -690,6 +702,109 @@ class LeasequerySqliteStoreTestCase(unittest.TestCase):
             self.assertEqual(len(cm.output), 1)
             self.assertRegex(cm.output[0], 'Ignoring invalid prefix range')
 
+    def test_query_in_chunks(self):
+        with TemporaryDirectory() as tmp_dir_name:
+            store = LeasequerySqliteStore(os.path.join(tmp_dir_name, 'lq.sqlite'))
+            store.worker_init([])
+            store.client_data_chunk_size = 10
+
+            now = int(time.time())
+            with store.db:
+                for number in range(25):
+                    address = IPv6Address('2001:db8::{:x}'.format(number + 1)).exploded
+                    prefix = IPv6Network('2001:db8:{:x}::/48'.format(number + 1))
+                    duid = normalise_hex(LinkLayerDUID(hardware_type=1, link_layer_address=bytes([number])).save())
+                    store.apply_lease_update(LeaseUpdate(duid, '2001:0db8:ffff:0001:0000:0000:0000:0001',
+                                                         now, b'', b'', (), (),
+                                                         ((address, now + 1800, now + 3600, b''),),
+                                                         ((prefix[0].exploded, prefix[-1].exploded,
+                                                           now + 1800, now + 3600, b''),)))
+
+            query = LQQueryOption(QUERY_BY_LINK_ADDRESS, link_address=IPv6Address('2001:db8:ffff:1::1'))
+
+            with patch.object(store, 'generate_client_data_chunk', wraps=store.generate_client_data_chunk) as chunks:
+                nr_found, results = store.find_leases(query)
+
+                # Only the first chunk is read for the first result
+                self.assertEqual(nr_found, 2)
+                results = iter(results)
+                first_result = next(results)
+                self.assertEqual(chunks.call_count, 1)
+                self.assertEqual(len(chunks.call_args[0][0]), 10)
+
+                results = [first_result] + list(results)
+                self.assertEqual(chunks.call_count, 3)
+
+            self.assertEqual(len(results), 25)
+            for link_address, client_data in results:
+                number = client_data.get_option_of_type(ClientIdOption).duid.link_layer_address[0]
+                self.assertEqual(client_data.get_option_of_type(IAAddressOption).address,
+                                 IPv6Address('2001:db8::{:x}'.format(number + 1)))
+                self.assertEqual(client_data.get_option_of_type(IAPrefixOption).prefix,
+                                 IPv6Network('2001:db8:{:x}::/48'.format(number + 1)))
+
+    @staticmethod
+    def prefix_update(client_id: str, prefixes: Iterable[str]) -> LeaseUpdate:
+        now = int(time.time())
+        return LeaseUpdate(client_id, '2001:0db8:0000:0000:0000:0000:0000:0001', now, b'', b'', (), (), (),
+                           tuple((IPv6Network(prefix)[0].exploded, IPv6Network(prefix)[-1].exploded,
+                                  now + 3600, now + 3600, b'') for prefix in prefixes))
+
+    def find_by_address(self, store: LeasequerySqliteStore, address: str) -> set:
+        query = LQQueryOption(QUERY_BY_ADDRESS, options=[IAAddressOption(IPv6Address(address))])
+        nr_found, results = store.find_leases(query)
+        return {client_data.get_option_of_type(ClientIdOption).duid.link_layer_address.hex()
+                for link_address, client_data in results}
+
+    def test_prefix_containment(self):
+        with TemporaryDirectory() as tmp_dir_name:
+            store = LeasequerySqliteStore(os.path.join(tmp_dir_name, 'lq.sqlite'))
+            store.worker_init([])
+
+            duid_1 = normalise_hex(LinkLayerDUID(hardware_type=1, link_layer_address=b'\x01').save())
+            duid_2 = normalise_hex(LinkLayerDUID(hardware_type=1, link_layer_address=b'\x02').save())
+            with store.db:
+                store.apply_lease_update(self.prefix_update(duid_1, ['2001:db8:1::/48', '2001:db8:1:100::/56']))
+                store.apply_lease_update(self.prefix_update(duid_2, ['2001:db8:2::/62']))
+
+            host_bits = {row['host_bits'] for row in store.db.execute("SELECT host_bits FROM prefix_lengths")}
+            self.assertSetEqual(host_bits, {80, 72, 66})
+
+            self.assertSetEqual(self.find_by_address(store, '2001:db8:1::1'), {'01'})
+            self.assertSetEqual(self.find_by_address(store, '2001:db8:1:1ff::1'), {'01'})
+            self.assertSetEqual(self.find_by_address(store, '2001:db8:2:3:ffff:ffff:ffff:ffff'), {'02'})
+            self.assertSetEqual(self.find_by_address(store, '2001:db8:2:4::'), set())
+
+            # A new lease on an overlapping prefix overrides the old ones of other clients, both the ones that contain
+            # it and the ones inside it
+            with store.db:
+                store.apply_lease_update(self.prefix_update(duid_2, ['2001:db8:1:180::/57']))
+                store.apply_lease_update(self.prefix_update(duid_1, ['2001:db8:2::/64']))
+
+            rows = store.db.execute("SELECT first_address FROM prefixes WHERE client_fk IN "
+                                    "(SELECT id FROM clients WHERE client_id=?)", (duid_1,))
+            self.assertSetEqual({row['first_address'] for row in rows}, {'2001:0db8:0002:0000:0000:0000:0000:0000'})
+            rows = store.db.execute("SELECT first_address FROM prefixes WHERE client_fk IN "
+                                    "(SELECT id FROM clients WHERE client_id=?)", (duid_2,))
+            self.assertSetEqual({row['first_address'] for row in rows}, {'2001:0db8:0001:0180:0000:0000:0000:0000'})
+
+    def test_upgrade_prefix_lengths(self):
+        with TemporaryDirectory() as tmp_dir_name:
+            store = LeasequerySqliteStore(os.path.join(tmp_dir_name, 'lq.sqlite'))
+            store.worker_init([])
+            with store.db:
+                store.apply_lease_update(self.prefix_update('0001', ['2001:db8:1::/48']))
+
+                # Turn it back into a version 1 database
+                store.db.execute("DROP TABLE prefix_lengths")
+                store.db.execute("PRAGMA user_version=1")
+            store.db.close()
+
+            store = LeasequerySqliteStore(os.path.join(tmp_dir_name, 'lq.sqlite'))
+            store.worker_init([])
+            self.assertEqual(store.db.execute("PRAGMA user_version").fetchone()[0], 2)
+            self.assertEqual([tuple(row) for row in store.db.execute("SELECT host_bits FROM prefix_lengths")], [(80,)])
+
 
 if __name__ == '__main__':  # pragma: no cover
     unittest.main()
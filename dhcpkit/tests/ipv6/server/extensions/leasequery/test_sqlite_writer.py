@@ -0,0 +1,176 @@
+"""
+Testing of the writer process of the SQLite LeaseQuery store
+"""
+import os
+import sqlite3
+import unittest
+from ipaddress import IPv6Address
+from tempfile import TemporaryDirectory
+
+from dhcpkit.ipv6.duids import LinkLayerDUID
+from dhcpkit.ipv6.extensions.remote_id import RemoteIdOption
+from dhcpkit.ipv6.messages import RelayForwardMessage, SolicitMessage
+from dhcpkit.ipv6.options import ClientIdOption, IANAOption, InterfaceIdOption, RelayMessageOption
+from dhcpkit.ipv6.server.extensions.leasequery import LeasequeryHandler
+from dhcpkit.ipv6.server.extensions.leasequery.sqlite import LeasequerySqliteStore
+from dhcpkit.ipv6.server.extensions.leasequery.sqlite_writer import LeasequerySqliteWriter, find_writers
+from dhcpkit.ipv6.server.filters.marks.config import MarkedWithFilter
+from dhcpkit.ipv6.server.message_handler import MessageHandler
+from dhcpkit.ipv6.server.statistics import ServerStatistics
+from dhcpkit.ipv6.server.transaction_bundle import TransactionBundle
+from dhcpkit.tests.ipv6.messages.test_reply_message import reply_message
+
+
+def relayed_solicit(client_number: int) -> RelayForwardMessage:
+    """
+    Create a relayed solicit message for a client
+
+    :param client_number: The number of the client, used to create its DUID
+    :return: The relayed message
+    """
+    return RelayForwardMessage(
+        hop_count=0,
+        link_address=IPv6Address('2001:db8:ffff:1::1'),
+        peer_address=IPv6Address('fe80::1'),
+        options=[
+            RelayMessageOption(relayed_message=SolicitMessage(
+                transaction_id=bytes.fromhex('f350d6'),
+                options=[
+                    ClientIdOption(duid=LinkLayerDUID(hardware_type=1,
+                                                      link_layer_address=client_number.to_bytes(6, 'big'))),
+                    IANAOption(iaid=bytes.fromhex('c43cb2f1')),
+                ],
+            )),
+            InterfaceIdOption(interface_id=b'Gi0/0/0'),
+            RemoteIdOption(enterprise_number=9, remote_id=client_number.to_bytes(4, 'big')),
+        ],
+    )
+
+
+class LeasequerySqliteWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, 'lq.sqlite')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def remember(self, store: LeasequerySqliteStore, client_number: int):
+        bundle = TransactionBundle(relayed_solicit(client_number), received_over_multicast=False)
+        bundle.response = reply_message
+        store.remember_lease(bundle)
+
+    def count_rows(self, table: str) -> int:
+        db = sqlite3.connect(self.filename)
+        try:
+            return db.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+        finally:
+            db.close()
+
+    def test_writer_process(self):
+        writer = LeasequerySqliteWriter(batch_size=10, batch_interval=0.5)
+        store = LeasequerySqliteStore(self.filename, writer=writer)
+        store.worker_init([])
+
+        for client_number in range(25):
+            self.remember(store, client_number)
+
+        # Nothing is written by the worker itself, and stopping writes the remaining updates
+        writer.stop()
+        self.assertFalse(writer.process.is_alive())
+
+        self.assertEqual(self.count_rows('clients'), 25)
+        self.assertEqual(self.count_rows('remote_ids'), 25)
+        self.assertEqual(writer.written.value, 25)
+        self.assertEqual(writer.failed.value, 0)
+        self.assertEqual(writer.waited.value, 0)
+        self.assertEqual(writer.dropped.value, 0)
+
+        # Batches are limited in size, but at least some updates were grouped
+        self.assertGreaterEqual(writer.batches.value, 3)
+        self.assertLess(writer.batches.value, 25)
+
+    def test_stop_twice(self):
+        writer = LeasequerySqliteWriter()
+        LeasequerySqliteStore(self.filename, writer=writer)
+        writer.stop()
+        writer.stop()
+        self.assertFalse(writer.process.is_alive())
+
+    def test_back_pressure(self):
+        # A writer that is never started, so the queue fills up
+        writer = LeasequerySqliteWriter(queue_size=1, queue_timeout=0.01)
+        store = LeasequerySqliteStore(self.filename)
+        store.writer = writer
+        store.worker_init([])
+
+        self.remember(store, 1)
+        with self.assertLogs('dhcpkit.ipv6.server.extensions.leasequery.sqlite_writer', 'WARNING') as cm:
+            self.remember(store, 2)
+
+        self.assertRegex(cm.output[0], 'dropping lease update')
+        self.assertEqual(writer.waited.value, 1)
+        self.assertEqual(writer.dropped.value, 1)
+
+    def test_get_batch(self):
+        writer = LeasequerySqliteWriter(batch_size=2, batch_interval=0.5)
+        for update in ['a', 'b', 'c', None]:
+            writer.queue.put(update)
+
+        self.assertEqual(writer.get_batch(), ['a', 'b'])
+        self.assertEqual(writer.get_batch(), ['c'])
+        self.assertEqual(writer.get_batch(), [])
+
+    def test_bad_update_in_batch(self):
+        store = LeasequerySqliteStore(self.filename)
+        store.worker_init([])
+
+        bundle = TransactionBundle(relayed_solicit(1), received_over_multicast=False)
+        bundle.response = reply_message
+        good_update = store.build_lease_update(bundle)
+        bad_update = good_update._replace(options=None)
+
+        writer = LeasequerySqliteWriter()
+        with self.assertLogs('dhcpkit.ipv6.server.extensions.leasequery.sqlite_writer', 'ERROR') as cm:
+            writer.write_batch(store, [bad_update, good_update])
+
+        self.assertEqual(len(cm.output), 2)
+        self.assertRegex(cm.output[0], 'retrying them separately')
+        self.assertRegex(cm.output[1], 'Could not write lease update')
+
+        # The good one made it anyway
+        self.assertEqual(self.count_rows('clients'), 1)
+        self.assertEqual(writer.written.value, 1)
+        self.assertEqual(writer.failed.value, 1)
+        self.assertEqual(writer.batches.value, 1)
+
+
+    def test_statistics(self):
+        writer = LeasequerySqliteWriter(batch_size=10, batch_interval=0.5)
+        store = LeasequerySqliteStore(self.filename, writer=writer)
+        store.worker_init([])
+
+        # The writer is found, even when the handler is inside a filter
+        message_handler = MessageHandler(server_id=LinkLayerDUID(hardware_type=1, link_layer_address=bytes(6)),
+                                         sub_filters=[MarkedWithFilter('test',
+                                                                       sub_handlers=[LeasequeryHandler(store)])])
+        writers = find_writers(message_handler)
+        self.assertEqual(writers, [writer])
+
+        statistics = ServerStatistics()
+        statistics.set_lease_writers(writers)
+
+        for client_number in range(5):
+            self.remember(store, client_number)
+
+        # Replacing the writer stops it, and keeps what it counted
+        statistics.set_lease_writers([])
+        self.assertFalse(writer.process.is_alive())
+
+        self.assertEqual(statistics.get_lease_writer_counter('written'), 5)
+        self.assertEqual(statistics.export_server()['leasequery_updates_written'], 5)
+        self.assertIn('- Leasequery updates written: 5', str(statistics).split('\n'))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,44 @@
+"""
+Test the marked-with filter and its index
+"""
+import unittest
+from types import SimpleNamespace
+
+from dhcpkit.ipv6.server.filters import SubFilterDecider
+from dhcpkit.ipv6.server.filters.marks.config import MarkedWithFilter, MarkedWithFilterIndex
+
+
+class MarkedWithFilterIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.filters = [
+            MarkedWithFilter('one', sub_filters=[MarkedWithFilter('two'), MarkedWithFilter('three')]),
+            MarkedWithFilter('two'),
+            MarkedWithFilter('one'),
+        ]
+        self.decider = SubFilterDecider(self.filters)
+
+    def test_compiled(self):
+        self.assertEqual(len(self.decider.indexes), 1)
+        self.assertIsInstance(self.decider.indexes[0], MarkedWithFilterIndex)
+        self.assertEqual(self.decider.unindexed, [])
+
+    def test_matches(self):
+        index = self.decider.indexes[0]
+        self.assertEqual(index.get_matches(SimpleNamespace(marks={'one'})), [0, 2])
+        self.assertEqual(index.get_matches(SimpleNamespace(marks={'two', 'one'})), [0, 1, 2])
+        self.assertEqual(index.get_matches(SimpleNamespace(marks={'four'})), [])
+
+    def test_same_decisions(self):
+        for marks in ({'one'}, {'one', 'two'}, {'two', 'three'}, set()):
+            with self.subTest(marks=marks):
+                bundle = SimpleNamespace(marks=marks)
+                expected = tuple([sub_filter.get_decision(bundle) for sub_filter in self.filters])
+                self.assertEqual(self.decider.get_decisions(bundle), expected)
+
+        # Sub-filters of matching filters are decided too
+        self.assertEqual(self.decider.get_decisions(SimpleNamespace(marks={'one', 'three'})),
+                         ((None, ()), None, ()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+Test the subnet filter and its index
+"""
+import unittest
+from ipaddress import IPv6Address, IPv6Network
+from types import SimpleNamespace
+
+from dhcpkit.ipv6.server.filters import SubFilterDecider
+from dhcpkit.ipv6.server.filters.marks.config import MarkedWithFilter
+from dhcpkit.ipv6.server.filters.subnets.config import SubnetFilter, SubnetFilterIndex
+
+
+class CustomSubnetFilter(SubnetFilter):
+    """
+    A subnet filter with its own matching logic
+    """
+
+    def match(self, bundle) -> bool:
+        """
+        Never match
+        """
+        return False
+
+
+class SubnetFilterIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.filters = [
+            SubnetFilter([IPv6Network('2001:db8::/32')]),
+            SubnetFilter([IPv6Network('2001:db8:1::/48'), IPv6Network('2001:db8:2::/48')]),
+            MarkedWithFilter('one'),
+            SubnetFilter([IPv6Network('2001:db8:1:2::/64')],
+                         sub_filters=[SubnetFilter([IPv6Network('2001:db8:1:2::/64')])]),
+            SubnetFilter([IPv6Network('::/0')]),
+            CustomSubnetFilter([IPv6Network('::/0')]),
+        ]
+        self.decider = SubFilterDecider(self.filters)
+
+    def test_compiled(self):
+        self.assertEqual(len(self.decider.indexes), 1)
+        self.assertIsInstance(self.decider.indexes[0], SubnetFilterIndex)
+
+        # The marked-with filter and the filter with custom matching aren't in the index
+        self.assertEqual([position for position, sub_filter in self.decider.unindexed], [2, 5])
+
+    def test_matches(self):
+        index = self.decider.indexes[0]
+        for address, positions in (('2001:db8:1:2::1', [0, 1, 3, 4]),
+                                    ('2001:db8:2::1', [0, 1, 4]),
+                                    ('2001:db8:3::1', [0, 4]),
+                                    ('2001:db9::1', [4])):
+            with self.subTest(address=address):
+                bundle = SimpleNamespace(link_address=IPv6Address(address), marks=set())
+                self.assertEqual(index.get_matches(bundle), positions)
+
+    def test_same_decisions(self):
+        for address in ('2001:db8:1:2::1', '2001:db8:2::1', '2001:db9::1'):
+            with self.subTest(address=address):
+                bundle = SimpleNamespace(link_address=IPv6Address(address), marks={'one'})
+                expected = tuple([sub_filter.get_decision(bundle) for sub_filter in self.filters])
+                self.assertEqual(self.decider.get_decisions(bundle), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,10 @@
 Basic handler testing
 """
 import unittest
+from unittest.mock import MagicMock
 
-from dhcpkit.ipv6.server.handlers import Handler
+from dhcpkit.ipv6.server.handlers import Handler, HandlerChain
+from dhcpkit.ipv6.server.transaction_bundle import TransactionBundle
 
 
 class TestHandler(Handler):
@@ -13,11 +15,60 @@ class TestHandler(Handler):
     pass
 
 
+class PreHandler(Handler):
+    """
+    A handler that only implements the pre phase
+    """
+
+    def pre(self, bundle: TransactionBundle):
+        """
+        Do nothing, but do it in the pre phase
+        """
+
+
+class PostHandler(PreHandler):
+    """
+    A handler that implements the post phase and inherits the pre phase
+    """
+
+    def post(self, bundle: TransactionBundle):
+        """
+        Do nothing, but do it in the post phase
+        """
+
+
 class HandlerTestCase(unittest.TestCase):
     def test_str(self):
         handler = TestHandler()
         self.assertEqual(str(handler), 'TestHandler')
 
 
+class HandlerChainTestCase(unittest.TestCase):
+    def test_phases(self):
+        test_handler = TestHandler()
+        pre_handler = PreHandler()
+        post_handler = PostHandler()
+        mock_handler = MagicMock(spec=Handler)
+
+        chain = HandlerChain([test_handler, pre_handler, post_handler, mock_handler])
+        self.assertEqual(list(chain), [test_handler, pre_handler, post_handler, mock_handler])
+        self.assertEqual(len(chain), 4)
+
+        # Mocks don't have real methods, so they must be called in every phase
+        self.assertEqual(chain.analyse_pre_handlers, [mock_handler])
+        self.assertEqual(chain.pre_handlers, [pre_handler, post_handler, mock_handler])
+        self.assertEqual(chain.handle_handlers, [mock_handler])
+        self.assertEqual(chain.post_handlers, [post_handler, mock_handler])
+        self.assertEqual(chain.analyse_post_handlers, [mock_handler])
+
+    def test_description(self):
+        test_handler = TestHandler()
+        pre_handler = PreHandler()
+
+        self.assertEqual(HandlerChain([test_handler, pre_handler]).description, 'TestHandler, PreHandler')
+        self.assertEqual(HandlerChain([test_handler, pre_handler], description_handlers=[pre_handler]).description,
+                         'PreHandler')
+
+
 if __name__ == '__main__':  # pragma: no cover
     unittest.main()
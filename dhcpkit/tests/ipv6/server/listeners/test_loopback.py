@@ -0,0 +1,109 @@
+"""
+Test the loopback relay listener
+"""
+import socket
+import unittest
+from ipaddress import IPv6Address
+
+from dhcpkit.ipv6.messages import RelayForwardMessage, RelayReplyMessage
+from dhcpkit.ipv6.options import InterfaceIdOption, RelayMessageOption
+from dhcpkit.ipv6.server.listeners import IgnoreMessage, ListeningSocketError
+from dhcpkit.ipv6.server.listeners.loopback import LoopbackRelayListener, LoopbackRelayReplier
+from dhcpkit.ipv6.server.listeners.udp import UDPListener
+from dhcpkit.tests.ipv6.messages.test_advertise_message import advertise_message
+from dhcpkit.tests.ipv6.messages.test_solicit_message import solicit_message
+from dhcpkit.tests.ipv6.server.listeners.test_udp import FakeSocket
+
+
+def create_socket(address: str = '::1') -> socket.socket:
+    """
+    Create a UDP socket on a free port
+
+    :param address: The address to bind to
+    :return: The socket
+    """
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.bind((address, 0))
+    return sock
+
+
+class LoopbackRelayListenerTestCase(unittest.TestCase):
+    def setUp(self):
+        try:
+            self.listen_socket = create_socket()
+        except OSError:
+            raise unittest.SkipTest("IPv6 loopback not available")
+
+        self.harness_socket = create_socket()
+        self.harness_socket.settimeout(1)
+        self.listener = LoopbackRelayListener('eth9', self.listen_socket, marks=['bench'])
+        self.relay_forward = RelayForwardMessage(hop_count=0,
+                                                 link_address=IPv6Address('2001:db8::1'),
+                                                 peer_address=IPv6Address('fe80::1'),
+                                                 options=[RelayMessageOption(relayed_message=solicit_message)])
+
+    def tearDown(self):
+        self.listen_socket.close()
+        self.harness_socket.close()
+
+    def send(self, data: bytes):
+        self.harness_socket.sendto(data, self.listen_socket.getsockname()[:2])
+
+    def test_relay_forward(self):
+        self.send(self.relay_forward.save())
+        packet, replier = self.listener.recv_request()
+
+        self.assertEqual(packet.source_address, IPv6Address('::1'))
+        self.assertEqual(packet.link_address, IPv6Address('::1'))
+        self.assertEqual(packet.relay_options, (InterfaceIdOption(interface_id=b'eth9'),))
+        self.assertEqual(packet.marks, ('bench',))
+        self.assertIsInstance(replier, LoopbackRelayReplier)
+        self.assertEqual(replier.port, self.harness_socket.getsockname()[1])
+
+        # Replies go back to the harness
+        relay_reply = self.relay_forward.wrap_response(advertise_message)
+        outgoing_message = RelayReplyMessage(hop_count=0,
+                                             link_address=packet.link_address,
+                                             peer_address=packet.source_address,
+                                             options=[InterfaceIdOption(interface_id=b'eth9'),
+                                                      RelayMessageOption(relayed_message=relay_reply)])
+        self.assertTrue(replier.send_reply(outgoing_message))
+        self.assertEqual(self.harness_socket.recv(65536), relay_reply.save())
+
+    def test_replier_per_port(self):
+        other_socket = create_socket()
+        try:
+            self.send(self.relay_forward.save())
+            self.send(self.relay_forward.save())
+            other_socket.sendto(self.relay_forward.save(), self.listen_socket.getsockname()[:2])
+
+            first, second, third = [replier for packet, replier in self.listener.recv_requests()]
+        finally:
+            other_socket.close()
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, third)
+
+    def test_ignore_client_messages(self):
+        self.send(solicit_message.save())
+        with self.assertRaises(IgnoreMessage):
+            self.listener.recv_request()
+
+    def test_name(self):
+        self.assertEqual(self.listener.name, 'loopback eth9/[::1]:{}'.format(self.listen_socket.getsockname()[1]))
+
+
+class LoopbackRelayValidationTestCase(unittest.TestCase):
+    def test_not_loopback(self):
+        with self.assertRaisesRegex(ListeningSocketError, 'loopback'):
+            LoopbackRelayListener('eth9', FakeSocket('2001:db8::1'))
+
+    def test_udp_listener_port(self):
+        fake_socket = FakeSocket('::1')
+        fake_socket.getsockname = lambda: ('::1', 10547, 0, 0)
+        with self.assertRaisesRegex(ListeningSocketError, 'port 547'):
+            UDPListener('lo', fake_socket)
+
+
+if __name__ == '__main__':
+    unittest.main()
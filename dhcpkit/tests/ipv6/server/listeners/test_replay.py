@@ -0,0 +1,275 @@
+"""
+Test the listener that replays requests from capture files
+"""
+import io
+import os
+import select
+import struct
+import tempfile
+import time
+import unittest
+from ipaddress import IPv6Address
+
+from dhcpkit.ipv6 import CLIENT_PORT, SERVER_PORT
+from dhcpkit.ipv6.messages import RelayReplyMessage
+from dhcpkit.ipv6.options import RelayMessageOption
+from dhcpkit.ipv6.server.capture import BLOCK_ENHANCED_PACKET, DIRECTION_INBOUND, LINKTYPE_IPV6, \
+    build_ipv6_udp_frame, pcapng_block, pcapng_enhanced_packet, pcapng_interface_description, pcapng_section_header
+from dhcpkit.ipv6.server.listeners import IgnoreMessage
+from dhcpkit.ipv6.server.listeners.replay import LINKTYPE_ETHERNET, LINKTYPE_LINUX_SLL, LINKTYPE_RAW, \
+    PENDING_PER_WORKER, ReplayListener, SinkReplier, parse_udp_frame, read_capture_frames
+from dhcpkit.tests.ipv6.messages.test_advertise_message import advertise_message
+from dhcpkit.tests.ipv6.messages.test_solicit_message import solicit_message
+
+PCAPS_DIR = os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', '..', 'pcaps')
+
+CLIENT = IPv6Address('fe80::1').packed
+SERVER = IPv6Address('ff02::1:2').packed
+
+
+def pcap_file(frames, link_type: int = LINKTYPE_RAW, byte_order: str = '<') -> bytes:
+    """
+    Create a classic pcap file
+
+    :param frames: The timestamps and contents of the frames
+    :param link_type: The link type of the frames
+    :param byte_order: The byte order to write the file in
+    :return: The contents of the file
+    """
+    data = struct.pack(byte_order + 'IHHiIII', 0xA1B2C3D4, 2, 4, 0, 0, 65535, link_type)
+    for timestamp, frame in frames:
+        data += struct.pack(byte_order + 'IIII', int(timestamp), int(timestamp % 1 * 1000000), len(frame), len(frame))
+        data += frame
+    return data
+
+
+def pcapng_file(frames) -> bytes:
+    """
+    Create a pcapng file with raw IPv6 frames, like the packet capture of the server writes
+
+    :param frames: The timestamps and contents of the frames
+    :return: The contents of the file
+    """
+    data = pcapng_section_header() + pcapng_interface_description('eth0')
+    for timestamp, frame in frames:
+        data += pcapng_enhanced_packet(0, timestamp, frame, DIRECTION_INBOUND, '')
+    return data
+
+
+class ReadCaptureTestCase(unittest.TestCase):
+    def setUp(self):
+        self.request = build_ipv6_udp_frame(CLIENT, SERVER, CLIENT_PORT, SERVER_PORT, solicit_message.save())
+        self.reply = build_ipv6_udp_frame(SERVER, CLIENT, SERVER_PORT, CLIENT_PORT, advertise_message.save())
+        self.frames = [(1000.5, self.request), (1001.25, self.reply)]
+
+    def test_pcapng(self):
+        frames = list(read_capture_frames(io.BytesIO(pcapng_file(self.frames))))
+        self.assertEqual(frames, [(1000.5, LINKTYPE_IPV6, self.request), (1001.25, LINKTYPE_IPV6, self.reply)])
+
+    def test_pcap(self):
+        for byte_order in '<>':
+            frames = list(read_capture_frames(io.BytesIO(pcap_file(self.frames, byte_order=byte_order))))
+            self.assertEqual(frames, [(1000.5, LINKTYPE_RAW, self.request), (1001.25, LINKTYPE_RAW, self.reply)])
+
+    def test_truncated(self):
+        data = pcapng_file(self.frames)
+        frames = list(read_capture_frames(io.BytesIO(data[:-10])))
+        self.assertEqual(frames, [(1000.5, LINKTYPE_IPV6, self.request)])
+
+    def test_truncated_block(self):
+        # A block that is complete, but too short for an enhanced packet block
+        data = pcapng_section_header() + pcapng_interface_description('eth0') + \
+            pcapng_block(BLOCK_ENHANCED_PACKET, b'\x00' * 8)
+        with self.assertRaisesRegex(ValueError, 'Truncated pcapng enhanced packet block'):
+            list(read_capture_frames(io.BytesIO(data)))
+
+    def test_undescribed_interface(self):
+        data = pcapng_section_header() + pcapng_interface_description('eth0') + \
+            pcapng_enhanced_packet(1, 1000.5, self.request, DIRECTION_INBOUND, '')
+        with self.assertRaisesRegex(ValueError, 'undescribed interface 1'):
+            list(read_capture_frames(io.BytesIO(data)))
+
+    def test_not_a_capture(self):
+        with self.assertRaisesRegex(ValueError, 'Not a pcap'):
+            list(read_capture_frames(io.BytesIO(b'Hello world')))
+
+    def test_repo_captures(self):
+        for filename in ('eth4-2.pcapng', 'eth4-3.pcap'):
+            with open(os.path.join(PCAPS_DIR, filename), 'rb') as capture_file:
+                packets = [parse_udp_frame(link_type, frame)
+                           for timestamp, link_type, frame in read_capture_frames(capture_file)]
+
+            self.assertTrue(all(packet.payload for packet in packets if packet))
+            self.assertTrue(any(packet.destination_port == SERVER_PORT for packet in packets if packet))
+
+
+class ParseUDPFrameTestCase(unittest.TestCase):
+    def setUp(self):
+        self.payload = solicit_message.save()
+        self.packet = build_ipv6_udp_frame(CLIENT, SERVER, CLIENT_PORT, SERVER_PORT, self.payload)
+
+    def check(self, link_type: int, frame: bytes):
+        packet = parse_udp_frame(link_type, frame)
+        self.assertEqual(packet.source, CLIENT)
+        self.assertEqual(packet.source_port, CLIENT_PORT)
+        self.assertEqual(packet.destination, SERVER)
+        self.assertEqual(packet.destination_port, SERVER_PORT)
+        self.assertEqual(packet.payload, self.payload)
+
+    def test_raw(self):
+        self.check(LINKTYPE_RAW, self.packet)
+
+    def test_ethernet(self):
+        self.check(LINKTYPE_ETHERNET, b'\x33\x33\x00\x01\x00\x02' + b'\x00\x01\x02\x03\x04\x05' + b'\x86\xdd' +
+                   self.packet)
+
+    def test_ethernet_vlan(self):
+        self.check(LINKTYPE_ETHERNET, b'\x33\x33\x00\x01\x00\x02' + b'\x00\x01\x02\x03\x04\x05' +
+                   b'\x81\x00\x00\x64' + b'\x86\xdd' + self.packet)
+
+    def test_linux_cooked(self):
+        self.check(LINKTYPE_LINUX_SLL, b'\x00\x00\x00\x01\x00\x06' + b'\x00\x01\x02\x03\x04\x05\x00\x00' +
+                   b'\x86\xdd' + self.packet)
+
+    def test_extension_header(self):
+        # Insert a hop-by-hop header with only padding
+        packet = bytearray(self.packet[:40] + b'\x11\x00' + b'\x01\x04\x00\x00\x00\x00' + self.packet[40:])
+        packet[6] = 0
+        self.check(LINKTYPE_RAW, bytes(packet))
+
+    def test_not_udp(self):
+        packet = bytearray(self.packet)
+        packet[6] = 6
+        self.assertIsNone(parse_udp_frame(LINKTYPE_RAW, bytes(packet)))
+
+    def test_ipv4(self):
+        self.assertIsNone(parse_udp_frame(LINKTYPE_ETHERNET, b'\x00' * 12 + b'\x08\x00' + b'\x45' + b'\x00' * 39))
+
+    def test_unknown_link_type(self):
+        self.assertIsNone(parse_udp_frame(12345, self.packet))
+
+
+class FakePool:
+    """
+    Just enough of a worker pool to see how busy it is
+    """
+    worker_count = 2
+    pending_tasks = 0
+
+
+class ReplayListenerTestCase(unittest.TestCase):
+    def setUp(self):
+        request = build_ipv6_udp_frame(CLIENT, SERVER, CLIENT_PORT, SERVER_PORT, solicit_message.save())
+        reply = build_ipv6_udp_frame(SERVER, CLIENT, SERVER_PORT, CLIENT_PORT, advertise_message.save())
+
+        with tempfile.NamedTemporaryFile(suffix='.pcapng', delete=False) as capture_file:
+            capture_file.write(pcapng_file([(1000.0, request), (1000.0, reply), (1000.2, request)]))
+        self.filename = capture_file.name
+
+        self.listener = ReplayListener(self.filename, 'eth0', IPv6Address('2001:db8::1'), speed=0, repeat=2,
+                                       marks=['replay'])
+
+    def tearDown(self):
+        self.listener.close()
+        os.unlink(self.filename)
+
+    def receive_all(self, expected: int, timeout: float = 5.0) -> list:
+        requests = []
+        end = time.monotonic() + timeout
+        while len(requests) < expected and time.monotonic() < end:
+            select.select([self.listener], [], [], 0.1)
+            requests += self.listener.recv_requests()
+        return requests
+
+    def test_name(self):
+        self.assertEqual(self.listener.name, 'replay ' + os.path.basename(self.filename))
+
+    def test_replay(self):
+        # Two requests in the file, replayed twice, and the reply is skipped
+        requests = self.receive_all(4)
+        self.assertEqual(len(requests), 4)
+
+        for packet, replier in requests:
+            self.assertEqual(packet.data, solicit_message.save())
+            self.assertEqual(packet.source_address, IPv6Address('fe80::1'))
+            self.assertEqual(packet.link_address, IPv6Address('2001:db8::1'))
+            self.assertTrue(packet.received_over_multicast)
+            self.assertFalse(packet.received_over_tcp)
+            self.assertEqual(packet.marks, ('replay',))
+            self.assertEqual(packet.relay_options[0].interface_id, b'eth0')
+            self.assertIsInstance(replier, SinkReplier)
+
+        self.listener.feeder.join(5)
+        self.assertFalse(self.listener.feeder.is_alive())
+        self.assertEqual(self.listener.recv_requests(), [])
+        self.assertFalse(self.listener.backlogged)
+
+        with self.assertRaises(IgnoreMessage):
+            self.listener.recv_request()
+
+    def test_original_speed(self):
+        self.listener.speed = 1
+        self.listener.repeat = 1
+
+        start = time.monotonic()
+        self.assertEqual(len(self.receive_all(2)), 2)
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+    def test_waits_for_workers(self):
+        pool = FakePool()
+        pool.pending_tasks = pool.worker_count * PENDING_PER_WORKER
+        self.listener.set_worker_pool(pool)
+
+        # The workers are busy, so nothing is queued or taken
+        self.assertEqual(self.receive_all(1, timeout=0.5), [])
+        self.assertFalse(self.listener.backlogged)
+        self.assertTrue(self.listener.packets.empty())
+        self.assertTrue(self.listener.feeder.is_alive())
+
+        # The feeder wakes us up when the workers have caught up
+        pool.pending_tasks = 0
+        readable = select.select([self.listener], [], [], 5)[0]
+        self.assertEqual(readable, [self.listener])
+        self.assertEqual(len(self.receive_all(4)), 4)
+
+    def test_nothing_to_replay(self):
+        with open(self.filename, 'wb') as capture_file:
+            capture_file.write(pcapng_file([]))
+
+        self.listener.repeat = 0
+        with self.assertLogs('dhcpkit.ipv6.server.listeners.replay', 'WARNING'):
+            self.listener.recv_requests()
+            self.listener.feeder.join(5)
+
+        self.assertFalse(self.listener.feeder.is_alive())
+
+    def test_malformed_capture(self):
+        request = build_ipv6_udp_frame(CLIENT, SERVER, CLIENT_PORT, SERVER_PORT, solicit_message.save())
+        with open(self.filename, 'wb') as capture_file:
+            capture_file.write(pcapng_section_header() + pcapng_enhanced_packet(0, 1000.0, request,
+                                                                                DIRECTION_INBOUND, ''))
+
+        # The feeder logs the problem and stops instead of dying with a traceback
+        with self.assertLogs('dhcpkit.ipv6.server.listeners.replay', 'ERROR') as cm:
+            self.listener.recv_requests()
+            self.listener.feeder.join(5)
+
+        self.assertRegex(cm.output[0], 'undescribed interface 0')
+        self.assertFalse(self.listener.feeder.is_alive())
+
+    def test_close(self):
+        self.listener.speed = 0.001
+        self.listener.recv_requests()
+        self.listener.close()
+        self.listener.feeder.join(5)
+        self.assertFalse(self.listener.feeder.is_alive())
+
+    def test_sink(self):
+        outgoing_message = RelayReplyMessage(hop_count=0, link_address=IPv6Address('2001:db8::1'),
+                                             peer_address=IPv6Address('fe80::1'),
+                                             options=[RelayMessageOption(relayed_message=advertise_message)])
+        self.assertTrue(SinkReplier().send_reply(outgoing_message))
+
+
+if __name__ == '__main__':
+    unittest.main()
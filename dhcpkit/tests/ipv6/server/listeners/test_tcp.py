@@ -0,0 +1,372 @@
+"""
+Test the TCP connection listener
+"""
+import socket
+import threading
+import time
+import unittest
+import weakref
+from ipaddress import IPv6Address
+from struct import pack
+from unittest.mock import Mock
+
+from dhcpkit.ipv6.server.listeners import ClosedListener, IncompleteMessage
+from dhcpkit.ipv6.server.listeners.tcp import RECEIVE_BUFFER_SIZE, REQUESTS_PER_TURN, StreamWriter, TCPConnection, \
+    TCPConnectionListener
+from dhcpkit.tests.ipv6.messages.test_solicit_message import solicit_message
+
+
+class FakeSocket:
+    """
+    A connected socket that returns pre-defined chunks of data
+    """
+    family = socket.AF_INET6
+    proto = socket.IPPROTO_TCP
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.recv_calls = 0
+
+    @staticmethod
+    def getsockname():
+        return '2001:db8::1', 547, 0, 2
+
+    peer = ('2001:db8::2', 12345, 0, 2)
+
+    def getpeername(self):
+        return self.peer
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        self.chunks = []
+
+    def recv_into(self, buffer, nbytes=0, flags=0) -> int:
+        self.recv_calls += 1
+        if not self.chunks:
+            return 0
+
+        chunk = self.chunks.pop(0)
+        if isinstance(chunk, Exception):
+            raise chunk
+
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+class TCPConnectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.message_data = solicit_message.save()
+        self.framed = pack('!H', len(self.message_data)) + self.message_data
+
+    def create_connection(self, chunks) -> TCPConnection:
+        return TCPConnection('eth0', FakeSocket(chunks), threading.Lock(), IPv6Address('2001:db8::1'))
+
+    def test_multiple_messages_per_read(self):
+        connection = self.create_connection([self.framed * 3])
+        requests = connection.recv_requests()
+
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(connection.connected_socket.recv_calls, 1)
+        for packet, replier in requests:
+            self.assertEqual(packet.data, self.message_data)
+            self.assertIsInstance(packet.data, bytes)
+            self.assertTrue(packet.received_over_tcp)
+            self.assertEqual(packet.source_address, IPv6Address('2001:db8::2'))
+
+        # Everything has been consumed
+        self.assertEqual(connection.buffer_start, connection.buffer_end)
+
+    def test_split_messages(self):
+        # One and a half message, then the rest, split inside the length prefix of the next message
+        data = self.framed * 3
+        cut1 = len(self.framed) + len(self.framed) // 2
+        cut2 = 2 * len(self.framed) + 1
+        connection = self.create_connection([data[:cut1], data[cut1:cut2], data[cut2:]])
+
+        self.assertEqual(len(connection.recv_requests()), 1)
+        self.assertEqual(len(connection.recv_requests()), 1)
+        self.assertEqual(len(connection.recv_requests()), 1)
+
+        # The partial message was moved to the start of the buffer
+        self.assertEqual(connection.buffer_start, connection.buffer_end)
+
+    def test_incomplete(self):
+        connection = self.create_connection([self.framed[:5], self.framed[5:]])
+        with self.assertRaises(IncompleteMessage):
+            connection.recv_requests()
+
+        packet, replier = connection.recv_request()
+        self.assertEqual(packet.data, self.message_data)
+
+    def test_recv_request_uses_buffered_messages(self):
+        connection = self.create_connection([self.framed * 2])
+        connection.recv_request()
+        connection.recv_request()
+        self.assertEqual(connection.connected_socket.recv_calls, 1)
+
+    def test_closed(self):
+        connection = self.create_connection([])
+        with self.assertRaises(ClosedListener):
+            connection.recv_requests()
+
+    def test_fair_share(self):
+        connection = self.create_connection([self.framed * (REQUESTS_PER_TURN + 5), self.framed])
+
+        # The first turn only takes part of the messages
+        self.assertEqual(len(connection.recv_requests()), REQUESTS_PER_TURN)
+        self.assertTrue(connection.backlogged)
+
+        # The next turn takes the rest from the buffer without reading more data
+        self.assertEqual(len(connection.recv_requests()), 5)
+        self.assertEqual(connection.connected_socket.recv_calls, 1)
+
+        # New data might have arrived in the meantime, so it needs another turn
+        self.assertTrue(connection.backlogged)
+        self.assertEqual(len(connection.recv_requests()), 1)
+        self.assertEqual(connection.connected_socket.recv_calls, 2)
+        self.assertFalse(connection.backlogged)
+
+    def test_more_waiting(self):
+        # Fill the whole buffer, there might be more on the socket
+        data = (self.framed * (RECEIVE_BUFFER_SIZE // len(self.framed) + 1))[:RECEIVE_BUFFER_SIZE]
+        connection = self.create_connection([data, BlockingIOError()])
+        connection.recv_requests()
+        self.assertTrue(connection.more_waiting)
+
+        while connection.message_in_buffer():
+            connection.recv_requests()
+
+        # Until the socket tells us it is empty
+        with self.assertRaises(IncompleteMessage):
+            connection.recv_requests()
+        self.assertFalse(connection.backlogged)
+
+    def test_idle_timeout(self):
+        connection = TCPConnection('eth0', FakeSocket([self.framed]), threading.Lock(), IPv6Address('2001:db8::1'),
+                                   idle_timeout=60)
+        self.assertIsNone(self.create_connection([]).deadline)
+        self.assertEqual(connection.deadline, connection.created + 60)
+        self.assertFalse(connection.expired(connection.created + 59))
+        self.assertTrue(connection.expired(connection.created + 61))
+
+        # Receiving data is activity
+        connection.recv_requests()
+        self.assertGreaterEqual(connection.deadline, connection.created + 60)
+
+    def test_idle_timeout_with_replies(self):
+        activity = FakeValue()
+        connection = TCPConnection('eth0', FakeSocket([]), threading.Lock(), IPv6Address('2001:db8::1'),
+                                   idle_timeout=60, activity=activity)
+
+        # Workers are still sending replies
+        activity.value = connection.created + 30
+        self.assertFalse(connection.expired(connection.created + 61))
+        self.assertEqual(connection.deadline, connection.created + 90)
+        self.assertTrue(connection.expired(connection.created + 91))
+
+    def test_max_connection_time(self):
+        connection = TCPConnection('eth0', FakeSocket([]), threading.Lock(), IPv6Address('2001:db8::1'),
+                                   idle_timeout=60, max_connection_time=30)
+        self.assertEqual(connection.deadline, connection.created + 30)
+        self.assertTrue(connection.expired(connection.created + 31))
+
+
+class FakeValue:
+    """
+    A replacement for a value from a manager
+    """
+    value = 0.0
+
+
+class FakeManager:
+    """
+    A replacement for the manager of the TCP listener
+    """
+
+    @staticmethod
+    def Lock():
+        return threading.Lock()
+
+    @staticmethod
+    def Value(typecode, value):
+        return FakeValue()
+
+
+class FakeListenSocket:
+    """
+    A listening socket that accepts connections from pre-defined peers
+    """
+
+    def __init__(self, peers):
+        self.peers = list(peers)
+
+    def accept(self):
+        connected_socket = FakeSocket([])
+        connected_socket.peer = self.peers.pop(0)
+        return connected_socket, connected_socket.peer
+
+
+class TCPConnectionListenerTestCase(unittest.TestCase):
+    def create_listener(self, peers, **kwargs) -> TCPConnectionListener:
+        # Skip the socket checks of the constructor
+        listener = TCPConnectionListener.__new__(TCPConnectionListener)
+        listener.interface_name = 'eth0'
+        listener.marks = []
+        listener.allow_from = []
+        listener.global_address = IPv6Address('2001:db8::1')
+        listener.listen_socket = FakeListenSocket(peers)
+        listener.manager = FakeManager()
+        listener.open_connections = weakref.WeakSet()
+        listener.max_connections = kwargs.get('max_connections', 10)
+        listener.max_connections_per_peer = kwargs.get('max_connections_per_peer', 0)
+        listener.idle_timeout = kwargs.get('idle_timeout', 0)
+        listener.max_connection_time = kwargs.get('max_connection_time', 0)
+        return listener
+
+    def test_max_connections(self):
+        listener = self.create_listener([('2001:db8::2', port, 0, 2) for port in range(1000, 1004)],
+                                        max_connections=3)
+        connections = [listener.create_listener() for _ in range(4)]
+        self.assertEqual(sum([1 for connection in connections if connection]), 3)
+        self.assertEqual(listener.open_listeners, 3)
+
+    def test_max_connections_per_peer(self):
+        listener = self.create_listener([('2001:db8::2', 1000, 0, 2), ('2001:db8::2', 1001, 0, 2),
+                                         ('2001:db8::3', 1000, 0, 2)],
+                                        max_connections_per_peer=1, idle_timeout=60)
+        first = listener.create_listener()
+        self.assertIsNotNone(first)
+        self.assertIsNone(listener.create_listener())
+        other = listener.create_listener()
+        self.assertIsNotNone(other)
+
+        # The connections get the timeout settings and something to see the activity of the workers with
+        self.assertEqual(first.idle_timeout, 60)
+        self.assertIsInstance(first.activity, FakeValue)
+
+        # Closed connections are forgotten, even when something still refers to them
+        self.assertEqual(listener.open_listeners, 2)
+        other.close()
+        self.assertEqual(listener.open_listeners, 1)
+        del first
+        self.assertEqual(listener.open_listeners, 0)
+
+
+class FakeReplier:
+    """
+    Just enough of a TCPReplier for the stream writer
+    """
+    client_address = IPv6Address('2001:db8::2')
+    client_port = 12345
+    activity = None
+
+    def __init__(self, reply_socket: socket.socket, reply_lock: threading.Lock):
+        self.reply_socket = reply_socket
+        self.reply_lock = reply_lock
+        self.failed = False
+
+
+class StreamWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server_socket, self.client_socket = socket.socketpair()
+        self.lock = threading.Lock()
+        self.statistics = Mock()
+        self.writer = StreamWriter(high_water=10 * 1024 * 1024, timeout=10, statistics=self.statistics)
+        self.writer.start()
+
+    def tearDown(self):
+        self.server_socket.close()
+        self.client_socket.close()
+
+    def receive(self, length: int) -> bytes:
+        self.client_socket.settimeout(10)
+        data = b''
+        while len(data) < length:
+            chunk = self.client_socket.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_does_not_block_on_slow_client(self):
+        replier = FakeReplier(self.server_socket, self.lock)
+        messages = [pack('!H', 1000) + bytes([i % 256]) * 1000 for i in range(2000)]
+
+        # Much more than the socket buffer, while the client isn't reading yet
+        start = time.monotonic()
+        for message in messages:
+            self.writer.write(replier, message)
+        self.assertLess(time.monotonic() - start, 5)
+
+        # Everything arrives in order
+        expected = b''.join(messages)
+        self.assertEqual(self.receive(len(expected)), expected)
+
+        # And the stream is cleaned up
+        deadline = time.monotonic() + 5
+        while self.writer.streams and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.writer.streams, {})
+        self.assertEqual(self.writer.buffered, 0)
+
+    def test_waits_for_lock(self):
+        replier = FakeReplier(self.server_socket, self.lock)
+
+        with self.lock:
+            self.writer.write(replier, b'\x00\x01a')
+            time.sleep(0.05)
+            self.assertEqual(self.writer.buffered, 3)
+
+        self.assertEqual(self.receive(3), b'\x00\x01a')
+
+    def test_closed_by_client(self):
+        replier = FakeReplier(self.server_socket, self.lock)
+        self.client_socket.close()
+
+        with self.assertLogs('dhcpkit.ipv6.server.listeners.tcp', 'ERROR'):
+            self.writer.write(replier, b'\x00\x01a')
+            deadline = time.monotonic() + 5
+            while not replier.failed and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+        self.assertTrue(replier.failed)
+        self.assertEqual(self.statistics.count_dropped_stream.call_count, 1)
+
+    def test_stop_sends_remaining_data(self):
+        replier = FakeReplier(self.server_socket, self.lock)
+        messages = [pack('!H', 1000) + bytes([i % 256]) * 1000 for i in range(2000)]
+        for message in messages:
+            self.writer.write(replier, message)
+
+        # The client only starts reading while the writer is being stopped
+        expected = b''.join(messages)
+        received = []
+        reader = threading.Thread(target=lambda: received.append(self.receive(len(expected))))
+        reader.start()
+        self.writer.stop(timeout=10)
+        reader.join()
+
+        self.assertEqual(received, [expected])
+        self.assertFalse(self.writer.thread.is_alive())
+        self.assertFalse(replier.failed)
+        self.statistics.count_dropped_stream.assert_not_called()
+
+    def test_stop_drops_unfinished_streams(self):
+        replier = FakeReplier(self.server_socket, self.lock)
+        for i in range(2000):
+            self.writer.write(replier, pack('!H', 1000) + bytes(1000))
+
+        with self.assertLogs('dhcpkit.ipv6.server.listeners.tcp', 'ERROR'):
+            self.writer.stop(timeout=0.1)
+
+        self.assertFalse(self.writer.thread.is_alive())
+        self.assertEqual(self.writer.streams, {})
+        self.assertEqual(self.writer.buffered, 0)
+        self.assertTrue(replier.failed)
+        self.assertEqual(self.statistics.count_dropped_stream.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+"""
+Test the UDP listener and replier
+"""
+import pickle
+import socket
+import unittest
+from ipaddress import IPv6Address
+from unittest.mock import patch
+
+from dhcpkit.ipv6 import CLIENT_PORT
+from dhcpkit.ipv6.messages import RelayReplyMessage
+from dhcpkit.ipv6.options import InterfaceIdOption, RelayMessageOption
+from dhcpkit.ipv6.server.listeners import IncomingPacketBundle, ListeningSocketError
+from dhcpkit.ipv6.server.listeners import udp
+from dhcpkit.ipv6.server.listeners.udp import IN6_PKTINFO, RECEIVE_BATCH_SIZE, UDPListener, UDPReplier
+from dhcpkit.tests.ipv6.messages.test_advertise_message import advertise_message
+from dhcpkit.tests.ipv6.messages.test_solicit_message import solicit_message
+
+
+class FakeSocket:
+    """
+    A UDP socket that returns pre-defined packets and remembers what was sent
+    """
+    family = socket.AF_INET6
+    proto = socket.IPPROTO_UDP
+
+    def __init__(self, address: str, packets=()):
+        self.address = address
+        self.packets = list(packets)
+        self.sent = []
+        self.recv_calls = 0
+
+    def getsockname(self):
+        return self.address, 547, 0, 0 if self.address == '::' else 2
+
+    def recvmsg_into(self, buffers, ancillary_size=0, flags=0):
+        self.recv_calls += 1
+        if not self.packets:
+            raise BlockingIOError
+
+        packet = self.packets.pop(0)
+        data, sender = packet[:2]
+        ancillary_data = list(packet[2:]) if ancillary_size else []
+        buffers[0][:len(data)] = data
+        return len(data), ancillary_data, 0, sender
+
+    def sendto(self, data, destination):
+        self.sent.append((data, destination))
+        return len(data)
+
+    def sendmsg(self, buffers, ancillary_data, flags, destination):
+        self.sent.append((buffers[0], destination, ancillary_data))
+        return len(buffers[0])
+
+
+def packet_info(address: str, interface_index: int) -> tuple:
+    """
+    Create the ancillary data that tells where a packet was sent to
+
+    :param address: The destination address
+    :param interface_index: The interface the packet was received on
+    :return: The ancillary data item
+    """
+    return socket.IPPROTO_IPV6, socket.IPV6_PKTINFO, IN6_PKTINFO.pack(IPv6Address(address).packed, interface_index)
+
+
+class UDPListenerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = solicit_message.save()
+        self.listen_socket = FakeSocket('2001:db8::1', [
+            (self.data, ('fe80::1%eth0', 546, 0, 2)),
+            (self.data, ('fe80::1%eth0', 546, 0, 2)),
+            (self.data, ('fe80::2%eth0', 546, 0, 2)),
+        ])
+        self.listener = UDPListener('eth0', self.listen_socket, marks=['one'])
+
+    def test_recv_request(self):
+        packet, replier = self.listener.recv_request()
+
+        self.assertEqual(packet.data, self.data)
+        self.assertEqual(packet.source_address, IPv6Address('fe80::1'))
+        self.assertEqual(packet.link_address, IPv6Address('2001:db8::1'))
+        self.assertEqual(packet.interface_index, 2)
+        self.assertFalse(packet.received_over_multicast)
+        self.assertFalse(packet.received_over_tcp)
+        self.assertEqual(packet.marks, ('one',))
+        self.assertEqual(packet.relay_options, (InterfaceIdOption(interface_id=b'eth0'),))
+        self.assertRegex(packet.message_id, r'^#[0-9A-F]{6}$')
+        self.assertIsInstance(replier, UDPReplier)
+
+    def test_reply_interface(self):
+        packet, replier = self.listener.recv_request()
+
+        # The listener knows its interface, so replies don't look it up
+        with patch('socket.if_nametoindex') as if_nametoindex:
+            self.assertEqual(replier.get_reply_interface(b'eth0'), (2, 'eth0'))
+
+        if_nametoindex.assert_not_called()
+
+    def test_invariants_shared(self):
+        first, first_replier = self.listener.recv_request()
+        second, second_replier = self.listener.recv_request()
+        third, third_replier = self.listener.recv_request()
+
+        # Nothing that is the same for every packet is created again
+        self.assertIs(first.relay_options, second.relay_options)
+        self.assertIs(first.marks, second.marks)
+        self.assertIs(first_replier, second_replier)
+
+        # Addresses of the same sender are reused
+        self.assertIs(first.source_address, second.source_address)
+        self.assertEqual(third.source_address, IPv6Address('fe80::2'))
+
+        # But every packet gets its own message-ID
+        self.assertNotEqual(first.message_id, second.message_id)
+
+    def test_source_address_cache_limit(self):
+        with patch.object(udp, 'SOURCE_ADDRESS_CACHE_SIZE', 1):
+            self.listener.recv_request()
+            self.listener.recv_request()
+            self.listener.recv_request()
+
+        self.assertEqual(list(self.listener.source_addresses), ['fe80::2%eth0'])
+
+    def test_recv_requests(self):
+        requests = self.listener.recv_requests()
+        self.assertEqual([packet.source_address for packet, replier in requests],
+                         [IPv6Address('fe80::1'), IPv6Address('fe80::1'), IPv6Address('fe80::2')])
+
+        # Until the socket said it had nothing left
+        self.assertEqual(self.listen_socket.recv_calls, 4)
+        self.assertEqual(self.listener.recv_requests(), [])
+
+    def test_recv_requests_limit(self):
+        self.listen_socket.packets *= RECEIVE_BATCH_SIZE
+        for _ in range(3):
+            self.assertEqual(len(self.listener.recv_requests()), RECEIVE_BATCH_SIZE)
+            self.assertTrue(self.listener.backlogged)
+
+        self.assertEqual(self.listener.recv_requests(), [])
+        self.assertFalse(self.listener.backlogged)
+
+
+class WildcardUDPListenerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = solicit_message.save()
+        self.listen_socket = FakeSocket('::', [
+            (self.data, ('2001:db8::2', 547, 0, 0), packet_info('2001:db8::1', 1)),
+            (self.data, ('fe80::2%eth0', 546, 0, 2), packet_info('ff02::1:2', 2)),
+            (self.data, ('2001:db8::2', 547, 0, 0), packet_info('2001:db8:1::1', 1)),
+            (self.data, ('2001:db8::2', 547, 0, 0)),
+            (self.data, ('2001:db8::2', 547, 0, 0), packet_info('2001:db8::1', 1)),
+        ])
+        self.listener = UDPListener('*', self.listen_socket)
+
+    def test_recv_requests(self):
+        with patch('socket.if_indextoname', return_value='lo') as if_indextoname:
+            requests = self.listener.recv_requests()
+
+        # Multicast and packets without packet info are ignored
+        self.assertEqual([packet.link_address for packet, replier in requests],
+                         [IPv6Address('2001:db8::1'), IPv6Address('2001:db8:1::1'), IPv6Address('2001:db8::1')])
+        for packet, replier in requests:
+            self.assertEqual(packet.interface_index, 1)
+            self.assertEqual(packet.relay_options, (InterfaceIdOption(interface_id=b'lo'),))
+            self.assertFalse(packet.received_over_multicast)
+            self.assertTrue(replier.set_source_address)
+
+        # Looked up once per destination
+        self.assertEqual(if_indextoname.call_count, 2)
+        self.assertIs(requests[0][0].relay_options, requests[2][0].relay_options)
+        self.assertIs(requests[0][1], requests[2][1])
+
+        # And replies go out on the interface that the packet came in on
+        with patch('socket.if_nametoindex') as if_nametoindex:
+            self.assertEqual(requests[0][1].get_reply_interface(b'lo'), (1, 'lo'))
+
+        if_nametoindex.assert_not_called()
+
+    def test_separate_reply_socket(self):
+        with self.assertRaisesRegex(ListeningSocketError, 'separate reply sockets'):
+            UDPListener('*', self.listen_socket, reply_socket=FakeSocket('::'))
+
+
+class IncomingPacketBundleTestCase(unittest.TestCase):
+    def test_message_id(self):
+        self.assertEqual(IncomingPacketBundle(message_number=0x1234).message_id, '#001234')
+        self.assertEqual(IncomingPacketBundle(message_id='#000001').message_id, '#000001')
+        self.assertEqual(IncomingPacketBundle().message_id, '??????')
+
+    def test_pickle(self):
+        packet = pickle.loads(pickle.dumps(IncomingPacketBundle(message_number=0x1234, data=b'abc',
+                                                                relay_options=[InterfaceIdOption(b'eth0')])))
+        self.assertEqual(packet.message_id, '#001234')
+        self.assertEqual(packet.data, b'abc')
+        self.assertEqual(packet.relay_options, (InterfaceIdOption(b'eth0'),))
+
+
+class UDPReplierTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reply_socket = FakeSocket('2001:db8::1')
+        self.replier = UDPReplier(self.reply_socket)
+        self.outgoing_message = RelayReplyMessage(hop_count=0,
+                                                  link_address=IPv6Address('2001:db8::1'),
+                                                  peer_address=IPv6Address('fe80::1'),
+                                                  options=[InterfaceIdOption(interface_id=b'eth0'),
+                                                           RelayMessageOption(relayed_message=advertise_message)])
+
+    def test_interface_looked_up_once(self):
+        with patch('socket.if_nametoindex', return_value=5) as if_nametoindex:
+            self.assertTrue(self.replier.send_reply(self.outgoing_message))
+            self.assertTrue(self.replier.send_reply(self.outgoing_message))
+
+        if_nametoindex.assert_called_once_with(b'eth0')
+        self.assertEqual(self.reply_socket.sent, [(advertise_message.save(), ('fe80::1', CLIENT_PORT, 0, 5))] * 2)
+
+    def test_set_source_address(self):
+        replier = UDPReplier(self.reply_socket, set_source_address=True)
+        with patch('socket.if_nametoindex', return_value=5):
+            self.assertTrue(replier.send_reply(self.outgoing_message))
+
+        self.assertEqual(self.reply_socket.sent, [(advertise_message.save(), ('fe80::1', CLIENT_PORT, 0, 5),
+                                                   [packet_info('2001:db8::1', 5)])])
+
+    def test_unknown_interface_not_cached(self):
+        with patch('socket.if_nametoindex', side_effect=OSError) as if_nametoindex:
+            self.assertTrue(self.replier.send_reply(self.outgoing_message))
+            self.assertTrue(self.replier.send_reply(self.outgoing_message))
+
+        self.assertEqual(if_nametoindex.call_count, 2)
+        self.assertEqual(self.reply_socket.sent[0][1], ('fe80::1', CLIENT_PORT, 0, 0))
+
+    def test_interface_changed(self):
+        replier = UDPReplier(self.reply_socket, reply_interfaces={b'eth0': (5, 'eth0')})
+        sendto = self.reply_socket.sendto
+
+        def fail_on_old_index(data, destination):
+            if destination[3] == 5:
+                raise OSError("No such device")
+            return sendto(data, destination)
+
+        # The interface is looked up again and the reply is sent on the new index
+        with patch.object(self.reply_socket, 'sendto', side_effect=fail_on_old_index), \
+                patch('socket.if_nametoindex', return_value=6):
+            self.assertTrue(replier.send_reply(self.outgoing_message))
+
+        self.assertEqual(replier.reply_interfaces, {b'eth0': (6, 'eth0')})
+        self.assertEqual(self.reply_socket.sent, [(advertise_message.save(), ('fe80::1', CLIENT_PORT, 0, 6))])
+
+    def test_send_error_same_interface(self):
+        replier = UDPReplier(self.reply_socket, reply_interfaces={b'eth0': (5, 'eth0')})
+
+        # Nothing changed, so the error is not caused by the cache
+        with patch.object(self.reply_socket, 'sendto', side_effect=OSError("Network is unreachable")), \
+                patch('socket.if_nametoindex', return_value=5):
+            with self.assertRaises(OSError):
+                replier.send_reply(self.outgoing_message)
+
+
+if __name__ == '__main__':
+    unittest.main()
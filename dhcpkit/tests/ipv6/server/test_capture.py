@@ -0,0 +1,222 @@
+"""
+Test the pcapng packet capture
+"""
+import os
+import struct
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+from ipaddress import IPv6Address, IPv6Network
+
+from dhcpkit.ipv6.messages import RelayForwardMessage, RelayReplyMessage
+from dhcpkit.ipv6.options import RelayMessageOption
+from dhcpkit.ipv6.server.capture import BLOCK_ENHANCED_PACKET, BLOCK_INTERFACE_DESCRIPTION, BLOCK_SECTION_HEADER, \
+    CaptureWriter, DIRECTION_INBOUND, DIRECTION_OUTBOUND, PacketCapture, build_ipv6_udp_frame, internet_checksum
+from dhcpkit.ipv6.server.listeners import IncomingPacketBundle
+from dhcpkit.ipv6.server.statistics import ServerStatistics
+from dhcpkit.ipv6.server.transaction_bundle import TransactionBundle
+from dhcpkit.tests.ipv6.messages.test_advertise_message import advertise_message
+from dhcpkit.tests.ipv6.messages.test_solicit_message import solicit_message
+
+
+def read_blocks(filename: str) -> list:
+    """
+    Read the blocks from a pcapng file
+
+    :param filename: The file to read
+    :return: A list of block types and bodies
+    """
+    with open(filename, 'rb') as capture_file:
+        data = capture_file.read()
+
+    blocks = []
+    offset = 0
+    while offset < len(data):
+        block_type, total_length = struct.unpack_from('<II', data, offset)
+        trailing_length, = struct.unpack_from('<I', data, offset + total_length - 4)
+        assert total_length == trailing_length and total_length % 4 == 0
+        blocks.append((block_type, data[offset + 8:offset + total_length - 4]))
+        offset += total_length
+
+    return blocks
+
+
+class CaptureFormatTestCase(unittest.TestCase):
+    def test_checksum(self):
+        # Example from RFC 1071
+        self.assertEqual(internet_checksum(bytes.fromhex('0001f203f4f5f6f7')), ~0xddf2 & 0xFFFF)
+
+    def test_frame(self):
+        source = IPv6Address('fe80::1').packed
+        destination = IPv6Address('ff02::1:2').packed
+        frame = build_ipv6_udp_frame(source, destination, 546, 547, b'abc')
+
+        self.assertEqual(len(frame), 40 + 8 + 3)
+        self.assertEqual(frame[0] >> 4, 6)
+        self.assertEqual(struct.unpack_from('!HBB', frame, 4), (11, 17, 64))
+        self.assertEqual(frame[8:24], source)
+        self.assertEqual(frame[24:40], destination)
+        self.assertEqual(struct.unpack_from('!HHH', frame, 40), (546, 547, 11))
+        self.assertEqual(frame[48:], b'abc')
+
+        # The checksum over the pseudo-header and the UDP packet must add up
+        pseudo_header = source + destination + struct.pack('!IxxxB', 11, 17)
+        self.assertIn(internet_checksum(pseudo_header + frame[40:]), (0, 0xFFFF))
+
+
+class PacketCaptureTestCase(unittest.TestCase):
+    def setUp(self):
+        self.statistics = ServerStatistics()
+        self.incoming_packet = IncomingPacketBundle(message_id='#000001',
+                                                    data=solicit_message.save(),
+                                                    source_address=IPv6Address('fe80::3631:c4ff:fe3c:b2f1'),
+                                                    link_address=IPv6Address('2001:db8:ffff:1::1'),
+                                                    received_over_multicast=True)
+        self.bundle = TransactionBundle(incoming_message=RelayForwardMessage(
+            hop_count=0,
+            link_address=IPv6Address('2001:db8:ffff:1::1'),
+            peer_address=IPv6Address('fe80::3631:c4ff:fe3c:b2f1'),
+            options=[RelayMessageOption(relayed_message=solicit_message)]
+        ), received_over_multicast=True)
+        self.outgoing_message = RelayReplyMessage(hop_count=0,
+                                                  link_address=IPv6Address('2001:db8:ffff:1::1'),
+                                                  peer_address=IPv6Address('fe80::3631:c4ff:fe3c:b2f1'),
+                                                  options=[RelayMessageOption(relayed_message=advertise_message)])
+
+    def test_matches(self):
+        self.assertTrue(PacketCapture(10, self.statistics).matches('eth0', None))
+        self.assertTrue(PacketCapture(10, self.statistics, interfaces=['eth0']).matches('eth0', self.bundle))
+        self.assertFalse(PacketCapture(10, self.statistics, interfaces=['eth1']).matches('eth0', self.bundle))
+
+        by_subnet = PacketCapture(10, self.statistics, subnets=[IPv6Network('2001:db8:ffff:1::/64')])
+        self.assertTrue(by_subnet.matches('eth0', self.bundle))
+        self.assertFalse(by_subnet.matches('eth0', None))
+        self.assertFalse(PacketCapture(10, self.statistics, subnets=[IPv6Network('2001:db8:ffff:2::/64')])
+                         .matches('eth0', self.bundle))
+
+        self.assertTrue(PacketCapture(10, self.statistics, duids=[bytes.fromhex('000300013431c43cb2f1')])
+                        .matches('eth0', self.bundle))
+        self.assertFalse(PacketCapture(10, self.statistics, duids=[bytes.fromhex('0003000100000000')])
+                         .matches('eth0', self.bundle))
+
+    def test_queue_full(self):
+        capture = PacketCapture(1, self.statistics)
+        capture.put((0.0, DIRECTION_INBOUND, 'eth0', b'', b'', 0, 0, b'', ''))
+        capture.put((0.0, DIRECTION_INBOUND, 'eth0', b'', b'', 0, 0, b'', ''))
+        self.assertEqual(self.statistics.dropped_capture_frames.value, 1)
+
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'capture.pcapng')
+
+            capture = PacketCapture(10, self.statistics)
+            writer = CaptureWriter(filename, 0, 0, capture, self.statistics)
+            writer.start()
+            capture.capture_incoming('eth0', self.incoming_packet)
+            capture.capture_outgoing('eth0', self.incoming_packet, self.outgoing_message)
+            writer.stop()
+
+            blocks = read_blocks(filename)
+
+        self.assertEqual([block_type for block_type, body in blocks],
+                         [BLOCK_SECTION_HEADER, BLOCK_INTERFACE_DESCRIPTION, BLOCK_ENHANCED_PACKET,
+                          BLOCK_ENHANCED_PACKET])
+        self.assertEqual(self.statistics.captured_frames, 2)
+
+        # The packets contain the DHCPv6 messages
+        for (block_type, body), message in zip(blocks[2:], (solicit_message, advertise_message)):
+            interface_id, ts_high, ts_low, captured_length, original_length = struct.unpack_from('<IIIII', body)
+            packet = body[20:20 + captured_length]
+            self.assertEqual(interface_id, 0)
+            self.assertEqual(captured_length, original_length)
+            self.assertEqual(packet[48:], message.save())
+            self.assertIn(b'#000001', body)
+
+        # Received on the multicast address, sent back to the client
+        self.assertEqual(blocks[2][1][20 + 24:20 + 40], IPv6Address('ff02::1:2').packed)
+        self.assertEqual(blocks[3][1][20 + 24:20 + 40], IPv6Address('fe80::3631:c4ff:fe3c:b2f1').packed)
+        self.assertIn(struct.pack('<HHI', 2, 4, DIRECTION_OUTBOUND), blocks[3][1])
+
+    def test_rotate(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'capture.pcapng')
+
+            capture = PacketCapture(10, self.statistics)
+            writer = CaptureWriter(filename, 200, 2, capture, self.statistics)
+            writer.start()
+            for i in range(5):
+                capture.capture_incoming('eth0', self.incoming_packet)
+            writer.stop()
+
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['capture.pcapng', 'capture.pcapng.1', 'capture.pcapng.2'])
+
+            # Every file is a complete capture file
+            for name in os.listdir(directory):
+                blocks = read_blocks(os.path.join(directory, name))
+                if blocks:
+                    self.assertEqual(blocks[0][0], BLOCK_SECTION_HEADER)
+
+    def test_rotate_failure(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'capture.pcapng')
+
+            capture = PacketCapture(10, self.statistics)
+            writer = CaptureWriter(filename, 200, 2, capture, self.statistics)
+            writer.start()
+            with patch('os.replace', side_effect=PermissionError("Nope")), \
+                    self.assertLogs('dhcpkit.ipv6.server.capture', 'ERROR'):
+                capture.capture_incoming('eth0', self.incoming_packet)
+                capture.capture_incoming('eth0', self.incoming_packet)
+
+                # Wait until both are written
+                capture.queue.put(None)
+                writer.thread.join(5)
+
+            # The writer survived and kept appending to the same file
+            self.assertFalse(writer.thread.is_alive())
+            self.assertFalse(writer.file.closed)
+            writer.file.close()
+
+            blocks = read_blocks(filename)
+            self.assertEqual([block_type for block_type, body in blocks].count(BLOCK_ENHANCED_PACKET), 2)
+            self.assertEqual(os.listdir(directory), ['capture.pcapng'])
+
+    def test_restart_appends(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'capture.pcapng')
+
+            for i in range(2):
+                capture = PacketCapture(10, self.statistics)
+                writer = CaptureWriter(filename, 0, 0, capture, self.statistics)
+                writer.start()
+                capture.capture_incoming('eth0', self.incoming_packet)
+                writer.stop()
+
+            blocks = read_blocks(filename)
+
+        self.assertEqual([block_type for block_type, body in blocks],
+                         [BLOCK_SECTION_HEADER, BLOCK_INTERFACE_DESCRIPTION, BLOCK_ENHANCED_PACKET] * 2)
+
+    def test_stop_with_full_queue(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'capture.pcapng')
+
+            # A writer whose thread has died, so nobody empties the queue
+            capture = PacketCapture(1, self.statistics)
+            writer = CaptureWriter(filename, 0, 0, capture, self.statistics)
+            writer.open()
+            writer.thread = threading.Thread(target=lambda: None)
+            writer.thread.start()
+            capture.capture_incoming('eth0', self.incoming_packet)
+
+            with self.assertLogs('dhcpkit.ipv6.server.capture', 'WARNING') as cm:
+                writer.stop(timeout=0.1)
+
+            self.assertRegex(cm.output[0], 'still full')
+            self.assertTrue(writer.file.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
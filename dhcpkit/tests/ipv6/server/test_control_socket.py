@@ -0,0 +1,127 @@
+"""
+Test the control socket
+"""
+import json
+import os
+import socket
+import unittest
+from unittest.mock import Mock
+
+from dhcpkit.ipv6.messages import SolicitMessage
+from dhcpkit.ipv6.server.control_socket import ControlConnection
+from dhcpkit.ipv6.server.dhcpctl import apply_deltas, format_rates
+from dhcpkit.ipv6.server.main import handle_control_commands
+from dhcpkit.ipv6.server.statistics import ServerStatistics, get_deltas
+
+
+class ControlConnectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client_sock, server_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.client_sock.settimeout(1)
+        self.client_file = self.client_sock.makefile('rb')
+
+        self.connection = ControlConnection(server_sock)
+        self.statistics = ServerStatistics()
+
+        # Skip the welcome message
+        self.assertTrue(self.client_file.readline().startswith(b'DHCPKit '))
+
+    def tearDown(self):
+        self.connection.close()
+        self.client_file.close()
+        self.client_sock.close()
+
+    def test_commands(self):
+        self.client_sock.send(b'STATS-Watch 5\nquit\n')
+        self.assertEqual(self.connection.get_commands(), ['stats-watch 5', 'quit'])
+
+    def test_watch(self):
+        self.assertFalse(self.connection.watching)
+        self.connection.start_watch(1, self.statistics)
+        self.assertTrue(self.connection.watching)
+
+        update_set = self.statistics.get_update_set()
+        update_set.count_incoming_packet()
+        update_set.count_incoming_packet()
+        update_set.count_message_in(SolicitMessage.message_type)
+
+        self.assertTrue(self.connection.send_watch_update(self.statistics))
+        update = json.loads(self.client_file.readline().decode('utf-8'))
+        self.assertEqual(update['deltas'], {
+            'global': {
+                'incoming_packets': 2,
+                'messages_in': {'solicit': 1},
+            }
+        })
+        self.assertEqual(update['gauges'], {'workers': 0, 'pending_results': 0, 'task_queue_depth': 0,
+                                            'last_wakeup_events': 0, 'open_connections': 0})
+
+        # Nothing changed since the previous update
+        self.assertTrue(self.connection.send_watch_update(self.statistics))
+        update = json.loads(self.client_file.readline().decode('utf-8'))
+        self.assertEqual(update['deltas'], {})
+
+        self.connection.stop_watch()
+        self.assertFalse(self.connection.watching)
+
+    def handle_commands(self, commands: bytes, control_watchers: list = None) -> bytes:
+        signal_r, signal_w = os.pipe()
+        os.set_blocking(signal_r, False)
+        try:
+            self.client_sock.send(commands)
+            handle_control_commands(self.connection, Mock(), self.statistics, None,
+                                    control_watchers if control_watchers is not None else [], signal_w)
+            try:
+                return os.read(signal_r, 16)
+            except BlockingIOError:
+                return b''
+        finally:
+            os.close(signal_r)
+            os.close(signal_w)
+
+    def test_reject_unexpected_arguments(self):
+        with self.assertLogs('root', 'WARNING') as cm:
+            signals = self.handle_commands(b'stats foo\nreload now\nshutdown x\nstats-watch 1 2\n')
+
+        self.assertEqual(len(cm.output), 4)
+        self.assertEqual(signals, b'')
+        self.assertEqual([self.client_file.readline() for i in range(4)], [b'UNKNOWN\n'] * 4)
+        self.assertFalse(self.connection.watching)
+
+    def test_watch_twice(self):
+        control_watchers = []
+        self.handle_commands(b'stats-watch 1\nstats-watch 2\n', control_watchers)
+
+        self.assertEqual(control_watchers, [self.connection])
+        self.assertEqual(self.connection.watch_interval, 2)
+
+    def test_get_and_apply_deltas(self):
+        previous = {'a': 1, 'b': {'c': 2, 'd': 3}}
+        current = {'a': 1, 'b': {'c': 5, 'd': 3}, 'e': 4}
+        deltas = get_deltas(previous, current)
+        self.assertEqual(deltas, {'b': {'c': 3}, 'e': 4})
+
+        apply_deltas(previous, deltas)
+        self.assertEqual(previous, current)
+
+    def test_format_rates(self):
+        totals = self.statistics.export()
+        totals['global']['incoming_packets'] = 10
+        totals['global']['messages_in']['solicit'] = 10
+        update = {
+            'elapsed': 2.0,
+            'deltas': {'global': {'incoming_packets': 4, 'messages_in': {'solicit': 4}}},
+            'gauges': {'workers': 2, 'pending_results': 1, 'task_queue_depth': 0},
+        }
+
+        lines = format_rates(totals, update, 2.0)
+        self.assertIn('workers: 2, pending: 1, queued: 0', lines[0])
+        self.assertIn('  packets in                               2.0            10', lines)
+        self.assertIn('  solicit in                               2.0            10', lines)
+
+        # Message types that were never seen are left out
+        self.assertFalse([line for line in lines if 'advertise' in line])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""
+Test the selector of the main loop
+"""
+import selectors
+import socket
+import unittest
+
+from dhcpkit.ipv6.server.event_selector import DefaultEventSelector, EventSelector
+
+
+class EventSelectorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sel = EventSelector()
+        self.reader, self.writer = socket.socketpair()
+
+    def tearDown(self):
+        self.sel.close()
+        self.reader.close()
+        self.writer.close()
+
+    def test_callback(self):
+        called = []
+        self.sel.register_callback(self.reader, called.append)
+        self.writer.send(b'x')
+
+        for key, mask in self.sel.select(1):
+            key.data(key.fileobj)
+
+        self.assertEqual(called, [self.reader])
+
+    def test_level_triggered(self):
+        self.sel.register_callback(self.reader, print)
+        self.writer.send(b'x')
+
+        # Reported until the data is read
+        self.assertEqual(len(self.sel.select(0)), 1)
+        self.assertEqual(len(self.sel.select(0)), 1)
+
+    @unittest.skipUnless(EventSelector.supports_edge_triggered, "Edge-triggered mode is not supported")
+    def test_edge_triggered(self):
+        self.sel.register_callback(self.reader, print, edge_triggered=True)
+        self.writer.send(b'x')
+
+        # Reported once, even though the data is still there
+        self.assertEqual(len(self.sel.select(0)), 1)
+        self.assertEqual(self.sel.select(0), [])
+
+        # And again when new data arrives
+        self.writer.send(b'y')
+        events = self.sel.select(0)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0][1], selectors.EVENT_READ)
+
+    def test_edge_triggered_fallback(self):
+        sel = DefaultEventSelector()
+        try:
+            sel.register_callback(self.reader, print, edge_triggered=True)
+            self.writer.send(b'x')
+
+            self.assertEqual(len(sel.select(0)), 1)
+            self.assertEqual(len(sel.select(0)), 1)
+        finally:
+            sel.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+Test the flight recorder
+"""
+import unittest
+from ipaddress import IPv6Address
+
+from dhcpkit.ipv6.messages import RelayForwardMessage
+from dhcpkit.ipv6.options import RelayMessageOption
+from dhcpkit.ipv6.server.flight_recorder import FlightRecorder, OUTCOME_REPLIED, OUTCOME_UNPARSABLE, \
+    format_transaction
+from dhcpkit.ipv6.server.handlers import HandlerChain
+from dhcpkit.ipv6.server.handlers.ignore import IgnoreRequestHandler
+from dhcpkit.ipv6.server.transaction_bundle import TransactionBundle
+from dhcpkit.tests.ipv6.messages.test_advertise_message import advertise_message
+from dhcpkit.tests.ipv6.messages.test_solicit_message import solicit_message
+
+
+class FlightRecorderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.recorder = FlightRecorder(workers=2, size=3)
+        self.recorder.claim_ring()
+
+        self.duid = bytes.fromhex('000300013431c43cb2f1')
+        self.bundle = TransactionBundle(incoming_message=RelayForwardMessage(
+            hop_count=0,
+            link_address=IPv6Address('2001:db8:ffff:1::1'),
+            peer_address=IPv6Address('fe80::3631:c4ff:fe3c:b2f1'),
+            options=[RelayMessageOption(relayed_message=solicit_message)]
+        ), received_over_multicast=True)
+        self.bundle.handler_chain = HandlerChain([IgnoreRequestHandler()])
+        self.bundle.response = advertise_message
+
+    def test_claim_ring(self):
+        self.assertEqual(self.recorder.ring_index, 0)
+        self.recorder.claim_ring()
+        self.assertEqual(self.recorder.ring_index, 1)
+        self.recorder.claim_ring()
+        self.assertEqual(self.recorder.ring_index, 0)
+
+    def test_record_and_find(self):
+        self.recorder.record(1000.0, 0.0015, '#000001', OUTCOME_REPLIED, self.bundle)
+        self.recorder.record(1001.0, 0.0001, '#000002', OUTCOME_UNPARSABLE, None)
+
+        found = self.recorder.find(duid=self.duid)
+        self.assertEqual(len(found), 1)
+        transaction = found[0]
+        self.assertEqual(transaction['timestamp'], 1000.0)
+        self.assertEqual(transaction['latency'], 0.0015)
+        self.assertEqual(transaction['message_id'], '#000001')
+        self.assertEqual(transaction['request'], 'solicit')
+        self.assertEqual(transaction['responses'], ['advertise'])
+        self.assertEqual(transaction['outcome'], 'replied')
+        self.assertEqual(transaction['status_code'], None)
+        self.assertEqual(transaction['duid'], '000300013431c43cb2f1')
+        self.assertEqual(transaction['link_address'], '2001:db8:ffff:1::1')
+        self.assertEqual(transaction['peer_address'], 'fe80::3631:c4ff:fe3c:b2f1')
+        self.assertEqual(transaction['handlers'], 'IgnoreRequestHandler')
+
+        self.assertEqual(len(self.recorder.find(address=IPv6Address('fe80::3631:c4ff:fe3c:b2f1'))), 1)
+        self.assertEqual(len(self.recorder.find(address=IPv6Address('2001:db8:ffff:1::1'))), 1)
+        self.assertEqual(self.recorder.find(address=IPv6Address('2001:db8::1')), [])
+        self.assertEqual(self.recorder.find(duid=bytes.fromhex('0003000100000000')), [])
+
+        line = format_transaction(transaction)
+        self.assertIn('#000001 solicit -> advertise (replied, 1.500ms) duid 000300013431c43cb2f1', line)
+        self.assertIn('from fe80::3631:c4ff:fe3c:b2f1 via 2001:db8:ffff:1::1', line)
+
+    def test_ring_wraps(self):
+        for i in range(5):
+            self.recorder.record(1000.0 + i, 0.001, '#{:06X}'.format(i), OUTCOME_REPLIED, self.bundle)
+
+        # Only the most recent ones are remembered, oldest first
+        self.assertEqual([transaction['message_id'] for transaction in self.recorder.find(duid=self.duid)],
+                         ['#000002', '#000003', '#000004'])
+
+    def test_merge_rings(self):
+        self.recorder.record(1002.0, 0.001, '#000002', OUTCOME_REPLIED, self.bundle)
+        self.recorder.claim_ring()
+        self.recorder.record(1001.0, 0.001, '#000001', OUTCOME_REPLIED, self.bundle)
+        self.recorder.record(1003.0, 0.001, '#000003', OUTCOME_REPLIED, self.bundle)
+
+        self.assertEqual([transaction['message_id'] for transaction in self.recorder.find(duid=self.duid)],
+                         ['#000001', '#000002', '#000003'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,7 +4,7 @@ Testing of the message handler
 import logging
 import unittest
 from ipaddress import IPv6Address
-from unittest.mock import call
+from unittest.mock import call, patch
 
 from dhcpkit.ipv6.duids import LinkLayerTimeDUID
 from dhcpkit.ipv6.extensions.prefix_delegation import IAPDOption, STATUS_NO_PREFIX_AVAIL
@@ -13,6 +13,7 @@ from dhcpkit.ipv6.messages import AdvertiseMessage, ClientServerMessage, Confirm
 from dhcpkit.ipv6.options import ClientIdOption, IANAOption, STATUS_NOT_ON_LINK, STATUS_NO_ADDRS_AVAIL, \
     STATUS_USE_MULTICAST, ServerIdOption, StatusCodeOption
 from dhcpkit.ipv6.server.extension_registry import server_extension_registry
+from dhcpkit.ipv6.server.filters import Filter
 from dhcpkit.ipv6.server.filters.marks.config import MarkedWithFilter
 from dhcpkit.ipv6.server.handlers import Handler, UseMulticastError
 from dhcpkit.ipv6.server.handlers.ignore import IgnoreRequestHandler
@@ -67,6 +68,26 @@ class BadExceptionHandler(Handler):
             raise UseMulticastError("Oops, we shouldn't raise this for multicast requests...")
 
 
+class AlternatingFilter(Filter):
+    """
+    A filter that alternates between its sub-handlers, so its handlers can't be cached
+    """
+
+    cacheable = False
+
+    def __init__(self, sub_handlers):
+        super().__init__(filter_condition=None, sub_handlers=sub_handlers)
+        self.counter = 0
+
+    def get_handlers(self, bundle: TransactionBundle):
+        """
+        Return the next handler
+        """
+        handler = self.sub_handlers[self.counter % len(self.sub_handlers)]
+        self.counter += 1
+        return [handler]
+
+
 class DummyExtension:
     """
     A server extension that adds the DummyMarksHandler at both setup and cleanup
@@ -128,6 +149,59 @@ class MessageHandlerTestCase(unittest.TestCase):
             call.worker_init()
         ])
 
+    def test_no_formatting_when_disabled(self):
+        bundle = TransactionBundle(incoming_message=solicit_message,
+                                   received_over_multicast=True,
+                                   marks=['one', 'two', 'one'])
+
+        root_logger = logging.getLogger()
+        old_level = root_logger.level
+        root_logger.setLevel(logging.INFO)
+        try:
+            with patch.object(TransactionBundle, '__str__', autospec=True, return_value='bundle') as bundle_str:
+                self.message_handler.handle(bundle, StatisticsSet())
+
+            # Debug logging is disabled, so the bundle must never have been formatted
+            bundle_str.assert_not_called()
+            self.assertIsInstance(bundle.outgoing_message, AdvertiseMessage)
+        finally:
+            root_logger.setLevel(old_level)
+
+    def test_cached_handlers(self):
+        bundle = TransactionBundle(incoming_message=solicit_message,
+                                   received_over_multicast=True,
+                                   marks=['unicast-me'])
+        handlers = self.message_handler.get_cached_handlers(bundle)
+        self.assertEqual(list(handlers), self.message_handler.get_handlers(bundle))
+
+        # The same filter decisions give the same chain
+        bundle = TransactionBundle(incoming_message=solicit_message,
+                                   received_over_multicast=True,
+                                   marks=['unicast-me'])
+        self.assertIs(self.message_handler.get_cached_handlers(bundle), handlers)
+
+        # Different decisions give a different chain
+        bundle = TransactionBundle(incoming_message=solicit_message,
+                                   received_over_multicast=True,
+                                   marks=['ignore-me'])
+        other_handlers = self.message_handler.get_cached_handlers(bundle)
+        self.assertEqual(list(other_handlers), self.message_handler.get_handlers(bundle))
+        self.assertNotEqual(other_handlers, handlers)
+
+        self.assertEqual(len(self.message_handler.handler_cache), 2)
+
+    def test_uncacheable_filter(self):
+        handler1 = DummyMarksHandler('one')
+        handler2 = DummyMarksHandler('two')
+        message_handler = MessageHandler(server_id=self.duid,
+                                         sub_filters=[AlternatingFilter(sub_handlers=[handler1, handler2])])
+
+        bundle = TransactionBundle(incoming_message=solicit_message,
+                                   received_over_multicast=True)
+        self.assertIn(handler1, message_handler.get_cached_handlers(bundle))
+        self.assertIn(handler2, message_handler.get_cached_handlers(bundle))
+        self.assertIn(handler1, message_handler.get_cached_handlers(bundle))
+
     def test_empty_message(self):
         with self.assertLogs(level=logging.WARNING) as cm:
             bundle = TransactionBundle(incoming_message=RelayForwardMessage(),
@@ -0,0 +1,106 @@
+"""
+Test the OpenMetrics exporter
+"""
+import socket
+import time
+import unittest
+from ipaddress import IPv6Address, IPv6Network
+from types import SimpleNamespace
+from urllib.request import urlopen
+
+from dhcpkit.ipv6.messages import SolicitMessage
+from dhcpkit.ipv6.server.metrics import CONTENT_TYPE, MetricsServer, escape_label_value, render_openmetrics
+from dhcpkit.ipv6.server.statistics import ServerStatistics
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.statistics = ServerStatistics()
+        self.statistics.set_categories(SimpleNamespace(interfaces=['eth0'],
+                                                       subnets=[IPv6Network('2001:db8::/64')],
+                                                       relays=[]))
+
+        update_set = self.statistics.get_update_set(interface_name='eth0')
+        update_set.count_incoming_packet()
+        update_set.count_message_in(SolicitMessage.message_type)
+        update_set.count_handling_time(0.003)
+        update_set.count_handling_time(5)
+
+    def test_escape_label_value(self):
+        self.assertEqual(escape_label_value('a"b\\c\nd'), 'a\\"b\\\\c\\nd')
+
+    def test_render(self):
+        lines = render_openmetrics(self.statistics).splitlines()
+
+        self.assertEqual(lines[-1], '# EOF')
+        self.assertIn('# TYPE dhcpkit_incoming_packets counter', lines)
+        self.assertIn('dhcpkit_incoming_packets_total{category="global"} 1', lines)
+        self.assertIn('dhcpkit_incoming_packets_total{category="interface",interface="eth0"} 1', lines)
+        self.assertIn('dhcpkit_incoming_packets_total{category="subnet",subnet="2001:db8::/64"} 0', lines)
+        self.assertIn('dhcpkit_messages_in_total{category="global",message_type="solicit"} 1', lines)
+
+        # Histogram buckets are cumulative
+        self.assertIn('dhcpkit_handling_time_seconds_bucket{category="global",le="0.0025"} 0', lines)
+        self.assertIn('dhcpkit_handling_time_seconds_bucket{category="global",le="0.005"} 1', lines)
+        self.assertIn('dhcpkit_handling_time_seconds_bucket{category="global",le="2.5"} 1', lines)
+        self.assertIn('dhcpkit_handling_time_seconds_bucket{category="global",le="+Inf"} 2', lines)
+        self.assertIn('dhcpkit_handling_time_seconds_count{category="global"} 2', lines)
+        self.assertIn('dhcpkit_handling_time_seconds_sum{category="global"} 5.003', lines)
+
+        # No pool, so no workers
+        self.assertIn('dhcpkit_workers 0', lines)
+        self.assertIn('dhcpkit_pending_results 0', lines)
+        self.assertIn('dhcpkit_task_queue_depth 0', lines)
+        self.assertIn('dhcpkit_open_connections 0', lines)
+        self.assertIn('dhcpkit_dropped_packets_total 0', lines)
+        self.assertIn('dhcpkit_suppressed_log_records_total 0', lines)
+        self.assertIn('dhcpkit_dropped_log_records_total 0', lines)
+        self.assertIn('dhcpkit_captured_frames_total 0', lines)
+        self.assertIn('dhcpkit_dropped_capture_frames_total 0', lines)
+        self.assertIn('dhcpkit_leasequery_updates_dropped_total 0', lines)
+        self.assertIn('dhcpkit_leasequery_updates_written_total 0', lines)
+
+    def test_render_main_loop(self):
+        self.statistics.count_wakeup(3)
+        self.statistics.count_listener_packet('udp eth0/ff02::1:2')
+        self.statistics.count_listener_packet('udp eth0/ff02::1:2')
+        self.statistics.count_control_time(1, 0.5)
+
+        lines = render_openmetrics(self.statistics).splitlines()
+        self.assertIn('dhcpkit_select_wakeups_total 1', lines)
+        self.assertIn('dhcpkit_select_events_total 3', lines)
+        self.assertIn('dhcpkit_last_wakeup_events 3', lines)
+        self.assertIn('dhcpkit_listener_packets_total{listener="udp eth0/ff02::1:2"} 2', lines)
+        self.assertIn('dhcpkit_control_commands_total 1', lines)
+        self.assertIn('dhcpkit_control_seconds_total 0.5', lines)
+
+    def test_http(self):
+        metrics_server = MetricsServer(IPv6Address('::1'), 0, self.statistics)
+        metrics_server.start()
+        try:
+            port = metrics_server.http_server.server_address[1]
+            with urlopen('http://[::1]:{}/metrics'.format(port)) as response:
+                self.assertEqual(response.status, 200)
+                self.assertEqual(response.headers['Content-Type'], CONTENT_TYPE)
+                self.assertEqual(response.read().decode('utf-8'), render_openmetrics(self.statistics))
+        finally:
+            metrics_server.stop()
+
+    def test_idle_client(self):
+        metrics_server = MetricsServer(IPv6Address('::1'), 0, self.statistics)
+        metrics_server.start()
+        port = metrics_server.http_server.server_address[1]
+
+        # A client that connects and never sends a request doesn't block others
+        with socket.create_connection(('::1', port)):
+            with urlopen('http://[::1]:{}/metrics'.format(port), timeout=5) as response:
+                self.assertEqual(response.status, 200)
+
+            # Nor stopping the server
+            start = time.monotonic()
+            metrics_server.stop()
+            self.assertLess(time.monotonic() - start, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+"""
+Test the non-blocking worker pool
+"""
+import time
+import unittest
+
+from dhcpkit.ipv6.server.nonblocking_pool import NonBlockingPool
+
+
+def double(value: int) -> int:
+    """
+    A trivial task
+
+    :param value: A number
+    :return: Twice the number
+    """
+    return value * 2
+
+
+def slow_double(value: int) -> int:
+    """
+    A task that keeps the worker busy for a while
+
+    :param value: A number
+    :return: Twice the number
+    """
+    time.sleep(0.2)
+    return value * 2
+
+
+class NonBlockingPoolTestCase(unittest.TestCase):
+    def test_apply_async(self):
+        with NonBlockingPool(processes=1) as pool:
+            result = pool.apply_async(double, args=(21,))
+            self.assertEqual(result.get(timeout=10), 42)
+
+    def test_apply_async_batch(self):
+        with NonBlockingPool(processes=2) as pool:
+            results = pool.apply_async_batch(double, [(1,), (2,), (3,)])
+            self.assertEqual([result.get(timeout=10) for result in results], [2, 4, 6])
+            self.assertEqual(pool.pending_tasks, 0)
+
+    def test_max_pending_tasks(self):
+        with NonBlockingPool(processes=1, max_pending_tasks=3) as pool:
+            results = pool.apply_async_batch(slow_double, [(1,), (2,)])
+            self.assertEqual(len(results), 2)
+
+            # All or nothing
+            self.assertIsNone(pool.apply_async_batch(slow_double, [(3,), (4,)]))
+            self.assertEqual(pool.pending_tasks, 2)
+
+            results.append(pool.apply_async(slow_double, args=(5,)))
+            self.assertIsNone(pool.apply_async(slow_double, args=(6,)))
+
+            # Room again when the workers catch up
+            self.assertEqual([result.get(timeout=10) for result in results], [2, 4, 10])
+            self.assertEqual(pool.apply_async(slow_double, args=(7,)).get(timeout=10), 14)
+
+
+if __name__ == '__main__':
+    unittest.main()
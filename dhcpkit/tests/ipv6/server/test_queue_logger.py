@@ -0,0 +1,158 @@
+"""
+Test the batching and rate limiting of log records sent by the workers
+"""
+import logging
+import queue
+import unittest
+
+from dhcpkit.ipv6.server.queue_logger import LogRateLimiter, QueueLevelListener, WorkerQueueHandler
+from dhcpkit.ipv6.server.statistics import ServerStatistics
+
+
+def create_record(msg: str, *args, level: int = logging.INFO) -> logging.LogRecord:
+    """
+    Create a simple log record for testing
+
+    :param msg: The message format
+    :param args: The message arguments
+    :param level: The log level
+    :return: The log record
+    """
+    return logging.LogRecord('test', level, __file__, 1, msg, args, None)
+
+
+class FullQueue:
+    """
+    A queue that is always full
+    """
+
+    @staticmethod
+    def put_nowait(item):
+        """
+        Pretend that the queue is full
+        """
+        raise queue.Full
+
+
+class LogRateLimiterTestCase(unittest.TestCase):
+    def test_burst_and_refill(self):
+        limiter = LogRateLimiter(rate=2, burst=3)
+        record = create_record("Handling %s", 'something')
+
+        self.assertEqual([limiter.allow(record, 0.0) for _ in range(5)],
+                         [(True, 0), (True, 0), (True, 0), (False, 0), (False, 0)])
+
+        # Half a second later we have one token again, and get to know how many were suppressed
+        self.assertEqual(limiter.allow(record, 0.5), (True, 2))
+        self.assertEqual(limiter.allow(record, 0.5), (False, 0))
+
+    def test_different_messages(self):
+        limiter = LogRateLimiter(rate=1, burst=1)
+        self.assertEqual(limiter.allow(create_record("One %s", 1), 0.0), (True, 0))
+        self.assertEqual(limiter.allow(create_record("One %s", 2), 0.0), (False, 0))
+        self.assertEqual(limiter.allow(create_record("Two %s", 1), 0.0), (True, 0))
+
+    def test_summaries(self):
+        limiter = LogRateLimiter(rate=1, burst=1)
+        record = create_record("Handling %s", 'something', level=logging.WARNING)
+        limiter.allow(record, 0.0)
+        limiter.allow(record, 0.0)
+        limiter.allow(record, 0.0)
+
+        # Bucket not refilled yet
+        self.assertEqual(limiter.get_summaries(0.5), [])
+
+        summaries = limiter.get_summaries(1.0)
+        self.assertEqual(len(summaries), 1)
+        self.assertEqual(summaries[0].getMessage(), "2 similar messages suppressed: Handling %s")
+        self.assertEqual(summaries[0].levelno, logging.WARNING)
+        self.assertEqual(limiter.suppressed_keys, set())
+
+    def test_prune(self):
+        limiter = LogRateLimiter(rate=1, burst=1)
+        limiter.max_buckets = 2
+        limiter.allow(create_record("One"), 0.0)
+        limiter.allow(create_record("Two"), 0.0)
+        limiter.allow(create_record("Two"), 0.0)
+        limiter.allow(create_record("Three"), 10.0)
+
+        # The bucket for "One" was full and had nothing to report, "Two" has suppressed messages
+        self.assertEqual(set(limiter.buckets.keys()), {('test', "Two"), ('test', "Three")})
+
+
+class WorkerQueueHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.queue = queue.Queue()
+        self.statistics = ServerStatistics()
+
+    def test_batching(self):
+        handler = WorkerQueueHandler(self.queue, batch_size=3)
+        handler.handle(create_record("One"))
+        handler.handle(create_record("Two"))
+        self.assertTrue(self.queue.empty())
+
+        handler.handle(create_record("Three"))
+        self.assertEqual([record.msg for record in self.queue.get_nowait()], ["One", "Two", "Three"])
+
+        handler.handle(create_record("Four"))
+        handler.flush()
+        self.assertEqual([record.msg for record in self.queue.get_nowait()], ["Four"])
+
+        # Nothing left to flush
+        handler.flush()
+        self.assertTrue(self.queue.empty())
+
+    def test_batch_interval(self):
+        handler = WorkerQueueHandler(self.queue, batch_size=10, batch_interval=0.05)
+        handler.handle(create_record("One"))
+        handler.handle(create_record("Two"))
+        self.assertTrue(self.queue.empty())
+
+        # The batch is sent when the first record has waited long enough
+        self.assertEqual([record.msg for record in self.queue.get(timeout=5)], ["One", "Two"])
+        self.assertIsNone(handler.flush_timer)
+
+    def test_errors_are_sent_immediately(self):
+        handler = WorkerQueueHandler(self.queue, batch_size=10)
+        handler.handle(create_record("One"))
+        handler.handle(create_record("Broken", level=logging.ERROR))
+        self.assertEqual([record.msg for record in self.queue.get_nowait()], ["One", "Broken"])
+
+    def test_rate_limit(self):
+        handler = WorkerQueueHandler(self.queue, batch_size=10, rate_limiter=LogRateLimiter(rate=0.001, burst=2),
+                                     statistics=self.statistics)
+        for i in range(5):
+            handler.handle(create_record("Handling %s", i))
+        handler.flush()
+
+        self.assertEqual([record.msg for record in self.queue.get_nowait()], ["Handling 0", "Handling 1"])
+        self.assertEqual(self.statistics.suppressed_log_records.value, 3)
+
+    def test_dropped(self):
+        handler = WorkerQueueHandler(FullQueue(), batch_size=2, statistics=self.statistics)
+        handler.handle(create_record("One"))
+        handler.handle(create_record("Two"))
+        self.assertEqual(self.statistics.dropped_log_records.value, 2)
+        self.assertEqual(handler.buffer, [])
+
+    def test_log_id(self):
+        handler = WorkerQueueHandler(self.queue)
+        handler.log_id = 'abc'
+        handler.handle(create_record("Handling %s", 'something'))
+        self.assertEqual(self.queue.get_nowait()[0].msg, "abc: Handling something")
+
+
+class QueueLevelListenerTestCase(unittest.TestCase):
+    def test_batch(self):
+        handler = logging.Handler()
+        handler.setLevel(logging.INFO)
+        handled = []
+        handler.emit = handled.append
+
+        listener = QueueLevelListener(queue.Queue(), handler)
+        listener.handle([create_record("One"), create_record("Two", level=logging.DEBUG), create_record("Three")])
+        self.assertEqual([record.msg for record in handled], ["One", "Three"])
+
+
+if __name__ == '__main__':
+    unittest.main()
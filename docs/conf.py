@@ -275,6 +275,7 @@ man_pages = [
     ('man/ipv6-dhcpd', 'ipv6-dhcpd', 'IPv6 DHCP server', [author], 8),
     ('man/ipv6-dhcpctl', 'ipv6-dhcpctl', 'IPv6 DHCP server remote control', [author], 8),
     ('man/ipv6-dhcp-build-sqlite', 'ipv6-dhcp-build-sqlite', 'Static assignment CSV to SQLite tool', [author], 1),
+    ('man/ipv6-dhcp-loadgen', 'ipv6-dhcp-loadgen', 'DHCPv6 server load generator', [author], 1),
 ]
 
 # If true, show URL addresses after external links.
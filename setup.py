@@ -60,6 +60,7 @@ setup(
             'ipv6-dhcpd = dhcpkit.ipv6.server.main:run',
             'ipv6-dhcpctl = dhcpkit.ipv6.server.dhcpctl:run',
             'ipv6-dhcp-test-leasequery = dhcpkit.ipv6.client.test_leasequery:run',
+            'ipv6-dhcp-loadgen = dhcpkit.ipv6.client.loadgen:run',
             'ipv6-dhcp-build-sqlite = dhcpkit.ipv6.server.extensions.static_assignments.sqlite:build_sqlite',
         ],
         'pygments.lexers': [
@@ -153,6 +154,8 @@ setup(
             'listen-unicast     = dhcpkit.ipv6.server.listeners.unicast',
             'listen-interface   = dhcpkit.ipv6.server.listeners.multicast_interface',
             'listen-tcp         = dhcpkit.ipv6.server.listeners.unicast_tcp',
+            'listen-loopback-relay = dhcpkit.ipv6.server.listeners.loopback_relay',
+            'replay-pcap        = dhcpkit.ipv6.server.listeners.replay_pcap',
 
             # DUID elements for the configuration file
             'duid-ll            = dhcpkit.ipv6.server.duids.duid_ll',